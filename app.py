@@ -1,3 +1,6 @@
+from core.startup_profile import PROFILE
+PROFILE.watch_imports()
+
 from pathlib import Path
 from dotenv import load_dotenv, find_dotenv
 
@@ -9,11 +12,10 @@ if not env_loaded:  # fallback: .env рядом с app.py
 from core.logger import init_logging, self_test, LOG_DIR
 init_logging(console=True)
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import os
+import hmac
 import uuid
+import weakref
 import traceback
 import re
 import json
@@ -25,7 +27,7 @@ logging.getLogger("werkzeug").setLevel(logging.WARNING)
 logger = logging.getLogger("cesi")
 logger.info("✅ Логирование настроено (level=%s)", os.getenv("LOG_LEVEL", "INFO"))
 
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, Blueprint, current_app, g, request, jsonify, send_file, Response
 from flask_cors import CORS
 from collections import defaultdict
 
@@ -38,11 +40,18 @@ def wants_json(req):
         return True
     return "application/json" in req.headers.get("Accept", "").lower()
 
-from rag_engine import get_rag_answer
+from rag_engine import RagEngine
+from core.corpus_watcher import CORPUS_WATCH_INTERVAL
+from core.tenants import TenantRegistry
+from core.query_cache import get_query_cache
+from core.embed_coalescer import coalescer_stats
+from time import perf_counter
 from datetime import datetime, timezone, timedelta, time
 
 # Глобальные константы
 MAX_FINAL_CHARS = int(os.getenv("MAX_FINAL_CHARS", "800"))
+# токен изменяющих /admin-маршрутов (заголовок X-Admin-Token); пусто — такие маршруты закрыты
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 # Отладка ENV переменных
 print("DEBUG RESPONSE_MODE =", os.getenv("RESPONSE_MODE"))
@@ -56,8 +65,67 @@ except Exception as e:
     print(f"❌ Ошибка инициализации OpenAI клиента в app.py: {e}")
     openai_client = None
 
-app = Flask(__name__)
-CORS(app, origins=['https://dental41.ru', 'http://dental41.ru', 'https://dental-bot.ru', 'http://dental-bot.ru', 'https://dental-chat.ru', 'http://dental-chat.ru'])
+# маршруты, отвечающие из корпуса тенанта; health, ready, лиды и /admin тенант не разрешают
+TENANT_ENDPOINTS = frozenset({"cesi.chat"})
+
+# движок → pid воркера, в котором уже подняты его фоновые потоки
+_background_started: "weakref.WeakKeyDictionary[RagEngine, int]" = weakref.WeakKeyDictionary()
+
+
+def start_background(engine: RagEngine) -> None:
+    """
+    Фоновая сборка векторного индекса и наблюдение за md/ — один раз на движок в каждом воркере
+    (потоки не переживают fork при gunicorn --preload, поэтому запуск — в процессе-обработчике).
+    """
+    if _background_started.get(engine) == os.getpid():
+        return
+    engine.ensure_dense()
+    if CORPUS_WATCH_INTERVAL > 0:
+        engine.start_watching()
+    _background_started[engine] = os.getpid()
+
+
+def current_rag_engine() -> RagEngine:
+    """RAG-движок тенанта текущего запроса (см. create_app, core/tenants.py)"""
+    tenant = g.get("tenant")
+    if tenant is None:
+        return current_app.extensions["rag_engine"]
+    return current_app.extensions["tenants"].engine(tenant)
+
+# Очистка финального текста ответа: регэкспы компилируются один раз на процесс
+RX_CLEAN_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+RX_CLEAN_ALIASES = re.compile(r'(?im)^\s*aliases\s*:\s*\[.*?\]\s*$')
+RX_CLEAN_HEADING = re.compile(r'(?m)^\s*#{2,3}\s*')
+RX_CLEAN_EMPH = re.compile(r'(\*\*|_)(.*?)\1')
+RX_CLEAN_UNDERSCORE = re.compile(r'(?<!\w)_(.*?)_(?!\w)')
+RX_CLEAN_BULLET = re.compile(r'(?m)^\s*[•*]\s+')
+RX_CLEAN_BLANKS = re.compile(r'\n{3,}')
+
+def _clean_text(s: str) -> str:
+    """Финальный текст ответа без служебной разметки (комментарии, aliases, решётки, жир/курсив)"""
+    if not s: return ""
+    # 1) убрать HTML-комменты и aliases: [...]
+    s = RX_CLEAN_COMMENT.sub('', s)
+    s = RX_CLEAN_ALIASES.sub('', s)
+    # 2) убрать ### и ## в начале строк
+    s = RX_CLEAN_HEADING.sub('', s)
+    # 2.1) снять жир/курсив (**...** / __...__)
+    s = RX_CLEAN_EMPH.sub(r'\2', s)
+    s = RX_CLEAN_UNDERSCORE.sub(r'\1', s)
+    # 2.2) нормализовать маркеры списков (•, *) в '- '
+    s = RX_CLEAN_BULLET.sub('- ', s)
+    # 3) схлопнуть лишние пустые строки
+    s = RX_CLEAN_BLANKS.sub('\n\n', s)
+    # 4) убрать дубликаты первой строки
+    lines = [ln.strip() for ln in s.splitlines()]
+    if len(lines) >= 2 and lines[0] and lines[0] == lines[1]:
+        lines.pop(1)
+    return "\n".join(lines).strip()
+
+CORS_ORIGINS = ['https://dental41.ru', 'http://dental41.ru', 'https://dental-bot.ru', 'http://dental-bot.ru', 'https://dental-chat.ru', 'http://dental-chat.ru']
+
+# Маршруты бота; приложение собирает create_app()
+bp = Blueprint("cesi", __name__)
 
 session_messages = defaultdict(list)
 session_states = defaultdict(dict)
@@ -81,6 +149,11 @@ def check_rate_limit(session_id):
     return True
 
 def send_lead_email(name, phone):
+    # smtplib и email.mime нужны только при заявке — не грузим их на старте
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
     msg = MIMEMultipart()
     msg["From"] = EMAIL_USER
     msg["To"] = EMAIL_RECEIVER
@@ -262,26 +335,11 @@ def format_contacts_answer(text: str) -> str:
     'Адрес:', 'Время работы:', 'Телефон:', 'WhatsApp:', 'Парковка:'.
     Возвращает один компактный параграф без списков.
     """
-    import re
-    t = text or ""
-    def grab(label):
-        m = re.search(rf"{label}\s*:\s*(.+?)(?:[.;]|$)", t, flags=re.I)
-        return (m.group(1).strip() if m else "")
-    addr = grab("Адрес")
-    time = grab("Время работы")
-    tel  = grab("Телефон")
-    wa   = grab("WhatsApp")
-    park = grab("Парковка")
-    parts = []
-    if addr: parts.append(f"Адрес: {addr}")
-    if time: parts.append(f"Время работы: {time}")
-    if tel:  parts.append(f"Телефон: {tel}")
-    if wa:   parts.append(f"WhatsApp: {wa}")
-    if park: parts.append(f"Парковка: {park}")
-    return "Адрес и контакты — " + "; ".join(parts) + "."
-
-
-@app.route('/chat', methods=['POST'])
+    from core.fact_store import parse_contacts, render_contacts
+    return render_contacts(parse_contacts(text))
+
+
+@bp.route('/chat', methods=['POST'])
 def chat():
     try:
         data = request.json
@@ -400,23 +458,23 @@ def chat():
         from core import legacy_adapter
         from core.answer_builder import postprocess as json_adapter
         from config.feature_flags import feature_flags
-        from core.rag_integration import enhance_rag_retrieval
-        from core.router import theme_router
         from core.normalize import normalize_ru
         
         # 1. Нормализация запроса
         normalized_query = normalize_ru(message)
         
-        # 2. Тематический роутинг
+        # 2. Тематический роутинг (темы и врачи — из снимка движка тенанта)
         from core.router import route_theme
-        theme_hint = route_theme(message)  # Используем новый роутер
+        engine = current_rag_engine()
+        snap = engine.snapshot
+        theme_hint = route_theme(message, snap.theme_doctor_regex)  # Используем новый роутер
         
         # Логируем запрос
         from core.logger import log_query
         log_query(message, session_id)
         
         # 3. Получаем ответ от RAG
-        rag_payload, rag_meta = get_rag_answer(normalized_query)
+        rag_payload, rag_meta = engine.get_rag_answer(normalized_query)
         
         # 4. Усиливаем кандидатов тематикой (если есть кандидаты)
         if rag_meta.get("candidates_with_scores"):
@@ -433,6 +491,7 @@ def chat():
             enhanced_chunks, enh_meta = enhance_rag_retrieval(
                 normalized_query,
                 lambda q: rag_meta.get("candidates_with_scores", []),
+                router=snap.theme_router,
                 theme_hint=theme_hint
             )
             rag_meta["candidates_with_scores"] = enhanced_chunks
@@ -464,7 +523,8 @@ def chat():
                     user_text=message,
                     intent=rag_meta.get("theme_hint"),
                     topic_meta=rag_meta.get("meta", {}),
-                    session=session
+                    session=session,
+                    cta_cfg=current_rag_engine().cta_config
                 )
         else:
             # Legacy режим
@@ -479,28 +539,6 @@ def chat():
         # 1) если режим JSON -> ВСЕГДА отдаём JSON (независимо от Accept)
         if feature_flags.is_json_mode():
             # Нормализация payload (фикс для 'str'.get)
-            import re
-            
-            def _clean_text(s: str) -> str:
-                if not s: return ""
-                # 1) убрать HTML-комменты и aliases: [...]
-                s = re.sub(r'<!--.*?-->', '', s, flags=re.DOTALL)
-                s = re.sub(r'(?im)^\s*aliases\s*:\s*\[.*?\]\s*$', '', s)
-                # 2) убрать ### и ## в начале строк
-                s = re.sub(r'(?m)^\s*#{2,3}\s*', '', s)
-                # 2.1) снять жир/курсив (**...** / __...__)
-                s = re.sub(r'(\*\*|_)(.*?)\1', r'\2', s)
-                s = re.sub(r'(?<!\w)_(.*?)_(?!\w)', r'\1', s)
-                # 2.2) нормализовать маркеры списков (•, *) в '- '
-                s = re.sub(r'(?m)^\s*[•*]\s+', '- ', s)
-                # 3) схлопнуть лишние пустые строки
-                s = re.sub(r'\n{3,}', '\n\n', s)
-                # 4) убрать дубликаты первой строки
-                lines = [ln.strip() for ln in s.splitlines()]
-                if len(lines) >= 2 and lines[0] and lines[0] == lines[1]:
-                    lines.pop(1)
-                return "\n".join(lines).strip()
-            
             def _as_payload(obj):
                 """Приводит любой ответ к единому JSON-формату."""
                 if isinstance(obj, dict): return obj
@@ -560,7 +598,7 @@ def chat():
             style = decide_style(theme)
             
             # Специальная обработка для контактов
-            if theme == "contacts":
+            if theme == "contacts" and rag_meta.get("fast_path") != "facts":
                 raw_answer = out.get("answer","")
                 formatted_answer = format_contacts_answer(raw_answer)
                 # Умная обрезка для контактов
@@ -652,7 +690,7 @@ def chat():
             style_legacy = decide_style(theme_legacy)
             
             # Специальная обработка для контактов
-            if theme_legacy == "contacts":
+            if theme_legacy == "contacts" and rag_meta.get("fast_path") != "facts":
                 raw_answer_legacy = out_legacy.get("answer","")
                 formatted_answer_legacy = format_contacts_answer(raw_answer_legacy)
                 # Умная обрезка для контактов
@@ -702,17 +740,55 @@ def chat():
         return jsonify({"response": safe_text}), 200
 
 
-@app.route('/health', methods=['GET'])
+@bp.route('/health', methods=['GET'])
 def health():
     return "ok", 200
 
-@app.route('/admin/log-self-test', methods=['GET'])
+@bp.route('/ready', methods=['GET'])
+def ready():
+    """Готовность к трафику и уровни ретривала (векторный индекс подключается в фоне)"""
+    status = current_rag_engine().status()
+    return jsonify(status), (200 if status["ready"] else 503)
+
+@bp.route('/admin/log-self-test', methods=['GET'])
 def log_self_test():
     ok = self_test()
     return {"ok": ok, "log_dir": str(LOG_DIR)}
 
-
-@app.route('/submit-lead', methods=['POST'])
+@bp.route('/admin/startup-profile', methods=['GET'])
+def startup_profile():
+    """Этапы старта процесса: время и пиковый RSS (импорты, загрузка индексов)"""
+    return jsonify(PROFILE.to_dict())
+
+@bp.route('/admin/tenants', methods=['GET'])
+def tenants_stats():
+    """Тенанты: резидентность, память индексов, загрузки/вытеснения, латентность /chat"""
+    return jsonify(current_app.extensions["tenants"].stats())
+
+@bp.route('/admin/query-cache', methods=['GET'])
+def query_cache_stats():
+    """Кэш эмбеддингов запросов: попадания в память/файл, hit rate, размеры"""
+    cache = get_query_cache()
+    return jsonify(cache.stats() if cache is not None else {"enabled": False})
+
+@bp.route('/admin/embed-coalescer', methods=['GET'])
+def embed_coalescer_stats():
+    """Склейка эмбеддингов запросов: вызовы API, средний размер пакета, гистограмма размеров"""
+    return jsonify({"coalescers": coalescer_stats()})
+
+@bp.route('/admin/query-cache/purge', methods=['POST'])
+def query_cache_purge():
+    """Сброс кэша эмбеддингов запросов (?model=… — только одной модели), только с X-Admin-Token"""
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({"error": "forbidden"}), 403
+    cache = get_query_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"purged": cache.purge(request.args.get("model") or None), **cache.stats()})
+
+
+@bp.route('/submit-lead', methods=['POST'])
 def submit_lead():
     try:
         data = request.json
@@ -765,32 +841,91 @@ def submit_lead():
         return jsonify({"success": False, "message": "Произошла ошибка. Попробуйте позже."})
 
 
-@app.route('/')
+@bp.route('/')
 def root():
     return send_file('static/tester.html')
 
 
-@app.route('/widget')
+@bp.route('/widget')
 def widget():
     return jsonify(ok=True, app="cesi-bot", message="Widget endpoint")
 
 
-@app.route('/widget-embed.js')
+@bp.route('/widget-embed.js')
 def widget_embed():
     return send_file('widget-embed.js')
 
 
-@app.route('/demo')
+@bp.route('/demo')
 def demo():
     return jsonify(ok=True, app="cesi-bot", message="Demo endpoint")
 
 
-@app.route('/test-connection.html')
+@bp.route('/test-connection.html')
 def test_connection():
     return jsonify(ok=True, app="cesi-bot", message="Test connection endpoint")
 
 
 
 
+def create_app(engine: RagEngine | None = None) -> Flask:
+    """
+    Фабрика приложения.
+
+    Args:
+        engine: Загруженный RagEngine; по умолчанию — общий движок процесса (rag_engine.get_engine)
+
+    Returns:
+        Flask-приложение с маршрутами бота
+    """
+    app = Flask(__name__)
+    PROFILE.expect("app")
+    registry = TenantRegistry.from_config(default_engine=engine)
+    if engine is None:
+        with PROFILE.stage("rag_engine_init"):
+            engine = registry.engine(registry.default)
+    tenant_origins = [f"{scheme}://{host}" for host in registry.origins for scheme in ("https", "http")]
+    CORS(app, origins=CORS_ORIGINS + [o for o in tenant_origins if o not in CORS_ORIGINS])
+    app.extensions["rag_engine"] = engine
+    app.extensions["tenants"] = registry
+    app.register_blueprint(bp)
+    PROFILE.done("app")
+
+    @app.before_request
+    def _resolve_tenant():
+        # движок по умолчанию — с первого запроса воркера (и /ready), дальше — одна проверка pid
+        start_background(engine)
+        if request.endpoint not in TENANT_ENDPOINTS:
+            return None
+        g.t0 = perf_counter()
+        body = request.get_json(silent=True) if request.is_json else None
+        explicit = body.get("tenant") if isinstance(body, dict) else None
+        g.tenant = registry.resolve(explicit, request.headers.get("Origin") or request.headers.get("Referer"))
+        if g.tenant is None:
+            return jsonify({"error": f"unknown tenant: {explicit}"}), 404
+        start_background(current_rag_engine())
+
+    @app.after_request
+    def _observe_tenant(response):
+        if request.endpoint == "cesi.chat" and g.get("tenant"):
+            registry.observe(g.tenant, (perf_counter() - g.t0) * 1000, ok=response.status_code < 500)
+        return response
+    return app
+
+
+_app = None
+PROFILE.checkpoint("app_import")
+
+
+def __getattr__(name):
+    # gunicorn app:app — приложение (и индексы) создаются при первом обращении, а не при импорте
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000)
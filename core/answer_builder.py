@@ -8,9 +8,6 @@ from typing import Dict, List, Optional, Any
 import json
 import re
 
-# Импорты для эмпатии и CTA
-from core import empathy, cta
-
 def build_json(
     short: str = "",
     bullets: Optional[List[str]] = None,
@@ -82,11 +79,15 @@ def to_legacy_text(payload):
     except Exception:
         return ""
 
-def postprocess(answer_text: str, user_text: str, intent: str, topic_meta: dict, session: dict) -> dict:
+def postprocess(answer_text: str, user_text: str, intent: str, topic_meta: dict, session: dict,
+                cta_cfg: Optional[dict] = None) -> dict:
     """
     1) вставляем эмпатию-опенер или бридж (одна короткая строка)
-    2) решаем CTA (одна кнопка)
+    2) решаем CTA (одна кнопка); cta_cfg — cta.yaml тенанта (None — общий)
     """
+    # эмпатия и CTA нужны только при сборке ответа — импортируем при первом вызове, а не на старте
+    from core import empathy, cta
+
     # 0. убедимся, что конфиги загружены (однократно)
     if not hasattr(empathy, '_CFG') or not empathy._CFG:
         empathy.load_config()
@@ -115,7 +116,8 @@ def postprocess(answer_text: str, user_text: str, intent: str, topic_meta: dict,
         cta_obj = cta.decide_cta(
             intent=intent,
             topic_meta=topic_meta or {},
-            session=session
+            session=session,
+            cfg=cta_cfg
         )
     except Exception as e:
         print(f"CTA error: {e}")
@@ -0,0 +1,68 @@
+# core/chunk_fields.py
+"""
+Производные поля чанка, которые считаются один раз при индексации, а не на каждом запросе:
+текст в нижнем регистре (бусты, фильтры, fallback по теме — проверки подстрок и основ слов),
+текст для промпта (clean_section_for_prompt + схлопнутые пробелы) с границами предложений,
+текст для показа (без HTML-комментариев и решёток заголовков — best_text в get_rag_answer).
+"""
+
+import re
+from array import array
+from bisect import bisect_right
+from typing import Iterable
+
+from core.text_clean import clean_section_for_prompt
+
+RX_SPACES = re.compile(r'\s+')
+RX_SENT_END = re.compile(r'[.!?…]+(?=\s|$)')
+RX_DISPLAY_COMMENT = re.compile(r'<!--.*?>', re.DOTALL)
+RX_DISPLAY_HEADING = re.compile(r'^\s*#{1,6}\s*', re.MULTILINE)
+
+
+def display_text(text: str) -> str:
+    """Текст чанка для показа пользователю: без HTML-комментариев и маркеров заголовков"""
+    text = RX_DISPLAY_COMMENT.sub('', text or '')
+    return RX_DISPLAY_HEADING.sub('', text).strip()
+
+
+class ChunkFields:
+    """Производные поля одного чанка (только чтение после индексации)."""
+
+    __slots__ = ("lower", "clean", "prompt", "sentences", "display")
+
+    def __init__(self, text: str):
+        """
+        Args:
+            text: Текст чанка
+        """
+        text = text or ""
+        self.lower = text.lower()
+        self.clean = clean_section_for_prompt(text)
+        self.prompt = RX_SPACES.sub(" ", self.clean).strip()
+        # концы предложений в prompt — для обрезки по границе
+        self.sentences = array("I", (m.end() for m in RX_SENT_END.finditer(self.prompt)))
+        self.display = display_text(text)
+
+    def contains_any(self, needles: Iterable[str]) -> bool:
+        """Есть ли в тексте (нижний регистр) хоть одна из подстрок"""
+        lower = self.lower
+        return any(n in lower for n in needles)
+
+    def prompt_slice(self, limit_chars: int = 900) -> str:
+        """
+        Текст для промпта не длиннее limit_chars: по последней границе предложения в лимите,
+        если она есть во второй половине лимита, иначе — жёстко по лимиту (как slice_for_prompt).
+        """
+        prompt = self.prompt
+        if len(prompt) <= limit_chars:
+            return prompt
+        i = bisect_right(self.sentences, limit_chars)
+        if i and self.sentences[i - 1] >= limit_chars // 2:
+            return prompt[:self.sentences[i - 1]]
+        return prompt[:limit_chars]
+
+    @property
+    def nbytes(self) -> int:
+        """Примерный объём полей в памяти (для IndexSnapshot.memory_bytes)"""
+        return (len(self.lower) + len(self.clean) + len(self.prompt) + len(self.display)) * 2 \
+            + self.sentences.itemsize * len(self.sentences)
@@ -0,0 +1,120 @@
+# core/corpus_watcher.py
+"""
+Отслеживание изменений markdown-корпуса без внешних сервисов.
+Раз в interval секунд обходит папку и сравнивает (mtime, size) файлов;
+у подозрительных файлов сверяет sha256, чтобы touch без правок не вызывал переиндексацию.
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+CORPUS_WATCH_INTERVAL = float(os.getenv("CORPUS_WATCH_INTERVAL", "0"))  # 0 — не следить
+
+
+class CorpusChanges:
+    """Добавленные, изменённые и удалённые файлы (пути строками)."""
+
+    def __init__(self, added: List[str], modified: List[str], removed: List[str]):
+        self.added = added
+        self.modified = modified
+        self.removed = removed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.removed)
+
+    def to_dict(self) -> dict:
+        return {"added": self.added, "modified": self.modified, "removed": self.removed}
+
+
+def _digest(path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+class CorpusWatcher:
+    """Поллинг папки с md-файлами; при изменениях вызывает on_change(CorpusChanges) в фоновом потоке."""
+
+    def __init__(
+        self,
+        root: Path | str,
+        on_change: Callable[[CorpusChanges], object],
+        interval: float = CORPUS_WATCH_INTERVAL,
+        pattern: str = "*.md",
+    ):
+        self.root = Path(root)
+        self.on_change = on_change
+        self.interval = max(float(interval), 0.5)
+        self.pattern = pattern
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        self._hashes: Dict[str, Optional[str]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        out = {}
+        for p in self.root.rglob(self.pattern):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            out[str(p)] = (st.st_mtime_ns, st.st_size)
+        return out
+
+    def snapshot(self) -> None:
+        """Запоминает текущее состояние папки как исходное."""
+        self._stats = self._scan()
+        self._hashes = {path: _digest(Path(path)) for path in self._stats}
+
+    def poll(self) -> CorpusChanges:
+        """
+        Сравнивает папку с прошлым снимком и обновляет снимок.
+
+        Returns:
+            CorpusChanges (пустой, если ничего не поменялось)
+        """
+        stats = self._scan()
+        added = [p for p in stats if p not in self._stats]
+        removed = [p for p in self._stats if p not in stats]
+        modified = []
+        for p, st in stats.items():
+            if p in self._stats and self._stats[p] != st:
+                digest = _digest(Path(p))
+                if digest != self._hashes.get(p):
+                    modified.append(p)
+                self._hashes[p] = digest
+        for p in added:
+            self._hashes[p] = _digest(Path(p))
+        for p in removed:
+            self._hashes.pop(p, None)
+        self._stats = stats
+        return CorpusChanges(sorted(added), sorted(modified), sorted(removed))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                changes = self.poll()
+                if changes:
+                    print(f"📝 Изменения в {self.root}: {changes.to_dict()}")
+                    self.on_change(changes)
+            except Exception as e:
+                # ошибка перезагрузки не должна останавливать наблюдение
+                print(f"❌ Ошибка при обработке изменений корпуса: {e}")
+
+    def start(self) -> None:
+        self.snapshot()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="corpus-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+
+    def alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
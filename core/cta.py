@@ -14,6 +14,10 @@ def load_config(base_dir="config"):
     _CFG = _load_yaml(os.path.join(base_dir, "cta.yaml"))
     return _CFG
 
+def read_config(path: str) -> dict:
+    """cta.yaml тенанта — без подмены общего конфига"""
+    return _load_yaml(path)
+
 def _now(): return time.time()
 
 def _cta_key(obj: Dict[str, Any]) -> str:
@@ -29,8 +33,8 @@ def _cooldown_ok(session: Dict[str, Any], seconds: int) -> bool:
     if not last: return True
     return (_now() - last) >= seconds
 
-def _is_high_intent(intent: Optional[str]) -> bool:
-    tags = set((_CFG or {}).get("high_intent_tags") or [])
+def _is_high_intent(intent: Optional[str], cfg: Optional[dict] = None) -> bool:
+    tags = set(((_CFG if cfg is None else cfg) or {}).get("high_intent_tags") or [])
     return bool(intent and intent in tags)
 
 def _mark_shown(session: Dict[str, Any], obj: Dict[str, Any]):
@@ -63,30 +67,32 @@ def _intent_to_url_fallback(action: str, params: Dict[str, Any]) -> str:
     # consultation / call / whatsapp и прочее
     return f"/book?topic={topic}"
 
-def build_cta_from_intent(intent: Optional[str]) -> Optional[Dict[str, Any]]:
+def build_cta_from_intent(intent: Optional[str], cfg: Optional[dict] = None) -> Optional[Dict[str, Any]]:
     if not intent: return None
-    imap = (_CFG or {}).get("intent_map") or {}
+    imap = ((_CFG if cfg is None else cfg) or {}).get("intent_map") or {}
     obj = imap.get(intent)
     if not obj: return None
     obj = dict(obj)  # копия
     obj["key"] = _cta_key(obj)
     return obj
 
-def build_default_cta() -> Dict[str, Any]:
-    obj = dict(((_CFG or {}).get("default")) or {})
+def build_default_cta(cfg: Optional[dict] = None) -> Dict[str, Any]:
+    obj = dict((((_CFG if cfg is None else cfg) or {}).get("default")) or {})
     obj["key"] = _cta_key(obj)
     return obj
 
 def decide_cta(intent: Optional[str],
                topic_meta: Dict[str, Any],
-               session: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    cooldown = int(os.getenv("CTA_COOLDOWN_SECONDS", (_CFG or {}).get("cooldown_seconds", 90)))
+               session: Dict[str, Any],
+               cfg: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+    # cfg — cta.yaml тенанта; None — общий конфиг (load_config)
+    cooldown = int(os.getenv("CTA_COOLDOWN_SECONDS", ((_CFG if cfg is None else cfg) or {}).get("cooldown_seconds", 90)))
     override = os.getenv("CTA_HIGH_INTENT_OVERRIDE","true") == "true"
 
     # строим кандидат из темы/интента, а дефолт — только если флаг включён
-    cand = build_cta_from_topic(topic_meta) or build_cta_from_intent(intent)
+    cand = build_cta_from_topic(topic_meta) or build_cta_from_intent(intent, cfg)
     if not cand and os.getenv("ENABLE_CTA_GLOBAL_FALLBACK", "true") == "true":
-        cand = build_default_cta()
+        cand = build_default_cta(cfg)
 
     if not cand: return None
 
@@ -96,7 +102,7 @@ def decide_cta(intent: Optional[str],
 
     if not _cooldown_ok(session, cooldown):
         # пропускаем из-за кулдауна, кроме high-intent
-        if not (override and _is_high_intent(intent)):
+        if not (override and _is_high_intent(intent, cfg)):
             return None
 
     # TTL подавления после клика
@@ -0,0 +1,128 @@
+# core/dedup.py
+"""
+Поиск почти одинаковых секций при индексации: MinHash по словесным шинглам + LSH по полосам.
+Несколько страниц корпуса повторяют одни и те же абзацы (faq-implants-*, прайсы клиники и
+имплантации) — дубли раздувают BM25 и векторный поиск и вытесняют другие ответы из top-k.
+Кластер почти одинаковых чанков сводится к одному каноническому, остальные — ссылки на него.
+
+Сигнатуры детерминированы (crc32 + фиксированные перестановки) — одинаковы в воркерах
+разбора и между запусками, поэтому их можно считать по файлам и кэшировать в FileIndex.
+"""
+
+import os
+import re
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+DEDUP_ENABLE = os.getenv("DEDUP_ENABLE", "true").lower() == "true"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))      # оценка Jaccard по шинглам
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))           # длина сигнатуры
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))                  # полос LSH (DEDUP_NUM_PERM кратно)
+DEDUP_SHINGLE = int(os.getenv("DEDUP_SHINGLE", "3"))               # слов в шингле
+DEDUP_MIN_SHINGLES = int(os.getenv("DEDUP_MIN_SHINGLES", "12"))    # короче — не сравниваем (заголовки, контакты)
+
+_PRIME = np.uint64(4294967311)   # простое > 2^32: (a*h + b) помещается в uint64
+_RX_WORD = re.compile(r"\w+")
+
+_perm_cache: Dict[int, tuple] = {}
+
+
+def _permutations(num_perm: int):
+    if num_perm not in _perm_cache:
+        rng = np.random.default_rng(20250101)
+        a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        _perm_cache[num_perm] = (a[:, None], b[:, None])
+    return _perm_cache[num_perm]
+
+
+def shingles(text: str, size: int = DEDUP_SHINGLE) -> np.ndarray:
+    """Хэши словесных шинглов текста (уникальные, uint64)"""
+    words = _RX_WORD.findall((text or "").lower())
+    if len(words) < size:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+
+def signature(text: str, num_perm: int = DEDUP_NUM_PERM) -> Optional[np.ndarray]:
+    """
+    MinHash-сигнатура текста.
+
+    Args:
+        text: Текст чанка
+        num_perm: Число хэш-функций
+
+    Returns:
+        Массив uint32 длины num_perm или None, если текст слишком короткий для сравнения
+    """
+    h = shingles(text)
+    if len(h) < DEDUP_MIN_SHINGLES:
+        return None
+    a, b = _permutations(num_perm)
+    return ((a * h[None, :] + b) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """Оценка Jaccard по двум сигнатурам"""
+    return float(np.count_nonzero(sig_a == sig_b)) / len(sig_a)
+
+
+def find_clusters(signatures: Sequence[Optional[np.ndarray]], threshold: float = DEDUP_THRESHOLD,
+                  bands: int = DEDUP_BANDS) -> List[List[int]]:
+    """
+    Кластеры почти одинаковых текстов.
+
+    Кандидаты — совпадение хотя бы одной полосы сигнатуры (LSH), пара попадает в кластер,
+    если оценка Jaccard не ниже threshold; кластеры — компоненты связности пар.
+
+    Args:
+        signatures: Сигнатуры по позициям (None — не участвует)
+        threshold: Порог оценки Jaccard
+        bands: Число полос LSH
+
+    Returns:
+        Кластеры из двух и более позиций, позиции внутри кластера и сами кластеры — по возрастанию
+    """
+    present = [i for i, s in enumerate(signatures) if s is not None]
+    if len(present) < 2:
+        return []
+    rows = len(signatures[present[0]]) // bands
+
+    parent = {i: i for i in present}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    checked = set()
+    for band in range(bands):
+        buckets: Dict[bytes, List[int]] = {}
+        for i in present:
+            buckets.setdefault(signatures[i][band * rows:(band + 1) * rows].tobytes(), []).append(i)
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    i, j = members[x], members[y]
+                    if (i, j) in checked:
+                        continue
+                    checked.add((i, j))
+                    if similarity(signatures[i], signatures[j]) >= threshold:
+                        ri, rj = find(i), find(j)
+                        if ri != rj:
+                            parent[max(ri, rj)] = min(ri, rj)
+
+    groups: Dict[int, List[int]] = {}
+    for i in present:
+        groups.setdefault(find(i), []).append(i)
+    return sorted((g for g in groups.values() if len(g) > 1), key=lambda g: g[0])
+
+
+def pick_canonical(cluster: Iterable[int], texts: Sequence[str]) -> int:
+    """Канонический чанк кластера: самый полный текст, при равенстве — первый по порядку корпуса"""
+    return min(cluster, key=lambda i: (-len(texts[i]), i))
@@ -0,0 +1,214 @@
+# core/doc2query.py
+"""
+Doc2query: синтетические вопросы пациентов к каждому чанку, сгенерированные офлайн.
+Вопросы индексируются рядом с чанком — токенами в его документе BM25 и отдельными векторами
+в векторном индексе со ссылкой на чанк. Формулировки пациентов находятся без multi-query
+(generate_query_variants — блокирующий вызов чата на каждый длинный запрос).
+
+Генераторы подключаемые: "template" (локальный, по заголовкам/алиасам и шаблонам), "openai"
+(чат-модель, только офлайн — tools/build_doc2query.py) или "пакет.модуль:функция" — фабрика,
+которая получает (client, model) и возвращает функцию chunk -> List[str].
+Вопросы хранятся в JSON по sha256 текста чанка: неизменённые чанки не генерируются заново,
+а для новых/изменённых при индексации используется шаблонный генератор.
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from core.followups_enhanced import create_question_from_title
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+DOC2QUERY_ENABLE = os.getenv("DOC2QUERY_ENABLE", "false").lower() == "true"
+DOC2QUERY_PATH = Path(os.getenv("DOC2QUERY_PATH", BASE_DIR / "cache" / "doc2query.json"))
+DOC2QUERY_GENERATOR = os.getenv("DOC2QUERY_GENERATOR", "template")
+DOC2QUERY_PER_CHUNK = int(os.getenv("DOC2QUERY_PER_CHUNK", "5"))
+DOC2QUERY_MODEL = os.getenv("DOC2QUERY_MODEL", "gpt-4o-mini")
+# при вопросах в индексе multi-query на запросе не нужен
+DOC2QUERY_REPLACES_MQ = os.getenv("DOC2QUERY_REPLACES_MQ", "true").lower() == "true"
+
+Generator = Callable[[object], List[str]]
+
+_RX_SPACES = re.compile(r'\s+')
+_RX_NOISE = re.compile(r'[«»"*_`]|\(.*?\)|^\d+[.)]\s*|^[-•]\s*')
+# заголовок, который уже сформулирован как вопрос пациента
+_RX_QUESTION = re.compile(r'\?\s*$|^(а\s+)?(как|почему|зачем|можно|сколько|что|кому|когда|где|какие|какой|какая|'
+                          r'нужно|больно|возможн|вдруг)\b', re.IGNORECASE)
+_RX_TITLE_TAIL = re.compile(r'\s*[:(—–].*$')     # "All-on-6: усиленная опора…" → "All-on-6"
+
+# признаки в тексте чанка → шаблон вопроса о предмете секции
+# (предмет — название в именительном падеже: "имплантация all-on-4", поэтому "больно ли {}" не годится)
+_INTENTS = (
+    (("₽", "руб", "стоимост", "цена", "цены"), "сколько стоит {}"),
+    (("больно", "боль", "анестез", "обезбол"), "{} — это больно"),
+    (("длится", "срок", "дней", "месяц", "недел"), "сколько длится {}"),
+    (("противопоказ", "нельзя", "ограничен"), "{} — кому нельзя"),
+    (("гаранти",), "какая гарантия на {}"),
+    (("прижив", "оссеоинтегр"), "как приживается {}"),
+)
+
+
+def text_digest(text: str) -> str:
+    """Ключ вопросов чанка — sha256 его текста"""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def _clean_question(q: str) -> str:
+    q = _RX_NOISE.sub("", (q or "").strip())
+    return _RX_SPACES.sub(" ", q).strip(" .").lower()
+
+
+def _dedup(questions: Sequence[str], limit: int) -> List[str]:
+    out, seen = [], set()
+    for q in questions:
+        q = _clean_question(q)
+        if len(q) > 3 and q not in seen:
+            seen.add(q)
+            out.append(q)
+        if len(out) >= limit:
+            break
+    return out
+
+
+def template_questions(chunk, limit: int = DOC2QUERY_PER_CHUNK) -> List[str]:
+    """
+    Локальный генератор: вопросы по заголовкам секции и документа, алиасам и признакам в тексте.
+
+    Args:
+        chunk: RetrievedChunk (metadata: title, h2/h3, aliases; fields.lower)
+        limit: Максимум вопросов
+
+    Returns:
+        Вопросы в нижнем регистре без повторов
+    """
+    meta = chunk.metadata
+    section = (meta.get("h3_title") or meta.get("h2_title") or "").strip().lstrip("# ")
+    doc_title = (getattr(meta, "document", meta).get("title") or "").strip()
+    aliases = [a for a in (meta.get("aliases") or []) if isinstance(a, str)]
+    lower = chunk.fields.lower
+
+    # предмет вопросов — название документа ("All-on-4"), если оно не вопрос, иначе заголовок секции
+    subject = next((_RX_TITLE_TAIL.sub("", t).lower() for t in (doc_title, section)
+                    if t and not _RX_QUESTION.search(t)), "")
+
+    questions = [t for t in (section, doc_title) if t and _RX_QUESTION.search(t)]
+    if section and not _RX_QUESTION.search(section):
+        generic = f"расскажите про {section.lower()}"
+        question = create_question_from_title(section, {})
+        if question and question != generic:
+            # "Кому подходит" → "кому это подходит all-on-4" (если предмет не назван в самом заголовке)
+            named = subject in section.lower() or section.lower() in subject
+            questions.append(question if named else f"{question} {subject}".strip())
+        elif len(section.split()) > 1:
+            questions.append(section)
+    if subject:
+        # "сколько стоит цены…" не строим: признак уже в самом предмете
+        questions.extend(tpl.format(subject) for cues, tpl in _INTENTS
+                         if any(c in lower for c in cues) and not any(c in subject for c in cues))
+    # алиасы — это и есть формулировки пациентов
+    questions.extend(aliases)
+    return _dedup(questions, limit)
+
+
+def openai_generator(client, model: str = DOC2QUERY_MODEL, limit: int = DOC2QUERY_PER_CHUNK) -> Generator:
+    """
+    Генератор на чат-модели (для офлайн-сборки: один запрос на чанк).
+
+    Args:
+        client: OpenAI клиент v1
+        model: Чат-модель
+        limit: Вопросов на чанк
+
+    Returns:
+        Функция chunk -> List[str]; при ошибке модели — шаблонные вопросы
+    """
+    def generate(chunk) -> List[str]:
+        prompt = f"""Ниже фрагмент с сайта стоматологической клиники. Напиши {limit} разных коротких вопросов,
+которые пациент мог бы задать в чате и на которые отвечает этот фрагмент. Пиши как пациент: просто, без терминов.
+
+Фрагмент:
+\"\"\"{chunk.fields.prompt_slice(limit_chars=1500)}\"\"\"
+
+Верни ТОЛЬКО JSON:
+{{"questions": ["вопрос 1", "вопрос 2"]}}"""
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=300,
+                temperature=0.7,
+            )
+            questions = json.loads(response.choices[0].message.content).get("questions", [])
+            return _dedup(questions, limit) or template_questions(chunk, limit)
+        except Exception as e:
+            print(f"⚠️ doc2query: модель не ответила для {chunk.id}: {e}")
+            return template_questions(chunk, limit)
+
+    return generate
+
+
+GENERATORS: Dict[str, Callable[..., Generator]] = {
+    "template": lambda client=None, model=None: template_questions,
+    "openai": lambda client=None, model=None: openai_generator(client, model or DOC2QUERY_MODEL),
+}
+
+
+def make_generator(name: str = DOC2QUERY_GENERATOR, client=None, model: Optional[str] = None) -> Generator:
+    """
+    Генератор вопросов по имени.
+
+    Args:
+        name: "template", "openai" или "пакет.модуль:фабрика"
+        client: OpenAI клиент (для генераторов на модели)
+        model: Модель генерации
+
+    Returns:
+        Функция chunk -> List[str]
+    """
+    if name in GENERATORS:
+        return GENERATORS[name](client=client, model=model)
+    module, _, attr = name.partition(":")
+    if not attr:
+        raise ValueError(f"doc2query: неизвестный генератор {name!r}")
+    return getattr(importlib.import_module(module), attr)(client=client, model=model)
+
+
+class QuestionStore:
+    """Вопросы чанков по sha256 текста (JSON-файл офлайн-сборки)."""
+
+    def __init__(self, path: Path | str = DOC2QUERY_PATH):
+        self.path = Path(path)
+        self.generator = None
+        self.questions: Dict[str, List[str]] = {}
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                self.generator = data.get("generator")
+                self.questions = data.get("questions", {})
+            except Exception as e:
+                print(f"⚠️ doc2query: не удалось прочитать {self.path}: {e}")
+
+    def get(self, chunk) -> Optional[List[str]]:
+        """Сохранённые вопросы к чанку (None — чанк новый или изменился)"""
+        return self.questions.get(text_digest(chunk.text))
+
+    def questions_for(self, chunk) -> List[str]:
+        """Вопросы к чанку: из сборки, иначе — шаблонные (без сети)"""
+        stored = self.get(chunk)
+        return list(stored) if stored is not None else template_questions(chunk)
+
+    def put(self, chunk, questions: Sequence[str]) -> None:
+        self.questions[text_digest(chunk.text)] = list(questions)
+
+    def save(self, generator: str) -> None:
+        """Записывает файл атомарно (временный файл + rename)"""
+        self.generator = generator
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"generator": generator, "questions": self.questions},
+                                  ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.path)
@@ -0,0 +1,169 @@
+# core/embed_batcher.py
+"""
+Планировщик эмбеддингов для сборки индекса.
+Пакует много текстов в один вызов embeddings.create, гоняет ограниченное
+число пакетов параллельно, соблюдает лимит запросов (token bucket) и
+повторяет запросы при 429/5xx с экспоненциальной задержкой.
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+import numpy as np
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "96"))
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "100000"))
+EMBED_MAX_PARALLEL = int(os.getenv("EMBED_MAX_PARALLEL", "4"))
+EMBED_RPS = float(os.getenv("EMBED_RPS", "5"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "0.5"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "30"))
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(rate, 1e-6)
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Блокирует поток, пока в ведре не наберётся нужное число токенов."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _status_of(exc: Exception):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def _is_retryable(exc: Exception) -> bool:
+    """429 и 5xx, а также сетевые ошибки/таймауты клиента openai."""
+    status = _status_of(exc)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError", "RateLimitError",
+                                  "InternalServerError", "ConnectionError", "TimeoutError")
+
+
+def _retry_after(exc: Exception) -> float | None:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(exc: Exception, attempt: int, cap: float = EMBED_BACKOFF_MAX) -> float:
+    """Пауза перед повтором: Retry-After из ответа, иначе экспонента (потолок cap) с джиттером"""
+    delay = _retry_after(exc)
+    if delay is None:
+        delay = min(cap, EMBED_BACKOFF_BASE * (2 ** attempt))
+        delay *= 0.5 + random.random()
+    return delay
+
+
+def make_batches(texts: Sequence[str], batch_size: int = EMBED_BATCH_SIZE,
+                 max_tokens: int = EMBED_BATCH_MAX_TOKENS) -> List[List[int]]:
+    """
+    Делит тексты на пакеты по количеству и примерному числу токенов.
+
+    Args:
+        texts: Тексты для эмбеддинга
+        batch_size: Максимум текстов в пакете
+        max_tokens: Максимум токенов в пакете (1 токен ≈ 4 символа)
+
+    Returns:
+        Список пакетов — списков индексов в исходном порядке
+    """
+    batches, cur, cur_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        n_tokens = len(text) / 4 + 1
+        if cur and (len(cur) >= batch_size or cur_tokens + n_tokens > max_tokens):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(i)
+        cur_tokens += n_tokens
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def embed_texts(
+    client,
+    texts: Sequence[str],
+    model: str,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_parallel: int = EMBED_MAX_PARALLEL,
+    rps: float = EMBED_RPS,
+    max_retries: int = EMBED_MAX_RETRIES,
+) -> np.ndarray:
+    """
+    Эмбеддит тексты пакетами и возвращает матрицу в исходном порядке.
+
+    Args:
+        client: OpenAI клиент v1
+        texts: Тексты (порядок = порядок строк результата)
+        model: Модель эмбеддингов
+        batch_size: Текстов в одном запросе
+        max_parallel: Сколько пакетов выполняется одновременно
+        rps: Лимит запросов в секунду
+        max_retries: Повторов на пакет при 429/5xx
+
+    Returns:
+        np.ndarray формы (len(texts), dim), float32
+    """
+    if not texts:
+        return np.empty((0, 0), dtype="float32")
+
+    bucket = TokenBucket(rps)
+    batches = make_batches(texts, batch_size=batch_size)
+    out: List[np.ndarray | None] = [None] * len(batches)
+
+    def run(b: int) -> None:
+        idx = batches[b]
+        payload = [texts[i] for i in idx]
+        for attempt in range(max_retries + 1):
+            bucket.acquire()
+            try:
+                resp = client.embeddings.create(model=model, input=payload, encoding_format="float")
+                rows = [None] * len(payload)
+                for pos, item in enumerate(resp.data):
+                    rows[getattr(item, "index", pos)] = item.embedding
+                out[b] = np.asarray(rows, dtype="float32")
+                return
+            except Exception as e:
+                if attempt >= max_retries or not _is_retryable(e):
+                    raise
+                delay = _backoff_delay(e, attempt)
+                print(f"⏳ Эмбеддинги: пакет {b + 1}/{len(batches)} status={_status_of(e)}, повтор через {delay:.1f}s")
+                time.sleep(delay)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+        # list() пробрасывает первое исключение из пакетов
+        list(pool.map(run, range(len(batches))))
+
+    dim = out[0].shape[1]
+    xb = np.empty((len(texts), dim), dtype="float32")
+    for b, idx in enumerate(batches):
+        xb[idx] = out[b]
+    return xb
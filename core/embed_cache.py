@@ -0,0 +1,119 @@
+# core/embed_cache.py
+"""
+Персистентный кэш эмбеддингов чанков.
+Ключ — sha256 от (модель, текст), значение — вектор float32 в SQLite.
+При рестарте эмбеддятся только новые или изменённые чанки.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+CACHE_DIR = Path(os.getenv("CACHE_DIR", BASE_DIR / "cache"))
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", CACHE_DIR / "embeddings.sqlite"))
+
+# SQLite ограничивает число параметров в одном запросе
+_SQL_BATCH = 500
+
+
+def content_key(model: str, text: str) -> str:
+    """
+    Ключ кэша: хэш от модели и текста (текст уже включает alias-буст).
+
+    Args:
+        model: Имя модели эмбеддингов
+        text: Текст, который отправляется в embeddings API
+
+    Returns:
+        Hex-строка sha256
+    """
+    h = hashlib.sha256()
+    h.update(model.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """Кэш эмбеддингов на SQLite (один файл, безопасен для нескольких воркеров)."""
+
+    def __init__(self, model: str, path: Path | str = EMBED_CACHE_PATH):
+        self.model = model
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        Достаёт векторы для списка текстов.
+
+        Args:
+            texts: Тексты в порядке чанков
+
+        Returns:
+            Список той же длины: вектор float32 или None (промах)
+        """
+        keys = [content_key(self.model, t) for t in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQL_BATCH):
+                part = keys[i:i + _SQL_BATCH]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, dim, vec FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, dim, blob in rows:
+                    vec = np.frombuffer(blob, dtype="float32")
+                    if vec.shape[0] == dim:
+                        found[key] = vec
+
+        out = [found.get(k) for k in keys]
+        hit = sum(1 for v in out if v is not None)
+        self.hits += hit
+        self.misses += len(out) - hit
+        return out
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """
+        Сохраняет векторы для текстов (перезаписывает существующие ключи).
+
+        Args:
+            texts: Тексты
+            vectors: Векторы в том же порядке
+        """
+        rows = []
+        for text, vec in zip(texts, vectors):
+            arr = np.asarray(vec, dtype="float32")
+            rows.append((content_key(self.model, text), self.model, int(arr.shape[0]), arr.tobytes()))
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vec) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """Счётчики попаданий/промахов и размер кэша."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": size, "path": str(self.path)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
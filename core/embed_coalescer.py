@@ -0,0 +1,193 @@
+# core/embed_coalescer.py
+"""
+Склейка одновременных эмбеддингов запросов в один вызов API (micro-batching).
+Запросы /chat, пришедшие в пределах короткого окна (EMBED_COALESCE_WAIT_MS), уходят одним
+embeddings.create(input=[...]); каждый вызывающий получает свой вектор. При пиковой нагрузке
+это меньше HTTPS-запросов к API и короче хвост латентности; одиночный запрос ждёт не дольше окна.
+
+Пакет отправляется, как только набралось EMBED_COALESCE_MAX_BATCH текстов или истекло окно
+с момента первого текста в очереди. Одинаковые тексты в пакете эмбеддятся один раз.
+429/5xx повторяются с короткой паузой (EMBED_COALESCE_RETRIES): ошибка пакета бьёт по всем
+его запросам сразу, поэтому отдавать её на фолбэк с первой же попытки нельзя.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from core.embed_batcher import _backoff_delay, _is_retryable, _status_of
+
+EMBED_COALESCE_ENABLE = os.getenv("EMBED_COALESCE_ENABLE", "true").lower() == "true"
+EMBED_COALESCE_WAIT_MS = float(os.getenv("EMBED_COALESCE_WAIT_MS", "4"))
+EMBED_COALESCE_MAX_BATCH = int(os.getenv("EMBED_COALESCE_MAX_BATCH", "32"))
+EMBED_COALESCE_MAX_PARALLEL = int(os.getenv("EMBED_COALESCE_MAX_PARALLEL", "4"))
+EMBED_COALESCE_TIMEOUT = float(os.getenv("EMBED_COALESCE_TIMEOUT", "60"))
+EMBED_COALESCE_RETRIES = int(os.getenv("EMBED_COALESCE_RETRIES", "2"))
+EMBED_COALESCE_BACKOFF_MAX = float(os.getenv("EMBED_COALESCE_BACKOFF_MAX", "2"))   # пользователь ждёт ответа
+
+# корзины гистограммы размеров пакетов: (верхняя граница, подпись)
+_BUCKETS = ((1, "1"), (2, "2"), (4, "3-4"), (8, "5-8"), (16, "9-16"), (32, "17-32"), (64, "33-64"))
+
+
+def _bucket(size: int) -> str:
+    return next((label for top, label in _BUCKETS if size <= top), f">{_BUCKETS[-1][0]}")
+
+
+class EmbedCoalescer:
+    """Очередь эмбеддингов запросов с пакетной отправкой из фонового потока."""
+
+    def __init__(self, client, model: str, max_batch: int = EMBED_COALESCE_MAX_BATCH,
+                 max_wait_ms: float = EMBED_COALESCE_WAIT_MS, max_parallel: int = EMBED_COALESCE_MAX_PARALLEL):
+        """
+        Args:
+            client: OpenAI клиент v1
+            model: Модель эмбеддингов
+            max_batch: Максимум текстов в одном вызове API
+            max_wait_ms: Окно ожидания попутчиков после первого текста в очереди, мс
+            max_parallel: Пакетов в полёте одновременно (пока один ждёт API, копится следующий)
+        """
+        self.client = client
+        self.model = model
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: List[Tuple[str, Future, float]] = []     # (текст, future, время постановки)
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_parallel), thread_name_prefix="embed-coalesce")
+        self._thread: Optional[threading.Thread] = None
+        self.requests = 0
+        self.api_calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.histogram: Dict[str, int] = {label: 0 for _, label in _BUCKETS}
+        self.histogram[f">{_BUCKETS[-1][0]}"] = 0
+
+    def embed(self, text: str) -> List[float]:
+        """Вектор одного текста (блокирует до ответа своего пакета)"""
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: Sequence[str]) -> List[List[float]]:
+        """
+        Векторы нескольких текстов; они попадают в пакеты вместе с текстами других запросов.
+
+        Args:
+            texts: Тексты
+
+        Returns:
+            Векторы в порядке texts
+
+        Raises:
+            Исключение embeddings API (для всех текстов пакета) или TimeoutError
+        """
+        futures = [Future() for _ in texts]
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embed-coalescer", daemon=True)
+                self._thread.start()
+            now = time.monotonic()
+            self._queue.extend((text, future, now) for text, future in zip(texts, futures))
+            self.requests += len(futures)
+            self._cond.notify()
+        return [f.result(timeout=EMBED_COALESCE_TIMEOUT) for f in futures]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # окно считается от постановки первого текста в очереди, а не от пробуждения потока
+                deadline = self._queue[0][2] + self.max_wait
+                while len(self._queue) < self.max_batch:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: List[Tuple[str, Future, float]]) -> None:
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        with self._cond:
+            self.api_calls += 1
+            self.histogram[_bucket(len(batch))] += 1
+        try:
+            vectors = dict(zip(texts, self._create(texts)))
+            for text, future, _ in batch:
+                future.set_result(vectors[text])
+        except Exception as e:
+            with self._cond:
+                self.errors += 1
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _create(self, texts: List[str]) -> List[List[float]]:
+        """embeddings.create с повторами на 429/5xx; неполный ответ — ошибка, а не None в векторах"""
+        for attempt in range(EMBED_COALESCE_RETRIES + 1):
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=texts, encoding_format="float")
+                rows: List[Optional[List[float]]] = [None] * len(texts)
+                for pos, item in enumerate(resp.data):
+                    rows[getattr(item, "index", pos)] = item.embedding
+                if any(row is None for row in rows):
+                    raise ValueError(f"embeddings API вернул {len(resp.data)} векторов на {len(texts)} текстов")
+                return rows
+            except Exception as e:
+                if attempt >= EMBED_COALESCE_RETRIES or not _is_retryable(e):
+                    raise
+                delay = min(EMBED_COALESCE_BACKOFF_MAX, _backoff_delay(e, attempt, EMBED_COALESCE_BACKOFF_MAX))
+                with self._cond:
+                    self.retries += 1
+                print(f"⏳ Склейка эмбеддингов: status={_status_of(e)}, повтор через {delay:.2f}s")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        """Счётчики и гистограмма размеров пакетов"""
+        with self._cond:
+            return {
+                "model": self.model,
+                "requests": self.requests,
+                "api_calls": self.api_calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "avg_batch": round(self.requests / self.api_calls, 2) if self.api_calls else 0.0,
+                "queued": len(self._queue),
+                "batch_sizes": dict(self.histogram),
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000.0,
+            }
+
+
+_coalescers: Dict[Tuple[int, str], EmbedCoalescer] = {}
+_coalescers_pid = None
+_coalescers_lock = threading.Lock()
+
+
+def get_coalescer(client, model: str) -> Optional[EmbedCoalescer]:
+    """
+    Склейщик процесса для пары (клиент, модель); движки тенантов с общим клиентом делят один.
+
+    Returns:
+        EmbedCoalescer или None (EMBED_COALESCE_ENABLE=false или нет клиента)
+    """
+    global _coalescers_pid
+    if not EMBED_COALESCE_ENABLE or client is None:
+        return None
+    key = (id(client), model)
+    with _coalescers_lock:
+        # фоновый поток не переживает fork (gunicorn --preload) — в воркере заводим свои
+        if _coalescers_pid != os.getpid():
+            _coalescers.clear()
+            _coalescers_pid = os.getpid()
+        coalescer = _coalescers.get(key)
+        if coalescer is None or coalescer.client is not client:
+            coalescer = _coalescers[key] = EmbedCoalescer(client, model)
+        return coalescer
+
+
+def coalescer_stats() -> List[dict]:
+    """Статистика всех склейщиков процесса (для /admin)"""
+    with _coalescers_lock:
+        return [c.stats() for c in _coalescers.values()] if _coalescers_pid == os.getpid() else []
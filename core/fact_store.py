@@ -0,0 +1,340 @@
+# core/fact_store.py
+"""
+Структурированные факты корпуса, собранные при индексации: карточки врачей, контакты клиники,
+таблица цен и виды имплантации. Самые частые вопросы ("адрес", "телефон", "расскажите про Моисеева",
+"сколько стоят импланты", "какие виды имплантации") отвечаются прямо из хранилища — готовым текстом,
+уже обрезанным под стиль темы (decide_style), без эмбеддингов, BM25 и синтеза.
+
+Ответ из хранилища даётся, только если запрос короткий и в нём ровно одно такое намерение;
+всё остальное ("адрес и цены", опечатки в фамилии, рассрочка) идёт обычным ретривалом.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from core.answer_shaping import smart_trim
+from core.answer_style import decide_style
+
+FACTS_ENABLE = os.getenv("FACTS_ENABLE", "true").lower() == "true"
+# длинный вопрос обычно про несколько вещей сразу — его отдаём ретривалу
+FACTS_MAX_WORDS = int(os.getenv("FACTS_MAX_WORDS", "8"))
+
+# поля контактов в порядке показа: (ключ, подпись в md)
+CONTACT_LABELS = (("address", "Адрес"), ("hours", "Время работы"), ("phone", "Телефон"),
+                  ("whatsapp", "WhatsApp"), ("parking", "Парковка"))
+_LABEL_KEYS = {label.lower(): key for key, label in CONTACT_LABELS}
+_LABELS_RX = "|".join(re.escape(label) for _, label in CONTACT_LABELS)
+# значение — до ";", конца строки или следующей подписи ("г. Елизово" точкой не обрывается)
+RX_CONTACT = re.compile(rf'({_LABELS_RX})\s*:\s*(.+?)\s*(?=;|\n|(?:{_LABELS_RX})\s*:|$)', re.IGNORECASE)
+RX_EMPHASIS = re.compile(r'\*\*|__')
+
+# вопросы про отдельные поля контактов: (поля ответа, признаки в запросе)
+CONTACT_QUERIES = (
+    (("phone", "whatsapp"), re.compile(r'телефон|позвонить|дозвонить')),
+    (("whatsapp",), re.compile(r'whats\s*app|ватс\s*ап|вотс\s*ап|вацап')),
+    (("hours",), re.compile(r'врем\w* работы|график|режим работы|часы работы|до скольки|выходн')),
+    (("parking",), re.compile(r'парков')),
+    (tuple(key for key, _ in CONTACT_LABELS),
+     re.compile(r'адрес|контакт|где вы|где наход|где располож|как (добраться|доехать|проехать|найти)')),
+)
+RX_PRICE_QUERY = re.compile(r'\bцен[аыуе]?\b|стоимост|сколько стоит|сколько стоят|прайс|поч[её]м')
+# про цену, но не про таблицу имплантов: рассрочка, вычет, виды имплантации, наращивание кости
+RX_PRICE_OTHER = re.compile(r'рассроч|кредит|вычет|дорог|скидк|акци|наращ|костн|синус|удален|all\s*-?\s*on|'
+                            r'одномомент|классическ|при[её]м|консультац')
+RX_KINDS_QUERY = re.compile(r'(какие|какой|что за).* (вид|вариант).* (имплантац|имплант)|\bвиды имплант')
+RX_SPECIALTY = re.compile(r'главный врач|имплантолог|хирург|ортопед|пародонтолог|терапевт|ортодонт|гигиенист')
+RX_PRICE_ROW = re.compile(r'^\s*[-•*]\s*(.+?)\s+[—–]\s+(.*₽.*?)\s*$')
+RX_TITLE_TAIL = re.compile(r'\s*[:(—–].*$')
+RX_SENT = re.compile(r'^(.+?[.!?…])(?=\s|$)')
+# падежное окончание фамилии/имени: "бояршина" → "бояршин" ("бояршину", "бояршиной"), "горький" → "горьк"
+RX_NAME_ENDING = re.compile(r'(?<=\w{3})(?:[иыо]й|[аяоеиыуюь])$')
+
+# порядок видов имплантации в листинге (ключи — как у _slugify_implant_kind в rag_engine)
+IMPLANT_KINDS = ("single-stage", "classic", "all-on-4", "all-on-6")
+
+
+def parse_contacts(text: str) -> Dict[str, str]:
+    """
+    Поля контактов из текста вида "Адрес: …", "Телефон: …" (markdown-выделение не мешает).
+
+    Args:
+        text: Текст секции контактов или готового ответа
+
+    Returns:
+        {ключ из CONTACT_LABELS: значение}; первое вхождение подписи побеждает
+    """
+    out: Dict[str, str] = {}
+    for m in RX_CONTACT.finditer(RX_EMPHASIS.sub("", text or "")):
+        key = _LABEL_KEYS[m.group(1).lower()]
+        value = m.group(2).strip().rstrip(".").strip()
+        if value and key not in out:
+            out[key] = value
+    return out
+
+
+def render_contacts(values: Mapping[str, str], keys: Optional[Sequence[str]] = None) -> str:
+    """
+    Контакты одним компактным параграфом без списков.
+
+    Args:
+        values: Поля из parse_contacts
+        keys: Какие поля показать (None — все, с заголовком "Адрес и контакты")
+
+    Returns:
+        "Адрес и контакты — Адрес: …; Телефон: …." или "Телефон: …; WhatsApp: …."
+    """
+    wanted = keys or [key for key, _ in CONTACT_LABELS]
+    parts = [f"{label}: {values[key]}" for key, label in CONTACT_LABELS if key in wanted and values.get(key)]
+    text = "; ".join(parts) + "."
+    return text if keys else "Адрес и контакты — " + text
+
+
+def _trim(text: str, theme: str) -> str:
+    """Обрезка под стиль темы — та же, что app.py делает с ответом синтеза"""
+    style = decide_style(theme)
+    allow_ellipsis = theme not in {"safety", "contraindications", "warranty"}
+    return smart_trim(text, limit=style.max_chars, allow_ellipsis=allow_ellipsis)
+
+
+def _lines(display: str) -> List[str]:
+    """Строки текста чанка без первой (заголовок секции), пустых и markdown-выделения"""
+    lines = [RX_EMPHASIS.sub("", ln).strip() for ln in (display or "").splitlines()[1:]]
+    return [ln for ln in lines if ln]
+
+
+def _document_title(chunk) -> str:
+    meta = chunk.metadata
+    return (getattr(meta, "document", meta).get("title") or "").strip()
+
+
+def _document_type(chunk) -> str:
+    meta = chunk.metadata
+    return getattr(meta, "document", meta).get("doc_type") or ""
+
+
+@dataclass(frozen=True)
+class DoctorFact:
+    """Карточка врача"""
+    name: str                  # "Моисеев Кирилл Николаевич"
+    variants: Tuple[str, ...]  # ключи поиска в нижнем регистре: фамилия, имя+фамилия, ...
+    specialty: str             # "имплантолог, хирург" ("" — не указана)
+    card: str                  # текст карточки для ответа
+    chunk: object
+
+
+@dataclass(frozen=True)
+class PriceRow:
+    """Строка таблицы цен"""
+    item: str     # "Implantium (Корея)"
+    price: str    # "от 68 000 ₽"
+    section: str  # "Цены на импланты"
+    chunk: object
+
+
+@dataclass(frozen=True)
+class ImplantKind:
+    """Вид имплантации"""
+    key: str      # "all-on-4"
+    title: str    # "All-on-4"
+    summary: str  # первое предложение описания
+    chunk: object
+
+
+@dataclass(frozen=True)
+class FactAnswer:
+    """Готовый ответ из хранилища"""
+    intent: str   # тема ответа: contacts / doctors / prices / implants
+    key: str      # что именно: поле контактов, врач, позиция цен, "kinds"
+    text: str     # отрендеренный и обрезанный под стиль темы текст
+    chunk: object # чанк-источник (для followups, CTA и логов)
+
+
+class FactStore:
+    """
+    Факты корпуса и готовые ответы на них. Собирается один раз на снимок индекса
+    (RagEngine._build_state и загрузка бандла) и дальше только читается.
+    """
+
+    def __init__(self, doctors: Sequence[DoctorFact] = (), contacts: Optional[Mapping[str, str]] = None,
+                 contacts_chunk=None, prices: Sequence[PriceRow] = (), implant_kinds: Sequence[ImplantKind] = ()):
+        """
+        Args:
+            doctors: Карточки врачей
+            contacts: Поля контактов (parse_contacts)
+            contacts_chunk: Чанк, из которого взяты контакты
+            prices: Строки таблицы цен
+            implant_kinds: Виды имплантации в порядке листинга
+        """
+        self.doctors = tuple(doctors)
+        self.contacts = dict(contacts or {})
+        self.prices = tuple(prices)
+        self.implant_kinds = tuple(implant_kinds)
+        self.answers: Dict[Tuple[str, str], FactAnswer] = {}
+
+        # ответы рендерятся здесь, на запросе только выбираются
+        if self.contacts:
+            for keys, _ in CONTACT_QUERIES:
+                full = len(keys) == len(CONTACT_LABELS)
+                if full or any(self.contacts.get(k) for k in keys):
+                    text = render_contacts(self.contacts, None if full else keys)
+                    key = "all" if full else keys[0]
+                    self.answers[("contacts", key)] = FactAnswer("contacts", key, _trim(text, "contacts"),
+                                                                 contacts_chunk)
+        for doc in self.doctors:
+            header = f"{doc.name} — {doc.specialty}" if doc.specialty else doc.name
+            text = "\n".join([header] + [f"- {ln.lstrip('-•* ').strip()}" for ln in doc.card.splitlines() if ln])
+            self.answers[("doctors", doc.name)] = FactAnswer("doctors", doc.name, _trim(text, "doctors"), doc.chunk)
+        implants = [row for row in self.prices if "имплант" in row.section.lower()]
+        if implants:
+            self.answers[("prices", "implants")] = FactAnswer("prices", "implants",
+                                                              _trim(self._render_prices(implants), "prices"),
+                                                              implants[0].chunk)
+        for row in self.prices:
+            self.answers[("prices", row.item)] = FactAnswer("prices", row.item,
+                                                            _trim(self._render_prices([row]), "prices"), row.chunk)
+        if self.implant_kinds:
+            text = "Виды имплантации в клинике:\n" + "\n".join(
+                f"- {k.title} — {k.summary}" if k.summary else f"- {k.title}" for k in self.implant_kinds)
+            self.answers[("implants", "kinds")] = FactAnswer("implants", "kinds", _trim(text, "implants"),
+                                                             self.implant_kinds[0].chunk)
+
+        # врачи: основа каждого слова ключа как начало слова ("моисеев" → "Моисеева",
+        # "бояршина" → "Бояршину"), длинные ключи раньше коротких
+        self._doctor_rx = [(re.compile(r'\s+'.join(rf'\b{re.escape(RX_NAME_ENDING.sub("", w))}\w*' for w in v.split())), doc)
+                           for doc in self.doctors for v in doc.variants]
+        self._doctor_rx.sort(key=lambda p: -len(p[0].pattern))
+        # позиции таблицы цен по первому слову: "implantium", "nobel", "кт" (из "Стоимость КТ")
+        self._price_rx = [(re.compile(rf'\b{re.escape(word)}\b'), row) for row in self.prices
+                          for word in RX_TITLE_TAIL.sub("", row.item).lower().replace("стоимость", "").split()[:1]]
+
+    @staticmethod
+    def _render_prices(rows: Sequence[PriceRow]) -> str:
+        """Строки цен одним параграфом, по секциям таблицы"""
+        sections: Dict[str, List[str]] = {}
+        for row in rows:
+            sections.setdefault(row.section, []).append(f"{row.item} — {row.price}")
+        return " ".join(f"{section}: {'; '.join(items)}." for section, items in sections.items())
+
+    @classmethod
+    def build(cls, chunks: Iterable, doctor_name_to_chunk: Mapping[str, object],
+              entity_chunks: Mapping[Tuple[str, str], object], kind_of: Callable[[str], str]) -> "FactStore":
+        """
+        Собирает факты из чанков и карт индексации.
+
+        Args:
+            chunks: Все чанки снимка (RetrievedChunk с посчитанными fields)
+            doctor_name_to_chunk: {вариант имени: карточка врача}
+            entity_chunks: {(тема, сущность): чанк}; ("implants", вид) — секции каталога имплантов
+            kind_of: Название вида имплантации → ключ из IMPLANT_KINDS (_slugify_implant_kind)
+
+        Returns:
+            FactStore
+        """
+        chunks = list(chunks)
+
+        # врачи: варианты имени сгруппированы по карточке
+        variants: Dict[int, List[str]] = {}
+        cards: Dict[int, object] = {}
+        for key, ch in doctor_name_to_chunk.items():
+            variants.setdefault(id(ch), []).append(key.lower().replace("ё", "е"))
+            cards[id(ch)] = ch
+        doctors = []
+        for cid, ch in cards.items():
+            meta = ch.metadata
+            name = (meta.get("h3_title") or meta.get("h2_title") or max(variants[cid], key=len)).strip().lstrip("# ")
+            lower = " ".join([ch.fields.lower, *[a.lower() for a in (meta.get("aliases") or []) if isinstance(a, str)]])
+            specialty = ", ".join(dict.fromkeys(RX_SPECIALTY.findall(lower)))
+            doctors.append(DoctorFact(name, tuple(sorted(variants[cid])), specialty,
+                                      "\n".join(_lines(ch.fields.display)), ch))
+
+        contacts, contacts_chunk = {}, None
+        prices: List[PriceRow] = []
+        kinds: Dict[str, ImplantKind] = {}
+        for ch in chunks:
+            doc_type = _document_type(ch)
+            if doc_type == "contacts" and not contacts:
+                parsed = parse_contacts(ch.fields.display)
+                if len(parsed) >= 2:
+                    contacts, contacts_chunk = parsed, ch
+            elif doc_type == "prices":
+                section = RX_TITLE_TAIL.sub("", (ch.metadata.get("h2_title") or _document_title(ch)).lstrip("# "))
+                for ln in ch.fields.display.splitlines():
+                    m = RX_PRICE_ROW.match(RX_EMPHASIS.sub("", ln))
+                    if m:
+                        prices.append(PriceRow(m.group(1), m.group(2), section, ch))
+            elif doc_type == "implants":
+                # вид имплантации — первая секция документа с названием вида
+                title = RX_TITLE_TAIL.sub("", _document_title(ch))
+                key = kind_of(title) if title else ""
+                if key in IMPLANT_KINDS and key not in kinds:
+                    kinds[key] = ImplantKind(key, title, cls._summary(ch), ch)
+        # секции каталога имплантов точнее документов
+        for key in IMPLANT_KINDS:
+            ch = entity_chunks.get(("implants", key))
+            if ch is not None:
+                title = (ch.metadata.get("h3_title") or ch.metadata.get("h2_title") or key).strip().lstrip("# ")
+                kinds[key] = ImplantKind(key, title, cls._summary(ch), ch)
+
+        return cls(doctors, contacts, contacts_chunk, prices, [kinds[k] for k in IMPLANT_KINDS if k in kinds])
+
+    @staticmethod
+    def _summary(chunk, limit: int = 160) -> str:
+        """Первое предложение описания (без заголовка секции)"""
+        lines = _lines(chunk.fields.display)
+        if not lines:
+            return ""
+        first = lines[0].lstrip("-•* ").strip()
+        m = RX_SENT.match(first)
+        first = (m.group(1) if m else first).rstrip(".")
+        if first[1:2].islower():
+            first = first[0].lower() + first[1:]
+        return first if len(first) <= limit else first[:limit].rsplit(" ", 1)[0] + "…"
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def match(self, query: str) -> Optional[FactAnswer]:
+        """
+        Анализ запроса: если это вопрос ровно к одному факту — готовый ответ.
+
+        Args:
+            query: Вопрос пользователя
+
+        Returns:
+            FactAnswer или None (запрос идёт обычным ретривалом)
+        """
+        q = (query or "").lower().replace("ё", "е").replace(" ", " ")
+        if not self.answers or len(re.findall(r'\w+', q)) > FACTS_MAX_WORDS:
+            return None
+
+        found: List[FactAnswer] = []
+
+        doctor = next((doc for rx, doc in self._doctor_rx if rx.search(q)), None)
+        answer = self.answers.get(("doctors", doctor.name)) if doctor is not None else None
+        if answer is not None:
+            found.append(answer)
+
+        fields = [keys for keys, rx in CONTACT_QUERIES if rx.search(q)]
+        if fields:
+            # "адрес и телефон" — вся карточка контактов
+            key = fields[0][0] if len(fields) == 1 and len(fields[0]) < len(CONTACT_LABELS) else "all"
+            if ("contacts", key) in self.answers:
+                found.append(self.answers[("contacts", key)])
+
+        if RX_PRICE_QUERY.search(q):
+            # цена того, чего нет в таблице (рассрочка, приём врача) — не наш вопрос целиком
+            if RX_PRICE_OTHER.search(q):
+                return None
+            rows = [row for rx, row in self._price_rx if rx.search(q)]
+            answer = self.answers.get(("prices", rows[0].item)) if len(rows) == 1 else None
+            if answer is not None:
+                found.append(answer)
+            elif "имплант" in q and ("prices", "implants") in self.answers:
+                found.append(self.answers[("prices", "implants")])
+
+        if RX_KINDS_QUERY.search(q) and ("implants", "kinds") in self.answers:
+            found.append(self.answers[("implants", "kinds")])
+
+        return found[0] if len(found) == 1 else None
@@ -1,3 +1,8 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Sequence
+
 import numpy as np
 HAS_FAISS = False
 try:
@@ -6,33 +11,338 @@ try:
 except Exception:
     _faiss = None
 
+# Тип векторного индекса: flat — точный; hnsw / ivf — приближённый (нужен faiss, иначе точный)
+DENSE_INDEX = os.getenv("DENSE_INDEX", "flat").lower()
+ANN_MIN_VECTORS = int(os.getenv("ANN_MIN_VECTORS", "20000"))  # меньше — точный поиск и так быстр
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))     # 0 — 4·√n
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+
 def _normalize(x: np.ndarray) -> np.ndarray:
     n = np.linalg.norm(x, axis=1, keepdims=True) + 1e-10
     return x / n
 
+# float32 -FLT_MAX: так FAISS заполняет пустые позиции выдачи для скалярного произведения
+_EMPTY_SIM = -np.finfo("float32").max
+# предел матрицы сходств на один блок запросов (элементов float32, ~64 МБ)
+_SIMS_BLOCK = 1 << 24
+
+
 class NumpyIndexFlatIP:
+    """
+    Точный поиск по скалярному произведению без FAISS (тот же интерфейс, что у faiss.IndexFlatIP).
+    Векторы хранятся как переданы: для косинуса вызывающий нормирует их и запросы сам (normalize_L2_inplace).
+    """
+
     def __init__(self, d: int):
         self.d = d
-        self.x = np.empty((0, d), dtype="float32")
+        self.ntotal = 0
+        self._buf = np.empty((0, d), dtype="float32")
+
+    @property
+    def x(self) -> np.ndarray:
+        """Добавленные векторы (n × d), представление без копии"""
+        return self._buf[:self.ntotal]
+
     def add(self, xb: np.ndarray):
-        self.x = _normalize(xb.astype("float32"))
+        """Дописывает векторы в конец; ёмкость растёт удвоением, без копии на каждое добавление"""
+        xb = np.asarray(xb, dtype="float32").reshape(-1, self.d)
+        n, need = self.ntotal, self.ntotal + xb.shape[0]
+        if need > self._buf.shape[0]:
+            buf = np.empty((max(need, 2 * self._buf.shape[0]), self.d), dtype="float32")
+            buf[:n] = self._buf[:n]
+            self._buf = buf
+        self._buf[n:need] = xb
+        # ntotal — последним: параллельный search видит только записанные строки
+        self.ntotal = need
+
+    def reset(self):
+        self.ntotal = 0
+        self._buf = np.empty((0, self.d), dtype="float32")
+
+    def reconstruct_n(self, i0: int, n: int) -> np.ndarray:
+        return np.array(self._buf[i0:min(i0 + n, self.ntotal)], dtype="float32")
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        if not 0 <= i < self.ntotal:
+            raise IndexError(f"id {i} вне индекса из {self.ntotal} векторов")
+        return np.array(self._buf[i], dtype="float32")
+
     def search(self, q: np.ndarray, k: int):
-        qn = _normalize(q.astype("float32"))
-        if self.x.size == 0:
-            return np.zeros((qn.shape[0], k), dtype="float32"), -np.ones((qn.shape[0], k), dtype="int64")
-        sims = qn @ self.x.T  # косинус через скалярное произведение
-        idx = np.argsort(-sims, axis=1)[:, :k]
-        dist = np.take_along_axis(sims, idx, axis=1).astype("float32")
-        return dist, idx.astype("int64")
+        """
+        Top-k по скалярному произведению для пакета запросов: argpartition + сортировка только k лучших.
+
+        Args:
+            q: Запросы (n × d) или один вектор (d,)
+            k: Сколько соседей вернуть на запрос
+
+        Returns:
+            (D, I) формы (n × k): сходства по убыванию и номера векторов; недостающие позиции — -FLT_MAX и -1
+        """
+        q = np.ascontiguousarray(q, dtype="float32").reshape(-1, self.d)
+        ntotal, buf = self.ntotal, self._buf
+        D = np.full((q.shape[0], k), _EMPTY_SIM, dtype="float32")
+        I = np.full((q.shape[0], k), -1, dtype="int64")
+        kk = min(k, ntotal)
+        if kk <= 0:
+            return D, I
+        xt = buf[:ntotal].T
+        step = max(1, _SIMS_BLOCK // ntotal)
+        for b in range(0, q.shape[0], step):
+            sims = q[b:b + step] @ xt
+            if kk < ntotal:
+                part = np.argpartition(sims, ntotal - kk, axis=1)[:, ntotal - kk:]
+                top = np.take_along_axis(sims, part, axis=1)
+            else:
+                part = np.broadcast_to(np.arange(ntotal), sims.shape)
+                top = sims
+            order = np.argsort(-top, axis=1, kind="stable")
+            I[b:b + step, :kk] = np.take_along_axis(part, order, axis=1)
+            D[b:b + step, :kk] = np.take_along_axis(top, order, axis=1)
+        return D, I
+
+
+class NumpyIndexIDMap:
+    """
+    Векторы с внешними int64-id поверх NumpyIndexFlatIP (интерфейс faiss.IndexIDMap2):
+    search возвращает id, а не номера строк. Менять индекс можно только до публикации в снимок.
+    """
+
+    def __init__(self, d: int):
+        self.d = d
+        self.index = NumpyIndexFlatIP(d)
+        self._ids = np.empty(0, dtype="int64")
+        self._rows: Dict[int, int] = {}
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def id_array(self) -> np.ndarray:
+        """id в порядке строк"""
+        return np.array(self._ids[:self.ntotal])
+
+    def add_with_ids(self, xb: np.ndarray, ids: Sequence[int]):
+        ids = np.asarray(ids, dtype="int64").reshape(-1)
+        xb = np.asarray(xb, dtype="float32").reshape(-1, self.d)
+        if xb.shape[0] != ids.shape[0]:
+            raise ValueError(f"векторов {xb.shape[0]}, а id {ids.shape[0]}")
+        if len(set(ids.tolist())) != len(ids) or any(int(i) in self._rows for i in ids):
+            raise ValueError("id уже есть в индексе (для замены — update_ids)")
+        n, need = self.ntotal, self.ntotal + ids.shape[0]
+        if need > self._ids.shape[0]:
+            buf = np.empty(max(need, 2 * self._ids.shape[0]), dtype="int64")
+            buf[:n] = self._ids[:n]
+            self._ids = buf
+        self._ids[n:need] = ids
+        self._rows.update((int(i), n + j) for j, i in enumerate(ids))
+        self.index.add(xb)
+
+    def remove_ids(self, ids: Sequence[int]) -> int:
+        """Удаляет векторы по id (отсутствующие пропускаются); порядок остальных строк сохраняется"""
+        rows = [self._rows[int(i)] for i in np.asarray(ids, dtype="int64").reshape(-1) if int(i) in self._rows]
+        if not rows:
+            return 0
+        n = self.ntotal
+        keep = np.ones(n, dtype=bool)
+        keep[rows] = False
+        m = int(keep.sum())
+        self.index._buf[:m] = self.index._buf[:n][keep]
+        self._ids[:m] = self._ids[:n][keep]
+        self.index.ntotal = m
+        self._rows = {int(i): j for j, i in enumerate(self._ids[:m])}
+        return n - m
+
+    def reset(self):
+        self.index.reset()
+        self._ids = np.empty(0, dtype="int64")
+        self._rows = {}
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        row = self._rows.get(int(key))
+        if row is None:
+            raise KeyError(f"id {key} нет в индексе")
+        return self.index.reconstruct(row)
+
+    def search(self, q: np.ndarray, k: int):
+        D, I = self.index.search(q, k)
+        return D, np.where(I >= 0, self._ids[np.maximum(I, 0)], -1)
+
 
 def IndexFlatIP(d: int):
     if HAS_FAISS:
         return _faiss.IndexFlatIP(d)
     return NumpyIndexFlatIP(d)
 
+def IndexIDMap(d: int):
+    """Точный поиск по скалярному произведению с внешними int64-id (faiss.IndexIDMap2 или NumPy)."""
+    if HAS_FAISS:
+        return _faiss.IndexIDMap2(_faiss.IndexFlatIP(d))
+    return NumpyIndexIDMap(d)
+
 def normalize_L2_inplace(x: np.ndarray):
     if HAS_FAISS:
         _faiss.normalize_L2(x)
     else:
         x[:] = _normalize(x)
 
+
+def _is_id_map(index) -> bool:
+    return isinstance(index, NumpyIndexIDMap) or (HAS_FAISS and isinstance(index, _faiss.IndexIDMap))
+
+
+def _is_ivf(index) -> bool:
+    return HAS_FAISS and isinstance(index, _faiss.IndexIVF)
+
+
+def index_kind(index) -> str:
+    """flat / hnsw / ivf — что на самом деле построено (make_index может откатиться к flat)"""
+    if _is_ivf(index):
+        return "ivf"
+    if HAS_FAISS and _is_id_map(index) and isinstance(_faiss.downcast_index(index.index), _faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def tune_index(index, ef_search: int | None = None, nprobe: int | None = None):
+    """Параметры поиска ANN: efSearch у HNSW, nprobe у IVF (точность против скорости); flat не меняется."""
+    kind = index_kind(index)
+    if kind == "hnsw" and ef_search:
+        _faiss.downcast_index(index.index).hnsw.efSearch = ef_search
+    elif kind == "ivf" and nprobe:
+        index.nprobe = min(nprobe, index.nlist)
+    return index
+
+
+def make_index(xb: np.ndarray, ids: Sequence[int], kind: str | None = None):
+    """
+    Векторный индекс с внешними id нужного типа, сразу с векторами (IVF обучается на них же).
+
+    flat — точный (IndexIDMap): remove/update/save полностью.
+    hnsw — IndexHNSWFlat под IndexIDMap2: только добавление и поиск (faiss не удаляет из HNSW).
+    ivf  — IndexIVFFlat со своими id и hash-картой: remove_ids и update_ids работают.
+    Без faiss или при числе векторов меньше ANN_MIN_VECTORS — всегда flat.
+
+    Args:
+        xb: Нормированные векторы (n × d), float32
+        ids: int64-id строк (vector_id)
+        kind: flat / hnsw / ivf (None — DENSE_INDEX)
+
+    Returns:
+        Индекс с интерфейсом faiss (search возвращает id)
+    """
+    kind = (kind or DENSE_INDEX).lower()
+    if kind not in ("flat", "hnsw", "ivf"):
+        raise ValueError(f"неизвестный тип индекса: {kind}")
+    xb = np.ascontiguousarray(xb, dtype="float32")
+    ids = np.ascontiguousarray(ids, dtype="int64").reshape(-1)
+    n, d = xb.shape
+    if kind != "flat" and not HAS_FAISS:
+        print(f"⚠️ DENSE_INDEX={kind} требует faiss — используем точный поиск")
+        kind = "flat"
+    elif kind != "flat" and n < ANN_MIN_VECTORS:
+        kind = "flat"
+
+    if kind == "hnsw":
+        hnsw = _faiss.IndexHNSWFlat(d, HNSW_M, _faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index = _faiss.IndexIDMap2(hnsw)
+        index.add_with_ids(xb, ids)
+        return tune_index(index, ef_search=HNSW_EF_SEARCH)
+    if kind == "ivf":
+        # ~39+ точек обучения на центроид, иначе k-means ругается и центроиды плохие
+        nlist = max(1, min(IVF_NLIST or int(4 * np.sqrt(n)), n // 39))
+        index = _faiss.IndexIVFFlat(_faiss.IndexFlatIP(d), d, nlist, _faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+        index.set_direct_map_type(_faiss.DirectMap.Hashtable)
+        index.add_with_ids(xb, ids)
+        return tune_index(index, nprobe=IVF_NPROBE)
+    index = IndexIDMap(d)
+    if n:
+        index.add_with_ids(xb, ids)
+    return index
+
+
+def vector_id(key: str) -> int:
+    """Стабильный int64-id вектора по строковому ключу (id чанка): не зависит от порядка и процесса."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") & 0x7FFF_FFFF_FFFF_FFFF
+
+
+def id_array(index) -> np.ndarray:
+    """id векторов ID-индекса в порядке строк, int64."""
+    if isinstance(index, NumpyIndexIDMap):
+        return index.id_array()
+    if _is_ivf(index):
+        inv = index.invlists
+        parts = [_faiss.rev_swig_ptr(inv.get_ids(l), inv.list_size(l)).copy()
+                 for l in range(index.nlist) if inv.list_size(l)]
+        return np.concatenate(parts).astype("int64") if parts else np.empty(0, dtype="int64")
+    return _faiss.vector_to_array(index.id_map).astype("int64")
+
+
+def reconstruct_all(index) -> np.ndarray:
+    """Все векторы индекса одной матрицей (n × d), float32; у ID-индекса — в порядке id_array."""
+    if isinstance(index, NumpyIndexIDMap):
+        return index.index.reconstruct_n(0, index.ntotal)
+    if _is_ivf(index):
+        ids = id_array(index)
+        return index.reconstruct_batch(ids) if len(ids) else np.empty((0, index.d), dtype="float32")
+    if _is_id_map(index):
+        return _faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def reconstruct_ids(index, ids: Sequence[int]) -> np.ndarray:
+    """
+    Векторы ID-индекса в заданном порядке id.
+
+    Raises:
+        KeyError: какого-то id нет в индексе
+    """
+    rows = {int(i): j for j, i in enumerate(id_array(index))}
+    vectors = reconstruct_all(index)
+    return vectors[[rows[int(i)] for i in ids]] if len(ids) else vectors[:0]
+
+
+def update_ids(index, xb: np.ndarray, ids: Sequence[int]) -> None:
+    """
+    Заменяет векторы по id (новые id добавляются). В NumPy строки перезаписываются на месте,
+    в FAISS — remove_ids + add_with_ids (плоский индекс не умеет писать в строку; HNSW не умеет удалять).
+    """
+    ids = np.asarray(ids, dtype="int64").reshape(-1)
+    xb = np.ascontiguousarray(xb, dtype="float32").reshape(-1, index.d)
+    if isinstance(index, NumpyIndexIDMap):
+        fresh = [j for j, i in enumerate(ids) if int(i) not in index._rows]
+        for j, i in enumerate(ids):
+            if int(i) in index._rows:
+                index.index._buf[index._rows[int(i)]] = xb[j]
+        if fresh:
+            index.add_with_ids(xb[fresh], ids[fresh])
+        return
+    if index_kind(index) == "hnsw":
+        raise RuntimeError("HNSW не поддерживает удаление векторов — пересоберите индекс через make_index")
+    index.remove_ids(ids)
+    index.add_with_ids(xb, ids)
+
+
+def save_index(index, path) -> Path:
+    """
+    Сохраняет ID-индекс в .npz (id + векторы): формат общий для FAISS и NumPy,
+    файл, записанный на машине с FAISS, читается и без него. Запись атомарная.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, ids=id_array(index), vectors=reconstruct_all(index))
+    os.replace(tmp, path)
+    return path
+
+
+def load_index(path, kind: str | None = None):
+    """Читает ID-индекс, сохранённый save_index, в доступный бэкенд (тип — как у make_index)."""
+    with np.load(Path(path)) as data:
+        ids, vectors = data["ids"], data["vectors"]
+    return make_index(vectors, ids, kind)
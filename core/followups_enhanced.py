@@ -5,9 +5,12 @@
 """
 
 import re
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from .md_loader import parse_frontmatter, extract_followups_from_frontmatter
 
+# сколько followups документа хранить на чанке: 3 для показа + 1 на случай ссылки на текущий раздел
+INDEX_FOLLOWUPS_LIMIT = 4
+
 
 def generate_followups_from_content(
     content: str, 
@@ -43,6 +46,45 @@ def generate_followups_from_content(
     return followups
 
 
+def followups_for_document(doc, limit: int = INDEX_FOLLOWUPS_LIMIT) -> Tuple[Dict[str, Any], ...]:
+    """
+    Followups документа для индексации: сначала из frontmatter, затем по H2-секциям
+    (jump на настоящий h2_id секции). Считаются один раз при разборе файла и хранятся на чанках.
+
+    Args:
+        doc: Разобранный документ (core.md_document.ParsedDocument)
+        limit: Максимальное количество followups
+
+    Returns:
+        Кортеж followups в формате API (общий для всех чанков файла)
+    """
+    frontmatter = doc.frontmatter
+    followups = []
+    for f in extract_followups_from_frontmatter(frontmatter):
+        # во frontmatter часто только label и h2_id — вопрос строим по подписи
+        if not f["query"] and f["label"]:
+            f["query"] = create_question_from_title(f["label"], frontmatter) or ""
+        followups.append(f)
+
+    targets = {f["jump"]["h2_id"] for f in followups}
+    for section in doc.headings:
+        if len(followups) >= limit:
+            break
+        if section.h2_id in targets:
+            continue
+        # тело секции без строк заголовков ## / ###; короткие секции пропускаем
+        body = "\n".join(b.text.split("\n", 1)[1] if "\n" in b.text else "" for b in section.blocks).strip()
+        if len(body) < 50:
+            continue
+        followup = create_followup_from_section(
+            {"title": section.title, "body": body, "h2_id": section.h2_id}, frontmatter)
+        if followup:
+            targets.add(section.h2_id)
+            followups.append(followup)
+
+    return tuple(followups[:limit])
+
+
 def extract_h2_sections(content: str) -> List[Dict[str, str]]:
     """
     Извлекает секции H2 из контента.
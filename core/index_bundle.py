@@ -0,0 +1,293 @@
+# core/index_bundle.py
+"""
+Версионированный бандл индексов, собранный офлайн (tools/build_index.py).
+
+Раскладка:
+    <root>/CURRENT                 — id актуальной сборки
+    <root>/<build_id>/manifest.json
+    <root>/<build_id>/embeddings.npy    — нормированная матрица (n × d), float32
+    <root>/<build_id>/texts.bin         — тексты чанков подряд в UTF-8
+    <root>/<build_id>/text_offsets.npy  — смещения (n + 1), int64
+    <root>/<build_id>/chunks.json       — метаданные чанков (общие поля файла + отличия)
+    <root>/<build_id>/bm25.json         — статистики BM25Okapi
+    <root>/<build_id>/maps.json         — алиасы, H2, сущности, врачи
+
+Сервер читает бандл за миллисекунды: матрица открывается через np.load(mmap_mode='r'),
+тексты — ареной поверх texts.bin (core/text_arena.py), без строки на каждый чанк.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from core.text_arena import TextArena
+
+BUNDLE_FORMAT = 1
+BASE_DIR = Path(__file__).resolve().parents[1]
+INDEX_BUNDLE_DIR = Path(os.getenv("INDEX_BUNDLE_DIR", BASE_DIR / "index_bundle"))
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "text_offsets.npy"
+CHUNKS_FILE = "chunks.json"
+BM25_FILE = "bm25.json"
+MAPS_FILE = "maps.json"
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_hashes(base_dir: Path, files: Iterable[Path]) -> Dict[str, str]:
+    """
+    Хэши исходников бандла (md-файлы корпуса) с путями относительно base_dir.
+
+    Args:
+        base_dir: Корень проекта
+        files: Файлы-источники
+
+    Returns:
+        Словарь {относительный путь: sha256}
+    """
+    out = {}
+    for p in sorted(Path(f) for f in files):
+        try:
+            rel = p.resolve().relative_to(base_dir.resolve()).as_posix()
+        except ValueError:
+            rel = p.as_posix()
+        out[rel] = sha256_file(p)
+    return out
+
+
+def _json_dump(obj: Any, path: Path) -> None:
+    # date/datetime из YAML-фронтматтера сохраняем строкой
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _json_load(path: Path) -> Any:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ---- BM25 ----
+
+def bm25_stats(bm25) -> Dict[str, Any]:
+    """Статистики BM25Okapi (без токенизатора) для сериализации."""
+    return {k: v for k, v in vars(bm25).items() if k != "tokenizer"}
+
+
+def bm25_from_stats(stats: Dict[str, Any]):
+    """Восстанавливает BM25Okapi из статистик без повторного прохода по корпусу."""
+    from rank_bm25 import BM25Okapi
+    bm25 = BM25Okapi.__new__(BM25Okapi)
+    bm25.__dict__.update(stats)
+    bm25.tokenizer = None
+    return bm25
+
+
+# ---- Метаданные чанков ----
+
+def pack_chunk_records(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Компактная форма метаданных: общий словарь на файл + отличия на чанк.
+
+    Args:
+        records: [{"id", "file_name", "meta": dict[, "document": dict]}, ...] в порядке чанков
+
+    Returns:
+        {"files": {file_name: base_meta}, "chunks": [{"id","file","meta"[,"del"]}],
+         "documents": {file_name: фронтматтер файла}}
+    """
+    files: Dict[str, Dict[str, Any]] = {}
+    documents: Dict[str, Dict[str, Any]] = {}
+    chunks = []
+    for rec in records:
+        if "document" in rec:
+            documents.setdefault(rec["file_name"], rec["document"])
+        meta = rec["meta"]
+        base = files.setdefault(rec["file_name"], meta)
+        diff = {k: v for k, v in meta.items() if k not in base or base[k] != v}
+        item = {"id": rec["id"], "file": rec["file_name"], "meta": diff}
+        dropped = [k for k in base if k not in meta]
+        if dropped:
+            item["del"] = dropped
+        chunks.append(item)
+    return {"files": files, "chunks": chunks, "documents": documents}
+
+
+def unpack_chunk_records(packed: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Обратная операция к pack_chunk_records."""
+    files = packed["files"]
+    documents = packed.get("documents", {})
+    out = []
+    for item in packed["chunks"]:
+        meta = {**files[item["file"]], **item["meta"]}
+        for k in item.get("del", ()):
+            meta.pop(k, None)
+        rec = {"id": item["id"], "file_name": item["file"], "meta": meta}
+        if item["file"] in documents:
+            rec["document"] = documents[item["file"]]
+        out.append(rec)
+    return out
+
+
+# ---- Запись / чтение ----
+
+def write_bundle(
+    root: Path,
+    *,
+    texts: List[str] | TextArena,
+    records: List[Dict[str, Any]],
+    embeddings: Optional[np.ndarray],
+    bm25: Optional[Dict[str, Any]],
+    maps: Dict[str, Any],
+    sources: Dict[str, str],
+    embed_model: str,
+) -> Path:
+    """
+    Пишет новую сборку бандла и атомарно переключает CURRENT на неё.
+
+    Args:
+        root: Корневая папка бандлов
+        texts: Тексты чанков (список или готовая арена)
+        records: Метаданные чанков (см. pack_chunk_records)
+        embeddings: Нормированная матрица эмбеддингов или None (только BM25)
+        bm25: Статистики BM25 (bm25_stats) или None
+        maps: Карты алиасов/H2/сущностей/врачей (чанки — индексами)
+        sources: Хэши исходников (source_hashes)
+        embed_model: Модель эмбеддингов
+
+    Returns:
+        Путь к папке сборки
+    """
+    root = Path(root)
+    src_digest = hashlib.sha256(json.dumps(sources, sort_keys=True).encode("utf-8")).hexdigest()
+    build_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ") + "-" + src_digest[:8]
+    out = root / build_id
+    out.mkdir(parents=True, exist_ok=True)
+
+    arena = texts if isinstance(texts, TextArena) else TextArena.from_texts(texts)
+    arena.write(out / TEXTS_FILE, out / OFFSETS_FILE)
+
+    if embeddings is not None:
+        np.save(out / EMBEDDINGS_FILE, np.ascontiguousarray(embeddings, dtype="float32"))
+    _json_dump(pack_chunk_records(records), out / CHUNKS_FILE)
+    if bm25 is not None:
+        _json_dump(bm25, out / BM25_FILE)
+    _json_dump(maps, out / MAPS_FILE)
+
+    files = [p for p in sorted(out.iterdir()) if p.name != MANIFEST_FILE]
+    artifacts = {p.name: sha256_file(p) for p in files}
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "build_id": build_id,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "embed_model": embed_model,
+        "n_chunks": len(arena),
+        "dim": int(embeddings.shape[1]) if embeddings is not None else None,
+        "sources": sources,
+        "artifacts": artifacts,
+        "sizes": {p.name: p.stat().st_size for p in files},
+    }
+    _json_dump(manifest, out / MANIFEST_FILE)
+
+    tmp = root / (CURRENT_FILE + ".tmp")
+    tmp.write_text(build_id, encoding="utf-8")
+    os.replace(tmp, root / CURRENT_FILE)
+    return out
+
+
+class IndexBundle:
+    """
+    Прочитанный бандл: матрица и тексты — memory-mapped, остальное — в памяти.
+    При открытии сверяются размеры файлов и формы массивов с манифестом (дёшево, без чтения файлов);
+    полная сверка sha256 — verify() (tools/build_index.py --check).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.manifest = _json_load(self.path / MANIFEST_FILE)
+        if self.manifest.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"unsupported bundle format: {self.manifest.get('format')}")
+        self._check_sizes()
+
+        emb_path = self.path / EMBEDDINGS_FILE
+        self.embeddings = np.load(emb_path, mmap_mode="r") if emb_path.exists() else None
+
+        self.arena = TextArena.open(self.path / TEXTS_FILE, self.path / OFFSETS_FILE)
+
+        self.records = unpack_chunk_records(_json_load(self.path / CHUNKS_FILE))
+        bm25_path = self.path / BM25_FILE
+        self.bm25 = _json_load(bm25_path) if bm25_path.exists() else None
+        self.maps = _json_load(self.path / MAPS_FILE)
+        self._check_shapes()
+
+    def _check_sizes(self) -> None:
+        """Все файлы манифеста на месте и того же размера, что при сборке"""
+        sizes = self.manifest.get("sizes") or {}
+        for name in self.manifest.get("artifacts", {}):
+            p = self.path / name
+            if not p.exists():
+                raise ValueError(f"bundle artifact missing: {name}")
+            if name in sizes and p.stat().st_size != sizes[name]:
+                raise ValueError(f"bundle artifact size mismatch: {name} ({p.stat().st_size} != {sizes[name]})")
+
+    def _check_shapes(self) -> None:
+        """Число чанков и размерность из манифеста совпадают с прочитанными массивами"""
+        n, dim = self.manifest.get("n_chunks"), self.manifest.get("dim")
+        if len(self.arena) != n or len(self.records) != n:
+            raise ValueError(f"bundle n_chunks mismatch: manifest {n}, texts {len(self.arena)}, "
+                             f"chunks {len(self.records)}")
+        if self.arena.nbytes != (self.path / TEXTS_FILE).stat().st_size:
+            raise ValueError("bundle texts.bin does not match text_offsets.npy")
+        if (self.embeddings is None) != (dim is None):
+            raise ValueError(f"bundle embeddings mismatch: manifest dim {dim}")
+        if self.embeddings is not None:
+            # строки матрицы: чанки, затем вопросы doc2query
+            rows = n + len(self.maps.get("doc2query", []))
+            if self.embeddings.ndim != 2 or self.embeddings.shape != (rows, dim):
+                raise ValueError(f"bundle embeddings shape {self.embeddings.shape}, expected {(rows, dim)}")
+
+    def verify(self) -> List[str]:
+        """
+        Полная сверка файлов с sha256 из манифеста (читает бандл целиком).
+
+        Returns:
+            Имена файлов, не совпавших с манифестом (пусто — бандл цел)
+        """
+        return [name for name, digest in self.manifest.get("artifacts", {}).items()
+                if sha256_file(self.path / name) != digest]
+
+    @property
+    def texts(self) -> List[str]:
+        """Тексты чанков строками (сверка, утилиты; сервер читает их из арены)"""
+        return self.arena.texts()
+
+    @property
+    def build_id(self) -> str:
+        return self.manifest["build_id"]
+
+    def is_stale(self, current_sources: Dict[str, str]) -> bool:
+        """True, если исходники изменились после сборки."""
+        return self.manifest.get("sources") != current_sources
+
+
+def current_bundle_path(root: Path = INDEX_BUNDLE_DIR) -> Optional[Path]:
+    """Путь к актуальной сборке по файлу CURRENT (или None)."""
+    pointer = Path(root) / CURRENT_FILE
+    if not pointer.exists():
+        return None
+    path = Path(root) / pointer.read_text(encoding="utf-8").strip()
+    return path if (path / MANIFEST_FILE).exists() else None
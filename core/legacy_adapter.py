@@ -23,7 +23,7 @@ def safe_followups(fm: Dict[str, Any], md_body: str) -> List[Dict[str, Any]]:
     
     try:
         from .followups_enhanced import get_smart_followups
-        smart = get_smart_followups(md_body, fm)
+        smart = get_smart_followups(md_body, fm, "")
     except Exception:
         smart = []
     
@@ -172,16 +172,13 @@ def process_query_with_new_system(
     # Извлекаем followups (если включены)
     followups = []
     if feature_flags.is_enabled("ENABLE_FOLLOWUPS"):
-        from .followups_enhanced import get_smart_followups
         from .followups import filter_followups
         
-        # Получаем контент для генерации followups
-        content = ""
-        if hasattr(primary_chunk, 'text'):
-            content = primary_chunk.text
-        
-        # Безопасное получение followups
-        followups = safe_followups(frontmatter, content)
+        # Followups документа посчитаны при индексации (followups_for_document) и лежат на чанке
+        followups = getattr(primary_chunk, 'followups', None)
+        if followups is None:
+            # чанк не из индекса — собираем по тексту, как раньше
+            followups = safe_followups(frontmatter, getattr(primary_chunk, 'text', "") or "")
         
         # 3) Убрать ссылку на текущий раздел (если это ответ по доп-H2)
         current_h2_id = None
@@ -0,0 +1,232 @@
+# core/md_document.py
+"""
+Разбор markdown-документа корпуса за один проход.
+ParsedDocument содержит фронтматтер, тело, дерево секций H2/H3 (id, заголовки, локальные алиасы),
+карточки врачей и позиции каталога. Фильтр служебных файлов, карты H2/алиасов, чанкинг
+и индексы врачей/каталога читают этот объект, а не разбирают текст заново.
+"""
+
+import re
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from core.md_loader import parse_frontmatter
+
+RX_H2_SPLIT = re.compile(r'(?m)^\s*##\s+')
+RX_H3_SPLIT = re.compile(r'(?m)^\s*###\s+')
+RX_HEADING_ID = re.compile(r'\{#([^}]+)\}')
+RX_HEADING_ID_STRIP = re.compile(r'\s*\{#[^}]+\}\s*')
+RX_ALIASES_COMMENT = re.compile(r'<!--\s*aliases:\s*\[(.*?)\]\s*-->', re.IGNORECASE)
+RX_CATALOG_ALIASES = re.compile(r'<!--\s*aliases:\s*\[(.*?)\]\s*-->')
+RX_PERSON = re.compile(r'^[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2}$')
+
+
+def slugify(s: str) -> str:
+    s = unicodedata.normalize("NFKD", s.lower().strip())
+    s = re.sub(r"\s+", "-", s)
+    s = re.sub(r"[^a-z0-9\-а-яё]", "", s)
+    return s
+
+
+def normalize_text(text: str) -> str:
+    # NBSP -> обычный пробел; CRLF -> LF
+    return text.replace('\u00A0', ' ').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _person(title: str) -> Optional[str]:
+    """'Фамилия Имя [Отчество]' из заголовка или None"""
+    title = (title or "").strip()
+    return title if RX_PERSON.match(title) else None
+
+
+class Block:
+    """
+    Единица чанкинга: вся H2-секция, её часть до первого H3 (преамбула) или одна H3-подсекция.
+    Слишком длинный блок заменяется окнами (core/splitter.py) — у окна есть parent_id.
+    """
+
+    def __init__(self, chunk_id: str, text: str, block_id: str, h2_id: str, h2_title: str,
+                 h3_id: str = "", h3_title: str = "", aliases: Optional[List[str]] = None,
+                 doctor: Optional[str] = None, catalog_aliases: Optional[List[str]] = None,
+                 parent_id: Optional[str] = None, window: int = 0, overlap: int = 0):
+        self.chunk_id = chunk_id
+        self.text = text
+        self.block_id = block_id
+        self.h2_id = h2_id
+        self.h2_title = h2_title
+        self.h3_id = h3_id
+        self.h3_title = h3_title
+        self.aliases = aliases or []
+        self.doctor = doctor                      # ФИО из заголовка блока (карточка врача)
+        self.catalog_aliases = catalog_aliases    # для H3: алиасы позиции каталога (None — не H3)
+        self.parent_id = parent_id                # окно длинного блока: id блока целиком
+        self.window = window                      # номер окна
+        self.overlap = overlap                    # символов тела, повторённых из предыдущего окна
+
+    @property
+    def catalog_name(self) -> Optional[str]:
+        """Название позиции каталога — заголовок H3"""
+        return self.h3_title.strip() if self.catalog_aliases is not None else None
+
+    def metadata(self) -> Dict[str, Any]:
+        """Поля чанка, которые сливаются с фронтматтером файла"""
+        meta = {
+            "h2_id": self.h2_id,
+            "h2_title": self.h2_title,
+            "h3_id": self.h3_id,
+            "h3_title": self.h3_title,
+            "aliases": self.aliases,
+            "block_id": self.block_id,
+        }
+        if self.parent_id:
+            meta.update(parent_id=self.parent_id, window=self.window, overlap=self.overlap)
+        return meta
+
+
+class Section:
+    """H2-секция: заголовок, id ({#id} или slug), локальные алиасы и блоки для чанкинга."""
+
+    def __init__(self, index: int, title: str, h2_id: str, aliases: List[str], is_heading: bool):
+        self.index = index
+        self.title = title
+        self.h2_id = h2_id
+        self.aliases = aliases
+        self.is_heading = is_heading    # False — текст до первого ## (у него нет заголовка H2)
+        self.blocks: List[Block] = []
+
+
+def parse_sections(content: str, file_name: str) -> List[Section]:
+    """
+    Режет тело документа на секции ## и подсекции ### (один проход по тексту).
+
+    Args:
+        content: Тело документа без фронтматтера
+        file_name: Имя файла (префикс id чанков)
+
+    Returns:
+        Список Section в порядке документа
+    """
+    sections = []
+    for block_idx, block in enumerate(RX_H2_SPLIT.split(content)):
+        block = block.strip()
+        if not block:
+            continue
+
+        lines = block.splitlines()
+        h2_title = lines[0]
+        h2_body = '\n'.join(lines[1:])
+
+        # {#id} в заголовке, иначе slug заголовка
+        id_match = RX_HEADING_ID.search(h2_title)
+        if id_match:
+            h2_id = id_match.group(1)
+            h2_title = RX_HEADING_ID_STRIP.sub('', h2_title).strip()
+        else:
+            h2_id = slugify(h2_title)
+
+        # локальные алиасы — комментарий в первой строке после заголовка
+        h2_aliases = []
+        if len(lines) > 1:
+            alias_match = RX_ALIASES_COMMENT.search(lines[1].strip())
+            if alias_match:
+                h2_aliases = [a.strip().strip('"\'') for a in re.split(r',\s*', alias_match.group(1)) if a.strip()]
+
+        section = Section(block_idx, h2_title, h2_id, h2_aliases, is_heading=block_idx > 0)
+        h2_doctor = _person(h2_title)
+
+        h3_blocks = RX_H3_SPLIT.split(block)
+        if len(h3_blocks) > 1:
+            # текст до первого ### сохраняем отдельным блоком
+            if h3_blocks[0].strip():
+                section.blocks.append(Block(
+                    chunk_id=f"{file_name}#{h2_id}_preamble",
+                    text=f"## {h2_title}\n{h3_blocks[0].strip()}".strip(),
+                    block_id=f"{file_name}#{block_idx:04d}",
+                    h2_id=h2_id, h2_title=h2_title, aliases=h2_aliases, doctor=h2_doctor,
+                ))
+
+            for h3_idx, h3 in enumerate(h3_blocks[1:], 1):
+                h3 = h3.strip()
+                if not h3:
+                    continue
+                lines = h3.splitlines()
+                h3_title = lines[0]
+                h3_body = '\n'.join(lines[1:])
+                h3_id = slugify(h3_title)
+                catalog = RX_CATALOG_ALIASES.search(h3_body)
+                section.blocks.append(Block(
+                    chunk_id=f"{file_name}#{h2_id}_{h3_id}",
+                    text=f"## {h2_title}\n### {h3_title}\n{h3_body}".strip(),
+                    block_id=f"{file_name}#{block_idx:04d}_{h3_idx:04d}",
+                    h2_id=h2_id, h2_title=h2_title, h3_id=h3_id, h3_title=h3_title, aliases=h2_aliases,
+                    doctor=h2_doctor or _person(h3_title),
+                    catalog_aliases=[a.strip() for a in catalog.group(1).split(',')] if catalog else [],
+                ))
+        else:
+            # H3 нет — вся H2-секция одним блоком
+            section.blocks.append(Block(
+                chunk_id=f"{file_name}#{h2_id}",
+                text=f"## {h2_title}\n{h2_body}".strip(),
+                block_id=f"{file_name}#{block_idx:04d}",
+                h2_id=h2_id, h2_title=h2_title, aliases=h2_aliases, doctor=h2_doctor,
+            ))
+        sections.append(section)
+    return sections
+
+
+class ParsedDocument:
+    """Один md-файл, разобранный за один проход."""
+
+    def __init__(self, path: Path | str, text: str):
+        """
+        Args:
+            path: Путь к файлу
+            text: Содержимое файла
+        """
+        self.path = Path(path)
+        self.file_name = self.path.name
+        self.raw = text
+        self.text = normalize_text(text)
+        fm, body = parse_frontmatter(self.text)
+        # фронтматтер-не-словарь (строка, список) считаем отсутствующим
+        self.frontmatter: Dict[str, Any] = fm if isinstance(fm, dict) else {}
+        self.body = body.strip()
+        self.sections = parse_sections(self.body, self.file_name)
+        from core.splitter import split_block
+        # длинные блоки — окнами с перекрытием (CHUNK_MAX_TOKENS)
+        self._blocks = [w for s in self.sections for b in s.blocks for w in split_block(b)]
+
+    @property
+    def blocks(self) -> List[Block]:
+        """Все блоки для чанкинга в порядке документа (длинные — окнами)"""
+        return self._blocks
+
+    @property
+    def headings(self) -> List[Section]:
+        """Настоящие H2-секции (без текста до первого ##)"""
+        return [s for s in self.sections if s.is_heading]
+
+    def doctor_names(self) -> List[str]:
+        """
+        Имена врачей из строк вида 'Фамилия Имя [Отчество]' (в т.ч. заголовков ## / ###).
+
+        Returns:
+            Отсортированный список: полное ФИО, фамилия, 'Фамилия Имя', 'Имя Фамилия'
+        """
+        names = set()
+        for line in self.body.split('\n'):
+            line = line.strip()
+            if line.startswith('### '):
+                line = line[4:]
+            elif line.startswith('## '):
+                line = line[3:]
+            if RX_PERSON.match(line):
+                parts = line.split()
+                names.update({line, parts[0], f"{parts[0]} {parts[1]}", f"{parts[1]} {parts[0]}"})
+        return sorted(names)
+
+
+def parse_document(path: Path | str, text: str) -> ParsedDocument:
+    """Разбирает md-файл: фронтматтер, тело, секции, блоки"""
+    return ParsedDocument(path, text)
@@ -16,13 +16,14 @@ def looks_like_fact_sheet(text: str) -> bool:
     if FACT_SIGNS.search(t):    return True
     return False
 
-def is_index_like(path: Path, text: str) -> bool:
+def is_index_like(path: Path, text: str, frontmatter: dict | None = None) -> bool:
     """
     Возвращает True, если файл следует считать «мусорным индексом» и НЕ индексировать.
     Логика:
       - если doc_type один из факт-типов — индексируем всегда;
       - иначе отбрасываем только ОЧЕНЬ короткие тексты (<80) без сигналов фактов;
       - короткие 80..120 оставляем, если видим факты (цифры/₽/телефон/адрес).
+    frontmatter — уже разобранный фронтматтер (ParsedDocument), чтобы не парсить YAML повторно.
     """
     name = path.name.lower()
     if name in ALIASES:
@@ -31,7 +32,7 @@ def is_index_like(path: Path, text: str) -> bool:
         return True
     
     t = (text or "")
-    fm = _frontmatter(t) or {}
+    fm = (frontmatter if frontmatter is not None else _frontmatter(t)) or {}
     doc_type = str(fm.get("doc_type", "")).lower()
     keep_types = {"contacts","prices","warranty","safety","doctors","consultation"}
     if doc_type in keep_types:
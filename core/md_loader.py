@@ -134,20 +134,22 @@ def build_index_text(frontmatter: dict, body_md: str, h2_texts: list[str]) -> st
 ALIAS_MAP = {}
 
 
-def register_aliases(frontmatter: dict, file_path: str):
+def register_aliases(frontmatter: dict, file_path: str, target: Optional[dict] = None):
     """
     Регистрирует алиасы в глобальной карте для fallback поиска.
     
     Args:
         frontmatter: Метаданные из YAML
         file_path: Путь к файлу
+        target: Куда писать вместо ALIAS_MAP (вклад одного файла при переиндексации)
     """
     primary_h2_id = frontmatter.get("primary_h2_id")
     aliases = frontmatter.get("aliases") or []
+    alias_map = ALIAS_MAP if target is None else target
     
     for alias in aliases:
         normalized_alias = normalize_ru(alias)
-        ALIAS_MAP[normalized_alias] = {
+        alias_map[normalized_alias] = {
             "file_path": file_path,
             "primary_h2_id": primary_h2_id
         }
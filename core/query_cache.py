@@ -0,0 +1,280 @@
+# core/query_cache.py
+"""
+Кэш эмбеддингов запросов пользователей (get_embedding на каждом /chat).
+Два уровня: LRU в памяти процесса с TTL и SQLite-файл, общий для всех воркеров.
+Ключ — sha256 от (модель, нормализованный запрос): "Адрес?" и "адрес" — один вектор.
+
+Сброс (POST /admin/query-cache/purge с X-Admin-Token) чистит файл и поднимает поколение кэша;
+остальные воркеры видят новое поколение не позже чем через QUERY_CACHE_SYNC_INTERVAL
+и очищают свой уровень в памяти.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from core.embed_cache import CACHE_DIR, content_key
+
+QUERY_CACHE_ENABLE = os.getenv("QUERY_CACHE_ENABLE", "true").lower() == "true"
+QUERY_CACHE_PATH = Path(os.getenv("QUERY_CACHE_PATH", CACHE_DIR / "query_embeddings.sqlite"))
+QUERY_CACHE_MAX_ITEMS = int(os.getenv("QUERY_CACHE_MAX_ITEMS", "2048"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))               # память, секунд
+QUERY_CACHE_DISK_TTL = float(os.getenv("QUERY_CACHE_DISK_TTL", "2592000"))  # файл, секунд (30 дней; 0 — без файла)
+QUERY_CACHE_SYNC_INTERVAL = float(os.getenv("QUERY_CACHE_SYNC_INTERVAL", "1.0"))
+
+_RX_SPACES = re.compile(r'\s+')
+_RX_EDGE_PUNCT = re.compile(r'^[\s.,!?…:;"«»()\-–—]+|[\s.,!?…:;"«»()\-–—]+$')
+
+
+def normalize_query(text: str) -> str:
+    """
+    Нормализация запроса для ключа кэша: регистр, ё, пробелы, пунктуация по краям.
+
+    Args:
+        text: Запрос в том виде, в каком он уходит в embeddings API
+
+    Returns:
+        Нормализованная строка
+    """
+    t = (text or "").lower().replace("ё", "е").replace("\u00a0", " ")
+    return _RX_EDGE_PUNCT.sub("", _RX_SPACES.sub(" ", t))
+
+
+class QueryEmbeddingCache:
+    """Двухуровневый кэш эмбеддингов запросов (LRU в памяти + SQLite). Потокобезопасен."""
+
+    def __init__(self, path: Path | str | None = QUERY_CACHE_PATH, max_items: int = QUERY_CACHE_MAX_ITEMS,
+                 ttl: float = QUERY_CACHE_TTL, disk_ttl: float = QUERY_CACHE_DISK_TTL):
+        """
+        Args:
+            path: SQLite-файл общего уровня (None — только память)
+            max_items: Векторов в памяти процесса
+            ttl: Время жизни записи в памяти, секунд
+            disk_ttl: Время жизни записи в файле, секунд (0 — файл не используется)
+        """
+        self.max_items = max_items
+        self.ttl = ttl
+        self.disk_ttl = disk_ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (вектор, истекает)
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._generation = 0
+        self._synced = 0.0
+
+        self.path = Path(path) if path and disk_ttl > 0 else None
+        self._conn = None
+        if self.path is not None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(str(self.path), timeout=5.0, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                    " key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL,"
+                    " created REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL)")
+                self._conn.commit()
+                self._generation = self._read_generation()
+                self._synced = time.monotonic()
+            except sqlite3.Error as e:
+                print(f"⚠️ Кэш запросов: файл {self.path} недоступен, работаем только в памяти: {e}")
+                self._conn = None
+
+    # ---- общий уровень (SQLite) ----
+
+    def _read_generation(self) -> int:
+        with self._db_lock:
+            row = self._conn.execute("SELECT v FROM meta WHERE k = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _sync(self) -> None:
+        """Сброс в другом воркере: новое поколение в файле → очищаем свою память"""
+        now = time.monotonic()
+        if self._conn is None or now - self._synced < QUERY_CACHE_SYNC_INTERVAL:
+            return
+        self._synced = now
+        try:
+            generation = self._read_generation()
+        except sqlite3.Error:
+            return
+        if generation != self._generation:
+            with self._lock:
+                self._mem.clear()
+            self._generation = generation
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        try:
+            with self._db_lock:
+                row = self._conn.execute("SELECT dim, vec, created FROM query_embeddings WHERE key = ?",
+                                         (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ Кэш запросов: ошибка чтения: {e}")
+            return None
+        if row is None or time.time() - row[2] > self.disk_ttl:
+            return None
+        vec = np.frombuffer(row[1], dtype="float32")
+        return vec if vec.shape[0] == row[0] else None
+
+    def _disk_put(self, key: str, model: str, vec: np.ndarray) -> None:
+        try:
+            with self._db_lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, model, dim, vec, created) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, int(vec.shape[0]), vec.tobytes(), time.time()),
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            # кэш не должен ломать ответ: вектор уже получен
+            print(f"⚠️ Кэш запросов: ошибка записи: {e}")
+
+    # ---- память процесса (LRU + TTL) ----
+
+    def _remember(self, key: str, vec: np.ndarray) -> None:
+        with self._lock:
+            self._mem[key] = (vec, time.monotonic() + self.ttl)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, model: str, query: str) -> Optional[np.ndarray]:
+        """
+        Вектор запроса из кэша.
+
+        Args:
+            model: Модель эмбеддингов
+            query: Текст запроса (нормализуется здесь)
+
+        Returns:
+            Вектор float32 (только чтение) или None
+        """
+        self._sync()
+        key = content_key(model, normalize_query(query))
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                if item[1] > time.monotonic():
+                    self._mem.move_to_end(key)
+                    self.memory_hits += 1
+                    return item[0]
+                del self._mem[key]
+        vec = self._disk_get(key) if self._conn is not None else None
+        if vec is not None:
+            self.disk_hits += 1
+            self._remember(key, vec)
+            return vec
+        self.misses += 1
+        return None
+
+    def put(self, model: str, query: str, vector: Sequence[float]) -> np.ndarray:
+        """
+        Сохраняет вектор запроса в оба уровня.
+
+        Args:
+            model: Модель эмбеддингов
+            query: Текст запроса
+            vector: Вектор из embeddings API
+
+        Returns:
+            Сохранённый вектор float32 (только чтение)
+        """
+        key = content_key(model, normalize_query(query))
+        vec = np.array(vector, dtype="float32")
+        vec.setflags(write=False)
+        self._remember(key, vec)
+        if self._conn is not None:
+            self._disk_put(key, model, vec)
+        return vec
+
+    def purge(self, model: Optional[str] = None) -> Dict[str, int]:
+        """
+        Сбрасывает кэш (все модели или одну) и поднимает поколение для других воркеров.
+
+        Args:
+            model: Только векторы этой модели (None — все)
+
+        Returns:
+            {"memory": удалено из памяти, "disk": удалено из файла}
+        """
+        with self._lock:
+            memory = len(self._mem)
+            self._mem.clear()
+        disk = 0
+        if self._conn is not None:
+            with self._db_lock:
+                if model is None:
+                    cur = self._conn.execute("DELETE FROM query_embeddings")
+                else:
+                    cur = self._conn.execute("DELETE FROM query_embeddings WHERE model = ?", (model,))
+                disk = cur.rowcount
+                self._conn.execute("INSERT INTO meta (k, v) VALUES ('generation', 1) "
+                                   "ON CONFLICT(k) DO UPDATE SET v = v + 1")
+                self._conn.commit()
+            self._generation = self._read_generation()
+        from core.logger import log_m
+        log_m.info({"ev": "query_cache_purged", "model": model, "memory": memory, "disk": disk})
+        return {"memory": memory, "disk": disk}
+
+    def stats(self) -> dict:
+        """Попадания по уровням, hit rate и размеры"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        disk_size = None
+        if self._conn is not None:
+            try:
+                with self._db_lock:
+                    disk_size = self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "memory_size": len(self._mem),
+            "memory_max": self.max_items,
+            "evictions": self.evictions,
+            "disk_size": disk_size,
+            "path": str(self.path) if self._conn is not None else None,
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+            self._conn = None
+
+
+_cache: Optional[QueryEmbeddingCache] = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> Optional[QueryEmbeddingCache]:
+    """
+    Кэш запросов процесса (общий для движков тенантов: ключ включает модель).
+
+    Returns:
+        QueryEmbeddingCache или None (QUERY_CACHE_ENABLE=false)
+    """
+    global _cache, _cache_pid
+    if not QUERY_CACHE_ENABLE:
+        return None
+    # соединение SQLite не переживает fork (gunicorn --preload) — в воркере открываем своё
+    if _cache is None or _cache_pid != os.getpid():
+        with _cache_lock:
+            if _cache is None or _cache_pid != os.getpid():
+                _cache, _cache_pid = QueryEmbeddingCache(), os.getpid()
+    return _cache
@@ -6,7 +6,7 @@
 
 from typing import List, Tuple, Dict, Any, Optional
 from .normalize import normalize_query_for_search
-from .router import theme_router, apply_theme_boost_to_candidates
+from .router import ThemeRouter, theme_router, apply_theme_boost_to_candidates
 from .guard import guard_with_candidates
 from config.feature_flags import feature_flags
 
@@ -15,6 +15,7 @@ def enhance_rag_retrieval(
     query: str,
     original_retrieve_func,
     *args,
+    router: Optional[ThemeRouter] = None,
     **kwargs
 ) -> Tuple[List, Dict[str, Any]]:
     """
@@ -24,6 +25,7 @@ def enhance_rag_retrieval(
         query: Запрос пользователя
         original_retrieve_func: Оригинальная функция поиска
         *args, **kwargs: Аргументы для оригинальной функции
+        router: Роутер тем тенанта (по умолчанию — глобальный theme_router)
     
     Returns:
         Tuple[enhanced_chunks, enhancement_meta]
@@ -47,7 +49,8 @@ def enhance_rag_retrieval(
         search_query = query
     
     # Тематический роутинг
-    detected_themes = theme_router.detect_themes(search_query)
+    router = router or theme_router
+    detected_themes = router.detect_themes(search_query)
     enhancement_meta["detected_themes"] = list(detected_themes)  # Конвертируем set в list
     
     # Вызываем оригинальную функцию поиска
@@ -67,7 +70,8 @@ def enhance_rag_retrieval(
                 if detected_themes:
                     enhanced_candidates = apply_theme_boost_to_candidates(
                         candidates_with_scores, 
-                        detected_themes
+                        detected_themes,
+                        router
                     )
                     enhancement_meta["theme_boost_applied"] = True
                 else:
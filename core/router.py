@@ -7,7 +7,7 @@
 import json
 import re
 from pathlib import Path
-from typing import Set, Dict, Any, List
+from typing import Iterable, Optional, Set, Dict, Any, List
 from .normalize import normalize_ru
 
 
@@ -155,7 +155,7 @@ class ThemeRouter:
         return self.theme_map.get(theme, {})
 
 
-# Глобальный экземпляр роутера
+# Глобальный экземпляр роутера (config/themes.json); у движка тенанта — свой (IndexSnapshot.theme_router)
 theme_router = ThemeRouter()
 
 
@@ -174,7 +174,8 @@ def route_topics(query: str) -> Set[str]:
 
 def apply_theme_boost_to_candidates(
     candidates: List[tuple], 
-    detected_themes: Set[str]
+    detected_themes: Set[str],
+    router: Optional[ThemeRouter] = None
 ) -> List[tuple]:
     """
     Применяет тематический буст к кандидатам.
@@ -182,12 +183,14 @@ def apply_theme_boost_to_candidates(
     Args:
         candidates: Список (chunk, score) кортежей
         detected_themes: Найденные темы
+        router: Роутер с весами тем (по умолчанию — глобальный theme_router)
     
     Returns:
         Список кандидатов с примененным бустом
     """
     if not detected_themes or not candidates:
         return candidates
+    router = router or theme_router
     
     boosted_candidates = []
     
@@ -198,7 +201,7 @@ def apply_theme_boost_to_candidates(
         if hasattr(chunk, 'metadata') and chunk.metadata:
             chunk_topic = getattr(chunk.metadata, 'topic', '')
             if chunk_topic in detected_themes:
-                final_score = theme_router.apply_theme_boost(score, chunk_topic)
+                final_score = router.apply_theme_boost(score, chunk_topic)
         
         boosted_candidates.append((chunk, final_score))
     
@@ -209,14 +212,21 @@ def apply_theme_boost_to_candidates(
 
 
 # ШАГ 5: Тематический роутер «doctors» (чтобы theme_hint ≠ null)
-def build_doctor_name_regex():
-    """Сгенерируй один общий regex из всех фамилий (aliases) и общих слов"""
+def build_doctor_name_regex(aliases: Optional[Iterable[str]] = None):
+    """
+    Сгенерируй один общий regex из всех фамилий (aliases) и общих слов
+
+    Args:
+        aliases: Алиасы корпуса (по умолчанию — общий md_loader.ALIAS_MAP; у движка тенанта — свои)
+    """
     names = []
     
     # Собираем все алиасы из документов типа "doctors"
     try:
-        from .md_loader import ALIAS_MAP
-        for alias, data in ALIAS_MAP.items():
+        if aliases is None:
+            from .md_loader import ALIAS_MAP
+            aliases = ALIAS_MAP
+        for alias in aliases:
             # Проверяем, что это алиас врача (можно добавить проверку по doc_type)
             if len(alias) > 2:  # фильтруем короткие алиасы
                 names.append(alias)
@@ -239,16 +249,14 @@ def build_doctor_name_regex():
     return pattern
 
 
-# Компилируем regex для поиска врачей
-DOCTORS_QUERY_REGEX = re.compile(build_doctor_name_regex(), re.IGNORECASE)
-
-
-def route_theme(user_q: str) -> str | None:
+def route_theme(user_q: str, doctors_regex: Optional[re.Pattern] = None) -> str | None:
     """
     Определяет тему запроса для theme_hint.
     
     Args:
         user_q: Запрос пользователя
+        doctors_regex: Regex темы "doctors" движка (IndexSnapshot.theme_doctor_regex; по умолчанию —
+            по текущей общей карте md_loader.ALIAS_MAP)
     
     Returns:
         Название темы или None
@@ -256,7 +264,9 @@ def route_theme(user_q: str) -> str | None:
     nq = normalize_ru(user_q)
     
     # Проверяем тему "doctors"
-    if DOCTORS_QUERY_REGEX.search(nq):
+    if doctors_regex is None:
+        doctors_regex = re.compile(build_doctor_name_regex(), re.IGNORECASE)
+    if doctors_regex.search(nq):
         return "doctors"
     
     # ...другие темы...
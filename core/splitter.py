@@ -0,0 +1,153 @@
+# core/splitter.py
+"""
+Нарезка слишком длинных секций на окна с перекрытием.
+Блок H2/H3 длиннее CHUNK_MAX_TOKENS режется по границам предложений и пунктов списка;
+каждое окно начинается с заголовков секции (## / ###, алиасы) и хранит id родительского блока,
+номер окна и длину перекрытия с предыдущим окном — по ним текст секции собирается обратно
+(expand_windows) без повторов.
+"""
+
+import os
+import re
+from typing import List, Sequence, Tuple
+
+from core.md_document import Block
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "225"))          # 0 — не резать; 225 ≈ 900 символов (slice_for_prompt)
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))   # перекрытие соседних окон
+
+RX_LINE = re.compile(r'[^\n]+')
+RX_SENTENCE = re.compile(r'\S.*?(?:[.!?…]+(?=\s)|$)')
+RX_LIST_ITEM = re.compile(r'^\s*(?:[-*•—–]|\d+[.)])\s')
+
+
+def estimate_tokens(text: str) -> float:
+    """Примерная оценка токенов (1 токен ≈ 4 символа), как в _len_penalty и пакетах эмбеддингов"""
+    return len(text) / 4
+
+
+def _units(body: str, max_chars: int) -> List[Tuple[int, int]]:
+    """
+    Границы единиц нарезки в body: пункт списка/строка таблицы/заголовок — целиком,
+    обычный текст — по предложениям; единица длиннее max_chars режется по пробелам.
+
+    Returns:
+        [(начало, конец)] по возрастанию
+    """
+    spans = []
+    for line in RX_LINE.finditer(body):
+        text = line.group()
+        if not text.strip():
+            continue
+        if RX_LIST_ITEM.match(text) or text.lstrip().startswith(("|", "#", "<!--")):
+            parts = [(line.start() + len(text) - len(text.lstrip()), line.end())]
+        else:
+            parts = [(line.start() + m.start(), line.start() + m.end()) for m in RX_SENTENCE.finditer(text)]
+        for start, end in parts:
+            while end - start > max_chars:
+                # жёсткий разрез по последнему пробелу в пределах лимита
+                cut = body.rfind(" ", start + 1, start + max_chars)
+                cut = cut if cut > start else start + max_chars
+                spans.append((start, cut))
+                start = cut
+                while start < end and body[start].isspace():
+                    start += 1
+            if end > start:
+                spans.append((start, end))
+    return spans
+
+
+def split_block(block: Block, max_tokens: int = CHUNK_MAX_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Block]:
+    """
+    Режет блок на окна, если он длиннее max_tokens.
+
+    Args:
+        block: Блок H2/H3 из ParsedDocument
+        max_tokens: Максимум токенов в окне вместе с заголовками (0 — не резать)
+        overlap_tokens: Сколько токенов конца окна повторить в начале следующего
+
+    Returns:
+        [block], если резать не нужно, иначе окна в порядке текста
+    """
+    if max_tokens <= 0 or estimate_tokens(block.text) <= max_tokens:
+        return [block]
+
+    # заголовки ## / ### и комментарий с алиасами — в начале каждого окна
+    header, body = _split_header(block.text)
+
+    max_chars = max(int(max_tokens * 4) - len(header) - 1, 200)
+    overlap_chars = int(overlap_tokens * 4)
+    units = _units(body, max_chars)
+    if len(units) < 2:
+        return [block]
+
+    # окно — от начала своей первой единицы до начала следующей за последней (пробелы на стыке — в окне),
+    # поэтому окна вместе покрывают тело без пропусков и собираются обратно точно
+    windows = []    # (начало, конец, перекрытие с предыдущим окном в символах)
+    i = 0
+    prev_end = 0
+    while i < len(units):
+        j = i
+        while j + 1 < len(units) and units[j + 1][1] - units[i][0] <= max_chars:
+            j += 1
+        start = units[i][0]
+        end = units[j + 1][0] if j + 1 < len(units) else units[j][1]
+        windows.append((start, end, prev_end - start if windows else 0))
+        prev_end = end
+        if j + 1 >= len(units):
+            break
+        # следующее окно начинается с хвоста текущего (не длиннее overlap_chars), но всегда сдвигается вперёд
+        k = j + 1
+        while k - 1 > i and units[j][1] - units[k - 1][0] <= overlap_chars:
+            k -= 1
+        i = k
+
+    if len(windows) < 2:
+        return [block]
+
+    out = []
+    for n, (start, end, overlap) in enumerate(windows):
+        first = n == 0
+        out.append(Block(
+            chunk_id=f"{block.chunk_id}~w{n}",
+            text=f"{header}\n{body[start:end]}" if header else body[start:end],
+            block_id=f"{block.block_id}~{n:02d}",
+            h2_id=block.h2_id, h2_title=block.h2_title, h3_id=block.h3_id, h3_title=block.h3_title,
+            aliases=block.aliases,
+            # карточка врача и позиция каталога — по первому окну
+            doctor=block.doctor if first else None,
+            catalog_aliases=block.catalog_aliases if first else None,
+            parent_id=block.chunk_id, window=n, overlap=overlap,
+        ))
+    return out
+
+
+def expand_windows(texts: Sequence[str], overlaps: Sequence[int]) -> str:
+    """
+    Собирает текст секции из её окон.
+
+    Args:
+        texts: Тексты окон по порядку (каждое начинается с заголовков секции)
+        overlaps: Перекрытие каждого окна с предыдущим в символах (metadata.overlap)
+
+    Returns:
+        Заголовки + тело секции без повторов на стыках
+    """
+    if not texts:
+        return ""
+    header, body = _split_header(texts[0])
+    skip = len(header) + 1 if header else 0    # заголовки у всех окон одинаковые
+    parts = [body]
+    for text, overlap in zip(texts[1:], overlaps[1:]):
+        parts.append(text[skip + overlap:])
+    body = "".join(parts)
+    return f"{header}\n{body}" if header else body
+
+
+def _split_header(text: str) -> Tuple[str, str]:
+    lines = text.split("\n")
+    n = 0
+    while n < len(lines) and lines[n].lstrip().startswith(("#", "<!--")):
+        n += 1
+    return "\n".join(lines[:n]), "\n".join(lines[n:])
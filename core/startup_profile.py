@@ -0,0 +1,178 @@
+# core/startup_profile.py
+"""
+Профиль старта процесса: время и пиковый RSS по этапам — импорты тяжёлых библиотек,
+импорт app.py, загрузка индексов (темы, бандл, чтение и разбор md/, BM25, эмбеддинги).
+Итог пишется одним JSON-событием startup_profile, когда все участники старта
+(приложение, движок с фоновой сборкой эмбеддингов) отметились через done(),
+и отдаётся на /admin/startup-profile.
+"""
+
+import importlib.abc
+import importlib.util
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# библиотеки, чей первый импорт замеряется отдельно
+HEAVY_IMPORTS = ("openai", "numpy", "faiss", "rank_bm25", "rapidfuzz", "yaml", "flask", "flask_cors", "dotenv")
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Пиковый RSS процесса в МБ (None, если платформа не отдаёт)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def rss_mb() -> Optional[float]:
+    """Текущий RSS процесса в МБ (Linux, /proc/self/statm; иначе None)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+
+
+class _TimedLoader(importlib.abc.Loader):
+    """Обёртка загрузчика: замеряет выполнение модуля, остальное делегирует исходному"""
+
+    def __init__(self, loader, name: str, profile: "StartupProfile"):
+        self._loader = loader
+        self._name = name
+        self._profile = profile
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        with self._profile.stage(f"import:{self._name}"):
+            self._loader.exec_module(module)
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Ловит первый импорт модулей из списка и подменяет им загрузчик на замеряющий"""
+
+    def __init__(self, profile: "StartupProfile", names: Iterable[str]):
+        self.profile = profile
+        self.pending = {n for n in names if n not in sys.modules}
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.pending:
+            return None
+        self.pending.discard(fullname)
+        spec = importlib.util.find_spec(fullname)
+        if spec is not None and spec.loader is not None:
+            spec.loader = _TimedLoader(spec.loader, fullname, self.profile)
+        return spec
+
+
+class StartupProfile:
+    """Этапы старта процесса: длительность, смещение от старта, пиковый RSS и его прирост."""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.started_at = time.time()
+        self.stages: List[Dict[str, Any]] = []
+        self.emitted = False
+        self._pending: set = set()
+        self._claimed: set = set()
+        self._last = self.t0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замер этапа: with PROFILE.stage("bm25"): ..."""
+        start = time.perf_counter()
+        rss_before = peak_rss_mb()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._record(name, start, rss_before, error)
+
+    def checkpoint(self, name: str) -> None:
+        """Этап от предыдущей отметки (или старта процесса) до текущего момента"""
+        start, self._last = self._last, time.perf_counter()
+        self._record(name, start, None)
+
+    def _record(self, name: str, start: float, rss_before: Optional[float], error: Optional[str] = None) -> None:
+        end = time.perf_counter()
+        peak = peak_rss_mb()
+        item = {
+            "stage": name,
+            "ms": round((end - start) * 1000, 1),
+            "at_ms": round((start - self.t0) * 1000, 1),
+            "peak_rss_mb": peak,
+            "rss_growth_mb": round(peak - rss_before, 1) if peak is not None and rss_before is not None else None,
+        }
+        if error:
+            item["error"] = error
+        with self._lock:
+            self.stages.append(item)
+
+    def watch_imports(self, names: Iterable[str] = HEAVY_IMPORTS) -> None:
+        """Замеряет первый импорт перечисленных модулей (вместе с их зависимостями)"""
+        if not any(isinstance(f, _ImportTimer) for f in sys.meta_path):
+            sys.meta_path.insert(0, _ImportTimer(self, names))
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = sorted(self.stages, key=lambda s: s["at_ms"])
+        return {
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "uptime_ms": round((time.perf_counter() - self.t0) * 1000, 1),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": stages,
+        }
+
+    def expect(self, part: str) -> bool:
+        """
+        Регистрирует участника старта: событие не пишется, пока он не вызовет done().
+
+        Returns:
+            False — участник с таким именем уже был (второй движок в процессе не профилируется)
+        """
+        with self._lock:
+            if self.emitted or part in self._claimed:
+                return False
+            self._claimed.add(part)
+            self._pending.add(part)
+            return True
+
+    def done(self, part: str) -> None:
+        """Участник закончил старт; когда закончили все — пишем событие"""
+        with self._lock:
+            self._pending.discard(part)
+            ready = not self._pending
+        if ready:
+            self.emit()
+
+    def emit(self) -> None:
+        """Пишет профиль одним событием startup_profile (один раз на процесс)"""
+        with self._lock:
+            if self.emitted:
+                return
+            self.emitted = True
+        from core.logger import log_m
+        log_m.info({"ev": "startup_profile", **self.to_dict()})
+
+
+PROFILE = StartupProfile()
@@ -0,0 +1,306 @@
+# core/tenants.py
+"""
+Несколько сайтов клиник в одном процессе: у каждого тенанта свои md/, themes.json,
+cta.yaml и индексы. Тенант выбирается по полю tenant в /chat или по домену Origin/Referer.
+Движки тенантов поднимаются при первом запросе; при превышении бюджета памяти
+вытесняются давно не использованные. Тенант по умолчанию — общий движок процесса
+(rag_engine.get_engine), он не вытесняется.
+
+Конфиг (TENANTS_CONFIG, пример — config/tenants_example.json):
+    {
+      "default": {"name": "dental41", "origins": ["dental41.ru"]},
+      "tenants": {
+        "dental-bot": {"origins": ["dental-bot.ru"], "root": "tenants/dental-bot"}
+      }
+    }
+root задаёт раскладку <root>/md, <root>/themes.json, <root>/cta.yaml, <root>/index_bundle;
+каждый путь можно указать явно (md_dir, themes, cta, bundle_dir). Нет файла конфига —
+работает один тенант по умолчанию, как раньше.
+Бандл индексов тенанта собирается офлайн: python tools/build_index.py --tenant <name>.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+TENANTS_CONFIG = Path(os.getenv("TENANTS_CONFIG", BASE_DIR / "config" / "tenants.json"))
+TENANT_MEMORY_BUDGET_MB = float(os.getenv("TENANT_MEMORY_BUDGET_MB", "0"))  # 0 — без вытеснения
+TENANT_LATENCY_WINDOW = int(os.getenv("TENANT_LATENCY_WINDOW", "500"))     # последних запросов для p50/p95
+
+DEFAULT_TENANT = "default"
+
+
+def _host(value: Optional[str]) -> Optional[str]:
+    """Домен из Origin/Referer или голого имени хоста (без www.)"""
+    if not value:
+        return None
+    host = urlparse(value if "//" in value else f"//{value}").hostname
+    if not host:
+        return None
+    return host[4:] if host.startswith("www.") else host
+
+
+def _path(value: Optional[str], fallback: Path) -> Path:
+    if not value:
+        return fallback
+    p = Path(value)
+    return p if p.is_absolute() else BASE_DIR / p
+
+
+class Tenant:
+    """Сайт клиники: домены и пути к корпусу, темам, CTA и бандлу индексов."""
+
+    def __init__(self, name: str, origins: List[str], md_dir: Optional[Path] = None, themes_path: Optional[Path] = None,
+                 cta_path: Optional[Path] = None, bundle_dir: Optional[Path] = None, pinned: bool = False):
+        self.name = name
+        self.origins = [h for h in (_host(o) for o in origins) if h]
+        self.md_dir = md_dir
+        self.themes_path = themes_path
+        self.cta_path = cta_path
+        self.bundle_dir = bundle_dir
+        self.pinned = pinned            # тенант по умолчанию — не вытесняется
+
+    @classmethod
+    def from_config(cls, name: str, cfg: Dict[str, Any]) -> "Tenant":
+        root = _path(cfg.get("root"), BASE_DIR / "tenants" / name)
+        themes = _path(cfg.get("themes"), root / "themes.json")
+        cta = _path(cfg.get("cta"), root / "cta.yaml")
+        return cls(
+            name,
+            origins=cfg.get("origins") or [],
+            md_dir=_path(cfg.get("md_dir"), root / "md"),
+            # своих тем/CTA у тенанта может не быть — берём общие
+            themes_path=themes if themes.exists() else BASE_DIR / "config" / "themes.json",
+            cta_path=cta if cta.exists() else BASE_DIR / "config" / "cta.yaml",
+            bundle_dir=_path(cfg.get("bundle_dir"), root / "index_bundle"),
+        )
+
+    def create_engine(self):
+        """Поднимает движок тенанта (тенант по умолчанию — общий движок процесса)"""
+        from rag_engine import RagEngine, get_engine
+        if self.pinned:
+            return get_engine()
+        return RagEngine(md_dir=self.md_dir, themes_path=self.themes_path, bundle_dir=self.bundle_dir,
+                         cta_path=self.cta_path, global_aliases=False).load()
+
+
+class _TenantState:
+    """Резидентный движок тенанта и его метрики."""
+
+    def __init__(self, tenant: Tenant):
+        self.tenant = tenant
+        self.engine = None
+        self.lock = threading.Lock()    # загрузка — один раз, параллельные запросы ждут
+        self.loads = 0
+        self.evictions = 0
+        self.load_ms: Optional[float] = None
+        self.load_rss_mb: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=TENANT_LATENCY_WINDOW)
+        self.last_used: Optional[float] = None
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 1)
+
+
+class TenantRegistry:
+    """Тенанты процесса: выбор по запросу, загрузка по требованию, LRU-вытеснение по бюджету памяти."""
+
+    def __init__(self, tenants: List[Tenant], default: str, budget_mb: float = TENANT_MEMORY_BUDGET_MB,
+                 engine_factory: Optional[Callable[[Tenant], Any]] = None):
+        """
+        Args:
+            tenants: Все тенанты (включая тенант по умолчанию)
+            default: Имя тенанта по умолчанию
+            budget_mb: Бюджет памяти индексов тенантов в МБ (0 — без вытеснения)
+            engine_factory: Как поднять движок тенанта (по умолчанию Tenant.create_engine)
+        """
+        self.tenants = {t.name: t for t in tenants}
+        self.default = default
+        self.budget_mb = budget_mb
+        self.engine_factory = engine_factory or (lambda tenant: tenant.create_engine())
+        self.by_origin = {host: t.name for t in tenants for host in t.origins}
+        self._states = {name: _TenantState(t) for name, t in self.tenants.items()}
+        self._resident: "OrderedDict[str, None]" = OrderedDict()   # порядок — от давно использованных к свежим
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path: Path = TENANTS_CONFIG, default_engine=None) -> "TenantRegistry":
+        """
+        Реестр из конфига тенантов; без конфига — один тенант по умолчанию.
+
+        Args:
+            path: JSON с тенантами
+            default_engine: Готовый движок тенанта по умолчанию (фабрика приложения, тесты)
+        """
+        cfg = {}
+        if Path(path).exists():
+            with open(path, "r", encoding="utf-8") as f:
+                cfg = json.load(f)
+        default_cfg = cfg.get("default") or {}
+        default = Tenant(default_cfg.get("name", DEFAULT_TENANT), default_cfg.get("origins") or [], pinned=True)
+        tenants = [default] + [Tenant.from_config(name, t) for name, t in (cfg.get("tenants") or {}).items()
+                               if name != default.name]
+        registry = cls(tenants, default.name)
+        if default_engine is not None:
+            registry._attach(default.name, default_engine, load_ms=None, rss_growth=None)
+        return registry
+
+    # ---- Выбор тенанта ----
+
+    def resolve(self, tenant: Optional[str] = None, origin: Optional[str] = None) -> Optional[str]:
+        """
+        Имя тенанта для запроса: явное поле tenant, иначе домен Origin/Referer, иначе тенант по умолчанию.
+
+        Returns:
+            Имя тенанта или None, если явно назван неизвестный тенант
+        """
+        if tenant:
+            return tenant if tenant in self.tenants else None
+        return self.by_origin.get(_host(origin), self.default)
+
+    @property
+    def origins(self) -> List[str]:
+        """Домены всех тенантов (для CORS)"""
+        return sorted(self.by_origin)
+
+    # ---- Движки ----
+
+    def engine(self, name: str):
+        """Движок тенанта; не загружен — загружаем (другие запросы к нему ждут, к остальным — нет)"""
+        state = self._states[name]
+        engine = state.engine
+        loaded = False
+        if engine is None:
+            with state.lock:
+                engine = state.engine
+                if engine is None:
+                    engine, loaded = self._load(state), True
+        state.last_used = time.time()
+        with self._lock:
+            if name in self._resident:
+                self._resident.move_to_end(name)
+        if loaded:
+            # вытесняем вне блокировки тенанта: иначе две параллельные загрузки ждали бы друг друга
+            self._evict_over_budget(keep=name)
+        return engine
+
+    def _load(self, state: _TenantState):
+        from core.logger import log_m
+        from core.startup_profile import rss_mb
+        name = state.tenant.name
+        rss_before = rss_mb()
+        t0 = time.perf_counter()
+        engine = self.engine_factory(state.tenant)
+        load_ms = round((time.perf_counter() - t0) * 1000, 1)
+        rss_after = rss_mb()
+        growth = round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None
+        self._attach(name, engine, load_ms, growth)
+        memory = self._memory_mb(name)
+        print(f"🏥 Тенант {name} загружен за {load_ms}ms (~{memory} МБ индексов)")
+        log_m.info({"ev": "tenant_loaded", "tenant": name, "ms": load_ms, "memory_mb": memory, "rss_growth_mb": growth})
+        return engine
+
+    def _attach(self, name: str, engine, load_ms: Optional[float], rss_growth: Optional[float]) -> None:
+        state = self._states[name]
+        state.engine = engine
+        state.loads += 1
+        state.load_ms = load_ms
+        state.load_rss_mb = rss_growth
+        with self._lock:
+            self._resident[name] = None
+            self._resident.move_to_end(name)
+
+    def _memory_mb(self, name: str) -> Optional[float]:
+        engine = self._states[name].engine
+        if engine is None:
+            return None
+        return round(engine.snapshot.memory_bytes()["total"] / (1024 * 1024), 1)
+
+    def resident_mb(self) -> float:
+        """Оценка памяти индексов всех загруженных тенантов"""
+        with self._lock:
+            names = list(self._resident)
+        return round(sum(self._memory_mb(n) or 0 for n in names), 1)
+
+    def _evict_over_budget(self, keep: str) -> None:
+        """Вытесняет давно не использованных тенантов, пока индексы не уложатся в бюджет"""
+        if self.budget_mb <= 0:
+            return
+        while self.resident_mb() > self.budget_mb:
+            with self._lock:
+                victim = next((n for n in self._resident if n != keep and not self.tenants[n].pinned), None)
+            if victim is None:
+                break
+            self.evict(victim, reason="budget")
+
+    def evict(self, name: str, reason: str = "manual") -> bool:
+        """Выгружает движок тенанта. Запросы, уже работающие с ним, дорабатывают на своём снимке."""
+        from core.logger import log_m
+        state = self._states[name]
+        if self.tenants[name].pinned:
+            return False
+        with state.lock:
+            engine, state.engine = state.engine, None
+            if engine is None:
+                return False
+            memory = round(engine.snapshot.memory_bytes()["total"] / (1024 * 1024), 1)
+            with self._lock:
+                self._resident.pop(name, None)
+            state.evictions += 1
+        engine.close()
+        print(f"♻️ Тенант {name} выгружен ({reason}, ~{memory} МБ)")
+        log_m.info({"ev": "tenant_evicted", "tenant": name, "reason": reason, "memory_mb": memory})
+        return True
+
+    # ---- Метрики ----
+
+    def observe(self, name: str, ms: float, ok: bool = True) -> None:
+        """Длительность обработанного запроса тенанта"""
+        state = self._states.get(name)
+        if state is None:
+            return
+        state.requests += 1
+        state.latencies.append(ms)
+        if not ok:
+            state.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики для /admin/tenants: резидентность, память, загрузки, латентность по тенантам"""
+        from core.startup_profile import rss_mb
+        out = {}
+        for name, state in self._states.items():
+            latencies = list(state.latencies)
+            out[name] = {
+                "resident": state.engine is not None,
+                "pinned": state.tenant.pinned,
+                "origins": state.tenant.origins,
+                "memory_mb": self._memory_mb(name),
+                "loads": state.loads,
+                "evictions": state.evictions,
+                "load_ms": state.load_ms,
+                "load_rss_growth_mb": state.load_rss_mb,
+                "requests": state.requests,
+                "errors": state.errors,
+                "latency_ms": {"p50": _percentile(latencies, 0.5), "p95": _percentile(latencies, 0.95),
+                               "max": round(max(latencies), 1) if latencies else None},
+                "last_used": state.last_used,
+            }
+        return {
+            "default": self.default,
+            "budget_mb": self.budget_mb,
+            "resident_mb": self.resident_mb(),
+            "process_rss_mb": rss_mb(),
+            "tenants": out,
+        }
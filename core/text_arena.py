@@ -0,0 +1,114 @@
+# core/text_arena.py
+"""
+Арена текстов чанков: один непрерывный UTF-8 буфер и массив смещений (n + 1).
+Чанк хранит только позицию в арене, строка собирается из среза буфера при обращении.
+Буфер арены из бандла индексов может быть memory-mapped (texts.bin + text_offsets.npy) —
+тогда страницы текстов общие для процессов и корпусов, открытых из одной сборки.
+"""
+
+import mmap
+import os
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+TEXT_ARENA_MMAP = os.getenv("TEXT_ARENA_MMAP", "true").lower() == "true"  # false — читать texts.bin в память
+
+
+class TextArena:
+    """Неизменяемый набор текстов в одном буфере; срезы — memoryview без копирования."""
+
+    __slots__ = ("_buf", "_view", "_offsets", "_mmap")
+
+    def __init__(self, buf, offsets: Iterable[int], mm: mmap.mmap | None = None):
+        """
+        Args:
+            buf: Буфер с текстами подряд в UTF-8 (bytes, mmap)
+            offsets: Смещения начала каждого текста и конец буфера (n + 1 значений)
+            mm: Открытый mmap, если буфер отображён из файла
+        """
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._offsets = array("q", offsets)
+        self._mmap = mm
+        if not self._offsets:
+            self._offsets.append(0)
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str]) -> "TextArena":
+        """Собирает арену из строк (порядок сохраняется)"""
+        blobs = [t.encode("utf-8") for t in texts]
+        offsets = array("q", [0])
+        pos = 0
+        for b in blobs:
+            pos += len(b)
+            offsets.append(pos)
+        return cls(b"".join(blobs), offsets)
+
+    @classmethod
+    def open(cls, texts_path: Path | str, offsets_path: Path | str, use_mmap: bool = TEXT_ARENA_MMAP) -> "TextArena":
+        """
+        Открывает арену из файлов бандла.
+
+        Args:
+            texts_path: texts.bin — тексты подряд в UTF-8
+            offsets_path: text_offsets.npy — смещения int64 (n + 1)
+            use_mmap: Отобразить texts.bin в память вместо чтения
+
+        Returns:
+            TextArena
+        """
+        offsets = np.load(offsets_path)
+        texts_path = Path(texts_path)
+        if use_mmap and texts_path.stat().st_size > 0:
+            with open(texts_path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(mm, offsets.tolist(), mm)
+        return cls(texts_path.read_bytes(), offsets.tolist())
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        o = self._offsets
+        return str(self._view[o[i]:o[i + 1]], "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def view(self, i: int) -> memoryview:
+        """UTF-8 байты i-го текста без копирования"""
+        o = self._offsets
+        return self._view[o[i]:o[i + 1]]
+
+    def texts(self) -> List[str]:
+        return list(self)
+
+    @property
+    def nbytes(self) -> int:
+        """Размер буфера текстов в байтах"""
+        return self._offsets[-1]
+
+    @property
+    def mapped(self) -> bool:
+        return self._mmap is not None
+
+    def write(self, texts_path: Path | str, offsets_path: Path | str) -> None:
+        """Пишет арену в файлы бандла (texts.bin + text_offsets.npy)"""
+        with open(texts_path, "wb") as f:
+            f.write(self._view[:self.nbytes])
+        np.save(offsets_path, np.asarray(self._offsets, dtype="int64"))
+
+    def __getstate__(self):
+        # mmap не сериализуется — в воркеры и обратно уходят байты
+        return bytes(self._view[:self.nbytes]), self._offsets
+
+    def __setstate__(self, state):
+        buf, offsets = state
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._offsets = offsets
+        self._mmap = None
@@ -1,16 +1,30 @@
 # rag_engine.py
 import os
+import sys
 import numpy as np
 from openai import OpenAI
-from core.faiss_compat import IndexFlatIP, normalize_L2_inplace, HAS_FAISS
-import yaml
+from core.faiss_compat import IndexIDMap, index_kind, make_index, normalize_L2_inplace, vector_id, HAS_FAISS
+from core.startup_profile import PROFILE
+from core.text_arena import TextArena
+from core.chunk_fields import ChunkFields, display_text
+from core.dedup import DEDUP_ENABLE, signature as minhash_signature, find_clusters, pick_canonical
+from core.doc2query import DOC2QUERY_ENABLE, DOC2QUERY_PER_CHUNK, DOC2QUERY_REPLACES_MQ, QuestionStore
+from core.fact_store import FACTS_ENABLE, FactStore
+from core.query_cache import get_query_cache
+from core.embed_coalescer import get_coalescer
 import re
 import json
-import difflib
 import random
+import threading
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+from types import MappingProxyType
 from dotenv import load_dotenv
-from typing import Dict, List, Optional, Any, Set, Tuple
+from typing import Dict, List, Optional, Any, Sequence, Set, Tuple
 from textwrap import dedent
 from rank_bm25 import BM25Okapi
 from rapidfuzz import fuzz
@@ -35,9 +49,12 @@ except Exception:
             pass
 
 # ==== КОНСТАНТЫ ====
+BASE_DIR = Path(__file__).resolve().parent
 CONFIG_DIR = Path("config")
 MD_DIR = Path("md")
-THEMES_PATH = CONFIG_DIR / "themes.json"
+THEMES_PATH = BASE_DIR / "config" / "themes.json"
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_CACHE_ENABLE = os.getenv("EMBED_CACHE_ENABLE", "true").lower() == "true"
 
 # ==== АНТИ-ВОДА РЕГЕКСЫ ====
 ANTI_FLUFF = [
@@ -51,11 +68,6 @@ ANTI_FLUFF = [
     r"^открывает\s+возможности.*",
 ]
 
-# ==== ГЛОБАЛЬНЫЕ СТРУКТУРЫ ДЛЯ КАТАЛОГА СУЩНОСТЕЙ ====
-ENTITY_INDEX = {}  # alias_norm -> {"topic": str, "entity": str, "doc_id": str, "section": str}
-ENTITY_CHUNKS = {}  # (topic, entity) -> RetrievedChunk
-ALIAS_MAP = {}  # normalize(alias) -> {"file": path, "primary_h2_id": ...}
-
 # ==== НОВАЯ АРХИТЕКТУРА ИНДЕКСОВ ====
 # === 1) Нормализация тем ===
 CANON = {"doctors","consultation","prices","warranty","contacts","implants","safety","clinic"}
@@ -69,20 +81,6 @@ def norm_text(x: str) -> str:
     x = re.sub(r"\s+", " ", x)
     return x
 
-# === 2) Контейнеры индексов ===
-ALIAS_MAP_GLOBAL = {}   # norm(alias) -> {"topic":..., "file":...}
-H2_INDEX = {}           # norm(h2_text/h2_id/local_alias) -> {"topic":..., "file":..., "h2_id":...}
-FILE_META = {}          # file -> {"topic":..., "aliases": [...], "mini_links":[...]}
-ALL_CHUNKS = []         # ваши чанк-объекты (как и раньше)
-
-# ==== BM25 ИНДЕКС ====
-bm25_index = None
-bm25_corpus = []
-
-def _normalize(text: str) -> str:
-    # NBSP -> обычный пробел; CRLF -> LF
-    return text.replace('\u00A0', ' ').replace('\r\n', '\n').replace('\r', '\n')
-
 def _norm(s: str) -> str:
     """Нормализация строки для индексации"""
     return re.sub(r'\s+', ' ', s.lower().replace('\u00a0', ' ')).strip()
@@ -124,88 +122,200 @@ except Exception as e:
     openai_client = None
 
 # Типы данных
+
+# Стандартные поля фронтматтера и значения по умолчанию (порядок — как в to_dict)
+FRONTMATTER_DEFAULTS: Dict[str, Any] = {
+    'id': '', 'slug': '', 'title': '', 'description': '', 'doc_type': 'info', 'topic': '',
+    'tags': [], 'aliases': [], 'audience': '', 'updated': '', 'locale': 'ru-RU', 'tone': 'friendly',
+    'emotion': '', 'criticality': 'medium', 'verbatim': False, 'policy_ref': [], 'source': [],
+    'preferred_format': ['short', 'bullets', 'cta'], 'canonical_url': '', 'noindex': False,
+    'cta_action': '', 'cta_text': '', 'cta_link': '',
+    # Дополнительные поля для совместимости
+    'h2_id': '', 'h2_title': '', 'h3_id': '', 'h3_title': '', 'h2_aliases': [],
+}
+
+# Поля, которые задаёт секция (H2/H3), а не файл; parent_id/window/overlap — у окон длинных секций
+CHUNK_FIELDS = ('h2_id', 'h2_title', 'h3_id', 'h3_title', 'aliases', 'block_id', 'parent_id', 'window', 'overlap')
+
+# Короткие повторяющиеся значения храним в одном экземпляре на процесс
+INTERNED_FIELDS = frozenset({'topic', 'doc_type', 'h2_id', 'h2_title', 'criticality', 'tone', 'locale',
+                             'audience', 'emotion', 'updated', 'cta_action', 'cta_text', 'doc_id'})
+
+
+_NO_TAGS: List[str] = []  # tags_lower для чанков без тегов (общий, не изменяется)
+
+
+def _intern_values(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: sys.intern(v) if k in INTERNED_FIELDS and type(v) is str else v for k, v in data.items()}
+
+
+def _default(key: str) -> Any:
+    # списки по умолчанию общие — наружу отдаём копию, чтобы правка не задела все чанки
+    value = FRONTMATTER_DEFAULTS[key]
+    return list(value) if isinstance(value, list) else value
+
+
 class Frontmatter:
-    def __init__(self, data: Dict[str, Any]):
-        self._d = dict(data or {})
-        
-        # Устанавливаем стандартные поля как атрибуты
-        self.id = self._d.get('id', '')
-        self.slug = self._d.get('slug', '')
-        self.title = self._d.get('title', '')
-        self.description = self._d.get('description', '')
-        self.doc_type = self._d.get('doc_type', 'info')
-        self.topic = self._d.get('topic', '')
-        self.tags = self._d.get('tags', [])
-        self.aliases = self._d.get('aliases', [])
-        self.audience = self._d.get('audience', '')
-        self.updated = self._d.get('updated', '')
-        self.locale = self._d.get('locale', 'ru-RU')
-        self.tone = self._d.get('tone', 'friendly')
-        self.emotion = self._d.get('emotion', '')
-        self.criticality = self._d.get('criticality', 'medium')
-        self.verbatim = self._d.get('verbatim', False)
-        self.policy_ref = self._d.get('policy_ref', [])
-        self.source = self._d.get('source', [])
-        self.preferred_format = self._d.get('preferred_format', ['short', 'bullets', 'cta'])
-        self.canonical_url = self._d.get('canonical_url', '')
-        self.noindex = self._d.get('noindex', False)
-        self.cta_action = self._d.get('cta_action', '')
-        self.cta_text = self._d.get('cta_text', '')
-        self.cta_link = self._d.get('cta_link', '')
-        
-        # Дополнительные поля для совместимости
-        self.h2_id = self._d.get('h2_id', '')
-        self.h2_title = self._d.get('h2_title', '')
-        self.h3_id = self._d.get('h3_id', '')
-        self.h3_title = self._d.get('h3_title', '')
-        self.h2_aliases = self._d.get('h2_aliases', [])
-        
-        # Устанавливаем все остальные поля как атрибуты
-        for k, v in self._d.items():
-            if not hasattr(self, k):
-                setattr(self, k, v)
+    """
+    Метаданные документа или чанка с доступом и как к атрибутам, и как к dict.
+
+    Метаданные чанка (file=...) хранят только поля своей секции, а фронтматтер файла —
+    ссылкой, общей для всех чанков файла (flyweight). Стандартные поля, не заданные секцией,
+    берутся из FRONTMATTER_DEFAULTS и перекрывают поля файла — как прежнее слияние
+    {**файл, **чанк}, в котором у чанка были заполнены все поля по умолчанию.
+    """
+
+    __slots__ = ('_own', '_file', 'tags_lower')
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None, file: Optional["Frontmatter"] = None):
+        """
+        Args:
+            data: Поля документа (или секции, если задан file)
+            file: Метаданные файла, общие для всех его чанков
+        """
+        own = _intern_values(data or {})
+        if file is not None:
+            # у чанка поля, совпадающие с умолчаниями, не храним
+            own = {k: v for k, v in own.items() if k not in FRONTMATTER_DEFAULTS or v != FRONTMATTER_DEFAULTS[k]}
+        self._own = own
+        self._file = file
+
+    def __getattr__(self, name):
+        # сюда попадаем, только если обычного атрибута нет: поле секции/документа → умолчание → поле файла
+        if name.startswith('_'):
+            raise AttributeError(name)
+        own = self._own
+        if name in own:
+            return own[name]
+        if name in FRONTMATTER_DEFAULTS:
+            return FRONTMATTER_DEFAULTS[name]
+        if self._file is not None and name in self._file._own:
+            return self._file._own[name]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        return self._own, self._file, getattr(self, 'tags_lower', None)
+
+    def __setstate__(self, state):
+        own, self._file, tags_lower = state
+        # строки из другого процесса приходят новыми объектами — интернируем заново
+        self._own = _intern_values(own)
+        if tags_lower is not None:
+            self.tags_lower = tags_lower
+
+    @property
+    def document(self) -> "Frontmatter":
+        """Фронтматтер файла (у метаданных чанка стандартные поля файла перекрыты умолчаниями)"""
+        return self._file if self._file is not None else self
 
     # --- dict-совместимость ---
-    def __getitem__(self, key): 
-        return self._d[key]
-    
-    def __iter__(self): 
-        return iter(self._d)
-    
-    def __len__(self): 
-        return len(self._d)
-    
-    def get(self, key, default=None): 
-        return self._d.get(key, default)
-    
-    def to_dict(self): 
-        return dict(self._d)
-    
+    def get(self, key, default=None):
+        own = self._own
+        if key in own:
+            return own[key]
+        if self._file is None:
+            return default
+        if key in FRONTMATTER_DEFAULTS:
+            return _default(key)
+        return self._file._own.get(key, default)
+
+    def to_dict(self):
+        if self._file is None:
+            return dict(self._own)
+        d = {k: self._own[k] if k in self._own else _default(k) for k in FRONTMATTER_DEFAULTS}
+        for k, v in self._file._own.items():
+            if k not in d:
+                d[k] = v
+        for k, v in self._own.items():
+            if k not in FRONTMATTER_DEFAULTS:
+                d[k] = v
+        return d
+
+    def __getitem__(self, key):
+        d = self.to_dict()
+        return d[key]
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self._own) if self._file is None else len(self.to_dict())
+
     def keys(self):
-        return self._d.keys()
-    
+        return self.to_dict().keys()
+
     def values(self):
-        return self._d.values()
-    
+        return self.to_dict().values()
+
     def items(self):
-        return self._d.items()
-    
+        return self.to_dict().items()
+
     # опционально: обновление/добавление
     def set(self, key, value):
-        self._d[key] = value
-        setattr(self, key, value)
+        self._own[key] = value
 
 class RetrievedChunk:
-    def __init__(self, id: str, text: str, metadata: Frontmatter, file_name: str):
+    """
+    Чанк корпуса: id, текст (строкой или позицией в арене), метаданные (общие с файлом).
+    Чанки принадлежат опубликованному снимку и общие для всех запросов — оценки ретривала
+    на них не пишутся, они живут в ScoreTable запроса.
+    """
+
+    __slots__ = ('id', '_text', '_arena', '_fields', 'metadata', 'file_name', 'followups')
+
+    def __init__(self, id: str, text: str | int, metadata: Frontmatter, file_name: str,
+                 arena: Optional[TextArena] = None):
+        """
+        Args:
+            id: id чанка
+            text: Текст чанка или его позиция в arena
+            metadata: Метаданные чанка
+            file_name: Имя файла-источника
+            arena: Арена текстов, если text — позиция
+        """
         self.id = id
-        self.text = text
+        self._text = text
+        self._arena = arena
+        self._fields = None
         self.metadata = metadata
-        self.file_name = file_name
-        # Безопасное извлечение атрибутов с fallback значениями
-        self.updated = metadata.updated if metadata else ""
-        self.criticality = metadata.criticality if metadata else "medium"
-        self.doc_type = metadata.doc_type if metadata else "info"
-        self.tags = metadata.tags if metadata else []
+        self.file_name = sys.intern(file_name)
+        self.followups = ()     # followups документа (считаются при индексации, общие для чанков файла)
+
+    @property
+    def text(self) -> str:
+        arena = self._arena
+        return self._text if arena is None else arena[self._text]
+
+    def bind_text(self, arena: TextArena, pos: int) -> None:
+        """Переносит текст в арену (только до публикации чанка в снимке)"""
+        self._text = pos
+        self._arena = arena
+
+    @property
+    def fields(self) -> ChunkFields:
+        """Производные поля текста (core/chunk_fields.py): считаются при индексации, здесь — только чтение"""
+        fields = self._fields
+        if fields is None:
+            # чанк, собранный на лету (склейка окон) — считаем один раз
+            fields = self._fields = ChunkFields(self.text)
+        return fields
+
+    # Безопасное извлечение атрибутов с fallback значениями
+    @property
+    def updated(self):
+        return self.metadata.updated if self.metadata else ""
+
+    @property
+    def criticality(self):
+        return self.metadata.criticality if self.metadata else "medium"
+
+    @property
+    def doc_type(self):
+        return self.metadata.doc_type if self.metadata else "info"
+
+    @property
+    def tags(self):
+        return self.metadata.tags if self.metadata else []
 
 class SynthJSON:
     def __init__(self, short: str, bullets: List[str], cta: str, used_chunks: List[str], tone: str, warnings: Optional[List[str]] = None):
@@ -217,61 +327,9 @@ class SynthJSON:
         self.warnings = warnings or []
 
 # === 3) Парс MD ===
-RX_H2 = re.compile(r"(?m)^##\s+([^\n{]+?)(?:\s*\{#([^\}]+)\})?\s*$")
-RX_LOC = re.compile(r"<!--\s*aliases:\s*\[(.*?)\]\s*-->", re.S|re.I)
-
-def parse_frontmatter(text: str):
-    if not text.startswith("---"): return {}, text
-    m = re.match(r"^---\s*\n(.*?)\n---\s*\n(.*)$", text, re.S)
-    if not m: return {}, text
-    fm = yaml.safe_load(m.group(1)) or {}
-    body = m.group(2)
-    return fm, body
-
-def parse_h2_sections(body: str):
-    sections = []
-    for m in RX_H2.finditer(body):
-        title = m.group(1).strip()
-        h2_id = m.group(2) or slugify(title)
-        tail = body[m.end(): m.end()+400]
-        loc = RX_LOC.search(tail)
-        local_aliases = []
-        if loc:
-            raw = loc.group(1)
-            local_aliases = [a.strip().strip("'\"") for a in re.split(r",\s*", raw) if a.strip()]
-        sections.append({"title": title, "h2_id": h2_id, "local_aliases": local_aliases})
-    return sections
-
-def slugify(s: str) -> str:
-    import unicodedata
-    s = unicodedata.normalize("NFKD", s.lower().strip())
-    s = re.sub(r"\s+", "-", s)
-    s = re.sub(r"[^a-z0-9\-а-яё]", "", s)
-    return s
-
-# === 4) Регистрация индексов при загрузке файла ===
-def register_file(file_name: str, md_text: str):
-    fm, body = parse_frontmatter(md_text)
-    doc_type = norm_topic(fm.get("doc_type"))
-    topic = norm_topic(fm.get("topic") or doc_type)
-    if topic not in CANON:
-        topic = "clinic"  # fallback на clinic
-
-    aliases = fm.get("aliases") or []
-    if isinstance(aliases, str): aliases = [aliases]
-    mini_links = fm.get("mini_links") or []
-
-    FILE_META[file_name] = {"topic": topic, "aliases": aliases, "mini_links": mini_links}
-
-    # глобальные алиасы → файл/тема
-    for a in aliases:
-        ALIAS_MAP_GLOBAL[norm_text(a)] = {"topic": topic, "file": file_name}
-
-    # H2 и локальные алиасы → точный индекс
-    for s in parse_h2_sections(body):
-        # индексируем заголовок и h2_id
-        for key in [s["title"], s["h2_id"], *s["local_aliases"]]:
-            H2_INDEX[norm_text(key)] = {"topic": topic, "file": file_name, "h2_id": s["h2_id"]}
+# фронтматтер, секции H2/H3, врачи и каталог разбираются за один проход (core/md_document.py)
+from core.md_document import ParsedDocument, parse_document
+from core.followups_enhanced import followups_for_document
 
 # === 5) DEFAULT_H2 (страховка) ===
 DEFAULT_H2 = {
@@ -285,144 +343,9 @@ DEFAULT_H2 = {
   "clinic":       ("advantages-general.md",        "обзор")
 }
 
-def _find_chunk(file_name: str, h2_id: str|None):
-    for ch in ALL_CHUNKS:
-        if ch.file_name == file_name:
-            if h2_id is None or getattr(ch.metadata, "h2_id", None) == h2_id:
-                return ch
-    return None
-
-def get_default_chunk_for_topic(topic: str):
-    file_name, h2_id = DEFAULT_H2.get(topic, (None, None))
-    if file_name:
-        ch = _find_chunk(file_name, h2_id)
-        if ch: return ch, {"source":"default","topic":topic,"exact_h2_match":bool(h2_id)}
-    # запасной путь — первый чанк этой темы
-    for ch in ALL_CHUNKS:
-        if getattr(ch.metadata, "topic", None) == topic:
-            return ch, {"source":"default-any","topic":topic,"exact_h2_match":False}
-    return None, {}
-
-def parse_yaml_front_matter(text: str):
-    """Парсит YAML front matter из markdown файла"""
-    pattern = r'^---\s*\n(.*?)\n---\s*\n'
-    m = re.search(pattern, text, re.DOTALL | re.MULTILINE)
-    
-    if m:
-        yaml_content = m.group(1)
-        try:
-            metadata = yaml.safe_load(yaml_content) or {}
-        except yaml.YAMLError:
-            metadata = {}
-        # КЛЮЧЕВАЯ ПРАВКА: вырезаем только первый front-matter
-        content = text[m.end():]
-        return Frontmatter(metadata), content.strip()
-    else:
-        return Frontmatter({}), text
-
-def chunk_text_by_sections(content: str, file_name: str) -> List[RetrievedChunk]:
-    """Разбивает текст на чанки по секциям (## и ###) с H2/H3 метаданными"""
-    chunks = []
-    
-    # Разрезаем Н2 (## ...)
-    h2_blocks = re.split(r'(?m)^\s*##\s+', content)
-    
-    for block_idx, block in enumerate(h2_blocks):
-        block = block.strip()
-        if not block:
-            continue
-        
-        lines = block.splitlines()
-        h2_title = lines[0]
-        h2_body = '\n'.join(lines[1:])
-        
-        # Парсим H2-алиасы из HTML-комментариев
-        h2_aliases = []
-        h2_id = None
-        
-        # Ищем {#id} в заголовке
-        id_match = re.search(r'\{#([^}]+)\}', h2_title)
-        if id_match:
-            h2_id = id_match.group(1)
-            h2_title = re.sub(r'\s*\{#[^}]+\}\s*', '', h2_title).strip()
-        else:
-            # Создаем slug из заголовка если нет явного ID
-            h2_id = slugify(h2_title)
-        
-        # Ищем алиасы в первой строке после заголовка
-        if lines and len(lines) > 1:
-            first_line = lines[1].strip()
-            alias_match = re.search(r'<!--\s*aliases:\s*\[(.*?)\]\s*-->', first_line, re.IGNORECASE)
-            if alias_match:
-                aliases_str = alias_match.group(1)
-                # Парсим алиасы из строки
-                h2_aliases = [a.strip().strip('"\'') for a in re.split(r',\s*', aliases_str) if a.strip()]
-        
-        # Если внутри есть Н3 режем по ним (### ...)
-        h3_blocks = re.split(r'(?m)^\s*###\s+', block)
-        if len(h3_blocks) > 1:
-            # parts[0] — содержимое до первого ### <- ЭТО НУЖНО СОХРАНИТЬ!
-            if h3_blocks[0].strip():
-                preamble_text = f"## {h2_title}\n{h3_blocks[0].strip()}"
-                chunk_id = f"{file_name}#{h2_id}_preamble"
-                block_id = f"{file_name}#{block_idx:04d}"
-                
-                # Создаем метаданные с H2/H3 полями
-                temp_metadata = Frontmatter({
-                    "h2_id": h2_id,
-                    "h2_title": h2_title,
-                    "h3_id": "",
-                    "h3_title": "",
-                    "aliases": h2_aliases,
-                    "block_id": block_id
-                })
-                
-                chunks.append(RetrievedChunk(chunk_id, preamble_text.strip(), temp_metadata, file_name))
-            
-            # дальше создать чанки для каждого ### как сейчас
-            for h3_idx, h3 in enumerate(h3_blocks[1:], 1):
-                h3 = h3.strip()
-                if not h3:
-                    continue
-                
-                lines = h3.splitlines()
-                h3_title = lines[0]
-                h3_body = '\n'.join(lines[1:])
-                
-                text = f"## {h2_title}\n### {h3_title}\n{h3_body}"
-                chunk_id = f"{file_name}#{h2_id}_{slugify(h3_title)}"
-                block_id = f"{file_name}#{block_idx:04d}_{h3_idx:04d}"
-                
-                # Создаем метаданные с H2/H3 полями
-                temp_metadata = Frontmatter({
-                    "h2_id": h2_id,
-                    "h2_title": h2_title,
-                    "h3_id": slugify(h3_title),
-                    "h3_title": h3_title,
-                    "aliases": h2_aliases,
-                    "block_id": block_id
-                })
-                
-                chunks.append(RetrievedChunk(chunk_id, text.strip(), temp_metadata, file_name))
-        else:
-            # Н3 нет - сохраняем Н2 как единый чанк
-            text = f"## {h2_title}\n{h2_body}"
-            chunk_id = f"{file_name}#{h2_id}"
-            block_id = f"{file_name}#{block_idx:04d}"
-            
-            # Создаем метаданные с H2/H3 полями
-            temp_metadata = Frontmatter({
-                "h2_id": h2_id,
-                "h2_title": h2_title,
-                "h3_id": "",
-                "h3_title": "",
-                "aliases": h2_aliases,
-                "block_id": block_id
-            })
-            
-            chunks.append(RetrievedChunk(chunk_id, text.strip(), temp_metadata, file_name))
-    
-    return chunks
+def chunks_from_document(doc: ParsedDocument) -> List[RetrievedChunk]:
+    """Чанки документа по блокам H2/H3 (метаданные блока, без фронтматтера файла)"""
+    return [RetrievedChunk(b.chunk_id, b.text, Frontmatter(b.metadata()), doc.file_name) for b in doc.blocks]
 
 def extract_aliases_from_chunk(chunk_text: str) -> List[str]:
     """Извлекает алиасы из HTML-комментариев в чанке"""
@@ -434,111 +357,25 @@ def extract_aliases_from_chunk(chunk_text: str) -> List[str]:
     aliases = [a or b for a, b in pairs]
     return [a.strip() for a in aliases if a and a.strip()]
 
-def update_entity_index(chunk: RetrievedChunk, topic: str, entity_key: str):
-    """Обновляет ENTITY_INDEX с алиасами из чанка"""
-    # Извлекаем заголовок ##
-    header_match = re.search(r'(?m)^##\s+(.+?)\s*$', chunk.text)
-    title = header_match.group(1).strip() if header_match else ""
-    
-    # Алиасы: HTML-коммент в тексте + фронтматтер
-    aliases = extract_aliases_from_chunk(chunk.text)
-    if hasattr(chunk, "metadata") and getattr(chunk.metadata, "aliases", None):
-        aliases.extend(chunk.metadata.aliases)
-    if title:
-        aliases.append(title)
-    
-    # Индексируем все алиасы
-    for alias in aliases:
-        alias_norm = _norm(alias)
-        if alias_norm:
-            ENTITY_INDEX[alias_norm] = {
-                "topic": topic,
-                "entity": entity_key,
-                "doc_id": chunk.file_name,
-                "section": title
-            }
-
-# Загружаем и разбиваем все markdown-файлы
-folder_path = Path("md/")
-all_chunks: List[RetrievedChunk] = []
-
-# Глобальные переменные для динамического поиска врачей
-DOCTOR_NAME_TOKENS: set[str] = set()
-# Прямая адресация врачей: имя -> чанк
-DOCTOR_NAME_TO_CHUNK: dict[str, RetrievedChunk] = {}
-DOCTOR_REGEX = None
-DOCTOR_NAME_REGEX = None  # только имена
-DOCTOR_QUERY_REGEX = None  # имена + слова "врач/доктор/..."
-
 # ==== THEMES (усиление по темам) ====
-try:
-    from pathlib import Path
-    import json, re
-    
-    BASE_DIR = Path(__file__).resolve().parent
-    THEMES_PATH = BASE_DIR / "config" / "themes.json"
-    
-    with open(THEMES_PATH, "r", encoding="utf-8") as f:
-        THEME_MAP = json.load(f)
-    
-    # компиляция регексов и нормализация
-    for k, cfg in THEME_MAP.items():
-        cfg["query_regex_compiled"] = re.compile(cfg["query_regex"], re.IGNORECASE)
-        cfg["tag_aliases"] = [str(t).lower() for t in cfg.get("tag_aliases", [])]
-        cfg["weight"] = float(cfg.get("weight", 0.2))
-    print(f"OK: themes.json loaded: {len(THEME_MAP)} themes from {THEMES_PATH}")
-    for theme, cfg in THEME_MAP.items():
-        print(f"  Theme: {theme}: weight={cfg.get('weight', 'N/A')}, regex={cfg.get('query_regex', 'N/A')[:30]}...")
-except Exception as e:
-    print(f"WARNING: Не удалось загрузить themes.json: {e}")
-    THEME_MAP = {}
-
-def _extract_doctor_names_from_text(text: str) -> list[str]:
-    """Извлекает имена врачей из текста"""
-    names = set()
-    
-    for line in text.split('\n'):
-        line = line.strip()
-        if not line:
-            continue
-            
-        # срезать префикс ### / ##
-        if line.startswith('### '):
-            line = line[4:]
-        elif line.startswith('## '):
-            line = line[3:]
-            
-        # Имя Фамилия [Отчество]
-        match = re.match(r'^[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2}$', line)
-        if match:
-            full = match.group(0)
-            parts = full.split()
-            if len(parts) >= 2:
-                names.add(full)  # полное ФИО
-                names.add(parts[0])  # фамилия
-                names.add(f"{parts[0]} {parts[1]}")  # Фамилия Имя
-                names.add(f"{parts[1]} {parts[0]}")  # Имя Фамилия
-                print(f"    🏥 Извлечено имя: '{full}' → {parts[0]}, {parts[1]} {parts[0]}")
-    
-    return sorted(list(names))
-
-def _rebuild_doctor_regex():
-    """Пересобирает regex для поиска врачей"""
-    global DOCTOR_REGEX, DOCTOR_NAME_REGEX, DOCTOR_QUERY_REGEX
-    
-    base = ['врач', 'доктор', 'хирург', 'имплантолог', 'специалист']
-    name_tokens = sorted([re.escape(t) for t in DOCTOR_NAME_TOKENS], key=len, reverse=True)
-    base_tokens = [re.escape(t) for t in base]
-
-    if name_tokens:
-        DOCTOR_NAME_REGEX = re.compile(r'(' + '|'.join(name_tokens) + r')', re.IGNORECASE)
-        DOCTOR_QUERY_REGEX = re.compile(r'(' + '|'.join(name_tokens + base_tokens) + r')', re.IGNORECASE)
-    else:
-        DOCTOR_NAME_REGEX = None
-        DOCTOR_QUERY_REGEX = re.compile(r'(' + '|'.join(base_tokens) + r')', re.IGNORECASE)
-    
-    # Оставляем старый DOCTOR_REGEX для совместимости
-    DOCTOR_REGEX = DOCTOR_QUERY_REGEX
+def load_theme_map(path: Path = THEMES_PATH) -> Dict[str, dict]:
+    """Загружает themes.json и компилирует регексы тем"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            theme_map = json.load(f)
+        
+        # компиляция регексов и нормализация
+        for k, cfg in theme_map.items():
+            cfg["query_regex_compiled"] = re.compile(cfg["query_regex"], re.IGNORECASE)
+            cfg["tag_aliases"] = [str(t).lower() for t in cfg.get("tag_aliases", [])]
+            cfg["weight"] = float(cfg.get("weight", 0.2))
+        print(f"OK: themes.json loaded: {len(theme_map)} themes from {path}")
+        for theme, cfg in theme_map.items():
+            print(f"  Theme: {theme}: weight={cfg.get('weight', 'N/A')}, regex={cfg.get('query_regex', 'N/A')[:30]}...")
+    except Exception as e:
+        print(f"WARNING: Не удалось загрузить themes.json: {e}")
+        theme_map = {}
+    return theme_map
 
 def build_empathy_prompt(tone: str = "friendly", emotion: str = "empathy", allow_emoji: bool = True, cta_text: str | None = None, cta_link: str | None = None) -> str:
     """Собирает короткий промпт для «оживления» ответа без искажения фактов."""
@@ -577,7 +414,7 @@ def postprocess_answer_with_empathy(answer_text, user_text, intent, topic_meta,
 
 def theme_boost(score: float, theme_key: str, cfg: dict, chunk) -> float:
     # бустим, если в тегах или тексте есть тематические алиасы
-    text_l = chunk.text.lower()
+    text_l = chunk.fields.lower
     tags_l = getattr(chunk.metadata, 'tags_lower', [])
     
     # Проверяем теги
@@ -600,68 +437,22 @@ def has_numeric_facts(text: str) -> bool:
     text_l = text.lower()
     return bool(PCT_RE.search(text_l) or NUM_RE.search(text_l))
 
-def _find_doctor_direct_or_fuzzy(query: str):
-    q = (query or "").lower().replace("\u00a0", "")
-    # 1) прямое подстрочное совпадение по ключам
-    for k, ch in DOCTOR_NAME_TO_CHUNK.items():
-        if k in q:
-            return ch
-    # 2) морфологически «мягко» по фамилии: Моисеев/Моисеева/Моисееву...
-    for k, ch in DOCTOR_NAME_TO_CHUNK.items():
-        if " " not in k: # только однословные ключи = фамилии
-            if re.search(rf"\b{k}\w*\b", q, flags=re.IGNORECASE):
-                return ch
-    # 3) опечатки
-    tokens = re.findall(r"[а-яё]{4,}", q)
-    keys = list(DOCTOR_NAME_TO_CHUNK.keys())
-    for t in tokens:
-        best = difflib.get_close_matches(t, keys, n=1, cutoff=0.84)
-        if best:
-            return DOCTOR_NAME_TO_CHUNK[best[0]]
-    return None
-
-def fallback_theme_chunks(theme_key: str, limit: int = 3):
-    """Если семантика промахнулась - вернуть несколько явных тематических чанков."""
-    if not theme_key:
-        return []
-    
-    cfg = THEME_MAP[theme_key]
-    out = []
-    
-    print(f"🔍 Fallback для темы '{theme_key}': ищем теги {cfg['tag_aliases']}")
-    
-    for ch in ALL_CHUNKS:
-        tags_l = getattr(ch.metadata, 'tags_lower', [])
-        text_l = ch.text.lower()
-        
-        # Проверяем теги
-        tag_match = any(alias in (tags_l or []) for alias in cfg["tag_aliases"])
-        # Проверяем текст
-        text_match = any(alias in text_l for alias in cfg["tag_aliases"])
-        
-        if tag_match or text_match:
-            out.append(ch)
-            print(f"  ✅ Найден чанк: {ch.file_name} (теги: {tags_l}, текст содержит: {[alias for alias in cfg['tag_aliases'] if alias in text_l]})")
-            if len(out) >= limit:
-                break
-    
-    print(f"🔍 Fallback вернул {len(out)} чанков")
-    return out
-
-def route_topics(query: str) -> Set[str]:
-    """Роутер по темам - определяет темы запроса"""
-    if not hasattr(route_topics, 'theme_map'):
-        try:
-            with open(THEMES_PATH, "r", encoding="utf-8") as f:
-                route_topics.theme_map = json.load(f)
-        except Exception as e:
-            print(f"⚠️ Не удалось загрузить themes.json: {e}")
-            route_topics.theme_map = {}
+def route_topics(query: str, theme_map: Optional[Dict[str, dict]] = None) -> Set[str]:
+    """Роутер по темам - определяет темы запроса (theme_map по умолчанию — config/themes.json)"""
+    if theme_map is None:
+        if not hasattr(route_topics, 'theme_map'):
+            try:
+                with open(THEMES_PATH, "r", encoding="utf-8") as f:
+                    route_topics.theme_map = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Не удалось загрузить themes.json: {e}")
+                route_topics.theme_map = {}
+        theme_map = route_topics.theme_map
     
     detected_topics = set()
     query_lower = query.lower()
     
-    for topic, config in route_topics.theme_map.items():
+    for topic, config in theme_map.items():
         # Проверяем regex
         if "query_regex" in config:
             try:
@@ -708,276 +499,51 @@ def strip_fluff_start(text: str) -> str:
     
     return '\n'.join(lines)
 
-try:
-    # Проверяем наличие папки md
-    if not folder_path.exists():
-        print(f"ERROR: Папка {folder_path} НЕ найдена!")
-        raise Exception(f"Папка {folder_path} не существует")
-    
-    # Проверяем наличие doctors.md
-    doctors_file = Path("md/doctors.md")
-    if doctors_file.exists():
-        print(f"OK: Файл doctors.md найден")
-    else:
-        print(f"ERROR: Файл doctors.md НЕ найден!")
-    
-    # Проверяем наличие themes.json
-    themes_file = Path("config/themes.json")
-    if themes_file.exists():
-        print(f"OK: Файл config/themes.json найден")
-    else:
-        print(f"ERROR: Файл config/themes.json НЕ найден!")
-    
-    # Подключаем фильтр для служебных MD файлов
-    from core.md_filter import is_index_like
-    import json, logging
-    log_m = logging.getLogger("cesi.minimal_logs")
-    
-    all_md_files = list(folder_path.rglob("*.md"))
-    skipped = 0
-    docs = []
-    
-    for file in all_md_files:
-        try:
-            print(f"📄 Обрабатываю файл: {file}")
-            text = file.read_text(encoding="utf-8")
-            
-            # Фильтруем служебные файлы
-            if is_index_like(file, text):
-                skipped += 1
-                print(f"  ⏭️ Пропускаем служебный файл: {file.name}")
-                continue
-            
-            print(f"  📖 Прочитан файл: {file.name} ({len(text)} символов)")
-            
-            # Регистрируем файл в новых индексах
-            register_file(file.name, text)
-            
-            # Парсим YAML front matter
-            metadata, content = parse_yaml_front_matter(text)
-            content = _normalize(content) # нормализуем пробелы
-            print(f"  ✅ YAML парсинг: {metadata.id if metadata.id else 'без ID'}")
-            
-            # Регистрируем алиасы для fallback поиска
-            try:
-                from core.md_loader import register_aliases
-                # Конвертируем metadata в dict для register_aliases
-                frontmatter_dict = {
-                    "aliases": getattr(metadata, 'aliases', []),
-                    "primary_h2_id": getattr(metadata, 'primary_h2_id', None)
-                }
-                register_aliases(frontmatter_dict, str(file))
-            except Exception as e:
-                print(f"  ⚠️ Ошибка регистрации алиасов: {e}")
-            
-            # Локальная регистрация алиасов
-            for a in (getattr(metadata, 'aliases', ()) or []):
-                ALIAS_MAP[_norm(a)] = {"file": str(file), "primary_h2_id": getattr(metadata, 'primary_h2_id', None)}
-            
-            # если это файл с врачами - собрать имена
-            if getattr(metadata, 'doc_type', '') in ('doctor', 'doctors') or file.name == "doctors.md":
-                found = _extract_doctor_names_from_text(content)
-                if found:
-                    DOCTOR_NAME_TOKENS.update(found)
-                    print(f"  🏥 Найдены врачи в {file.name}: {found}")
-            
-            # Разбиваем на чанки по секциям
-            file_chunks = chunk_text_by_sections(content, file.name)
-            print(f"  📝 Создано чанков: {len(file_chunks)}")
-            
-            # ==== ИНДЕКСАЦИЯ КАТАЛОГА ИМПЛАНТОВ ====
-            if metadata.doc_type == "catalog" and metadata.topic == "implants":
-                print(f"  🏷️ Индексируем каталог имплантов из {file.name}")
-                for ch in file_chunks:
-                    # Ищем секции по ### Заголовок
-                    m = re.search(r'(?m)^###\s+(.+?)\s*$', ch.text)
-                    if not m:
-                        continue
-                    
-                    name = m.group(1).strip()
-                    
-                    # Парсим алиасы из HTML-комментариев
-                    alias_m = re.search(r'<!--\s*aliases:\s*\[(.*?)\]\s*-->', ch.text)
-                    aliases = [name]
-                    if alias_m:
-                        aliases.extend([a.strip() for a in alias_m.group(1).split(',')])
-                    
-                    # Создаем entity_key
-                    entity_key = _slugify_implant_kind(name)
-                    print(f"    📋 Секция: '{name}' → '{entity_key}' (алиасы: {aliases})")
-                    
-                    # Сохраняем чанк
-                    ENTITY_CHUNKS[("implants", entity_key)] = ch
-                    
-                    # Индексируем алиасы
-                    for a in aliases:
-                        ENTITY_INDEX[_norm(a)] = {
-                            "topic": "implants", 
-                            "entity": entity_key, 
-                            "doc_id": metadata.id or file.name, 
-                            "section": name
-                        }
-            
-            # Привязываем метаданные к каждому чанку (merge: поля чанка важнее полей файла)
-            for chunk in file_chunks:
-                file_meta = metadata.__dict__ if hasattr(metadata, "__dict__") else {}
-                chunk_meta = chunk.metadata.__dict__ if hasattr(chunk.metadata, "__dict__") else {}
-                merged = {**file_meta, **chunk_meta}  # H2/H3/aliases из чанка НЕ теряем
-                chunk.metadata = Frontmatter(merged)
-                
-                # Обновляем ENTITY_INDEX для всех чанков
-                if metadata.topic:
-                    update_entity_index(chunk, metadata.topic, chunk.id)
-                
-                # перед append(chunk) - нормализуй теги в метаданных
-                try:
-                    if hasattr(chunk.metadata, "tags") and isinstance(chunk.metadata.tags, list):
-                        chunk.metadata.tags_lower = [str(t).strip().lower() for t in chunk.metadata.tags]
-                    else:
-                        chunk.metadata.tags_lower = []
-                except Exception:
-                    chunk.metadata.tags_lower = []
-                
-                all_chunks.append(chunk)
-                
-                # Регистрируем все чанки в ENTITY_CHUNKS (не только импланты)
-                ENTITY_CHUNKS[(chunk.metadata.topic or "general", chunk.id)] = chunk
-                
-                # Если это карточка врача (подзаголовок ## или ### Имя Фамилия [Отчество]) — запоминаем прямую ссылку
-                hdr = re.search(r'(?m)^#{2,3}\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2})\s*$', chunk.text)
-                if hdr:
-                    full = hdr.group(1).strip()
-                    parts = full.split()
-                    last = parts[0] # Фамилия
-                    first = parts[1] if len(parts) > 1 else ""
-                    patr = parts[2] if len(parts) > 2 else ""
-                    
-                    # Ключи, по которым реально спрашивают
-                    keys = {
-                        full,                               # "Моисеев Кирилл Николаевич"
-                        last,                               # "Моисеев"
-                        (f"{last} {first}").strip(),        # "Моисеев Кирилл"
-                        (f"{first} {last}").strip(),        # "Кирилл Моисеев"
-                    }
-                    
-                    for k in keys:
-                        DOCTOR_NAME_TO_CHUNK[k.lower()] = chunk
-                    
-                    # Для регэкспа/подсветки - без отчеств, чтобы не засорять
-                    DOCTOR_NAME_TOKENS.update({full, last, f"{first} {last}".strip(), f"{last} {first}".strip()})
-                    print(f"🔗 Карточка врача: {full} → {getattr(chunk, 'section', chunk.file_name)}; ключи: {sorted(keys)}")
-            
-            print(f"  ✅ Файл обработан успешно")
-        except Exception as e:
-            print(f"❌ Ошибка при обработке файла {file}: {e}")
-            import traceback
-            traceback.print_exc()
-            continue
-    
-    # Логируем статистику фильтрации
-    log_m.info({"ev":"filter_index_like","skipped":skipped,"total":len(all_md_files)})
-    
-    print(f"\u23f3 Найдено {len(all_chunks)} чанков")
-    
-    # Инициализируем ALL_CHUNKS для новых индексов
-    ALL_CHUNKS.extend(all_chunks)
-    print(f"✅ ALL_CHUNKS инициализирован: {len(ALL_CHUNKS)} чанков")
-    print(f"✅ ALIAS_MAP_GLOBAL: {len(ALIAS_MAP_GLOBAL)} алиасов")
-    print(f"✅ H2_INDEX: {len(H2_INDEX)} заголовков")
-    print(f"✅ FILE_META: {len(FILE_META)} файлов")
-    
-    # Логируем статистику индексов
-    print(f"📊 INDEX STATS: docs={len(FILE_META)}, chunks={len(ALL_CHUNKS)}, aliases={len(ALIAS_MAP_GLOBAL)}, h2s={len(H2_INDEX)}")
-    
-    # Создаем BM25 индекс
-    if ALL_CHUNKS:
-        print(f"🔍 Создаем BM25 индекс для {len(ALL_CHUNKS)} чанков...")
-        bm25_corpus = []
-        for chunk in ALL_CHUNKS:
-            # Токенизируем текст + реальные алиасы для BM25
-            boost_aliases = extract_aliases_from_chunk(chunk.text)
-            if getattr(chunk.metadata, "aliases", None):
-                boost_aliases += list(chunk.metadata.aliases)
-            alias_boost = " ".join(boost_aliases)
-            tokens = re.findall(r'\w+', (chunk.text + " " + alias_boost).lower())
-            bm25_corpus.append(tokens)
-        
-        bm25_index = BM25Okapi(bm25_corpus)
-        print(f"✅ BM25 индекс создан")
-    
-    # Отладочная информация о чанках
-    for chunk in ALL_CHUNKS[:5]:  # Показываем первые 5 чанков
-        print(f"  📄 {chunk.file_name}: {chunk.text[:80]}...")
-    
-    # Пересобираем regex для врачей
-    _rebuild_doctor_regex()
-    print(f"Врачи: Собраны имена врачей: {len(DOCTOR_NAME_TOKENS)} -> {sorted(list(DOCTOR_NAME_TOKENS))[:6]} ...")
-    
-    # Проверяем, что есть чанки для обработки
-    if len(all_chunks) == 0:
-        print("⚠️ Предупреждение: Не найдено ни одного чанка для обработки")
-        # Создаем пустой индекс
-        dimension = 1536  # размерность text-embedding-3-small
-        index = IndexFlatIP(dimension)
-    else:
-        # Получаем эмбеддинги для всех фрагментов
-        print(f"\u23f3 Генерация эмбеддингов для {len(all_chunks)} чанков...")
-        
-        def get_embedding(text: str) -> List[float]:
-            resp = openai_client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text,
-                encoding_format="float"
-            )
-            return resp.data[0].embedding
-        
-        # Делаем функцию глобально доступной
-        globals()['get_embedding'] = get_embedding
-        
-        # Создаем эмбеддинги: текст + реальные алиасы для поиска
-        chunk_texts = []
-        for chunk in ALL_CHUNKS:
-            boost_aliases = extract_aliases_from_chunk(chunk.text)
-            if getattr(chunk.metadata, "aliases", None):
-                boost_aliases += list(chunk.metadata.aliases)
-            alias_boost = " ".join(boost_aliases)
-            chunk_texts.append((chunk.text + " " + alias_boost).strip())
-        embeddings = [get_embedding(text) for text in chunk_texts]
-        
-        dimension = len(embeddings[0])
-        xb = np.asarray(embeddings, dtype="float32")
-        normalize_L2_inplace(xb)
-        index = IndexFlatIP(dimension)
-        index.add(xb)
-        
-        print(f"✅ Индекс создан с {len(ALL_CHUNKS)} чанками")
-        
-        # Логируем backend при старте
-        from core.logger import log_m
-        log_m.info({"event": "faiss_backend", "value": "faiss" if HAS_FAISS else "numpy"})
+# ==== БАНДЛ ИНДЕКСОВ (tools/build_index.py) ====
+INDEX_BUNDLE_LOAD = os.getenv("INDEX_BUNDLE_LOAD", "true").lower() == "true"
+INDEX_BUNDLE_VERIFY = os.getenv("INDEX_BUNDLE_VERIFY", "true").lower() == "true"
 
-except Exception as e:
-    print(f"❌ Критическая ошибка при инициализации: {e}")
-    import traceback
-    traceback.print_exc()
-    print("⚠️ Embeddings недоступны, работаем только на BM25 и правилах")
-    index = None
-    # нет FAISS, но чанки оставляем!
-
-# Fallback функция get_embedding
-def get_embedding(text: str) -> List[float]:
-    """Fallback функция для создания эмбеддингов"""
-    try:
-        resp = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text,
-            encoding_format="float"
-        )
-        return resp.data[0].embedding
-    except Exception as e:
-        print(f"Ошибка при создании эмбеддинга: {e}")
-        # Возвращаем нулевой вектор
-        return [0.0] * 1536
+# Прогрессивный старт: сначала BM25/сущности/врачи, векторный индекс подключается из фонового потока
+DENSE_ASYNC = os.getenv("DENSE_ASYNC", "true").lower() == "true"
+DENSE_RETRY_BASE = float(os.getenv("DENSE_RETRY_BASE", "5"))     # первая пауза между попытками, сек
+DENSE_RETRY_MAX = float(os.getenv("DENSE_RETRY_MAX", "300"))     # потолок паузы, сек
+
+# Разбор md-файлов в пуле процессов (1 — последовательно в текущем процессе, 0 — по числу CPU)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+
+# Оценка памяти снимка: накладные расходы CPython на чанк с метаданными и на запись BM25
+# (см. tools/bench_chunk_memory.py)
+CHUNK_OVERHEAD_BYTES = 400
+BM25_POSTING_BYTES = 100
+
+def _chunk_record(chunk: RetrievedChunk) -> Dict[str, Any]:
+    """Плоская запись чанка для бандла (поля файла и секции вместе)"""
+    meta = chunk.metadata.to_dict()
+    meta["tags_lower"] = list(getattr(chunk.metadata, "tags_lower", []) or [])
+    # в to_dict стандартные поля файла (title, doc_type) перекрыты умолчаниями — фронтматтер файла пишем отдельно
+    return {"id": chunk.id, "file_name": chunk.file_name, "meta": meta, "document": dict(chunk.metadata.document._own)}
+
+def _chunk_from_record(pos: int, rec: Dict[str, Any], files: Dict[str, Frontmatter], arena: TextArena) -> RetrievedChunk:
+    """
+    Чанк из записи бандла; поля файла выносятся в общий для его чанков Frontmatter.
+
+    Args:
+        pos: Позиция чанка (и его текста в арене)
+        rec: Запись бандла (id, file_name, meta, document)
+        files: Кэш метаданных файлов {file_name: Frontmatter}, общий для всех записей бандла
+        arena: Арена текстов бандла
+    """
+    meta = dict(rec["meta"])
+    tags_lower = meta.pop("tags_lower", [])
+    own = {k: v for k, v in meta.items() if k in FRONTMATTER_DEFAULTS or k in CHUNK_FIELDS}
+    # бандлы до записи "document" — поля файла только те, что не перекрыты умолчаниями
+    file_fields = rec["document"] if "document" in rec else {k: v for k, v in meta.items() if k not in own}
+    file = files.get(rec["file_name"])
+    if file is None or file._own != file_fields:
+        file = files[rec["file_name"]] = Frontmatter(file_fields)
+    metadata = Frontmatter(own, file=file)
+    metadata.tags_lower = tags_lower or _NO_TAGS
+    return RetrievedChunk(rec["id"], pos, metadata, rec["file_name"], arena=arena)
 
 def generate_query_variants(query: str) -> List[str]:
     """Генерирует 2-3 варианта перефразировки запроса для лучшего поиска"""
@@ -1065,12 +631,37 @@ def _len_penalty(item):
     penalty = float(os.getenv('LEN_PENALTY', '0.05')) * (len_tokens / 1000)
     return penalty
 
+class ScoreTable(dict):
+    """
+    Оценки ретривала одного запроса: чанк → {"total_rrf", "hybrid", "score", ...}.
+    Чанки снимка общие для параллельных запросов, поэтому оценки живут здесь, а не на чанках.
+    """
+
+    def of(self, chunk) -> Dict[str, float]:
+        """Оценки чанка (пустой словарь, если в этом запросе он не оценивался)"""
+        return self.get(chunk, {})
+
+    def put(self, chunk, **values: float) -> None:
+        self.setdefault(chunk, {}).update(values)
+
+    def add(self, entries: List[Dict[str, Any]]) -> List[RetrievedChunk]:
+        """Записи rrf_fusion/hybrid_merge → оценки в таблицу; возвращает чанки в порядке записей"""
+        for e in entries:
+            self.put(e["chunk"], **{k: v for k, v in e.items() if k != "chunk"})
+        return [e["chunk"] for e in entries]
+
 def rrf_score(rank: int, k: int = 60) -> float:
     """Вычисляет RRF score для ранга"""
     return 1.0 / (k + rank)
 
-def rrf_fusion(emb_hits, bm25_hits, k: int = 8) -> List[RetrievedChunk]:
-    """RRF fusion для объединения результатов embed и BM25 поиска"""
+def rrf_fusion(emb_hits, bm25_hits, k: int = 8) -> List[Dict[str, Any]]:
+    """
+    RRF fusion для объединения результатов embed и BM25 поиска
+
+    Returns:
+        top-k записей {"chunk", "rrf_emb", "rrf_bm25", "total_rrf"} по убыванию total_rrf
+        (оценки — в записях, чанки снимка не меняются)
+    """
     rrf_k = int(os.getenv('RRF_K', '60'))
     
     # Создаем словарь для RRF scores
@@ -1101,24 +692,20 @@ def rrf_fusion(emb_hits, bm25_hits, k: int = 8) -> List[RetrievedChunk]:
     # Вычисляем общий RRF score
     candidates = []
     for key, data in rrf_scores.items():
-        chunk = data['chunk']
-        rrf_emb = data['rrf_emb']
-        rrf_bm25 = data['rrf_bm25']
-        total_rrf = rrf_emb + rrf_bm25
-        
-        # Устанавливаем атрибуты для логирования
-        chunk.rrf_emb = rrf_emb
-        chunk.rrf_bm25 = rrf_bm25
-        chunk.total_rrf = total_rrf
-        
-        candidates.append(chunk)
+        data['total_rrf'] = data['rrf_emb'] + data['rrf_bm25']
+        candidates.append(data)
     
     # Сортируем по общему RRF score и возвращаем top-k
-    candidates.sort(key=lambda x: x.total_rrf, reverse=True)
+    candidates.sort(key=lambda x: x['total_rrf'], reverse=True)
     return candidates[:k]
 
-def hybrid_merge(emb_hits, bm25_hits, k, w_emb, w_bm25):
-    """Сливает результаты embed и BM25 поиска с ключами по H3/блоку"""
+def hybrid_merge(emb_hits, bm25_hits, k, w_emb, w_bm25) -> List[Dict[str, Any]]:
+    """
+    Сливает результаты embed и BM25 поиска с ключами по H3/блоку
+
+    Returns:
+        top-k записей {"chunk", "emb", "bm25", "hybrid"} по убыванию hybrid
+    """
     # Нормируем scores в [0, 1]
     emb_scores = [score for _, score in emb_hits] if emb_hits else [0.0]
     bm25_scores = [score for _, score in bm25_hits] if bm25_hits else [0.0]
@@ -1168,124 +755,25 @@ def hybrid_merge(emb_hits, bm25_hits, k, w_emb, w_bm25):
     candidates = []
     for key, data in merged.items():
         chunk = data['chunk']
-        emb_score = data['emb']
-        bm25_score = data['bm25']
         
         # Комбинированный score
-        hybrid_score = w_emb * emb_score + w_bm25 * bm25_score
+        hybrid_score = w_emb * data['emb'] + w_bm25 * data['bm25']
         
         # Добавляем бусты и штрафы
         hybrid_score += _boost_by_doctype(chunk)
         hybrid_score -= _len_penalty(chunk)
         
-        # Устанавливаем атрибуты для логирования
-        chunk.emb = emb_score
-        chunk.bm25 = bm25_score
-        chunk.hybrid = hybrid_score
-        
-        candidates.append(chunk)
+        data['hybrid'] = hybrid_score
+        candidates.append(data)
     
     # Сортируем по hybrid score и возвращаем top-k
-    candidates.sort(key=lambda x: x.hybrid, reverse=True)
+    candidates.sort(key=lambda x: x['hybrid'], reverse=True)
     return candidates[:k]
 
-def embed_search(query, top=6):
-    """Поиск по эмбеддингам"""
-    if not index or not all_chunks:
-        return []
-    
-    try:
-        query_embedding = get_embedding(query)
-        q = np.asarray([query_embedding], dtype="float32")
-        normalize_L2_inplace(q)
-        D, I = index.search(q, min(top, len(all_chunks)))
-        
-        results = []
-        for i, sim in zip(I[0], D[0]):
-            # Для IndexFlatIP D возвращает сходство (больше — лучше)
-            results.append((all_chunks[i], float(sim)))
-        
-        return results
-    except Exception as e:
-        print(f"Ошибка в embed поиске: {e}")
-        return []
-
-def bm25_search(query, top=8):
-    """Поиск по BM25"""
-    if not bm25_index or not all_chunks:
-        return []
-    
-    query_tokens = re.findall(r'\w+', query.lower())
-    bm25_scores = bm25_index.get_scores(query_tokens)
-    
-    results = []
-    for i, score in enumerate(bm25_scores):
-        if score > 0:
-            results.append((all_chunks[i], score))
-    
-    # Сортируем по score и берем top
-    results.sort(key=lambda x: x[1], reverse=True)
-    return results[:top]
-
-def hybrid_retriever(query: str, top_n: int = 20) -> List[Tuple[RetrievedChunk, float]]:
-    """Гибридный ретривер: объединяет BM25 и эмбеддинги"""
-    if not all_chunks or len(all_chunks) == 0:
-        return []
-    
-    candidates = []
-    
-    # ==== BM25 поиск ====
-    if bm25_index:
-        query_tokens = re.findall(r'\w+', query.lower())
-        bm25_scores = bm25_index.get_scores(query_tokens)
-        bm25_candidates = []
-        
-        for i, score in enumerate(bm25_scores):
-            if score > 0:
-                bm25_candidates.append((all_chunks[i], score))
-        
-        # Нормализуем BM25 scores
-        if bm25_candidates:
-            max_score = max(score for _, score in bm25_candidates)
-            if max_score > 0:
-                bm25_candidates = [(chunk, score / max_score * 0.6) for chunk, score in bm25_candidates]
-                candidates.extend(bm25_candidates[:top_n])
-    
-    # ==== Эмбеддинги поиск ====
-    try:
-        query_embedding = get_embedding(query)
-        q = np.asarray([query_embedding], dtype="float32")
-        normalize_L2_inplace(q)
-        D, I = index.search(q, min(top_n, len(all_chunks)))
-        
-        # Нормализуем embedding scores для IP (max = лучший)
-        max_ip = max(D[0]) if len(D[0]) > 0 else 1.0
-        if max_ip > 0:
-            embedding_candidates = []
-            for i, sim in zip(I[0], D[0]):
-                score = (sim / max_ip) * 0.4  # чем больше IP, тем выше скор
-                embedding_candidates.append((all_chunks[i], score))
-            candidates.extend(embedding_candidates)
-    except Exception as e:
-        print(f"Ошибка в embedding поиске: {e}")
-    
-    # ==== Объединяем и убираем дубли ====
-    seen_chunks = set()
-    unique_candidates = []
-    
-    for chunk, score in candidates:
-        if chunk.id not in seen_chunks:
-            seen_chunks.add(chunk.id)
-            unique_candidates.append((chunk, score))
-    
-    # Сортируем по score и возвращаем top_n
-    unique_candidates.sort(key=lambda x: x[1], reverse=True)
-    return unique_candidates[:top_n]
-
-# --- safe structured_log (never raise) ---
-import logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-logger = logging.getLogger("cesi.rag")
+# --- safe structured_log (never raise) ---
+import logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logger = logging.getLogger("cesi.rag")
 
 try:
     # если у тебя уже есть модуль с реализацией — используем его
@@ -1355,12 +843,15 @@ RERANK_MAX_CHARS = int(os.getenv("RERANK_MAX_CHARS", "320"))
 _rerank_fail_streak = 0
 RERANK_CIRCUIT_MAX_FAILS = int(os.getenv("RERANK_CIRCUIT_MAX_FAILS", "3"))
 
-def llm_rerank(candidates: List[Tuple[RetrievedChunk, float]], query: str) -> List[Tuple[RetrievedChunk, float]]:
+def llm_rerank(candidates: List[Tuple[RetrievedChunk, float]], query: str,
+               scores: Optional[ScoreTable] = None) -> List[Tuple[RetrievedChunk, float]]:
     """
     candidates: list[Chunk]; у каждого есть .id, .text, .metadata
+    scores: оценки запроса (базовый вес — hybrid, если кандидат прошёл hybrid_merge)
     Возвращает list[(chunk, score)] по убыванию score.
     """
     global _rerank_fail_streak
+    scores = scores if scores is not None else ScoreTable()
     n = len(candidates)
     if n <= 1:
         return [(c, 1.0) for c in candidates]
@@ -1368,7 +859,7 @@ def llm_rerank(candidates: List[Tuple[RetrievedChunk, float]], query: str) -> Li
     # circuit breaker: если подряд много фейлов — не дергаем LLM
     if _rerank_fail_streak >= RERANK_CIRCUIT_MAX_FAILS:
         # базовое (до реранка) сортирование уже есть — просто вернём его
-        return [(c, getattr(c, "hybrid", 0.5)) for c in candidates]
+        return [(c, scores.of(c).get("hybrid", 0.5)) for c in candidates]
 
     # подготовим компактные элементы (чтоб не упереться в токены)
     items = []
@@ -1414,7 +905,7 @@ def llm_rerank(candidates: List[Tuple[RetrievedChunk, float]], query: str) -> Li
         # применяем к кандидатам; если какого-то id нет — даём базовый вес
         out = []
         for c in candidates:
-            sc = mapping.get(c.id, getattr(c, "hybrid", 0.5))
+            sc = mapping.get(c.id, scores.of(c).get("hybrid", 0.5))
             out.append((c, float(sc)))
         out.sort(key=lambda x: x[1], reverse=True)
         _rerank_fail_streak = 0
@@ -1427,8 +918,8 @@ def llm_rerank(candidates: List[Tuple[RetrievedChunk, float]], query: str) -> Li
             structured_log("rerank.error", reason=str(e), streak=_rerank_fail_streak)
         except Exception:
             pass
-        # Фолбэк: базовая сортировка (hybrid/RRF score уже на кандидатах есть)
-        return [(c, getattr(c, "hybrid", 0.5)) for c in candidates]
+        # Фолбэк: базовая сортировка (hybrid/RRF score уже в оценках запроса)
+        return [(c, scores.of(c).get("hybrid", 0.5)) for c in candidates]
 
 def select_chunk_by_alias(chunks: List[RetrievedChunk], query: str) -> RetrievedChunk | None:
     """Форс-матч по алиасам перед финальным выбором чанка"""
@@ -1441,489 +932,6 @@ def select_chunk_by_alias(chunks: List[RetrievedChunk], query: str) -> Retrieved
                 return chunk
     return None
 
-def reranker(candidates: List[Tuple[RetrievedChunk, float]], query: str, detected_topics: Set[str]) -> List[RetrievedChunk]:
-    """Реранкер с LLM-оценкой релевантности для HYBRID_TIGHT режима"""
-    if not candidates:
-        return []
-    
-    rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
-    rerank_enable = os.getenv('RERANK_ENABLE', 'false').lower() == 'true'
-    
-    # В PRECISE_SIMPLE режиме реранк отключен
-    if rag_mode == 'PRECISE_SIMPLE' or not rerank_enable:
-        # Простая сортировка по score
-        candidates.sort(key=lambda x: x[1], reverse=True)
-        return [chunk for chunk, _ in candidates[:3]]
-    
-    # В HYBRID_TIGHT режиме применяем LLM-реранкинг
-    if rag_mode == 'HYBRID_TIGHT':
-        # Берем больше кандидатов для реранкинга
-        top_candidates = [chunk for chunk, _ in candidates[:6]]  # минимум 6-8 кандидатов
-        llm_reranked = llm_rerank(top_candidates, query)
-        
-        # Затем применяем эвристические бонусы
-        scored_candidates = []
-        query_lower = query.lower()
-        
-        for chunk, base_score in llm_reranked:
-            final_score = base_score
-            
-            # +0.2 если тема от router совпала с темой чанка
-            if detected_topics and chunk.metadata.topic:
-                if chunk.metadata.topic in detected_topics:
-                    final_score += 0.2
-            
-            # +0.1 если найден alias через ENTITY_INDEX
-            for alias, meta in ENTITY_INDEX.items():
-                if alias in query_lower:
-                    if meta["doc_id"] == chunk.file_name:
-                        final_score += 0.1
-                        break
-            
-            scored_candidates.append((chunk, final_score))
-        
-        # Применяем штраф длины на финальной сортировке
-        len_penalty = float(os.getenv('LEN_PENALTY', '0.03'))
-        final_candidates = []
-        for chunk, score in scored_candidates:
-            # Штраф за длину
-            text = getattr(chunk, 'text', '') or ''
-            len_tokens = len(text) / 4  # Примерная оценка токенов
-            penalty = len_penalty * (len_tokens / 1000)
-            final_score = score - penalty
-            final_candidates.append((chunk, final_score))
-        
-        # Сортируем по финальному score
-        final_candidates.sort(key=lambda x: x[1], reverse=True)
-        
-        # Возвращаем top-RERANK_TOP_R чанков
-        rerank_top_r = int(os.getenv('RERANK_TOP_R', '3'))
-        return [chunk for chunk, _ in final_candidates[:rerank_top_r]]
-    
-    # Fallback для других режимов
-    candidates.sort(key=lambda x: x[1], reverse=True)
-    return [chunk for chunk, _ in candidates[:3]]
-
-
-
-# === 6) Ранний детектор H2 ===
-def detect_section_early(user_q: str):
-    q = norm_text(user_q)
-    hit = H2_INDEX.get(q)
-    if not hit:
-        # мягкое вхождение (минимум 3 символа для избежания ложных срабатываний)
-        for k, v in H2_INDEX.items():
-            if k and len(k) > 2 and k in q:
-                hit = v; break
-    if not hit: return None, {}
-    ch = _find_chunk(hit["file"], hit["h2_id"])
-    if not ch: return None, {}
-    return ch, {"source":"alias","exact_h2_match":True,"topic":hit["topic"]}
-
-# === 7) Главная функция ретрива ===
-def retrieve_relevant_chunks_new(user_q: str, theme_hint: str|None, candidates_func):
-    """Новая функция ретрива: подсказки (H2/тема) добавляются к кандидатам, а не прерывают поиск."""
-    print(f"🔍 NEW ENGINE: query='{user_q}', theme_hint='{theme_hint}'")
-
-    # Если явно разрешён старый fastpath — оставим прежнее поведение
-    if os.getenv("DISABLE_ALIAS_FASTPATH", "true").lower() != "true":
-        ch, flags = detect_section_early(user_q)
-        if ch:
-            print(f"✅ H2 match found (fastpath): {ch.id}")
-            return [ch], flags
-        if theme_hint in CANON:
-            ch, flags = get_default_chunk_for_topic(theme_hint)
-            if ch:
-                print(f"✅ Theme match found (fastpath): {theme_hint} -> {ch.id}")
-                return [ch], flags
-
-    mixed: list[RetrievedChunk] = []
-
-    # 1) точный H2 — добавляем к кандидатам
-    ch, _flags = detect_section_early(user_q)
-    if ch:
-        print(f"✅ H2 hint: {ch.id}")
-        mixed.append(ch)
-
-    # 2) дефолт по теме — тоже добавляем
-    if theme_hint in CANON:
-        ch2, _flags2 = get_default_chunk_for_topic(theme_hint)
-        if ch2:
-            print(f"✅ Theme hint: {theme_hint} -> {ch2.id}")
-            mixed.append(ch2)
-
-    # 3) обычный поиск
-    search_cands = candidates_func(user_q) or []
-    print(f"🔍 Search candidates: {len(search_cands)} found")
-    mixed.extend(search_cands)
-
-    # 4) дедуп по chunk.id или file_name
-    seen = set()
-    out = []
-    for c in mixed:
-        cid = getattr(c, "id", None) or getattr(getattr(c, "meta", {}), "get", lambda k=None: None)("id")
-        fid = getattr(c, "file_name", None)
-        key = cid or fid
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append(c)
-
-    # 5) Реранкер: дать базовый score и реально пересортировать
-    def _ensure_scores(cands):
-        """Убеждаемся, что у каждого кандидата есть базовый score"""
-        for i, c in enumerate(cands):
-            score = getattr(c, "score", None) or getattr(c, "cosine", None) or getattr(c, "bm25", None)
-            if score is None:
-                score = 0.5  # базовый score
-            c.score = float(score) - i * 1e-6  # стабильность порядка
-    
-    def _bonus_for_query(c, q: str, theme: str) -> float:
-        """Бонус за релевантность к запросу и теме"""
-        t = (getattr(c, "text", "") or "").lower()
-        q = (q or "").lower()
-        b = 0.0
-        
-        # прижив/оссео
-        if "прижив" in q or "оссео" in q:
-            if any(x in t for x in ["прижив", "оссеоинтегр"]): b += 0.10
-        
-        # боязнь/боль
-        if any(x in q for x in ["боюсь", "боль", "анестез", "обезбол"]):
-            if any(x in t for x in ["без боли", "анестез", "обезбол"]): b += 0.10
-        
-        # контакты
-        if theme == "contacts":
-            if any(x in t for x in ["адрес", "телефон", "график", "как добраться"]): b += 0.10
-        
-        # гарантия
-        if theme == "warranty":
-            if "гаранти" in t: b += 0.08
-        
-        # цены
-        if theme == "prices":
-            if any(x in t for x in ["цена", "стоимость", "сколько стоит", "рассрочка"]): b += 0.08
-        
-        return b
-    
-    _ensure_scores(out)
-    for c in out:
-        c.score += _bonus_for_query(c, user_q, theme_hint or "")
-    out.sort(key=lambda x: x.score, reverse=True)
-
-    return out, {"source": "mix", "exact_h2_match": False}
-
-def retrieve_relevant_chunks(query: str, top_k: int = None) -> List[RetrievedChunk]:
-    if top_k is None:
-        top_k = int(os.getenv("RAG_TOP_K", 5))  # было 8, теперь 5 по умолчанию
-    """Извлекает релевантные чанки с multi-query rewrite и улучшенным ранжированием"""
-    if len(ALL_CHUNKS) == 0:
-        print("⚠️ Нет чанков для поиска")
-        return []
-    
-    # ==== РОУТЕР ПО ТЕМАМ ====
-    detected_topics = route_topics(query)
-    print(f"🎯 Роутер определил темы: {detected_topics}")
-    
-    # Прямой alias-fallback по карте frontmatter (ОТКЛЮЧЕН)
-    # q = _norm(query or "")
-    # hit_map = ALIAS_MAP.get(q)
-    # if not hit_map:
-    #     # допускаем "alias ⊆ query" (например, запрос длиннее)
-    #     for a, meta in ALIAS_MAP.items():
-    #         if a and a in q:
-    #             hit_map = meta
-    #             break
-    #
-    # if hit_map:
-    #     # находим первый чанк соответствующего файла и возвращаем его
-    #     target = Path(hit_map["file"]).name
-    #     for ch in ALL_CHUNKS:
-    #         if ch.file_name == target:
-    #             print(f"✅ Alias-fallback: {q} -> {hit_map['file']}")
-    #             return [ch]
-    
-    # ==== БЫСТРЫЙ ПУТЬ: ДЕТЕКТ СУЩНОСТИ ====
-    q = _norm(query or "")
-    hit = None
-    
-    # Прямое вхождение алиаса
-    for alias, meta in ENTITY_INDEX.items():
-        if alias in q:
-            hit = ENTITY_CHUNKS.get((meta["topic"], meta["entity"]))
-            if not hit:
-                hit = next((ch for ch in all_chunks if ch.id == meta["entity"]), None) \
-                    or next((ch for ch in all_chunks if ch.file_name == meta["doc_id"]), None)
-            if hit:
-                break
-    
-    # Мягкий матч (разделители -/-/- и пробелы)
-    if not hit:
-        q2 = re.sub(r'[\-–—]', '', q)   # дефис/тире
-        for alias, meta in ENTITY_INDEX.items():
-            a2 = re.sub(r'[\-–—]', '', alias)   # дефис/тире
-            if a2 in q2:
-                hit = ENTITY_CHUNKS.get((meta["topic"], meta["entity"]))
-                if not hit:
-                    hit = next((ch for ch in all_chunks if ch.id == meta["entity"]), None) \
-                        or next((ch for ch in all_chunks if ch.file_name == meta["doc_id"]), None)
-                if hit:
-                    break
-    
-    if hit:
-        print(f"✅ Найдена сущность каталога: '{query}' → {hit.id}")
-        return [hit]  # ровно нужная секция каталога
-    
-    # ==== СПЕЦИАЛЬНЫЕ ЗАПРОСЫ: ЛИСТИНГ И СРАВНЕНИЕ ====
-    # Листинг ("какие виды")
-    if re.search(r'(какие|какой|что за).* (вид|вариант).* (имплантац|имплант)', q):
-        kinds_order = ["single-stage", "classic", "all-on-4", "all-on-6"]
-        out = [ENTITY_CHUNKS[("implants", k)] for k in kinds_order if ("implants", k) in ENTITY_CHUNKS]
-        print(f"📋 Листинг видов имплантации: найдено {len(out)} типов")
-        return out[:4]
-    
-    # Сравнение ("чем отличается / что лучше")
-    if re.search(r'(чем\s+отлич|различ|разница|сравн|что\s+лучше|vs)', q):
-        kinds_order = ["single-stage", "classic", "all-on-4", "all-on-6"]
-        out = [ENTITY_CHUNKS[("implants", k)] for k in kinds_order if ("implants", k) in ENTITY_CHUNKS]
-        print(f"📊 Сравнение видов имплантации: найдено {len(out)} типов")
-        return out[:4]
-    
-    # 0) если нашли врача напрямую — сразу отдаём карточку, минуя FAISS
-    hit = _find_doctor_direct_or_fuzzy(query)
-    if hit:
-        print(f"✅ Карточка врача по запросу: {query} → {getattr(hit, 'section', hit.file_name)}")
-        return [hit] # без дедупа
-    
-    try:
-        print(f"🔍 Поиск: '{query}' в {len(all_chunks)} чанках")
-        
-        # ==== УСЛОВНЫЙ MULTI-QUERY ====
-        mq_enable   = os.getenv('MQ_ENABLE_CONDITIONAL','true').lower() == 'true'
-        mq_minwords = int(os.getenv('MQ_MIN_WORDS','5'))
-        mq_maxvars  = int(os.getenv('MQ_MAX_VARIANTS','2'))
-        mq_budget   = int(os.getenv('MQ_MAX_CANDIDATES','8'))
-        mq_exclude_patterns = os.getenv('MQ_EXCLUDE_PATTERNS','больно|страшно|адрес|как добраться')
-
-        words = re.findall(r'\w+', query, flags=re.U)
-        
-        # Проверяем исключающие паттерны
-        exclude_mq = False
-        if mq_exclude_patterns:
-            exclude_patterns = mq_exclude_patterns.split('|')
-            query_lower = query.lower()
-            for pattern in exclude_patterns:
-                if pattern.strip() in query_lower:
-                    exclude_mq = True
-                    print(f"🔍 MQ исключен по паттерну: '{pattern}'")
-                    break
-        
-        use_mq = mq_enable and (len(words) >= mq_minwords) and not exclude_mq
-        query_variants = [query] if not use_mq else generate_query_variants(user_message)[:mq_maxvars]
-        print(f"🔍 Multi-query: используем {len(query_variants)} вариантов (условно: {use_mq}, слов: {len(words)})")
-        
-        # Логируем MQ использование
-        try:
-            structured_log["mq_used"] = use_mq
-        except Exception:
-            pass
-        
-        # ==== ГИБРИДНЫЙ РЕТРИВЕР ДЛЯ КАЖДОГО ВАРИАНТА ====
-        all_candidates = []
-        rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
-        
-        for variant in query_variants:
-            if rag_mode == 'HYBRID_TIGHT' and os.getenv('HYBRID_ENABLE', 'true').lower() == 'true':
-                # HYBRID_TIGHT режим с RRF fusion
-                topk_emb = int(os.getenv('HYBRID_TOPK_EMB', '6'))
-                topk_bm25 = int(os.getenv('HYBRID_TOPK_BM25', '6'))
-                k = int(os.getenv('HYBRID_K', '8'))
-                fusion_method = os.getenv('FUSION_METHOD', 'RRF')
-                
-                # Выполняем раздельный поиск
-                emb_hits = embed_search(variant, top=topk_emb)
-                bm25_hits = bm25_search(variant, top=topk_bm25)
-                
-                # Логируем пул кандидатов
-                from core.logger import log_m
-                log_m.info({
-                    "ev": "hybrid_pool",
-                    "emb_n": len(emb_hits),
-                    "bm25_n": len(bm25_hits),
-                    "fusion_method": fusion_method
-                })
-                
-                # Выбираем метод fusion
-                if fusion_method == 'RRF':
-                    candidates = rrf_fusion(emb_hits, bm25_hits, k)
-                else:
-                    # Fallback к старому методу
-                    w_emb = float(os.getenv('HYBRID_W_EMB', '0.60'))
-                    w_bm25 = float(os.getenv('HYBRID_W_BM25', '0.40'))
-                    candidates = hybrid_merge(emb_hits, bm25_hits, k, w_emb, w_bm25)
-                
-                # Логируем топ кандидатов
-                log_m.info({
-                    "ev": "hybrid_top",
-                    "cands": [
-                        {
-                            "doc": getattr(c, "file_name", None),
-                            "h2": getattr(c.metadata, "h2_id", None) if hasattr(c, "metadata") else None,
-                            "h3": getattr(c.metadata, "h3_id", None) if hasattr(c, "metadata") else None,
-                            "rrf_emb": float(getattr(c, "rrf_emb", 0.0)),
-                            "rrf_bm25": float(getattr(c, "rrf_bm25", 0.0)),
-                            "total_rrf": float(getattr(c, "total_rrf", 0.0))
-                        } for c in candidates
-                    ]
-                })
-                
-                # Добавляем в структурированный лог
-                try:
-                    structured_log["candidates_before"].extend([
-                        {
-                            "id": getattr(c, "id", ""),
-                            "file": getattr(c, "file_name", ""),
-                            "h2": getattr(c.metadata, "h2_id", "") if hasattr(c, "metadata") else "",
-                            "h3": getattr(c.metadata, "h3_id", "") if hasattr(c, "metadata") else "",
-                            "src": "emb" if fusion_method == "RRF" else "hybrid",
-                            "rank": i+1,
-                            "score": float(getattr(c, "total_rrf", 0.0))
-                        } for i, c in enumerate(candidates)
-                    ])
-                    
-                    structured_log["fusion"].extend([
-                        {
-                            "id": getattr(c, "id", ""),
-                            "rrf": float(getattr(c, "total_rrf", 0.0))
-                        } for c in candidates
-                    ])
-                except Exception:
-                    pass
-                
-                # Конвертируем в формат (chunk, score) для совместимости
-                candidates_with_scores = [(c, getattr(c, 'total_rrf', 0.0)) for c in candidates]
-                all_candidates.extend(candidates_with_scores)
-            else:
-                # PRECISE_SIMPLE режим - только embed поиск
-                top_k = int(os.getenv('EMB_TOPK', '4'))
-                emb_hits = embed_search(variant, top=top_k)
-                candidates_with_scores = [(c, score) for c, score in emb_hits]
-                all_candidates.extend(candidates_with_scores)
-            
-            print(f"🔍 Вариант '{variant[:30]}...': найдено {len(candidates_with_scores)} кандидатов")
-        
-        # ==== ОБЪЕДИНЕНИЕ И ДЕДУПЛИКАЦИЯ ====
-        seen_chunks = set()
-        unique_candidates = []
-        
-        for chunk, score in all_candidates:
-            if chunk.id not in seen_chunks:
-                seen_chunks.add(chunk.id)
-                unique_candidates.append((chunk, score))
-        
-        # Сортируем по score и берем top
-        unique_candidates.sort(key=lambda x: x[1], reverse=True)
-        # бюджет на первый проход
-        top_candidates = unique_candidates[:mq_budget] if mq_budget > 0 else unique_candidates[:25]
-        
-        print(f"🔍 Multi-query: объединено {len(unique_candidates)} уникальных кандидатов")
-        
-        # ==== ДЕДУП ПО H2/H3 И ПО ФАЙЛУ ====
-        uniq = {}
-        for chunk, score in top_candidates:
-            h2_id = getattr(chunk.metadata, "h2_id", "") if hasattr(chunk, "metadata") else ""
-            h3_id = getattr(chunk.metadata, "h3_id", "") if hasattr(chunk, "metadata") else ""
-            block_id = getattr(chunk.metadata, "block_id", "") if hasattr(chunk, "metadata") else ""
-            key = (chunk.file_name, h2_id, h3_id or block_id)
-            if key not in uniq:
-                uniq[key] = (chunk, score)
-        candidates = list(uniq.values())
-        
-        # ==== ТЕМАТИЧЕСКАЯ КОГЕРЕНТНОСТЬ (МЯГКИЙ БУСТ) ====
-        if candidates:
-            anchor = candidates[0][0]
-            anchor_topic = (getattr(anchor, "metadata", None) or {}).topic or ""
-            anchor_file = getattr(anchor, "file_name", "")
-            anchor_h2 = getattr(anchor.metadata, "h2_id", "") if hasattr(anchor, "metadata") else ""
-            
-            # Применяем мягкий буст вместо фильтра
-            boosted_candidates = []
-            for chunk, score in candidates:
-                final_score = score
-                
-                # Буст за когерентность
-                same_file = chunk.file_name == anchor_file
-                same_topic = getattr(getattr(chunk, "metadata", None), "topic", "") == anchor_topic
-                same_h2 = getattr(chunk.metadata, "h2_id", "") == anchor_h2 if hasattr(chunk, "metadata") else False
-                
-                if same_file or same_h2:
-                    final_score += 0.08  # НЕ фильтровать, а бустить!
-                elif same_topic:
-                    final_score += 0.04
-                
-                boosted_candidates.append((chunk, final_score))
-            
-            # Сортируем по финальному score
-            boosted_candidates.sort(key=lambda x: x[1], reverse=True)
-            candidates = boosted_candidates[:3]
-        
-        # ==== ФОРС-МАТЧ ПО АЛИАСАМ ====
-        forced_chunk = select_chunk_by_alias([chunk for chunk, _ in candidates], query)
-        if forced_chunk:
-            print(f"🎯 Форс-матч по алиасу: {forced_chunk.id}")
-            final_chunks = [forced_chunk]
-        else:
-            # ==== РЕРАНКЕР ====
-            final_chunks = reranker(candidates, query, detected_topics)
-            print(f"🔍 Реранкер отобрал {len(final_chunks)} финальных чанков")
-            
-            # Логируем реранк
-            try:
-                structured_log["rerank"] = [
-                    {
-                        "id": getattr(c, "id", ""),
-                        "score": float(getattr(c, "score", 0.0))
-                    } for c in final_chunks
-                ]
-            except Exception:
-                pass
-        
-        # если ничего внятного не попало и тема известна — жёсткий fallback
-        if not final_chunks and detected_topics:
-            theme_key = list(detected_topics)[0]
-            final_chunks = fallback_theme_chunks(theme_key, limit=top_k)
-        
-        # если ищем врача - не режем результаты по file_name
-        if DOCTOR_NAME_TO_CHUNK and _find_doctor_direct_or_fuzzy(query):
-            return final_chunks[:top_k] # без дедупа
-        
-        # иначе оставляем защитный дедуп по файлам
-        seen = set()
-        out = []
-        for chunk in final_chunks:
-            if chunk.file_name not in seen:
-                seen.add(chunk.file_name)
-                out.append(chunk)
-        
-        print(f"✅ Возвращаем {len(out)} уникальных чанков")
-        
-        # Логируем финальный контекст
-        try:
-            structured_log["final_ctx"] = [
-                {
-                    "id": getattr(c, "id", ""),
-                    "score": float(getattr(c, "score", 0.0))
-                } for c in out[:top_k]
-            ]
-        except Exception:
-            pass
-        
-        return out[:top_k]
-        
-    except Exception as e:
-        print(f"❌ Ошибка при поиске чанков: {e}")
-        return []
-
 def _strip_md(s: str) -> str:
     """Очистка от Markdown разметки"""
     if not s:
@@ -1941,20 +949,19 @@ def synthesize_answer(chunks: List[RetrievedChunk], user_query: str, verbatim=Fa
     """Мини-синтез без LLM: склеиваем 2-3 самых релевантных фрагмента, очищаем Markdown."""
     
     # Подготовка контекста с очисткой и shaping
-    from core.text_clean import clean_section_for_prompt
-    from core.answer_shaping import should_verbatim, clamp_bullets, slice_for_prompt
+    from core.answer_shaping import should_verbatim, clamp_bullets
     import json, logging
     log_m = logging.getLogger("cesi.minimal_logs")
     
     prepared_chunks, prepared_len, verbatim_used = [], 0, False
     for sec in chunks[:3]:  # берем только первые 3 чанка
         meta = getattr(sec, "meta", {}) or {}
-        clean = clean_section_for_prompt(sec.text)
+        fields = sec.fields  # очистка и границы предложений посчитаны при индексации
         if should_verbatim(meta):
-            prepared = clamp_bullets(clean, max_bullets=6)
+            prepared = clamp_bullets(fields.clean, max_bullets=6)
             verbatim_used = True
         else:
-            prepared = slice_for_prompt(clean, limit_chars=900)
+            prepared = fields.prompt_slice(limit_chars=900)
         prepared_chunks.append(prepared)
         prepared_len += len(prepared)
     
@@ -2003,8 +1010,7 @@ def synthesize_answer_old(chunks: List[RetrievedChunk], user_query: str, allow_c
         }
     
     # Формируем контекст из чанков для LLM
-    from core.text_clean import clean_section_for_prompt
-    from core.answer_shaping import should_verbatim, clamp_bullets, slice_for_prompt
+    from core.answer_shaping import should_verbatim, clamp_bullets
     import json, logging
     log_m = logging.getLogger("cesi.minimal_logs")
     
@@ -2016,7 +1022,7 @@ def synthesize_answer_old(chunks: List[RetrievedChunk], user_query: str, allow_c
     for chunk in chunks:
         t = chunk.text
         total_before += len(t)
-        c = clean_section_for_prompt(t)
+        c = chunk.fields.clean
         total_after += len(c)
         cleaned.append(c)
         
@@ -2025,7 +1031,7 @@ def synthesize_answer_old(chunks: List[RetrievedChunk], user_query: str, allow_c
         if should_verbatim(meta):
             prepared = clamp_bullets(c, max_bullets=6)
         else:
-            prepared = slice_for_prompt(c, limit_chars=900)
+            prepared = chunk.fields.prompt_slice(limit_chars=900)
         prepared_chunks.append(prepared)
         
         context_parts.append(f"ID: {chunk.id}\nОбновлено: {chunk.updated}\nКритичность: {chunk.criticality}\nКонтент:\n{prepared}\n")
@@ -2279,437 +1285,2562 @@ def render_markdown(synth: SynthJSON) -> str:
     
     return markdown
 
-# Основная функция
-def get_rag_answer(user_message: str, history: List[Dict] = []) -> tuple[str, dict]:
-    """Основная функция для получения ответа и метаданных"""
-    from logging import getLogger
-    import json
-    import re
-    from datetime import datetime
-    
-    logger = getLogger("cesi.rag")
-    logger.info("➡️ Новый вопрос: %s", user_message)
-    
-    # Логируем запрос в RAG
-    from core.logger import log_query
-    log_query(user_message, "rag_engine")
-    
-    # Всегда инициализируем — чтобы не ловить UnboundLocalError
-    detected_topics = []
-    theme_hint = None
-    rag_meta = {"user_query": user_message}
-    
-    # Инициализируем структурированный лог
-    rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
-    structured_log = {
-        "ts": datetime.now().isoformat(),
-        "mode": rag_mode,
-        "query": user_message,
-        "mq_used": False,
-        "candidates_before": [],
-        "fusion": [],
-        "rerank": [],
-        "final_ctx": [],
-        "guard": {"best": 0.0, "second": 0.0, "margin": 0.0, "passed": False}
-    }
-    
-    try:
-        # --- 1) Явный оверрайд темы по ключевым словам (если используешь root_aliases.yaml)
-        try:
-            import yaml
-            ROOT = yaml.safe_load(open("config/root_aliases.yaml", "r", encoding="utf-8")) or {}
-            ql = user_message.lower()
-            for doc_type, keys in (ROOT.get("root_aliases") or {}).items():
-                if any(k in ql for k in keys):
-                    theme_hint = doc_type
-                    break
-        except Exception:
-            pass
-    
-        # --- 2) Авто-детект темы (если оверрайд не дал тему)
-        if theme_hint is None:
-            try:
-                detected_topics = list(route_topics(user_message))
-                print(f"🎯 Роутер определил темы: {detected_topics}")
-            except Exception:
-                detected_topics = []
-            
-            if detected_topics:
-                theme_hint = detected_topics[0]
-
-        # --- 2.5) Быстрый путь по алиасам (ВРЕМЕННО ОТКЛЮЧЕН)
-        # q_norm = norm_text(user_message)
-        # if q_norm in ALIAS_MAP_GLOBAL:
-        #     key = ALIAS_MAP_GLOBAL[q_norm]
-        #     # найдём чанк по файлу и/или якорю Н2
-        #     ch = _find_chunk(key["file"], key.get("primary_h2_id"))
-        #     if ch:
-        #         topic_meta = getattr(ch.metadata, '__dict__', {}) or {}
-        #         payload = postprocess(
-        #             answer_text=ch.text,
-        #             user_text=user_message,
-        #             intent=theme_hint or key.get("topic"),
-        #             topic_meta=topic_meta,
-        #             session={},
-        #         )
-        #         return payload, {"user_query": user_message, "theme_hint": theme_hint, "fast_path": "alias"}
-
-        # --- 3) Ретривал (2 прохода: с темой → без темы)
-        # Увеличиваем top_k для поиска врачей
-        if DOCTOR_REGEX and DOCTOR_REGEX.search(user_message):
-            top_k = 12
-            print(f"🔍 Поиск врачей: используем top_k={top_k}")
-        else:
-            top_k = int(os.getenv("RAG_TOP_K", 5))  # было 8, теперь 5 по умолчанию
-        
-        # Определяем use_mq для guard логики
-        mq_enable   = os.getenv('MQ_ENABLE_CONDITIONAL','true').lower() == 'true'
-        mq_minwords = int(os.getenv('MQ_MIN_WORDS','4'))
-        words = re.findall(r'\w+', user_message, flags=re.U)
-        use_mq = mq_enable and (len(words) >= mq_minwords)
-        
-        # Извлекаем релевантные чанки (используем новую логику)
-        logger.info("🔎 theme_hint=%s detected_topics=%s", theme_hint, detected_topics)
-        relevant_chunks, meta_flags = retrieve_relevant_chunks_new(
-            user_message, 
-            theme_hint=theme_hint,
-            candidates_func=lambda q: retrieve_relevant_chunks(q, top_k=top_k)
-        )
-        
-        # Мини-фильтр по теме (минимум логики, максимум эффекта)
-        def filter_candidates(theme: str, q: str, cands: list):
-            t = (q or "").lower()
-            
-            def h2_of(c):
-                return (getattr(c, "h2", None) or getattr(c, "meta", {}).get("h2", "") or "").lower()
-            
-            def text_of(c):
-                return (getattr(c, "text", "") or "").lower()
-            
-            # «приживаемость» — оставляем только куски, где явно есть прижив/оссео
-            if any(k in t for k in ["прижив", "приживаем", "оссео"]):
-                return [c for c in cands if any(x in h2_of(c) + " " + text_of(c) for x in ["прижив", "оссеоинтегр"])]
-            
-            # страх/боль — выкидываем «противопоказания»
-            if any(k in t for k in ["боюсь", "боль", "страшно", "анестез", "обезбол"]):
-                bad = ["противопоказан", "противопоказания"]
-                return [c for c in cands if not any(x in h2_of(c) for x in bad)]
-            
-            return cands
-        
-        relevant_chunks = filter_candidates(theme_hint, user_message, relevant_chunks)
-        
-        # Лёгкий переранж (чтобы «нужное» всплывало первым)
-        def bonus_for_query(c, q):
-            t = (getattr(c, "text", "") or "").lower()
-            b = 0.0
-            
-            # прижив/оссео
-            if "прижив" in q or "оссео" in q:
-                if any(x in t for x in ["прижив", "оссеоинтегр"]): b += 0.1
-            
-            # боязнь/боль
-            if any(x in q for x in ["боюсь", "боль", "анестез", "обезбол"]):
-                if any(x in t for x in ["без боли", "анестез", "обезбол"]): b += 0.1
-            
-            return b
-        
-        for c in relevant_chunks:
-            base = getattr(c, "score", 0.0)  # твоя косинус/БМ25
-            c.score = float(base) + bonus_for_query(c, user_message.lower())
-        
-        relevant_chunks = sorted(relevant_chunks, key=lambda x: x.score, reverse=True)
-        
-        # Быстрая диагностика (чтобы понять причину)
-        for i, c in enumerate(relevant_chunks[:5], 1):
-            logger.info({
-                "ev": "rerank_top",
-                "rank": i,
-                "score": round(getattr(c, "score", 0.0), 3),
-                "h2": getattr(c, "h2", None) or getattr(c, "meta", {}).get("h2"),
-                "doc": getattr(c, "meta", {}).get("doc_id"),
-            })
-        
-        # Если нет кандидатов, пробуем без темы
-        if not relevant_chunks:
-            logger.info("⚠️ Первый проход не дал результатов, пробуем без темы...")
-            relevant_chunks, meta_flags = retrieve_relevant_chunks_new(
-                user_message, 
-                theme_hint=None,
-                candidates_func=lambda q: retrieve_relevant_chunks(q, top_k=top_k)
-            )
-        
-        # Логируем результат
-        logger.info("📦 candidates=%d", len(relevant_chunks))
-        logger.info("🔍 rag_engine: relevant_chunks[0] type=%s", type(relevant_chunks[0]) if relevant_chunks else "None")
-        
-        if not relevant_chunks:
-            # честный низкий релеванс
-            return LOW_REL_JSON.copy(), rag_meta
+# ==== ВКЛАД ФАЙЛА В ИНДЕКСЫ ====
+def _embed_text(chunk: RetrievedChunk) -> str:
+    """Текст для эмбеддинга: текст чанка + реальные алиасы"""
+    boost_aliases = extract_aliases_from_chunk(chunk.text)
+    if getattr(chunk.metadata, "aliases", None):
+        boost_aliases += list(chunk.metadata.aliases)
+    alias_boost = " ".join(boost_aliases)
+    return (chunk.text + " " + alias_boost).strip()
 
-        # ==== GUARD С ENV ПОРОГАМИ ====
-        if os.getenv('GUARD_ENABLE', 'true').lower() == 'true':
-            # Находим лучший и второй score
-            scores = []
-            for chunk in relevant_chunks:
-                # В зависимости от режима используем разные score
-                rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
-                if rag_mode == 'HYBRID_TIGHT':
-                    score = getattr(chunk, 'total_rrf', None) or getattr(chunk, 'hybrid', None) or getattr(chunk, 'score', 0.0)
-                else:
-                    score = getattr(chunk, 'score', 0.0)
-                scores.append(score)
-            
-            scores.sort(reverse=True)
-            best = scores[0] if scores else 0.0
-            second = scores[1] if len(scores) > 1 else 0.0
-            
-            # Пороги из ENV
-            hard_min = float(os.getenv('GUARD_THRESHOLD','0.60'))
-            dyn = os.getenv('GUARD_DYNAMIC','false').lower() == 'true'
-            soft_min = float(os.getenv('GUARD_SOFT_MIN','0.56'))
-            margin = float(os.getenv('GUARD_MARGIN','0.07'))
-
-            def passes_guard(b, s):
-                if not dyn:
-                    return b >= hard_min
-                if b >= hard_min:
-                    return True
-                if b >= soft_min and (b - (s or 0.0)) >= margin:
-                    return True
-                return False
+def _dense_ids(chunks: Sequence[RetrievedChunk], questions: Sequence[Tuple[int, str]] = ()) -> np.ndarray:
+    """
+    Стабильные id строк векторного индекса: чанк — по своему id, вопрос doc2query — по id чанка и тексту.
+    Не зависят от позиций, поэтому строки можно удалять и заменять без пересборки индекса.
+    """
+    keys, seen = [], {}
+    for ch in chunks:
+        # одинаковые id чанков (не должно быть, но индекс требует уникальных) — различаем по номеру
+        n = seen[ch.id] = seen.get(ch.id, 0) + 1
+        keys.append(ch.id if n == 1 else f"{ch.id}@{n}")
+    keys += [f"{keys[pos]}?{q}" for pos, q in questions]
+    return np.array([vector_id(k) for k in keys], dtype="int64")
+
+def _bm25_tokens(chunk: RetrievedChunk) -> List[str]:
+    """Токены чанка для BM25: текст + реальные алиасы"""
+    boost_aliases = extract_aliases_from_chunk(chunk.text)
+    if getattr(chunk.metadata, "aliases", None):
+        boost_aliases += list(chunk.metadata.aliases)
+    alias_boost = " ".join(boost_aliases)
+    return re.findall(r'\w+', (chunk.text + " " + alias_boost).lower())
+
+def build_doctor_regex(name_tokens) -> Tuple[Optional[re.Pattern], re.Pattern]:
+    """
+    Regex для поиска врачей.
 
-            # Логируем guard
-            try:
-                structured_log["guard"] = {
-                    "best": float(best),
-                    "second": float(second),
-                    "margin": float(best - second),
-                    "passed": passes_guard(best, second)
+    Returns:
+        (только имена или None, имена + слова "врач/доктор/...")
+    """
+    base = ['врач', 'доктор', 'хирург', 'имплантолог', 'специалист']
+    # длинные имена раньше коротких; при равной длине — по алфавиту, чтобы regex не зависел от порядка множества
+    names = sorted([re.escape(t) for t in name_tokens], key=lambda t: (-len(t), t))
+    base_tokens = [re.escape(t) for t in base]
+
+    if names:
+        name_regex = re.compile(r'(' + '|'.join(names) + r')', re.IGNORECASE)
+        query_regex = re.compile(r'(' + '|'.join(names + base_tokens) + r')', re.IGNORECASE)
+    else:
+        name_regex = None
+        query_regex = re.compile(r'(' + '|'.join(base_tokens) + r')', re.IGNORECASE)
+    return name_regex, query_regex
+
+class FileIndex:
+    """
+    Вклад одного md-файла в индексы движка: чанки, карты алиасов/H2/сущностей/врачей, токены BM25.
+    Пересобирается только при изменении файла; индексы движка — слияние FileIndex в порядке файлов.
+    """
+
+    # карты, которые сливаются в одноимённые атрибуты движка (позже записанный файл побеждает)
+    MAPS = ("file_meta", "alias_map_global", "h2_index", "alias_map", "entity_index", "entity_chunks",
+            "doctor_name_to_chunk", "md_aliases")
+
+    def __init__(self, path: str, digest: str):
+        self.path = path
+        self.file_name = Path(path).name
+        self.digest = digest            # sha256 содержимого
+        self.skipped = False            # служебный файл (md_filter)
+        self.chunks: List[RetrievedChunk] = []
+        self.arena: Optional[TextArena] = None   # тексты чанков файла одним буфером (pack_texts)
+        self.bm25_tokens: List[List[str]] = []
+        self.signatures: List[Optional[np.ndarray]] = []   # MinHash чанков для поиска дублей (core/dedup.py)
+        self.file_meta = {}
+        self.alias_map_global = {}
+        self.h2_index = {}
+        self.alias_map = {}
+        self.entity_index = {}
+        self.entity_chunks = {}
+        self.doctor_name_to_chunk = {}
+        self.doctor_name_tokens: set[str] = set()
+        self.md_aliases = {}            # вклад в core.md_loader.ALIAS_MAP
+
+    def __getstate__(self):
+        # из процесса-воркера чанки уходят плоскими записями, карты ссылаются на них по позиции
+        state = dict(self.__dict__)
+        refs = list(self.chunks)
+        pos = {id(ch): i for i, ch in enumerate(refs)}
+
+        def ref(ch):
+            if id(ch) not in pos:
+                pos[id(ch)] = len(refs)
+                refs.append(ch)
+            return pos[id(ch)]
+
+        state["entity_chunks"] = {k: ref(ch) for k, ch in self.entity_chunks.items()}
+        state["doctor_name_to_chunk"] = {k: ref(ch) for k, ch in self.doctor_name_to_chunk.items()}
+        state["chunks"] = len(self.chunks)
+        # метаданные уходят объектами: фронтматтер файла, общий для чанков, пишется в поток один раз
+        # арена текстов файла тоже пишется один раз, чанки ссылаются на позицию в ней
+        state["records"] = [(ch.id, ch._text, ch._arena, ch.file_name, ch.metadata, ch._fields, ch.followups)
+                            for ch in refs]
+        return state
+
+    def __setstate__(self, state):
+        objs = []
+        for chunk_id, text, arena, file_name, metadata, fields, followups in state.pop("records"):
+            ch = RetrievedChunk(chunk_id, text, metadata, file_name, arena=arena)
+            ch._fields = fields
+            ch.followups = followups
+            objs.append(ch)
+        state["chunks"] = objs[:state["chunks"]]
+        state["entity_chunks"] = {k: objs[i] for k, i in state["entity_chunks"].items()}
+        state["doctor_name_to_chunk"] = {k: objs[i] for k, i in state["doctor_name_to_chunk"].items()}
+        self.__dict__.update(state)
+
+    def pack_texts(self) -> None:
+        """Переносит тексты чанков файла в одну арену (вызывается до публикации чанков)"""
+        if not self.chunks:
+            return
+        self.arena = TextArena.from_texts(ch.text for ch in self.chunks)
+        for i, ch in enumerate(self.chunks):
+            ch.bind_text(self.arena, i)
+
+    def derive_fields(self) -> None:
+        """Считает производные поля чанков (нижний регистр, текст для промпта и показа) — один раз на файл"""
+        for ch in self.chunks:
+            ch._fields = ChunkFields(ch.text)
+
+    def register_document(self, doc: ParsedDocument):
+        fm, file_name = doc.frontmatter, doc.file_name
+        doc_type = norm_topic(fm.get("doc_type"))
+        topic = norm_topic(fm.get("topic") or doc_type)
+        if topic not in CANON:
+            topic = "clinic"  # fallback на clinic
+
+        aliases = fm.get("aliases") or []
+        if isinstance(aliases, str): aliases = [aliases]
+        mini_links = fm.get("mini_links") or []
+
+        self.file_meta[file_name] = {"topic": topic, "aliases": aliases, "mini_links": mini_links,
+                                     "followups": followups_for_document(doc)}
+
+        # глобальные алиасы → файл/тема
+        for a in aliases:
+            self.alias_map_global[norm_text(a)] = {"topic": topic, "file": file_name}
+
+        # H2 и локальные алиасы → точный индекс
+        for s in doc.headings:
+            # индексируем заголовок и h2_id
+            for key in [s.title, s.h2_id, *s.aliases]:
+                self.h2_index[norm_text(key)] = {"topic": topic, "file": file_name, "h2_id": s.h2_id}
+
+    def update_entity_index(self, chunk: RetrievedChunk, topic: str, entity_key: str):
+        """Обновляет entity_index с алиасами из чанка"""
+        # Извлекаем заголовок ##
+        header_match = re.search(r'(?m)^##\s+(.+?)\s*$', chunk.text)
+        title = header_match.group(1).strip() if header_match else ""
+
+        # Алиасы: HTML-коммент в тексте + фронтматтер
+        aliases = extract_aliases_from_chunk(chunk.text)
+        if hasattr(chunk, "metadata") and getattr(chunk.metadata, "aliases", None):
+            aliases.extend(chunk.metadata.aliases)
+        if title:
+            aliases.append(title)
+
+        # Индексируем все алиасы
+        for alias in aliases:
+            alias_norm = _norm(alias)
+            if alias_norm:
+                self.entity_index[alias_norm] = {
+                    "topic": topic,
+                    "entity": entity_key,
+                    "doc_id": chunk.file_name,
+                    "section": title
                 }
-            except Exception:
-                pass
-            
-            if not passes_guard(best, second):
-                # вторая попытка: узкий conditional MQ, если ещё не включали
-                mq_enable   = os.getenv('MQ_ENABLE_CONDITIONAL','true').lower() == 'true'
-                mq_maxvars  = int(os.getenv('MQ_MAX_VARIANTS','2'))
-                mq_budget   = int(os.getenv('MQ_MAX_CANDIDATES','4'))
-                
-                if mq_enable and not use_mq:
-                    qv = generate_query_variants(user_message)[:mq_maxvars]
-                    print(f"🔁 Low score (best={best:.3f}, second={second:.3f}) → дополнительный MQ={len(qv)}")
-                    extra = []
-                    for q2 in qv:
-                        e2 = embed_search(q2, top=3)
-                        b2 = bm25_search(q2, top=3)
-                        extra.extend(hybrid_merge(e2, b2, 3, 0.60, 0.40))
-                    # объединяем с бюджетом
-                    pool = (relevant_chunks + extra)[:max(6, mq_budget)]
-                    # повторим дедуп + когерентность
-                    uniq2 = {}
-                    for ch in pool:
-                        key = (ch.file_name, getattr(ch.metadata, "h2_id",""))
-                        if key not in uniq2: uniq2[key] = ch
-                    pool = list(uniq2.values())
-                    if pool:
-                        anchor = pool[0]
-                        atopic = (getattr(anchor, "metadata", None) or {}).topic or ""
-                        afile  = getattr(anchor, "file_name", "")
-                        coh = []
-                        seen = set()
-                        for ch in pool:
-                            if ch.file_name == afile or getattr(getattr(ch,"metadata",None),"topic","") == atopic:
-                                k = (ch.file_name, getattr(ch.metadata,"h2_id",""))
-                                if k not in seen:
-                                    coh.append(ch); seen.add(k)
-                        relevant_chunks = coh[:3] if coh else pool[:3]
-                        best  = getattr(relevant_chunks[0], 'hybrid', 0.0) if relevant_chunks else 0.0
-                        second= getattr(relevant_chunks[1], 'hybrid', 0.0) if len(relevant_chunks)>1 else 0.0
-                
-                if not passes_guard(best, second):
-                    # Возвращаем fallback без вызова LLM
-                    from core.logger import log_m
-                    log_m.info({
-                        "ev": "low_rel",
-                        "best": float(best),
-                        "second": float(second),
-                        "hard_min": float(hard_min),
-                        "soft_min": float(soft_min),
-                        "margin": float(margin),
-                        "passed": False
-                    })
-                    
-                    out = {
-                        "answer": "Хочу ответить точно. Подскажите, вас интересует адрес клиники, цены, врачи или противопоказания?",
-                        "empathy": "",
-                        "cta": {"show": False, "variant": "consult"},
-                        "followups": [
-                            {"label": "Адрес и контакты", "query": "адрес"},
-                            {"label": "Цены на имплантацию", "query": "цены"},
-                            {"label": "Противопоказания", "query": "противопоказания"}
-                        ]
-                    }
-                    return out, rag_meta
-                else:
-                    # Логируем успешное прохождение guard
-                    from core.logger import log_m
-                    log_m.info({
-                        "ev": "guard_passed",
-                        "best": float(best),
-                        "second": float(second),
-                        "hard_min": float(hard_min),
-                        "soft_min": float(soft_min),
-                        "margin": float(margin),
-                        "passed": True,
-                        "reason": "hard" if best >= hard_min else "soft+margin"
-                    })
 
-        # --- 4) Синтез ответа из нескольких чанков
-        synth = synthesize_answer(relevant_chunks, user_message)
-        answer_text = synth.get("text", "")
+def _collapse_duplicates(state: Dict[str, Any], bm25_corpus: List[List[str]],
+                         signatures: List[Optional[np.ndarray]]) -> List[List[str]]:
+    """
+    Сводит кластеры почти одинаковых чанков к каноническому (см. core/dedup.py).
+    Дубли убираются из all_chunks (а значит из BM25 и векторного индекса), в state["duplicate_of"]
+    остаётся ссылка id дубля → канонический чанк; карты сущностей и врачей переводятся на канонический.
 
-        # --- 4.5) Guard-fallback для «боль/страх»
-        cand_cnt = len(relevant_chunks)
-        if cand_cnt == 0:
-            return LOW_REL_JSON.copy(), {"meta": {"relevance_score": 0.0, "cand_cnt": 0}}
+    Args:
+        state: Слитое состояние _build_state (all_chunks, карты)
+        bm25_corpus: Токены BM25 по позициям all_chunks
+        signatures: MinHash по позициям all_chunks (None — не сравнивается)
 
-        best = relevant_chunks[0]
-        best_score = getattr(best, "score", 0.0)
-        
-        # Если после фильтра/переранжировки лучший скор слабый — отдай готовый «эмпатичный» ответ
-        if theme_hint in ("safety", "pain", "fear_pain") and best_score < 0.42:
-            payload = {
-                "response": {"text": "Понимаю, что страшит именно боль. Процедура делается под местной анестезией – во время операции вы ничего не почувствуете.\n\nПосле – обычно как после удаления зуба: даём обезболивающее и сопровождаем.\n\nЕсли хотите, врач коротко расскажет, как всё проходит именно в вашем случае."},
-                "cta": {"label": "Записаться на консультацию", "target": "whatsapp"},
-                "followups": ["Сколько длится приём?", "Какая анестезия используется?"]
-            }
-            return payload, {**rag_meta, "guard_used": True, "relevance_score": best_score}
-        
-        score = None
-        
-        # Пытаемся извлечь score из чанка
-        for key in ["score", "rank_score", "bm25_score", "similarity"]:
-            if isinstance(best, dict) and key in best:
-                score = best[key]
-                break
-            elif hasattr(best, key):
-                score = getattr(best, key)
+    Returns:
+        Токены BM25 оставшихся чанков
+    """
+    chunks = state["all_chunks"]
+    clusters = find_clusters(signatures)
+    if not clusters:
+        return bm25_corpus
+
+    texts = [ch.text for ch in chunks]
+    dropped = set()
+    cluster_map = {}
+    for cluster in clusters:
+        canon = pick_canonical(cluster, texts)
+        cluster_map[chunks[canon].id] = [chunks[i].id for i in cluster if i != canon]
+        for i in cluster:
+            if i != canon:
+                dropped.add(i)
+                state["duplicate_of"][chunks[i].id] = {"canonical": chunks[canon], "file": chunks[i].file_name,
+                                                       "h2_id": getattr(chunks[i].metadata, "h2_id", None)}
+
+    for name in ("entity_chunks", "doctor_name_to_chunk"):
+        state[name] = {k: state["duplicate_of"][ch.id]["canonical"] if ch.id in state["duplicate_of"] else ch
+                       for k, ch in state[name].items()}
+    state["all_chunks"] = [ch for i, ch in enumerate(chunks) if i not in dropped]
+
+    saved_bytes = sum(len(texts[i].encode("utf-8")) for i in dropped)
+    saved_tokens = sum(len(bm25_corpus[i]) for i in dropped)
+    print(f"🧬 Дубли секций: {len(clusters)} кластеров, убрано {len(dropped)} из {len(chunks)} чанков "
+          f"(~{saved_bytes / 1024:.1f} КБ текста, {saved_tokens} токенов BM25)")
+    from core.logger import log_m
+    log_m.info({"ev": "dedup", "clusters": len(clusters), "removed": len(dropped), "chunks": len(chunks),
+                "saved_text_bytes": saved_bytes, "saved_bm25_tokens": saved_tokens, "cluster_map": cluster_map})
+    return [tokens for i, tokens in enumerate(bm25_corpus) if i not in dropped]
+
+def _doc2query_questions(chunks: List[RetrievedChunk]) -> Tuple[Tuple[int, str], ...]:
+    """
+    Синтетические вопросы к чанкам (core/doc2query.py): из офлайн-сборки, для новых чанков — шаблонные.
+
+    Returns:
+        ((позиция чанка в all_chunks, вопрос), ...) — порядок строк-вопросов в векторном индексе
+    """
+    store = QuestionStore()
+    out, stored = [], 0
+    for pos, ch in enumerate(chunks):
+        if store.get(ch) is not None:
+            stored += 1
+        out.extend((pos, q) for q in store.questions_for(ch))
+    print(f"❓ doc2query: {len(out)} вопросов к {len(chunks)} чанкам (из сборки: {stored}, генератор: {store.generator or 'template'})")
+    from core.logger import log_m
+    log_m.info({"ev": "doc2query", "questions": len(out), "chunks": len(chunks), "stored": stored,
+                "generator": store.generator or "template"})
+    return tuple(out)
+
+# ==== RAG-ДВИЖОК ====
+class RagEngine:
+    """
+    Жизненный цикл индексов RAG: загрузка, перезагрузка корпуса, публикация снимков.
+    Ничего не загружается в конструкторе — индексы поднимает load().
+    Всё, что читает ретривал, лежит в неизменяемом IndexSnapshot; пересборка публикует
+    новый снимок одной заменой ссылки, а запрос работает со снимком, взятым в начале.
+
+    Пример:
+        engine = RagEngine().load()
+        payload, meta = engine.get_rag_answer("сколько стоит имплантация")
+    """
+
+    def __init__(
+        self,
+        md_dir: Path | str = MD_DIR,
+        themes_path: Path | str = THEMES_PATH,
+        client=None,
+        embed_model: str = EMBED_MODEL,
+        bundle_dir: Path | str | None = None,
+        use_bundle: bool = INDEX_BUNDLE_LOAD,
+        dense_async: bool = DENSE_ASYNC,
+        dense: bool = True,
+        ingest_workers: int = INGEST_WORKERS,
+        cta_path: Path | str | None = None,
+        global_aliases: bool = True,
+        doc2query: bool = DOC2QUERY_ENABLE,
+    ):
+        """
+        Args:
+            md_dir: Папка с markdown-корпусом
+            themes_path: Путь к themes.json
+            client: OpenAI клиент v1 (по умолчанию — общий клиент модуля)
+            embed_model: Модель эмбеддингов
+            bundle_dir: Корень бандлов индексов (по умолчанию INDEX_BUNDLE_DIR)
+            use_bundle: Поднимать индексы из бандла, если он актуален
+            dense_async: Строить векторный индекс в фоне (запросы сразу идут через BM25 и правила)
+            dense: Строить векторный индекс (False — только BM25 и правила, без вызовов embeddings API)
+            ingest_workers: Процессов для разбора md-файлов (1 — без пула, 0 — по числу CPU)
+            cta_path: cta.yaml тенанта (None — общий конфиг core.cta)
+            global_aliases: Публиковать алиасы md в общий core.md_loader.ALIAS_MAP (только движок по умолчанию)
+            doc2query: Индексировать синтетические вопросы к чанкам (core/doc2query.py)
+        """
+        from core.index_bundle import INDEX_BUNDLE_DIR
+        self.md_dir = Path(md_dir)
+        self.themes_path = Path(themes_path)
+        self.client = client if client is not None else openai_client
+        self.embed_model = embed_model
+        self.bundle_dir = Path(bundle_dir) if bundle_dir else INDEX_BUNDLE_DIR
+        self.use_bundle = use_bundle
+        self.dense_async = dense_async
+        self.dense = dense
+        self.ingest_workers = int(ingest_workers) or (os.cpu_count() or 1)
+        self.cta_path = Path(cta_path) if cta_path else None
+        self.global_aliases = global_aliases
+        self.doc2query = doc2query
+        self.loaded = False
+
+        self.theme_map: Dict[str, dict] = {}
+        self.theme_router = None                 # core.router.ThemeRouter по themes_path движка
+        self.cta_config: Optional[dict] = None
+        self._snapshot = IndexSnapshot(theme_map=self.theme_map, client=self.client, embed_model=self.embed_model)
+        self.md_aliases = {}                     # вклад в core.md_loader.ALIAS_MAP
+        self.files: Dict[str, FileIndex] = {}    # путь -> вклад файла (для перезагрузки)
+        self._reload_lock = threading.Lock()
+        self._watch_lock = threading.Lock()
+        self._watcher = None
+        self._dense_lock = threading.Lock()
+        self._dense_thread = None
+        self._dense_error: Optional[str] = None
+        self._profiling = False                  # этапы старта пишутся в core.startup_profile
+
+    def load(self) -> "RagEngine":
+        """
+        Поднимает индексы: из бандла, если он актуален, иначе разбором md/.
+
+        Returns:
+            self (для цепочки RagEngine().load())
+        """
+        self._profiling = PROFILE.expect("rag_engine")
+        with self._stage("themes"):
+            self.theme_map = load_theme_map(self.themes_path)
+            from core.router import ThemeRouter
+            self.theme_router = ThemeRouter(str(self.themes_path))
+            if self.cta_path is not None:
+                from core.cta import read_config
+                self.cta_config = read_config(str(self.cta_path))
+        with self._stage("bundle"):
+            from_bundle = self._load_index_bundle()
+        if not from_bundle:
+            self._ingest_md()
+        self.loaded = True
+        self.ensure_dense()
+        if self._dense_thread is None or not self._dense_thread.is_alive():
+            # векторный индекс уже есть (или не строится) — старт движка закончен
+            self._end_profiling()
+        return self
+
+    def _stage(self, name: str):
+        """Замер этапа старта; после старта (перезагрузки, повторные сборки) — пустой контекст"""
+        return PROFILE.stage(f"rag:{name}") if self._profiling else nullcontext()
+
+    def _end_profiling(self) -> None:
+        if self._profiling:
+            self._profiling = False
+            PROFILE.done("rag_engine")
+
+    # ---- Снимки индексов ----
+
+    @property
+    def snapshot(self) -> "IndexSnapshot":
+        """Текущий опубликованный снимок (без удержания — для разовых чтений)"""
+        return self._snapshot
+
+    @contextmanager
+    def acquire(self):
+        """
+        Снимок индексов на время запроса. Пересборка во время запроса его не меняет;
+        заменённый снимок освобождается, когда его отпустит последний запрос.
+
+        Пример:
+            with engine.acquire() as snap:
+                chunks = snap.retrieve_relevant_chunks(query)
+        """
+        while True:
+            snap = self._snapshot
+            # снимок могли заменить между чтением ссылки и захватом — берём новый
+            if snap._enter():
                 break
-        
-        # Если score нет - ставим разумный дефолт
-        if score is None:
-            score = 0.7  # если нет score - даем безопасный дефолт
-        
-        # Если это форс-совпадение по алиасу - повышаем score
-        if isinstance(best, dict) and (best.get("forced_by_alias") or best.get("h2_alias_hit")):
-            score = max(score, 0.9)  # если это был форс-алиас (если у вас есть такой флаг)
-
-        # --- 5) Постпроцесс: эмпатия/бридж + CTA
-        best_chunk = relevant_chunks[0] if relevant_chunks else None
-        topic_meta = getattr(best_chunk.metadata, '__dict__', {}) or {} if best_chunk else {}
-        intent = theme_hint  # или твой интент-детектор
-        payload = postprocess(
-            answer_text=answer_text,
-            user_text=user_message,
-            intent=intent,
-            topic_meta=topic_meta,
-            session={},  # session пока пустой
-        )
-        
-        # Подстраховка для payload
-        if not isinstance(payload, dict):
-            payload = {"text": str(payload) if payload is not None else best_text}
-        elif not payload.get("text"):
-            payload["text"] = best_text
-
-        # Обновляем метаданные с relevance_score
-        def _mget(meta, key, default=None):
-            """Безопасный доступ к метаданным: dict/obj"""
-            if meta is None:
-                return default
-            if isinstance(meta, dict):
-                return meta.get(key, default)
-            return getattr(meta, key, default)
-        
-        def _score_of(c):
-            """Пытаемся получить скор из разных полей; если нет - None"""
-            for k in ("score", "rank_score", "bm25_score", "similarity"):
-                v = c[k] if isinstance(c, dict) and k in c else getattr(c, k, None)
-                if v is not None:
-                    return v
-            return None
-        
-        cand_cnt = len(relevant_chunks)
-        best = relevant_chunks[0]
-        meta = getattr(best, "metadata", None) or getattr(best, "meta", {}) or {}
-        best_text = getattr(best, "section_text", None) or getattr(best, "text", "") or ""
-        # минимальная очистка прямо тут (та же, что в clean_response_text, но короткая)
-        import re
-        best_text = re.sub(r'<!--.*?>', '', best_text, flags=re.DOTALL)
-        best_text = re.sub(r'^\s*#{1,6}\s*', '', best_text, flags=re.MULTILINE)
-        best_text = best_text.strip()
-        rag_meta["best_text"] = best_text
-        score = _score_of(best)
-        if score is None:
-            score = 0.7  # дефолт, чтобы guard не резал нормальный ответ
-        best_chunk_id = f"{_mget(meta, 'file_basename','')}" + (f"#{_mget(meta, 'h2_id','')}" if _mget(meta, 'h2_id') else "")
-        
-        # ВАЖНО: список словарей {"chunk": ..., "score": ... } – именно так ждёт адаптер/арр.ру
-        candidates_with_scores = [
-            {"chunk": c, "score": _score_of(c)}
-            for c in relevant_chunks[:5]
-        ]
-        
-        # rag_meta плоские поля (+ вложенный meta для guard - на всякий случай)
-        rag_meta = {
-            "relevance_score": float(score),
-            "cand_cnt": cand_cnt,
-            "theme_hint": theme_hint,
-            "detected_topics": detected_topics,
-            "best_chunk_id": best_chunk_id,
-            "candidates_with_scores": candidates_with_scores,
-            "best_text": best_text,  # пригодится адаптеру как fallback
-            "meta": {
-                "relevance_score": float(score),
-                "cand_cnt": cand_cnt,
-                "doc_type": _mget(meta, "doc_type"),
-                "topic": _mget(meta, "topic"),
-                "best_chunk_id": best_chunk_id,
-            }
+        try:
+            yield snap
+        finally:
+            snap._exit()
+
+    def get_rag_answer(self, user_message: str, history: List[Dict] = []) -> tuple[str, dict]:
+        """Ответ на вопрос по снимку индексов, взятому один раз на весь запрос"""
+        with self.acquire() as snap:
+            return snap.get_rag_answer(user_message, history)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Готовность ретривала для /ready.
+
+        Returns:
+            ready, версия и размер снимка, уровни (bm25/entity/doctors/facts/dense) и состояние
+            фоновой сборки векторного индекса: ready | building | failed | off
+        """
+        snap = self._snapshot
+        tiers = snap.tiers()
+        if tiers["dense"]:
+            dense_state = "ready"
+        elif self._dense_thread is not None and self._dense_thread.is_alive():
+            dense_state = "building"
+        elif self._dense_error:
+            dense_state = "failed"
+        else:
+            dense_state = "off"
+        return {
+            "ready": self.loaded and bool(snap.all_chunks),
+            "version": snap.version,
+            "chunks": len(snap.all_chunks),
+            "tiers": tiers,
+            "dense_state": dense_state,
+            "dense_error": self._dense_error,
         }
 
-        # Логируем ответ в RAG
-        from core.logger import format_candidates_for_log
-        from logging import getLogger
-        log_m = getLogger("cesi.minimal_logs")
-        try:
-            log_m.info({
-                "ev":"search_candidates",
-                "count": len(relevant_chunks),
-                "cands": format_candidates_for_log(relevant_chunks, top=3)
-            })
-        except Exception as e:
-            logging.getLogger("cesi").warning(f"log_format_error: {e}")
-        
-        # Сохраняем структурированный лог
-        log_level = os.getenv('LOG_LEVEL', 'INFO')
-        if log_level in ('DEBUG', 'TRACE'):
+    # ---- Фоновая сборка векторного индекса ----
+
+    def ensure_dense(self) -> None:
+        """
+        Запускает фоновую сборку векторного индекса, если в текущем снимке его нет.
+        Дешёвая проверка — можно звать на каждый запрос (поток сборки не переживает fork).
+        """
+        if not self.dense or not self.dense_async or self._snapshot.index is not None or not self._snapshot.all_chunks:
+            return
+        if self._dense_thread is not None and self._dense_thread.is_alive():
+            return
+        with self._dense_lock:
+            if self._dense_thread is not None and self._dense_thread.is_alive():
+                return
+            self._dense_thread = threading.Thread(target=self._dense_worker, name="dense-index", daemon=True)
+            self._dense_thread.start()
+
+    def wait_dense(self, timeout: float | None = None) -> bool:
+        """Ждёт фоновую сборку (утилиты, прогрев). True — векторный индекс подключён."""
+        thread = self._dense_thread
+        if thread is not None:
+            thread.join(timeout)
+        return self._snapshot.index is not None
+
+    def _dense_worker(self) -> None:
+        """Строит векторный индекс для текущего снимка с повторами и подключает его заменой снимка"""
+        from core.logger import log_m
+        attempt = 0
+        while True:
+            snap = self._snapshot
+            if snap.index is not None or not snap.all_chunks:
+                return
+            attempt += 1
+            t0 = time.perf_counter()
             try:
-                logs_dir = Path("logs")
-                logs_dir.mkdir(exist_ok=True)
-                log_file = logs_dir / "rag_trace.jsonl"
-                with open(log_file, "a", encoding="utf-8") as f:
-                    f.write(json.dumps(structured_log, ensure_ascii=False) + "\n")
+                with self._stage("dense_background"):
+                    dense = self._build_dense(list(snap.all_chunks), questions=snap.doc2query)
             except Exception as e:
-                print(f"❌ Ошибка сохранения структурированного лога: {e}")
-        
-        return payload, rag_meta
-        
-    except Exception:
-        # Никогда не падаем наружу — лог и безопасный ответ
-        logger.exception("💥 get_rag_answer failed")
-        return LOW_REL_JSON.copy(), rag_meta
+                self._dense_error = f"{type(e).__name__}: {e}"
+                delay = min(DENSE_RETRY_MAX, DENSE_RETRY_BASE * (2 ** (attempt - 1)))
+                print(f"⚠️ Векторный индекс не построен (попытка {attempt}): {e}; повтор через {delay:.0f}s")
+                log_m.info({"ev": "dense_build_failed", "attempt": attempt, "error": self._dense_error, "retry_s": delay})
+                # профиль старта не ждёт повторов — в нём остаётся неудачная первая попытка
+                self._end_profiling()
+                time.sleep(delay)
+                continue
+
+            with self._reload_lock:
+                current = self._snapshot
+                if current.all_chunks is not snap.all_chunks:
+                    # пока строили, корпус перезагрузили — проверяем уже новый снимок
+                    continue
+                self._swap(current.replace(index=dense))
+            self._dense_error = None
+            ms = round((time.perf_counter() - t0) * 1000, 1)
+            print(f"✅ Векторный индекс подключён: {len(snap.all_chunks)} чанков за {ms}ms (попыток: {attempt})")
+            log_m.info({"ev": "dense_attached", "version": self._snapshot.version, "chunks": len(snap.all_chunks),
+                        "attempts": attempt, "ms": ms})
+            self._end_profiling()
+            return
+
+    # ---- Загрузка индексов ----
+
+    @staticmethod
+    def _ingest_file(file: Path, data: bytes) -> FileIndex:
+        """Разбирает один md-файл в FileIndex (чанки + вклад в карты). Не трогает движок — годится для воркеров."""
+        from core.md_filter import is_index_like
+        from core.md_loader import register_aliases
+
+        part = FileIndex(str(file), hashlib.sha256(data).hexdigest())
+        try:
+            print(f"📄 Обрабатываю файл: {file}")
+            text = data.decode("utf-8")
+            doc = parse_document(file, text)
+
+            # Фильтруем служебные файлы
+            if is_index_like(file, text, frontmatter=doc.frontmatter):
+                part.skipped = True
+                print(f"  ⏭️ Пропускаем служебный файл: {file.name}")
+                return part
+
+            print(f"  📖 Прочитан файл: {file.name} ({len(text)} символов)")
+
+            # Регистрируем файл в новых индексах
+            part.register_document(doc)
+
+            # YAML front matter
+            metadata = Frontmatter(doc.frontmatter)
+            print(f"  ✅ YAML парсинг: {metadata.id if metadata.id else 'без ID'}")
+
+            # Регистрируем алиасы для fallback поиска
+            try:
+                # Конвертируем metadata в dict для register_aliases
+                frontmatter_dict = {
+                    "aliases": getattr(metadata, 'aliases', []),
+                    "primary_h2_id": getattr(metadata, 'primary_h2_id', None)
+                }
+                register_aliases(frontmatter_dict, str(file), target=part.md_aliases)
+            except Exception as e:
+                print(f"  ⚠️ Ошибка регистрации алиасов: {e}")
+
+            # Локальная регистрация алиасов
+            for a in (getattr(metadata, 'aliases', ()) or []):
+                part.alias_map[_norm(a)] = {"file": str(file), "primary_h2_id": getattr(metadata, 'primary_h2_id', None)}
+
+            # если это файл с врачами - собрать имена
+            if getattr(metadata, 'doc_type', '') in ('doctor', 'doctors') or file.name == "doctors.md":
+                found = doc.doctor_names()
+                if found:
+                    part.doctor_name_tokens.update(found)
+                    print(f"  🏥 Найдены врачи в {file.name}: {found}")
+
+            # Разбиваем на чанки по секциям
+            blocks = doc.blocks
+            file_chunks = chunks_from_document(doc)
+            print(f"  📝 Создано чанков: {len(file_chunks)}")
+
+            # ==== ИНДЕКСАЦИЯ КАТАЛОГА ИМПЛАНТОВ ====
+            if metadata.doc_type == "catalog" and metadata.topic == "implants":
+                print(f"  🏷️ Индексируем каталог имплантов из {file.name}")
+                for ch, block in zip(file_chunks, blocks):
+                    # Позиции каталога — секции ### Заголовок
+                    name = block.catalog_name
+                    if not name:
+                        continue
+
+                    # Алиасы из HTML-комментария секции
+                    aliases = [name, *block.catalog_aliases]
+
+                    # Создаем entity_key
+                    entity_key = _slugify_implant_kind(name)
+                    print(f"    📋 Секция: '{name}' → '{entity_key}' (алиасы: {aliases})")
+
+                    # Сохраняем чанк
+                    part.entity_chunks[("implants", entity_key)] = ch
+
+                    # Индексируем алиасы
+                    for a in aliases:
+                        part.entity_index[_norm(a)] = {
+                            "topic": "implants", 
+                            "entity": entity_key, 
+                            "doc_id": metadata.id or file.name, 
+                            "section": name
+                        }
+
+            # Привязываем метаданные к каждому чанку (merge: поля чанка важнее полей файла)
+            for chunk, block in zip(file_chunks, blocks):
+                # фронтматтер файла общий для всех чанков, у чанка — только поля секции
+                chunk.metadata = Frontmatter(block.metadata(), file=metadata)  # H2/H3/aliases из чанка НЕ теряем
+                chunk.followups = part.file_meta[file.name]["followups"]
+
+                # Обновляем entity_index для всех чанков
+                if metadata.topic:
+                    part.update_entity_index(chunk, metadata.topic, chunk.id)
+
+                # перед append(chunk) - нормализуй теги в метаданных
+                try:
+                    if hasattr(chunk.metadata, "tags") and isinstance(chunk.metadata.tags, list):
+                        chunk.metadata.tags_lower = [str(t).strip().lower() for t in chunk.metadata.tags] or _NO_TAGS
+                    else:
+                        chunk.metadata.tags_lower = _NO_TAGS
+                except Exception:
+                    chunk.metadata.tags_lower = _NO_TAGS
+
+                part.chunks.append(chunk)
+
+                # Регистрируем все чанки в entity_chunks (не только импланты)
+                part.entity_chunks[(chunk.metadata.topic or "general", chunk.id)] = chunk
+
+                # Если это карточка врача (подзаголовок ## или ### Имя Фамилия [Отчество]) — запоминаем прямую ссылку
+                if block.doctor:
+                    full = block.doctor
+                    parts = full.split()
+                    last = parts[0] # Фамилия
+                    first = parts[1] if len(parts) > 1 else ""
+
+                    # Ключи, по которым реально спрашивают
+                    keys = {
+                        full,                               # "Моисеев Кирилл Николаевич"
+                        last,                               # "Моисеев"
+                        (f"{last} {first}").strip(),        # "Моисеев Кирилл"
+                        (f"{first} {last}").strip(),        # "Кирилл Моисеев"
+                    }
+
+                    for k in sorted(keys):
+                        part.doctor_name_to_chunk[k.lower()] = chunk
+
+                    # Для регэкспа/подсветки - без отчеств, чтобы не засорять
+                    part.doctor_name_tokens.update({full, last, f"{first} {last}".strip(), f"{last} {first}".strip()})
+                    print(f"🔗 Карточка врача: {full} → {getattr(chunk, 'section', chunk.file_name)}; ключи: {sorted(keys)}")
+
+            print(f"  ✅ Файл обработан успешно")
+        except Exception as e:
+            print(f"❌ Ошибка при обработке файла {file}: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            part.bm25_tokens = [_bm25_tokens(ch) for ch in part.chunks]
+            if DEDUP_ENABLE:
+                part.signatures = [minhash_signature(ch.text) for ch in part.chunks]
+            part.derive_fields()
+            part.pack_texts()
+        return part
+
+    def _ingest_files(self, items: List[Tuple[Path, bytes]]) -> List[FileIndex]:
+        """
+        Разбирает файлы последовательно или в пуле процессов (ingest_workers > 1).
+
+        Args:
+            items: [(путь, содержимое)] в порядке обхода md/
+
+        Returns:
+            FileIndex в том же порядке — слияние индексов не зависит от числа воркеров
+        """
+        workers = min(self.ingest_workers, len(items))
+        if workers > 1:
+            try:
+                # spawn: в процессе уже могут работать потоки (наблюдатель md/, сборка эмбеддингов), fork небезопасен
+                ctx = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                    chunksize = max(1, len(items) // (workers * 4))
+                    return list(pool.map(_ingest_task, [(str(f), data) for f, data in items], chunksize=chunksize))
+            except Exception as e:
+                print(f"⚠️ Пул процессов для разбора md недоступен ({e}), разбираем последовательно")
+        return [self._ingest_file(f, data) for f, data in items]
+
+    def _ingest_md(self):
+        """Разбирает md/ и строит индексы: алиасы, сущности, врачи, BM25, эмбеддинги"""
+        try:
+            # Проверяем наличие папки md
+            if not self.md_dir.exists():
+                print(f"ERROR: Папка {self.md_dir} НЕ найдена!")
+                raise Exception(f"Папка {self.md_dir} не существует")
+
+            # Проверяем наличие doctors.md
+            doctors_file = self.md_dir / "doctors.md"
+            if doctors_file.exists():
+                print(f"OK: Файл doctors.md найден")
+            else:
+                print(f"ERROR: Файл doctors.md НЕ найден!")
+
+            # Проверяем наличие themes.json
+            themes_file = self.themes_path
+            if themes_file.exists():
+                print(f"OK: Файл config/themes.json найден")
+            else:
+                print(f"ERROR: Файл config/themes.json НЕ найден!")
+
+            with self._stage("md_read"):
+                all_md_files = list(self.md_dir.rglob("*.md"))
+                items = []
+                for file in all_md_files:
+                    try:
+                        items.append((file, file.read_bytes()))
+                    except Exception as e:
+                        print(f"❌ Ошибка при обработке файла {file}: {e}")
+            with self._stage("md_parse"):
+                files = {part.path: part for part in self._ingest_files(items)}
+
+            # Логируем статистику фильтрации
+            from core.logger import log_m
+            skipped = sum(1 for part in files.values() if part.skipped)
+            log_m.info({"ev":"filter_index_like","skipped":skipped,"total":len(all_md_files)})
+
+            self._publish(self._build_state(files, dense=self.dense and not self.dense_async))
+        except Exception as e:
+            print(f"❌ Критическая ошибка при инициализации: {e}")
+            import traceback
+            traceback.print_exc()
+            print("⚠️ Embeddings недоступны, работаем только на BM25 и правилах")
+            # опубликованный снимок остаётся прежним
+
+    def _build_state(self, files: Dict[str, FileIndex], reuse: Optional[Dict[str, np.ndarray]] = None,
+                     dense: bool = True) -> Dict[str, Any]:
+        """
+        Сливает FileIndex в порядке файлов и строит BM25 и векторный индекс.
+        Ничего не меняет в движке — результат публикует _publish().
+
+        Args:
+            files: {путь: FileIndex} в порядке обхода md/
+            reuse: Готовые векторы по тексту эмбеддинга (неизменённые чанки)
+            dense: Строить векторный индекс сейчас (False — его подключит фоновая сборка)
+
+        Returns:
+            Поля снимка + files/md_aliases движка
+        """
+        state = {"files": files, "all_chunks": [], "doctor_name_tokens": set()}
+        for name in FileIndex.MAPS:
+            state[name] = {}
+        bm25_corpus = []
+        signatures = []
+        for part in files.values():
+            state["all_chunks"].extend(part.chunks)
+            bm25_corpus.extend(part.bm25_tokens)
+            signatures.extend(part.signatures or [None] * len(part.chunks))
+            for name in FileIndex.MAPS:
+                state[name].update(getattr(part, name))
+            state["doctor_name_tokens"].update(part.doctor_name_tokens)
+
+        # почти одинаковые секции: в индексы идёт один канонический чанк на кластер
+        state["duplicate_of"] = {}
+        if DEDUP_ENABLE:
+            with self._stage("dedup"):
+                bm25_corpus = _collapse_duplicates(state, bm25_corpus, signatures)
+        all_chunks = state["all_chunks"]
+
+        # вопросы пациентов к чанкам: токены — в документ чанка в BM25, векторы — строками после чанков
+        state["doc2query"] = ()
+        if self.doc2query and all_chunks:
+            with self._stage("doc2query"):
+                state["doc2query"] = _doc2query_questions(all_chunks)
+                bm25_corpus = list(bm25_corpus)
+                for pos, question in state["doc2query"]:
+                    bm25_corpus[pos] = bm25_corpus[pos] + re.findall(r'\w+', question.lower())
+
+        print(f"⏳ Найдено {len(all_chunks)} чанков")
+        print(f"✅ ALL_CHUNKS инициализирован: {len(all_chunks)} чанков")
+        print(f"✅ ALIAS_MAP_GLOBAL: {len(state['alias_map_global'])} алиасов")
+        print(f"✅ H2_INDEX: {len(state['h2_index'])} заголовков")
+        print(f"✅ FILE_META: {len(state['file_meta'])} файлов")
+
+        # Логируем статистику индексов
+        print(f"📊 INDEX STATS: docs={len(state['file_meta'])}, chunks={len(all_chunks)}, aliases={len(state['alias_map_global'])}, h2s={len(state['h2_index'])}")
+
+        # Создаем BM25 индекс (токены закэшированы в FileIndex)
+        state["bm25_index"] = None
+        if all_chunks:
+            print(f"🔍 Создаем BM25 индекс для {len(all_chunks)} чанков...")
+            with self._stage("bm25"):
+                state["bm25_index"] = BM25Okapi(bm25_corpus)
+            print(f"✅ BM25 индекс создан")
+
+        # Отладочная информация о чанках
+        for chunk in all_chunks[:5]:  # Показываем первые 5 чанков
+            print(f"  📄 {chunk.file_name}: {chunk.text[:80]}...")
+
+        # Пересобираем regex для врачей
+        state["doctor_name_regex"], state["doctor_query_regex"] = build_doctor_regex(state["doctor_name_tokens"])
+        state["doctor_regex"] = state["doctor_query_regex"]
+        print(f"Врачи: Собраны имена врачей: {len(state['doctor_name_tokens'])} -> {sorted(list(state['doctor_name_tokens']))[:6]} ...")
+
+        # факты для прямых ответов (врачи, контакты, цены, виды имплантации)
+        state["facts"] = self._build_facts(state)
+
+        if not dense:
+            print("⏳ Векторный индекс строится в фоне, пока работаем на BM25 и правилах")
+            state["index"] = None
+            return state
+
+        try:
+            with self._stage("dense"):
+                state["index"] = self._build_dense(all_chunks, reuse, state["doc2query"])
+        except Exception as e:
+            print(f"❌ Критическая ошибка при инициализации: {e}")
+            import traceback
+            traceback.print_exc()
+            print("⚠️ Embeddings недоступны, работаем только на BM25 и правилах")
+            state["index"] = None
+            # нет FAISS, но чанки оставляем!
+        return state
+
+    def _build_facts(self, state: Dict[str, Any]) -> Optional[FactStore]:
+        """Хранилище фактов по чанкам и картам состояния (None — FACTS_ENABLE=false)"""
+        if not FACTS_ENABLE:
+            return None
+        with self._stage("facts"):
+            facts = FactStore.build(state["all_chunks"], state["doctor_name_to_chunk"], state["entity_chunks"],
+                                    kind_of=_slugify_implant_kind)
+        print(f"✅ FACTS: врачей {len(facts.doctors)}, полей контактов {len(facts.contacts)}, "
+              f"цен {len(facts.prices)}, видов имплантации {len(facts.implant_kinds)}")
+        return facts
+
+    def _build_dense(self, chunks: List[RetrievedChunk], reuse: Optional[Dict[str, np.ndarray]] = None,
+                     questions: Sequence[Tuple[int, str]] = ()):
+        """
+        Векторный индекс по чанкам: готовые векторы → кэш → embeddings API (только промахи).
+        Вопросы doc2query идут строками после чанков; id строк — _dense_ids (по id чанков, а не по позиции).
+        """
+        # Проверяем, что есть чанки для обработки
+        if len(chunks) == 0:
+            print("⚠️ Предупреждение: Не найдено ни одного чанка для обработки")
+            # Создаем пустой индекс
+            dimension = 1536  # размерность text-embedding-3-small
+            return IndexIDMap(dimension)
+
+        # Получаем эмбеддинги для всех фрагментов
+        print(f"⏳ Генерация эмбеддингов для {len(chunks)} чанков...")
+
+        # Создаем эмбеддинги: текст + реальные алиасы для поиска
+        chunk_texts = [_embed_text(chunk) for chunk in chunks] + [q for _, q in questions]
+        if questions:
+            print(f"❓ + {len(questions)} векторов вопросов doc2query")
+
+        # Неизменённые чанки при перезагрузке берут вектор из текущего индекса
+        embeddings = [reuse.get(t) for t in chunk_texts] if reuse else [None] * len(chunk_texts)
+        reused = sum(1 for vec in embeddings if vec is not None)
+        if reuse:
+            print(f"♻️ Векторы переиспользованы для {reused} чанков")
+
+        # Персистентный кэш: эмбеддим только новые/изменённые чанки
+        pending = [i for i, vec in enumerate(embeddings) if vec is None]
+        embed_cache = None
+        if EMBED_CACHE_ENABLE and pending:
+            try:
+                from core.embed_cache import EmbeddingCache
+                embed_cache = EmbeddingCache(self.embed_model)
+            except Exception as e:
+                print(f"⚠️ Кэш эмбеддингов недоступен: {e}")
+
+        if embed_cache:
+            for i, vec in zip(pending, embed_cache.get_many([chunk_texts[i] for i in pending])):
+                embeddings[i] = vec
+        missing = [i for i, vec in enumerate(embeddings) if vec is None]
+
+        # Промахи эмбеддим пакетами (батчи + параллельность + ретраи на 429/5xx)
+        fresh = None
+        if missing:
+            from core.embed_batcher import embed_texts
+            fresh = embed_texts(self.client, [chunk_texts[i] for i in missing], self.embed_model)
+            print(f"✅ Эмбеддинги получены для {len(missing)} чанков")
+        if embed_cache:
+            if missing:
+                embed_cache.put_many([chunk_texts[i] for i in missing], fresh)
+            cache_stats = embed_cache.stats()
+            embed_cache.close()
+            print(f"💾 Кэш эмбеддингов: hits={cache_stats['hits']}, misses={cache_stats['misses']}, size={cache_stats['size']}")
+            from core.logger import log_m
+            log_m.info({"ev": "embed_cache", "reused": reused, **cache_stats})
+
+        # Собираем матрицу в порядке чанков
+        dimension = fresh.shape[1] if fresh is not None else len(next(vec for vec in embeddings if vec is not None))
+        xb = np.empty((len(chunk_texts), dimension), dtype="float32")
+        for i, vec in enumerate(embeddings):
+            if vec is not None:
+                xb[i] = vec
+        if missing:
+            xb[missing] = fresh
+        normalize_L2_inplace(xb)
+        # точный или ANN (DENSE_INDEX=hnsw|ivf) — см. core/faiss_compat.make_index
+        index = make_index(xb, _dense_ids(chunks, questions))
+
+        print(f"✅ Индекс создан с {len(chunks)} чанками ({index_kind(index)})")
+
+        # Логируем backend при старте
+        from core.logger import log_m
+        log_m.info({"event": "faiss_backend", "value": "faiss" if HAS_FAISS else "numpy", "kind": index_kind(index)})
+        return index
+
+    def _publish(self, state: Dict[str, Any]) -> "IndexSnapshot":
+        """Собирает из состояния новый снимок и публикует его одной заменой ссылки"""
+        import core.md_loader as md_loader
+        state = dict(state)
+        files = state.pop("files")
+        md_aliases = state.pop("md_aliases")
+        # regex темы "doctors" для route_theme — по алиасам своего корпуса, а не общей карты процесса
+        from core.router import build_doctor_name_regex
+        theme_doctor_regex = re.compile(build_doctor_name_regex(md_aliases), re.IGNORECASE)
+        snapshot = IndexSnapshot(version=self._snapshot.version + 1, theme_map=self.theme_map,
+                                 theme_router=self.theme_router, theme_doctor_regex=theme_doctor_regex,
+                                 client=self.client, embed_model=self.embed_model, cta_config=self.cta_config, **state)
+
+        # вклад движка в общую карту md_loader: старые алиасы убираем, новые добавляем
+        if self.global_aliases:
+            for key in self.md_aliases:
+                if key not in md_aliases:
+                    md_loader.ALIAS_MAP.pop(key, None)
+            md_loader.ALIAS_MAP.update(md_aliases)
+        self.files, self.md_aliases = files, md_aliases
+        return self._swap(snapshot)
+
+    def _swap(self, snapshot: "IndexSnapshot") -> "IndexSnapshot":
+        """Публикует снимок: одна замена ссылки, старый снимок освобождается после своих запросов"""
+        old, self._snapshot = self._snapshot, snapshot
+        old.retire()
+        from core.logger import log_m
+        log_m.info({"ev": "index_snapshot_published", "version": snapshot.version,
+                    "chunks": len(snapshot.all_chunks), "dense": snapshot.index is not None})
+        return snapshot
+
+    def _md_source_hashes(self) -> Dict[str, str]:
+        """Хэши md-файлов корпуса — для проверки актуальности бандла"""
+        from core.index_bundle import source_hashes
+        return source_hashes(Path.cwd(), self.md_dir.rglob("*.md"))
+
+    def _load_index_bundle(self) -> bool:
+        """Грузит готовый бандл вместо разбора md/. True — если индексы подняты из бандла."""
+        if not self.use_bundle:
+            return False
+        try:
+            from core.index_bundle import IndexBundle, current_bundle_path, bm25_from_stats
+            path = current_bundle_path(self.bundle_dir)
+            if path is None:
+                return False
+            bundle = IndexBundle(path)
+            if INDEX_BUNDLE_VERIFY and self.md_dir.exists() and bundle.is_stale(self._md_source_hashes()):
+                print(f"⚠️ Бандл {bundle.build_id} устарел (md/ изменились) — пересобираем индексы из md/")
+                return False
+            if bundle.manifest.get("embed_model") != self.embed_model and bundle.embeddings is not None:
+                print(f"⚠️ Бандл собран моделью {bundle.manifest.get('embed_model')}, ожидается {self.embed_model}")
+                return False
+
+            files: Dict[str, Frontmatter] = {}
+            chunks = [_chunk_from_record(i, r, files, bundle.arena) for i, r in enumerate(bundle.records)]
+            with self._stage("chunk_fields"):
+                for ch in chunks:
+                    ch._fields = ChunkFields(ch.text)
+            # followups в бандле — списками в file_meta; на чанки — один кортеж на файл
+            for meta in bundle.maps["file_meta"].values():
+                meta["followups"] = tuple(meta.get("followups") or ())
+            for ch in chunks:
+                ch.followups = bundle.maps["file_meta"].get(ch.file_name, {}).get("followups", ())
+            bm25 = bm25_from_stats(bundle.bm25) if bundle.bm25 else None
+            maps = bundle.maps
+            doc2query = tuple((p, q) for p, q in maps.get("doc2query", []))
+            dense = None
+            if bundle.embeddings is not None:
+                # в бандле строки позиционные (чанки, затем вопросы) — id восстанавливаем по чанкам
+                dense = make_index(bundle.embeddings, _dense_ids(chunks, doc2query))
+
+            state = {
+                "files": {},
+                "all_chunks": chunks,
+                "entity_index": maps["entity_index"],
+                "entity_chunks": {(t, e): chunks[i] for t, e, i in maps["entity_chunks"]},
+                "alias_map": maps["alias_map"],
+                "alias_map_global": maps["alias_map_global"],
+                "h2_index": maps["h2_index"],
+                "file_meta": maps["file_meta"],
+                "doctor_name_to_chunk": {k: chunks[i] for k, i in maps["doctor_name_to_chunk"].items()},
+                "doctor_name_tokens": set(maps["doctor_name_tokens"]),
+                "md_aliases": dict(maps.get("md_loader_alias_map", {})),
+                "duplicate_of": {k: {**d, "canonical": chunks[d["canonical"]]}
+                                 for k, d in maps.get("duplicate_of", {}).items()},
+                "doc2query": doc2query,
+                "bm25_index": bm25,
+                "index": dense,
+            }
+            state["doctor_name_regex"], state["doctor_query_regex"] = build_doctor_regex(state["doctor_name_tokens"])
+            state["doctor_regex"] = state["doctor_query_regex"]
+            state["facts"] = self._build_facts(state)
+            if dense is None:
+                print("⚠️ В бандле нет эмбеддингов, работаем только на BM25 и правилах")
+
+            self._publish(state)
+            print(f"📦 Индексы загружены из бандла {bundle.build_id}: {len(chunks)} чанков")
+            from core.logger import log_m
+            log_m.info({"ev": "index_bundle_loaded", "build_id": bundle.build_id, "chunks": len(chunks),
+                        "dense": dense is not None})
+            return True
+        except Exception as e:
+            print(f"❌ Не удалось загрузить бандл индексов: {e}")
+            return False
+
+    def export_index_bundle(self, root: Path | None = None) -> Path:
+        """Сохраняет текущие индексы в версионированный бандл (см. core/index_bundle.py)"""
+        from core.index_bundle import write_bundle, bm25_stats
+        from core.faiss_compat import reconstruct_ids
+
+        snap = self._snapshot
+        pos = {id(ch): i for i, ch in enumerate(snap.all_chunks)}
+        # карты снимка — MappingProxyType, в JSON пишем обычные dict
+        maps = {
+            "entity_index": dict(snap.entity_index),
+            "entity_chunks": [[t, e, pos[id(ch)]] for (t, e), ch in snap.entity_chunks.items() if id(ch) in pos],
+            "alias_map": dict(snap.alias_map),
+            "alias_map_global": dict(snap.alias_map_global),
+            "h2_index": dict(snap.h2_index),
+            "file_meta": dict(snap.file_meta),
+            "doctor_name_to_chunk": {k: pos[id(ch)] for k, ch in snap.doctor_name_to_chunk.items() if id(ch) in pos},
+            "doctor_name_tokens": sorted(snap.doctor_name_tokens),
+            "md_loader_alias_map": self.md_aliases,
+            "duplicate_of": {k: {"file": d["file"], "h2_id": d["h2_id"], "canonical": pos[id(d["canonical"])]}
+                             for k, d in snap.duplicate_of.items()},
+            "doc2query": [[p, q] for p, q in snap.doc2query],
+        }
+        # бандл хранит строки по позициям: чанки, затем вопросы doc2query
+        embeddings = (reconstruct_ids(snap.index, _dense_ids(snap.all_chunks, snap.doc2query))
+                      if snap.index is not None and snap.all_chunks else None)
+        return write_bundle(
+            Path(root) if root else self.bundle_dir,
+            texts=[ch.text for ch in snap.all_chunks],
+            records=[_chunk_record(ch) for ch in snap.all_chunks],
+            embeddings=embeddings,
+            bm25=bm25_stats(snap.bm25_index) if snap.bm25_index is not None else None,
+            maps=maps,
+            sources=self._md_source_hashes(),
+            embed_model=self.embed_model,
+        )
+
+    # ---- Перезагрузка корпуса ----
+
+    def reload(self) -> Dict[str, Any]:
+        """
+        Инкрементальная переиндексация md/: заново разбираются только добавленные и изменённые файлы,
+        эмбеддятся только их чанки. Запросы во время сборки обслуживаются старыми индексами.
+
+        Returns:
+            Сводка: added/modified/removed, число чанков, время
+        """
+        with self._reload_lock:
+            t0 = time.perf_counter()
+            files, added, modified, pending = {}, [], [], []
+            for file in self.md_dir.rglob("*.md"):
+                key = str(file)
+                try:
+                    data = file.read_bytes()
+                except OSError as e:
+                    print(f"⚠️ Не удалось прочитать {file}: {e}")
+                    continue
+                old = self.files.get(key)
+                if old is not None and old.digest == hashlib.sha256(data).hexdigest():
+                    files[key] = old
+                    continue
+                (modified if old is not None else added).append(key)
+                files[key] = None   # место в порядке обхода md/
+                pending.append((file, data))
+            for part in self._ingest_files(pending):
+                files[part.path] = part
+            removed = [key for key in self.files if key not in files]
+
+            summary = {"added": added, "modified": modified, "removed": removed}
+            if not (added or modified or removed) and self.files:
+                return {**summary, "changed": False}
+
+            # векторы текущего индекса по тексту эмбеддинга — чтобы не эмбеддить неизменённые чанки
+            reuse = {}
+            current = self._snapshot
+            if current.index is not None and current.all_chunks:
+                from core.faiss_compat import reconstruct_ids
+                vectors = reconstruct_ids(current.index, _dense_ids(current.all_chunks, current.doc2query))
+                texts = [_embed_text(ch) for ch in current.all_chunks] + [q for _, q in current.doc2query]
+                reuse = dict(zip(texts, vectors))
+
+            # пока фоновая сборка не закончилась, векторный индекс нового снимка тоже строится в фоне
+            dense_now = self.dense and (current.index is not None or not self.dense_async)
+            snap = self._publish(self._build_state(files, reuse, dense=dense_now))
+            summary.update(changed=True, chunks=len(snap.all_chunks), dense=snap.index is not None,
+                           version=snap.version, ms=round((time.perf_counter() - t0) * 1000, 1))
+            print(f"🔄 Корпус перезагружен: +{len(added)} ~{len(modified)} -{len(removed)}, чанков: {len(snap.all_chunks)}")
+            from core.logger import log_m
+            log_m.info({"ev": "corpus_reload", **summary})
+        # эмбеддинги недоступны — перезагруженный корпус получит векторный индекс из фона
+        self.ensure_dense()
+        return summary
+
+    def start_watching(self, interval: float | None = None):
+        """
+        Запускает фоновый опрос md/ (один на процесс; после fork — заново в каждом воркере).
+
+        Args:
+            interval: Период опроса в секундах (по умолчанию CORPUS_WATCH_INTERVAL)
+
+        Returns:
+            CorpusWatcher
+        """
+        from core.corpus_watcher import CorpusWatcher, CORPUS_WATCH_INTERVAL
+        if self._watcher is not None and self._watcher.alive():
+            return self._watcher
+        with self._watch_lock:
+            if self._watcher is not None and self._watcher.alive():
+                return self._watcher
+            self._watcher = CorpusWatcher(self.md_dir, on_change=lambda changes: self.reload(),
+                                          interval=interval or CORPUS_WATCH_INTERVAL)
+            self._watcher.start()
+            return self._watcher
+
+    def close(self) -> None:
+        """
+        Движок выгружен (тенант вытеснен): останавливаем наблюдение за md/.
+        Запросы, уже взявшие снимок, дорабатывают; фоновая сборка эмбеддингов дойдёт до конца
+        и освободится вместе с движком.
+        """
+        with self._watch_lock:
+            if self._watcher is not None:
+                self._watcher.stop()
+                self._watcher = None
+
+
+# ==== СНИМОК ИНДЕКСОВ ====
+class IndexSnapshot:
+    """
+    Неизменяемый снимок всего, что читают ретривал и get_rag_answer: чанки, BM25,
+    векторный индекс, карты алиасов/H2/сущностей/врачей, темы.
+    Списки хранятся кортежами, словари — через MappingProxyType (неизменяемость поверхностная:
+    чанки, BM25 и векторный индекс после публикации только читаются).
+    Снимки создаёт RagEngine._publish(); запрос получает снимок через RagEngine.acquire().
+    """
+
+    # поля-словари (только чтение после публикации)
+    MAPS = ("entity_index", "entity_chunks", "alias_map", "alias_map_global", "h2_index", "file_meta",
+            "doctor_name_to_chunk", "duplicate_of", "theme_map")
+    FIELDS = MAPS + ("all_chunks", "doctor_name_tokens", "doctor_regex", "doctor_name_regex", "doctor_query_regex",
+                     "bm25_index", "index", "doc2query", "facts", "client", "embed_model", "cta_config",
+                     "theme_router", "theme_doctor_regex")
+
+    def __init__(self, version: int = 0, **fields):
+        """
+        Args:
+            version: Номер публикации (0 — пустой снимок до load())
+            **fields: Значения полей из FIELDS (недостающие — пустые)
+        """
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise TypeError(f"IndexSnapshot: неизвестные поля {sorted(unknown)}")
+        values = {name: fields.get(name) for name in self.FIELDS}
+        for name in self.MAPS:
+            values[name] = MappingProxyType(values[name] if values[name] is not None else {})
+        values["all_chunks"] = tuple(values["all_chunks"] or ())
+        values["doc2query"] = tuple(values["doc2query"] or ())
+        values["doctor_name_tokens"] = frozenset(values["doctor_name_tokens"] or ())
+        # id строки векторного индекса → позиция чанка (вопросы doc2query — позиция их чанка)
+        dense_pos = {}
+        if values["index"] is not None:
+            positions = list(range(len(values["all_chunks"]))) + [pos for pos, _ in values["doc2query"]]
+            dense_pos = dict(zip(_dense_ids(values["all_chunks"], values["doc2query"]).tolist(), positions))
+        values["_dense_pos"] = dense_pos
+        values.update(version=version, created_at=time.time(),
+                      _lock=threading.Lock(), _leases=0, _retired=False)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"IndexSnapshot неизменяем: {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"IndexSnapshot неизменяем: {name}")
+
+    # ---- Удержание запросами ----
+
+    def _enter(self) -> bool:
+        """Запрос начал работу со снимком. False — снимок уже заменён, брать нельзя."""
+        with self._lock:
+            if self._retired:
+                return False
+            object.__setattr__(self, "_leases", self._leases + 1)
+            return True
+
+    def _exit(self) -> None:
+        with self._lock:
+            object.__setattr__(self, "_leases", self._leases - 1)
+            released = self._retired and self._leases == 0
+        if released:
+            self._released()
+
+    def retire(self) -> None:
+        """Снимок заменён новым: освобождается сразу или после последнего запроса."""
+        with self._lock:
+            object.__setattr__(self, "_retired", True)
+            released = self._leases == 0
+        if released:
+            self._released()
+
+    def _released(self) -> None:
+        if not self.all_chunks:
+            return
+        from core.logger import log_m
+        log_m.info({"ev": "index_snapshot_released", "version": self.version, "chunks": len(self.all_chunks),
+                    "age_s": round(time.time() - self.created_at, 1)})
+
+    def replace(self, **changes) -> "IndexSnapshot":
+        """Новый снимок (следующей версии) с заменёнными полями, остальное — общее с этим"""
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        fields.update(changes)
+        return IndexSnapshot(version=self.version + 1, **fields)
+
+    def tiers(self) -> Dict[str, bool]:
+        """Какие уровни ретривала доступны в этом снимке"""
+        return {
+            "bm25": self.bm25_index is not None,
+            "entity": bool(self.entity_index),
+            "doctors": bool(self.doctor_name_to_chunk),
+            "facts": bool(self.facts),
+            "dense": self.index is not None,
+        }
+
+    def mq_enabled(self) -> bool:
+        """Условный multi-query: выключен, если в индексе есть вопросы doc2query (DOC2QUERY_REPLACES_MQ)"""
+        if self.doc2query and DOC2QUERY_REPLACES_MQ:
+            return False
+        return os.getenv('MQ_ENABLE_CONDITIONAL','true').lower() == 'true'
+
+    def dense_search(self, q: np.ndarray, top: int) -> List[Tuple[RetrievedChunk, float]]:
+        """
+        Поиск по векторному индексу: строки-вопросы doc2query сводятся к своему чанку (лучшее сходство).
+
+        Args:
+            q: Нормированный вектор запроса, форма (1, d)
+            top: Сколько разных чанков вернуть
+
+        Returns:
+            [(чанк, сходство)] по убыванию сходства
+        """
+        return self.dense_search_many(q, top)[0]
+
+    def dense_search_many(self, Q: np.ndarray, top: int) -> List[List[Tuple[RetrievedChunk, float]]]:
+        """
+        Пакетный поиск: все запросы одним index.search — одно произведение (n × d) @ (d × N).
+
+        Args:
+            Q: Нормированные векторы запросов, форма (n, d)
+            top: Сколько разных чанков вернуть на запрос
+
+        Returns:
+            Для каждой строки Q — [(чанк, сходство)] по убыванию сходства
+        """
+        n = len(self.all_chunks)
+        questions = self.doc2query
+        # на чанк может прийтись до DOC2QUERY_PER_CHUNK строк-вопросов — берём с запасом
+        k = min(top * (1 + DOC2QUERY_PER_CHUNK), n + len(questions)) if questions else min(top, n)
+        D, I = self.index.search(Q, k)
+        out = []
+        for row_ids, row_sims in zip(I, D):
+            results, seen = [], set()
+            for i, sim in zip(row_ids.tolist(), row_sims):
+                # id строки индекса → позиция чанка; -1 и чужие id (не из этого снимка) пропускаем
+                pos = self._dense_pos.get(i)
+                if pos is None or pos in seen:
+                    continue
+                seen.add(pos)
+                results.append((self.all_chunks[pos], float(sim)))
+                if len(results) >= top:
+                    break
+            out.append(results)
+        return out
+
+    @property
+    def active_requests(self) -> int:
+        """Сколько запросов сейчас работают с этим снимком"""
+        return self._leases
+
+    def memory_bytes(self) -> Dict[str, int]:
+        """
+        Оценка памяти индексов снимка (бюджет тенантов, метрики).
+        Тексты из memory-mapped арены не считаются — это общий page cache, а не память процесса.
+
+        Returns:
+            Байты по частям: texts, fields (производные поля), chunks, bm25, dense и total
+        """
+        arenas, texts, fields = {}, 0, 0
+        for ch in self.all_chunks:
+            if ch._fields is not None:
+                fields += ch._fields.nbytes
+            if ch._arena is None:
+                texts += len(ch._text) * 2
+            else:
+                arenas[id(ch._arena)] = ch._arena
+        texts += sum(a.nbytes for a in arenas.values() if not a.mapped)
+        bm25 = 0
+        if self.bm25_index is not None:
+            bm25 = sum(len(df) for df in self.bm25_index.doc_freqs) * BM25_POSTING_BYTES
+        dense = 0
+        if self.index is not None:
+            dense = int(self.index.ntotal) * int(self.index.d) * 4
+        out = {"texts": texts, "fields": fields, "chunks": len(self.all_chunks) * CHUNK_OVERHEAD_BYTES,
+               "bm25": bm25, "dense": dense}
+        out["total"] = sum(out.values())
+        return out
+
+    # ---- Точные адреса: H2, темы, врачи ----
+
+    def _find_chunk(self, file_name: str, h2_id: str|None):
+        for ch in self.all_chunks:
+            if ch.file_name == file_name:
+                if h2_id is None or getattr(ch.metadata, "h2_id", None) == h2_id:
+                    return ch
+        # секция могла уйти в дубли — отдаём канонический чанк её кластера
+        for dup in self.duplicate_of.values():
+            if dup["file"] == file_name and (h2_id is None or dup["h2_id"] == h2_id):
+                return dup["canonical"]
+        return None
+
+    def get_default_chunk_for_topic(self, topic: str):
+        file_name, h2_id = DEFAULT_H2.get(topic, (None, None))
+        if file_name:
+            ch = self._find_chunk(file_name, h2_id)
+            if ch: return ch, {"source":"default","topic":topic,"exact_h2_match":bool(h2_id)}
+        # запасной путь — первый чанк этой темы
+        for ch in self.all_chunks:
+            if getattr(ch.metadata, "topic", None) == topic:
+                return ch, {"source":"default-any","topic":topic,"exact_h2_match":False}
+        return None, {}
+
+    def _find_doctor_direct_or_fuzzy(self, query: str):
+        q = (query or "").lower().replace("\u00a0", "")
+        # 1) прямое подстрочное совпадение по ключам
+        for k, ch in self.doctor_name_to_chunk.items():
+            if k in q:
+                return ch
+        # 2) морфологически «мягко» по фамилии: Моисеев/Моисеева/Моисееву...
+        for k, ch in self.doctor_name_to_chunk.items():
+            if " " not in k: # только однословные ключи = фамилии
+                if re.search(rf"\b{k}\w*\b", q, flags=re.IGNORECASE):
+                    return ch
+        # 3) опечатки
+        tokens = re.findall(r"[а-яё]{4,}", q)
+        keys = list(self.doctor_name_to_chunk.keys())
+        if not tokens:
+            return None
+        import difflib  # нужен только для опечаток в фамилиях — не грузим на старте
+        for t in tokens:
+            best = difflib.get_close_matches(t, keys, n=1, cutoff=0.84)
+            if best:
+                return self.doctor_name_to_chunk[best[0]]
+        return None
+
+    def fallback_theme_chunks(self, theme_key: str, limit: int = 3):
+        """Если семантика промахнулась - вернуть несколько явных тематических чанков."""
+        if not theme_key:
+            return []
+
+        cfg = self.theme_map[theme_key]
+        out = []
+
+        print(f"🔍 Fallback для темы '{theme_key}': ищем теги {cfg['tag_aliases']}")
+
+        for ch in self.all_chunks:
+            tags_l = getattr(ch.metadata, 'tags_lower', [])
+            text_l = ch.fields.lower
+
+            # Проверяем теги
+            tag_match = any(alias in (tags_l or []) for alias in cfg["tag_aliases"])
+            # Проверяем текст
+            text_match = any(alias in text_l for alias in cfg["tag_aliases"])
+
+            if tag_match or text_match:
+                out.append(ch)
+                print(f"  ✅ Найден чанк: {ch.file_name} (теги: {tags_l}, текст содержит: {[alias for alias in cfg['tag_aliases'] if alias in text_l]})")
+                if len(out) >= limit:
+                    break
+
+        print(f"🔍 Fallback вернул {len(out)} чанков")
+        return out
+
+    def expand_windows(self, chunks: List[RetrievedChunk]) -> List[RetrievedChunk]:
+        """
+        Окна одной длинной секции (core/splitter.py) среди chunks сливаются в один чанк на месте первого:
+        id родительского блока, текст от первого до последнего окна без повторов перекрытий
+        (пропущенные окна между ними берутся из снимка).
+
+        Args:
+            chunks: Отобранные для ответа чанки
+
+        Returns:
+            Чанки в том же порядке; окна — заменены собранной секцией
+        """
+        from core.splitter import expand_windows
+        parents: Dict[str, List[RetrievedChunk]] = {}
+        for ch in chunks:
+            pid = ch.metadata.get("parent_id")
+            if pid:
+                parents.setdefault(pid, []).append(ch)
+        parents = {pid: ws for pid, ws in parents.items() if len(ws) > 1}
+        if not parents:
+            return chunks
+
+        merged = {}
+        for pid, ws in parents.items():
+            lo = min(w.metadata.get("window") for w in ws)
+            hi = max(w.metadata.get("window") for w in ws)
+            windows = sorted((w for w in self.all_chunks if w.metadata.get("parent_id") == pid
+                              and lo <= w.metadata.get("window") <= hi), key=lambda w: w.metadata.get("window"))
+            if [w.metadata.get("window") for w in windows] != list(range(lo, hi + 1)):
+                continue    # часть окон ушла в дубли — оставляем окна как есть
+            first = ws[0]
+            section = RetrievedChunk(pid, expand_windows([w.text for w in windows],
+                                                         [w.metadata.get("overlap") for w in windows]),
+                                     first.metadata, first.file_name)
+            section.followups = first.followups
+            merged[pid] = section
+
+        out, done = [], set()
+        for ch in chunks:
+            pid = ch.metadata.get("parent_id")
+            if pid not in merged:
+                out.append(ch)
+            elif pid not in done:
+                done.add(pid)
+                out.append(merged[pid])
+        return out
+
+    # ---- Поиск ----
+
+    def get_embedding(self, text: str) -> List[float]:
+        """Эмбеддинг запроса: из кэша запросов (память → общий SQLite), иначе — embeddings API через склейщик"""
+        return self.get_embeddings([text])[0]
+
+    def get_embeddings(self, texts: Sequence[str]) -> List[List[float]]:
+        """
+        Эмбеддинги нескольких запросов (варианты multi-query): промахи кэша уходят в API одним пакетом.
+
+        Args:
+            texts: Тексты запросов
+
+        Returns:
+            Векторы в порядке texts; при ошибке API — нулевые векторы для промахов
+        """
+        cache = get_query_cache()
+        vectors: List[Any] = [cache.get(self.embed_model, t) if cache is not None else None for t in texts]
+        missing = [i for i, vec in enumerate(vectors) if vec is None]
+        if not missing:
+            return vectors
+        try:
+            batch = [texts[i] for i in missing]
+            # одновременные запросы разных пользователей уходят в API одним пакетом
+            coalescer = get_coalescer(self.client, self.embed_model)
+            if coalescer is not None:
+                fresh = coalescer.embed_many(batch)
+            else:
+                resp = self.client.embeddings.create(
+                    model=self.embed_model,
+                    input=batch,
+                    encoding_format="float"
+                )
+                fresh = [None] * len(batch)
+                for pos, item in enumerate(resp.data):
+                    fresh[getattr(item, "index", pos)] = item.embedding
+            # нулевой вектор при ошибке не кэшируем — только ответ API
+            for i, vec in zip(missing, fresh):
+                vectors[i] = cache.put(self.embed_model, texts[i], vec) if cache is not None else vec
+        except Exception as e:
+            print(f"Ошибка при создании эмбеддинга: {e}")
+            # Возвращаем нулевой вектор
+            for i in missing:
+                vectors[i] = [0.0] * 1536
+        return vectors
+
+    def embed_search(self, query, top=6):
+        """Поиск по эмбеддингам"""
+        return self.embed_search_many([query], top=top)[0]
+
+    def embed_search_many(self, queries: Sequence[str], top: int = 6) -> List[List[Tuple[RetrievedChunk, float]]]:
+        """
+        Поиск по эмбеддингам для нескольких запросов: один вызов embeddings API и один index.search.
+
+        Args:
+            queries: Тексты запросов (варианты multi-query)
+            top: Сколько чанков вернуть на запрос
+
+        Returns:
+            Для каждого запроса — [(чанк, сходство)]
+        """
+        if not self.index or not self.all_chunks or not queries:
+            return [[] for _ in queries]
+
+        try:
+            Q = np.asarray(self.get_embeddings(queries), dtype="float32")
+            normalize_L2_inplace(Q)
+            # Для IndexFlatIP D возвращает сходство (больше — лучше)
+            return self.dense_search_many(Q, top)
+        except Exception as e:
+            print(f"Ошибка в embed поиске: {e}")
+            return [[] for _ in queries]
+
+    def bm25_search(self, query, top=8):
+        """Поиск по BM25"""
+        return self.bm25_search_many([query], top=top)[0]
+
+    def bm25_search_many(self, queries: Sequence[str], top: int = 8) -> List[List[Tuple[RetrievedChunk, float]]]:
+        """
+        BM25 для нескольких запросов за один проход: вклад каждого терма по корпусу считается один раз
+        и складывается в оценки всех запросов, где он встречается (варианты multi-query делят большую часть слов).
+        Оценки совпадают с BM25Okapi.get_scores.
+
+        Args:
+            queries: Тексты запросов
+            top: Сколько чанков вернуть на запрос
+
+        Returns:
+            Для каждого запроса — [(чанк, score)] с score > 0 по убыванию
+        """
+        if not self.bm25_index or not self.all_chunks:
+            return [[] for _ in queries]
+
+        bm25 = self.bm25_index
+        token_lists = [re.findall(r'\w+', q.lower()) for q in queries]
+        doc_len = np.array(bm25.doc_len)
+        norm = bm25.k1 * (1 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+        term_scores: Dict[str, np.ndarray] = {}
+        for tokens in token_lists:
+            for t in tokens:
+                if t not in term_scores:
+                    q_freq = np.array([(doc.get(t) or 0) for doc in bm25.doc_freqs])
+                    term_scores[t] = (bm25.idf.get(t) or 0) * (q_freq * (bm25.k1 + 1) / (q_freq + norm))
+
+        out = []
+        for tokens in token_lists:
+            # тот же порядок сложения, что в get_scores (повторы терма учитываются)
+            bm25_scores = np.zeros(bm25.corpus_size)
+            for t in tokens:
+                bm25_scores += term_scores[t]
+
+            results = []
+            for i, score in enumerate(bm25_scores):
+                if score > 0:
+                    results.append((self.all_chunks[i], score))
+
+            # Сортируем по score и берем top
+            results.sort(key=lambda x: x[1], reverse=True)
+            out.append(results[:top])
+        return out
+
+    def hybrid_retriever(self, query: str, top_n: int = 20) -> List[Tuple[RetrievedChunk, float]]:
+        """Гибридный ретривер: объединяет BM25 и эмбеддинги"""
+        if not self.all_chunks or len(self.all_chunks) == 0:
+            return []
+
+        candidates = []
+
+        # ==== BM25 поиск ====
+        if self.bm25_index:
+            query_tokens = re.findall(r'\w+', query.lower())
+            bm25_scores = self.bm25_index.get_scores(query_tokens)
+            bm25_candidates = []
+
+            for i, score in enumerate(bm25_scores):
+                if score > 0:
+                    bm25_candidates.append((self.all_chunks[i], score))
+
+            # Нормализуем BM25 scores
+            if bm25_candidates:
+                max_score = max(score for _, score in bm25_candidates)
+                if max_score > 0:
+                    bm25_candidates = [(chunk, score / max_score * 0.6) for chunk, score in bm25_candidates]
+                    candidates.extend(bm25_candidates[:top_n])
+
+        # ==== Эмбеддинги поиск ====
+        # векторный индекс ещё строится — не тратим запрос к embeddings API
+        if self.index is not None:
+            try:
+                query_embedding = self.get_embedding(query)
+                q = np.asarray([query_embedding], dtype="float32")
+                normalize_L2_inplace(q)
+                hits = self.dense_search(q, top_n)
+
+                # Нормализуем embedding scores для IP (max = лучший)
+                max_ip = max(sim for _, sim in hits) if hits else 1.0
+                if max_ip > 0:
+                    embedding_candidates = []
+                    for chunk, sim in hits:
+                        score = (sim / max_ip) * 0.4  # чем больше IP, тем выше скор
+                        embedding_candidates.append((chunk, score))
+                    candidates.extend(embedding_candidates)
+            except Exception as e:
+                print(f"Ошибка в embedding поиске: {e}")
+
+        # ==== Объединяем и убираем дубли ====
+        seen_chunks = set()
+        unique_candidates = []
+
+        for chunk, score in candidates:
+            if chunk.id not in seen_chunks:
+                seen_chunks.add(chunk.id)
+                unique_candidates.append((chunk, score))
+
+        # Сортируем по score и возвращаем top_n
+        unique_candidates.sort(key=lambda x: x[1], reverse=True)
+        return unique_candidates[:top_n]
+
+    def reranker(self, candidates: List[Tuple[RetrievedChunk, float]], query: str, detected_topics: Set[str],
+                 scores: Optional[ScoreTable] = None) -> List[RetrievedChunk]:
+        """Реранкер с LLM-оценкой релевантности для HYBRID_TIGHT режима"""
+        if not candidates:
+            return []
+
+        rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
+        rerank_enable = os.getenv('RERANK_ENABLE', 'false').lower() == 'true'
+
+        # В PRECISE_SIMPLE режиме реранк отключен
+        if rag_mode == 'PRECISE_SIMPLE' or not rerank_enable:
+            # Простая сортировка по score
+            candidates.sort(key=lambda x: x[1], reverse=True)
+            return [chunk for chunk, _ in candidates[:3]]
+
+        # В HYBRID_TIGHT режиме применяем LLM-реранкинг
+        if rag_mode == 'HYBRID_TIGHT':
+            # Берем больше кандидатов для реранкинга
+            top_candidates = [chunk for chunk, _ in candidates[:6]]  # минимум 6-8 кандидатов
+            llm_reranked = llm_rerank(top_candidates, query, scores)
+
+            # Затем применяем эвристические бонусы
+            scored_candidates = []
+            query_lower = query.lower()
+
+            for chunk, base_score in llm_reranked:
+                final_score = base_score
+
+                # +0.2 если тема от router совпала с темой чанка
+                if detected_topics and chunk.metadata.topic:
+                    if chunk.metadata.topic in detected_topics:
+                        final_score += 0.2
+
+                # +0.1 если найден alias через self.entity_index
+                for alias, meta in self.entity_index.items():
+                    if alias in query_lower:
+                        if meta["doc_id"] == chunk.file_name:
+                            final_score += 0.1
+                            break
+
+                scored_candidates.append((chunk, final_score))
+
+            # Применяем штраф длины на финальной сортировке
+            len_penalty = float(os.getenv('LEN_PENALTY', '0.03'))
+            final_candidates = []
+            for chunk, score in scored_candidates:
+                # Штраф за длину
+                text = getattr(chunk, 'text', '') or ''
+                len_tokens = len(text) / 4  # Примерная оценка токенов
+                penalty = len_penalty * (len_tokens / 1000)
+                final_score = score - penalty
+                final_candidates.append((chunk, final_score))
+
+            # Сортируем по финальному score
+            final_candidates.sort(key=lambda x: x[1], reverse=True)
+
+            # Возвращаем top-RERANK_TOP_R чанков
+            rerank_top_r = int(os.getenv('RERANK_TOP_R', '3'))
+            return [chunk for chunk, _ in final_candidates[:rerank_top_r]]
+
+        # Fallback для других режимов
+        candidates.sort(key=lambda x: x[1], reverse=True)
+        return [chunk for chunk, _ in candidates[:3]]
+
+    # ---- Ранний детектор H2 и главная функция ретрива ----
+
+    def detect_section_early(self, user_q: str):
+        q = norm_text(user_q)
+        hit = self.h2_index.get(q)
+        if not hit:
+            # мягкое вхождение (минимум 3 символа для избежания ложных срабатываний)
+            for k, v in self.h2_index.items():
+                if k and len(k) > 2 and k in q:
+                    hit = v; break
+        if not hit: return None, {}
+        ch = self._find_chunk(hit["file"], hit["h2_id"])
+        if not ch: return None, {}
+        return ch, {"source":"alias","exact_h2_match":True,"topic":hit["topic"]}
+
+    def retrieve_relevant_chunks_new(self, user_q: str, theme_hint: str|None, candidates_func,
+                                     scores: Optional[ScoreTable] = None):
+        """Новая функция ретрива: подсказки (H2/тема) добавляются к кандидатам, а не прерывают поиск."""
+        if scores is None:
+            scores = ScoreTable()
+        print(f"🔍 NEW ENGINE: query='{user_q}', theme_hint='{theme_hint}'")
+
+        # Если явно разрешён старый fastpath — оставим прежнее поведение
+        if os.getenv("DISABLE_ALIAS_FASTPATH", "true").lower() != "true":
+            ch, flags = self.detect_section_early(user_q)
+            if ch:
+                print(f"✅ H2 match found (fastpath): {ch.id}")
+                return [ch], flags
+            if theme_hint in CANON:
+                ch, flags = self.get_default_chunk_for_topic(theme_hint)
+                if ch:
+                    print(f"✅ Theme match found (fastpath): {theme_hint} -> {ch.id}")
+                    return [ch], flags
+
+        mixed: list[RetrievedChunk] = []
+
+        # 1) точный H2 — добавляем к кандидатам
+        ch, _flags = self.detect_section_early(user_q)
+        if ch:
+            print(f"✅ H2 hint: {ch.id}")
+            mixed.append(ch)
+
+        # 2) дефолт по теме — тоже добавляем
+        if theme_hint in CANON:
+            ch2, _flags2 = self.get_default_chunk_for_topic(theme_hint)
+            if ch2:
+                print(f"✅ Theme hint: {theme_hint} -> {ch2.id}")
+                mixed.append(ch2)
+
+        # 3) обычный поиск
+        search_cands = candidates_func(user_q) or []
+        print(f"🔍 Search candidates: {len(search_cands)} found")
+        mixed.extend(search_cands)
+
+        # 4) дедуп по chunk.id или file_name
+        seen = set()
+        out = []
+        for c in mixed:
+            cid = getattr(c, "id", None) or getattr(getattr(c, "meta", {}), "get", lambda k=None: None)("id")
+            fid = getattr(c, "file_name", None)
+            key = cid or fid
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append(c)
+
+        # 5) Реранкер: дать базовый score и реально пересортировать
+        def _ensure_scores(cands):
+            """Убеждаемся, что у каждого кандидата есть базовый score (из оценок этого запроса)"""
+            for i, c in enumerate(cands):
+                sc = scores.of(c)
+                score = sc.get("score") or sc.get("cosine") or sc.get("bm25")
+                if score is None:
+                    score = 0.5  # базовый score
+                scores.put(c, score=float(score) - i * 1e-6)  # стабильность порядка
+
+        def _bonus_for_query(c, q: str, theme: str) -> float:
+            """Бонус за релевантность к запросу и теме"""
+            t = c.fields.lower
+            q = (q or "").lower()
+            b = 0.0
+
+            # прижив/оссео
+            if "прижив" in q or "оссео" in q:
+                if any(x in t for x in ["прижив", "оссеоинтегр"]): b += 0.10
+
+            # боязнь/боль
+            if any(x in q for x in ["боюсь", "боль", "анестез", "обезбол"]):
+                if any(x in t for x in ["без боли", "анестез", "обезбол"]): b += 0.10
+
+            # контакты
+            if theme == "contacts":
+                if any(x in t for x in ["адрес", "телефон", "график", "как добраться"]): b += 0.10
+
+            # гарантия
+            if theme == "warranty":
+                if "гаранти" in t: b += 0.08
+
+            # цены
+            if theme == "prices":
+                if any(x in t for x in ["цена", "стоимость", "сколько стоит", "рассрочка"]): b += 0.08
+
+            return b
+
+        _ensure_scores(out)
+        for c in out:
+            scores.put(c, score=scores.of(c)["score"] + _bonus_for_query(c, user_q, theme_hint or ""))
+        out.sort(key=lambda x: scores.of(x)["score"], reverse=True)
+
+        return out, {"source": "mix", "exact_h2_match": False}
+
+    def retrieve_relevant_chunks(self, query: str, top_k: int = None,
+                                 scores: Optional[ScoreTable] = None) -> List[RetrievedChunk]:
+        if scores is None:
+            scores = ScoreTable()   # оценки слияния нужны только внутри вызова
+        if top_k is None:
+            top_k = int(os.getenv("RAG_TOP_K", 5))  # было 8, теперь 5 по умолчанию
+        """Извлекает релевантные чанки с multi-query rewrite и улучшенным ранжированием"""
+        if len(self.all_chunks) == 0:
+            print("⚠️ Нет чанков для поиска")
+            return []
+
+        # ==== РОУТЕР ПО ТЕМАМ ====
+        detected_topics = route_topics(query, self.theme_map)
+        print(f"🎯 Роутер определил темы: {detected_topics}")
+
+        # Прямой alias-fallback по карте frontmatter (ОТКЛЮЧЕН)
+        # q = _norm(query or "")
+        # hit_map = ALIAS_MAP.get(q)
+        # if not hit_map:
+        #     # допускаем "alias ⊆ query" (например, запрос длиннее)
+        #     for a, meta in ALIAS_MAP.items():
+        #         if a and a in q:
+        #             hit_map = meta
+        #             break
+        #
+        # if hit_map:
+        #     # находим первый чанк соответствующего файла и возвращаем его
+        #     target = Path(hit_map["file"]).name
+        #     for ch in ALL_CHUNKS:
+        #         if ch.file_name == target:
+        #             print(f"✅ Alias-fallback: {q} -> {hit_map['file']}")
+        #             return [ch]
+
+        # ==== БЫСТРЫЙ ПУТЬ: ДЕТЕКТ СУЩНОСТИ ====
+        q = _norm(query or "")
+        hit = None
+
+        # Прямое вхождение алиаса
+        for alias, meta in self.entity_index.items():
+            if alias in q:
+                hit = self.entity_chunks.get((meta["topic"], meta["entity"]))
+                if not hit:
+                    hit = next((ch for ch in self.all_chunks if ch.id == meta["entity"]), None) \
+                        or next((ch for ch in self.all_chunks if ch.file_name == meta["doc_id"]), None)
+                if hit:
+                    break
+
+        # Мягкий матч (разделители -/-/- и пробелы)
+        if not hit:
+            q2 = re.sub(r'[\-–—]', '', q)   # дефис/тире
+            for alias, meta in self.entity_index.items():
+                a2 = re.sub(r'[\-–—]', '', alias)   # дефис/тире
+                if a2 in q2:
+                    hit = self.entity_chunks.get((meta["topic"], meta["entity"]))
+                    if not hit:
+                        hit = next((ch for ch in self.all_chunks if ch.id == meta["entity"]), None) \
+                            or next((ch for ch in self.all_chunks if ch.file_name == meta["doc_id"]), None)
+                    if hit:
+                        break
+
+        if hit:
+            print(f"✅ Найдена сущность каталога: '{query}' → {hit.id}")
+            return [hit]  # ровно нужная секция каталога
+
+        # ==== СПЕЦИАЛЬНЫЕ ЗАПРОСЫ: ЛИСТИНГ И СРАВНЕНИЕ ====
+        # Листинг ("какие виды")
+        if re.search(r'(какие|какой|что за).* (вид|вариант).* (имплантац|имплант)', q):
+            kinds_order = ["single-stage", "classic", "all-on-4", "all-on-6"]
+            out = [self.entity_chunks[("implants", k)] for k in kinds_order if ("implants", k) in self.entity_chunks]
+            print(f"📋 Листинг видов имплантации: найдено {len(out)} типов")
+            return out[:4]
+
+        # Сравнение ("чем отличается / что лучше")
+        if re.search(r'(чем\s+отлич|различ|разница|сравн|что\s+лучше|vs)', q):
+            kinds_order = ["single-stage", "classic", "all-on-4", "all-on-6"]
+            out = [self.entity_chunks[("implants", k)] for k in kinds_order if ("implants", k) in self.entity_chunks]
+            print(f"📊 Сравнение видов имплантации: найдено {len(out)} типов")
+            return out[:4]
+
+        # 0) если нашли врача напрямую — сразу отдаём карточку, минуя FAISS
+        hit = self._find_doctor_direct_or_fuzzy(query)
+        if hit:
+            print(f"✅ Карточка врача по запросу: {query} → {getattr(hit, 'section', hit.file_name)}")
+            return [hit] # без дедупа
+
+        try:
+            print(f"🔍 Поиск: '{query}' в {len(self.all_chunks)} чанках")
+
+            # ==== УСЛОВНЫЙ MULTI-QUERY ====
+            mq_enable   = self.mq_enabled()
+            mq_minwords = int(os.getenv('MQ_MIN_WORDS','5'))
+            mq_maxvars  = int(os.getenv('MQ_MAX_VARIANTS','2'))
+            mq_budget   = int(os.getenv('MQ_MAX_CANDIDATES','8'))
+            mq_exclude_patterns = os.getenv('MQ_EXCLUDE_PATTERNS','больно|страшно|адрес|как добраться')
+
+            words = re.findall(r'\w+', query, flags=re.U)
+
+            # Проверяем исключающие паттерны
+            exclude_mq = False
+            if mq_exclude_patterns:
+                exclude_patterns = mq_exclude_patterns.split('|')
+                query_lower = query.lower()
+                for pattern in exclude_patterns:
+                    if pattern.strip() in query_lower:
+                        exclude_mq = True
+                        print(f"🔍 MQ исключен по паттерну: '{pattern}'")
+                        break
+
+            use_mq = mq_enable and (len(words) >= mq_minwords) and not exclude_mq
+            query_variants = [query] if not use_mq else generate_query_variants(query)[:mq_maxvars]
+            print(f"🔍 Multi-query: используем {len(query_variants)} вариантов (условно: {use_mq}, слов: {len(words)})")
+
+            # Логируем MQ использование
+            try:
+                structured_log["mq_used"] = use_mq
+            except Exception:
+                pass
+
+            # ==== ГИБРИДНЫЙ РЕТРИВЕР ДЛЯ КАЖДОГО ВАРИАНТА ====
+            all_candidates = []
+            rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
+            hybrid = rag_mode == 'HYBRID_TIGHT' and os.getenv('HYBRID_ENABLE', 'true').lower() == 'true'
+
+            # все варианты сразу: один вызов embeddings API, один index.search, один проход BM25
+            if hybrid:
+                topk_emb = int(os.getenv('HYBRID_TOPK_EMB', '6'))
+                topk_bm25 = int(os.getenv('HYBRID_TOPK_BM25', '6'))
+                emb_batch = self.embed_search_many(query_variants, top=topk_emb)
+                bm25_batch = self.bm25_search_many(query_variants, top=topk_bm25)
+            else:
+                top_k = int(os.getenv('EMB_TOPK', '4'))
+                emb_batch = self.embed_search_many(query_variants, top=top_k)
+
+            for vi, variant in enumerate(query_variants):
+                if hybrid:
+                    # HYBRID_TIGHT режим с RRF fusion
+                    k = int(os.getenv('HYBRID_K', '8'))
+                    fusion_method = os.getenv('FUSION_METHOD', 'RRF')
+
+                    # Раздельный поиск уже выполнен пакетом
+                    emb_hits = emb_batch[vi]
+                    bm25_hits = bm25_batch[vi]
+
+                    # Логируем пул кандидатов
+                    from core.logger import log_m
+                    log_m.info({
+                        "ev": "hybrid_pool",
+                        "emb_n": len(emb_hits),
+                        "bm25_n": len(bm25_hits),
+                        "fusion_method": fusion_method
+                    })
+
+                    # Выбираем метод fusion (оценки — в таблицу запроса)
+                    if fusion_method == 'RRF':
+                        candidates = scores.add(rrf_fusion(emb_hits, bm25_hits, k))
+                    else:
+                        # Fallback к старому методу
+                        w_emb = float(os.getenv('HYBRID_W_EMB', '0.60'))
+                        w_bm25 = float(os.getenv('HYBRID_W_BM25', '0.40'))
+                        candidates = scores.add(hybrid_merge(emb_hits, bm25_hits, k, w_emb, w_bm25))
+
+                    # Логируем топ кандидатов
+                    log_m.info({
+                        "ev": "hybrid_top",
+                        "cands": [
+                            {
+                                "doc": getattr(c, "file_name", None),
+                                "h2": getattr(c.metadata, "h2_id", None) if hasattr(c, "metadata") else None,
+                                "h3": getattr(c.metadata, "h3_id", None) if hasattr(c, "metadata") else None,
+                                "rrf_emb": float(scores.of(c).get("rrf_emb", 0.0)),
+                                "rrf_bm25": float(scores.of(c).get("rrf_bm25", 0.0)),
+                                "total_rrf": float(scores.of(c).get("total_rrf", 0.0))
+                            } for c in candidates
+                        ]
+                    })
+
+                    # Добавляем в структурированный лог
+                    try:
+                        structured_log["candidates_before"].extend([
+                            {
+                                "id": getattr(c, "id", ""),
+                                "file": getattr(c, "file_name", ""),
+                                "h2": getattr(c.metadata, "h2_id", "") if hasattr(c, "metadata") else "",
+                                "h3": getattr(c.metadata, "h3_id", "") if hasattr(c, "metadata") else "",
+                                "src": "emb" if fusion_method == "RRF" else "hybrid",
+                                "rank": i+1,
+                                "score": float(scores.of(c).get("total_rrf", 0.0))
+                            } for i, c in enumerate(candidates)
+                        ])
+
+                        structured_log["fusion"].extend([
+                            {
+                                "id": getattr(c, "id", ""),
+                                "rrf": float(scores.of(c).get("total_rrf", 0.0))
+                            } for c in candidates
+                        ])
+                    except Exception:
+                        pass
+
+                    # Конвертируем в формат (chunk, score) для совместимости
+                    candidates_with_scores = [(c, scores.of(c).get('total_rrf', 0.0)) for c in candidates]
+                    all_candidates.extend(candidates_with_scores)
+                else:
+                    # PRECISE_SIMPLE режим - только embed поиск
+                    emb_hits = emb_batch[vi]
+                    candidates_with_scores = [(c, score) for c, score in emb_hits]
+                    all_candidates.extend(candidates_with_scores)
+
+                print(f"🔍 Вариант '{variant[:30]}...': найдено {len(candidates_with_scores)} кандидатов")
+
+            # ==== ОБЪЕДИНЕНИЕ И ДЕДУПЛИКАЦИЯ ====
+            seen_chunks = set()
+            unique_candidates = []
+
+            for chunk, score in all_candidates:
+                if chunk.id not in seen_chunks:
+                    seen_chunks.add(chunk.id)
+                    unique_candidates.append((chunk, score))
+
+            # Сортируем по score и берем top
+            unique_candidates.sort(key=lambda x: x[1], reverse=True)
+            # бюджет на первый проход
+            top_candidates = unique_candidates[:mq_budget] if mq_budget > 0 else unique_candidates[:25]
+
+            print(f"🔍 Multi-query: объединено {len(unique_candidates)} уникальных кандидатов")
+
+            # ==== ДЕДУП ПО H2/H3 И ПО ФАЙЛУ ====
+            uniq = {}
+            for chunk, score in top_candidates:
+                h2_id = getattr(chunk.metadata, "h2_id", "") if hasattr(chunk, "metadata") else ""
+                h3_id = getattr(chunk.metadata, "h3_id", "") if hasattr(chunk, "metadata") else ""
+                block_id = getattr(chunk.metadata, "block_id", "") if hasattr(chunk, "metadata") else ""
+                key = (chunk.file_name, h2_id, h3_id or block_id)
+                if key not in uniq:
+                    uniq[key] = (chunk, score)
+            candidates = list(uniq.values())
+
+            # ==== ТЕМАТИЧЕСКАЯ КОГЕРЕНТНОСТЬ (МЯГКИЙ БУСТ) ====
+            if candidates:
+                anchor = candidates[0][0]
+                anchor_topic = (getattr(anchor, "metadata", None) or {}).topic or ""
+                anchor_file = getattr(anchor, "file_name", "")
+                anchor_h2 = getattr(anchor.metadata, "h2_id", "") if hasattr(anchor, "metadata") else ""
+
+                # Применяем мягкий буст вместо фильтра
+                boosted_candidates = []
+                for chunk, score in candidates:
+                    final_score = score
+
+                    # Буст за когерентность
+                    same_file = chunk.file_name == anchor_file
+                    same_topic = getattr(getattr(chunk, "metadata", None), "topic", "") == anchor_topic
+                    same_h2 = getattr(chunk.metadata, "h2_id", "") == anchor_h2 if hasattr(chunk, "metadata") else False
+
+                    if same_file or same_h2:
+                        final_score += 0.08  # НЕ фильтровать, а бустить!
+                    elif same_topic:
+                        final_score += 0.04
+
+                    boosted_candidates.append((chunk, final_score))
+
+                # Сортируем по финальному score
+                boosted_candidates.sort(key=lambda x: x[1], reverse=True)
+                candidates = boosted_candidates[:3]
+
+            # ==== ФОРС-МАТЧ ПО АЛИАСАМ ====
+            forced_chunk = select_chunk_by_alias([chunk for chunk, _ in candidates], query)
+            if forced_chunk:
+                print(f"🎯 Форс-матч по алиасу: {forced_chunk.id}")
+                final_chunks = [forced_chunk]
+            else:
+                # ==== РЕРАНКЕР ====
+                final_chunks = self.reranker(candidates, query, detected_topics, scores)
+                print(f"🔍 Реранкер отобрал {len(final_chunks)} финальных чанков")
+
+                # Логируем реранк
+                try:
+                    structured_log["rerank"] = [
+                        {
+                            "id": getattr(c, "id", ""),
+                            "score": float(scores.of(c).get("score", 0.0))
+                        } for c in final_chunks
+                    ]
+                except Exception:
+                    pass
+
+            # если ничего внятного не попало и тема известна — жёсткий fallback
+            if not final_chunks and detected_topics:
+                theme_key = list(detected_topics)[0]
+                final_chunks = self.fallback_theme_chunks(theme_key, limit=top_k)
+
+            # если ищем врача - не режем результаты по file_name
+            if self.doctor_name_to_chunk and self._find_doctor_direct_or_fuzzy(query):
+                return final_chunks[:top_k] # без дедупа
+
+            # иначе оставляем защитный дедуп по файлам
+            seen = set()
+            out = []
+            for chunk in final_chunks:
+                if chunk.file_name not in seen:
+                    seen.add(chunk.file_name)
+                    out.append(chunk)
+
+            print(f"✅ Возвращаем {len(out)} уникальных чанков")
+
+            # Логируем финальный контекст
+            try:
+                structured_log["final_ctx"] = [
+                    {
+                        "id": getattr(c, "id", ""),
+                        "score": float(scores.of(c).get("score", 0.0))
+                    } for c in out[:top_k]
+                ]
+            except Exception:
+                pass
+
+            return out[:top_k]
+
+        except Exception as e:
+            print(f"❌ Ошибка при поиске чанков: {e}")
+            return []
+
+    # ---- Ответ ----
+
+    def get_rag_answer(self, user_message: str, history: List[Dict] = []) -> tuple[str, dict]:
+        """Основная функция для получения ответа и метаданных"""
+        from logging import getLogger
+        import json
+        import re
+        from datetime import datetime
+
+        logger = getLogger("cesi.rag")
+        logger.info("➡️ Новый вопрос: %s", user_message)
+
+        # Логируем запрос в RAG
+        from core.logger import log_query
+        log_query(user_message, "rag_engine")
+
+        # Всегда инициализируем — чтобы не ловить UnboundLocalError
+        detected_topics = []
+        theme_hint = None
+        rag_meta = {"user_query": user_message}
+        chunk_scores = ScoreTable()   # оценки чанков в этом запросе (чанки снимка общие для всех запросов)
+
+        # Инициализируем структурированный лог
+        rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
+        structured_log = {
+            "ts": datetime.now().isoformat(),
+            "mode": rag_mode,
+            "query": user_message,
+            "mq_used": False,
+            "candidates_before": [],
+            "fusion": [],
+            "rerank": [],
+            "final_ctx": [],
+            "guard": {"best": 0.0, "second": 0.0, "margin": 0.0, "passed": False}
+        }
+
+        try:
+            # --- 1) Явный оверрайд темы по ключевым словам (если используешь root_aliases.yaml)
+            try:
+                import yaml
+                ROOT = yaml.safe_load(open("config/root_aliases.yaml", "r", encoding="utf-8")) or {}
+                ql = user_message.lower()
+                for doc_type, keys in (ROOT.get("root_aliases") or {}).items():
+                    if any(k in ql for k in keys):
+                        theme_hint = doc_type
+                        break
+            except Exception:
+                pass
+
+            # --- 2) Авто-детект темы (если оверрайд не дал тему)
+            if theme_hint is None:
+                try:
+                    detected_topics = list(route_topics(user_message, self.theme_map))
+                    print(f"🎯 Роутер определил темы: {detected_topics}")
+                except Exception:
+                    detected_topics = []
+
+                if detected_topics:
+                    theme_hint = detected_topics[0]
+
+            # --- 2.5) Быстрый путь по алиасам (ВРЕМЕННО ОТКЛЮЧЕН)
+            # q_norm = norm_text(user_message)
+            # if q_norm in ALIAS_MAP_GLOBAL:
+            #     key = ALIAS_MAP_GLOBAL[q_norm]
+            #     # найдём чанк по файлу и/или якорю Н2
+            #     ch = _find_chunk(key["file"], key.get("primary_h2_id"))
+            #     if ch:
+            #         topic_meta = getattr(ch.metadata, '__dict__', {}) or {}
+            #         payload = postprocess(
+            #             answer_text=ch.text,
+            #             user_text=user_message,
+            #             intent=theme_hint or key.get("topic"),
+            #             topic_meta=topic_meta,
+            #             session={},
+            #         )
+            #         return payload, {"user_query": user_message, "theme_hint": theme_hint, "fast_path": "alias"}
+
+            # --- 2.6) Прямой ответ из хранилища фактов (контакты, врач, цены, виды имплантации):
+            # готовый обрезанный текст — без эмбеддингов, BM25 и синтеза
+            fact = self.facts.match(user_message) if self.facts is not None else None
+            if fact is not None:
+                topic_meta = fact.chunk.metadata.to_dict() if fact.chunk is not None else {}
+                payload = postprocess(
+                    answer_text=fact.text,
+                    user_text=user_message,
+                    intent=fact.intent,
+                    topic_meta=topic_meta,
+                    session={},
+                    cta_cfg=self.cta_config,
+                )
+                best_chunk_id = getattr(fact.chunk, "id", "")
+                from core.logger import log_m
+                log_m.info({"ev": "facts_hit", "intent": fact.intent, "key": fact.key, "chunk": best_chunk_id})
+                rag_meta = {
+                    "user_query": user_message,
+                    "fast_path": "facts",
+                    "fact": {"intent": fact.intent, "key": fact.key},
+                    "relevance_score": 1.0,
+                    "cand_cnt": 1,
+                    "theme_hint": fact.intent,
+                    "detected_topics": detected_topics,
+                    "best_chunk_id": best_chunk_id,
+                    "candidates_with_scores": [{"chunk": fact.chunk, "score": 1.0}] if fact.chunk is not None else [],
+                    "best_text": fact.text,
+                    "meta": {
+                        "relevance_score": 1.0,
+                        "cand_cnt": 1,
+                        "doc_type": topic_meta.get("doc_type"),
+                        "topic": topic_meta.get("topic"),
+                        "best_chunk_id": best_chunk_id,
+                    }
+                }
+                return payload, rag_meta
+
+            # --- 3) Ретривал (2 прохода: с темой → без темы)
+            # Увеличиваем top_k для поиска врачей
+            if self.doctor_regex and self.doctor_regex.search(user_message):
+                top_k = 12
+                print(f"🔍 Поиск врачей: используем top_k={top_k}")
+            else:
+                top_k = int(os.getenv("RAG_TOP_K", 5))  # было 8, теперь 5 по умолчанию
+
+            # Определяем use_mq для guard логики
+            mq_enable   = self.mq_enabled()
+            mq_minwords = int(os.getenv('MQ_MIN_WORDS','4'))
+            words = re.findall(r'\w+', user_message, flags=re.U)
+            use_mq = mq_enable and (len(words) >= mq_minwords)
+
+            # Извлекаем релевантные чанки (используем новую логику)
+            logger.info("🔎 theme_hint=%s detected_topics=%s", theme_hint, detected_topics)
+            relevant_chunks, meta_flags = self.retrieve_relevant_chunks_new(
+                user_message, 
+                theme_hint=theme_hint,
+                candidates_func=lambda q: self.retrieve_relevant_chunks(q, top_k=top_k, scores=chunk_scores),
+                scores=chunk_scores
+            )
+
+            # Мини-фильтр по теме (минимум логики, максимум эффекта)
+            def filter_candidates(theme: str, q: str, cands: list):
+                t = (q or "").lower()
+
+                def h2_of(c):
+                    return (getattr(c, "h2", None) or getattr(c, "meta", {}).get("h2", "") or "").lower()
+
+                def text_of(c):
+                    return c.fields.lower
+
+                # «приживаемость» — оставляем только куски, где явно есть прижив/оссео
+                if any(k in t for k in ["прижив", "приживаем", "оссео"]):
+                    return [c for c in cands if any(x in h2_of(c) + " " + text_of(c) for x in ["прижив", "оссеоинтегр"])]
+
+                # страх/боль — выкидываем «противопоказания»
+                if any(k in t for k in ["боюсь", "боль", "страшно", "анестез", "обезбол"]):
+                    bad = ["противопоказан", "противопоказания"]
+                    return [c for c in cands if not any(x in h2_of(c) for x in bad)]
+
+                return cands
+
+            relevant_chunks = filter_candidates(theme_hint, user_message, relevant_chunks)
+
+            # Лёгкий переранж (чтобы «нужное» всплывало первым)
+            def bonus_for_query(c, q):
+                t = c.fields.lower
+                b = 0.0
+
+                # прижив/оссео
+                if "прижив" in q or "оссео" in q:
+                    if any(x in t for x in ["прижив", "оссеоинтегр"]): b += 0.1
+
+                # боязнь/боль
+                if any(x in q for x in ["боюсь", "боль", "анестез", "обезбол"]):
+                    if any(x in t for x in ["без боли", "анестез", "обезбол"]): b += 0.1
+
+                return b
+
+            for c in relevant_chunks:
+                base = chunk_scores.of(c).get("score", 0.0)  # твоя косинус/БМ25
+                chunk_scores.put(c, score=float(base) + bonus_for_query(c, user_message.lower()))
+
+            relevant_chunks = sorted(relevant_chunks, key=lambda x: chunk_scores.of(x)["score"], reverse=True)
+
+            # Быстрая диагностика (чтобы понять причину)
+            for i, c in enumerate(relevant_chunks[:5], 1):
+                logger.info({
+                    "ev": "rerank_top",
+                    "rank": i,
+                    "score": round(chunk_scores.of(c).get("score", 0.0), 3),
+                    "h2": getattr(c, "h2", None) or getattr(c, "meta", {}).get("h2"),
+                    "doc": getattr(c, "meta", {}).get("doc_id"),
+                })
+
+            # Если нет кандидатов, пробуем без темы
+            if not relevant_chunks:
+                logger.info("⚠️ Первый проход не дал результатов, пробуем без темы...")
+                relevant_chunks, meta_flags = self.retrieve_relevant_chunks_new(
+                    user_message, 
+                    theme_hint=None,
+                    candidates_func=lambda q: self.retrieve_relevant_chunks(q, top_k=top_k, scores=chunk_scores),
+                    scores=chunk_scores
+                )
+
+            # Логируем результат
+            logger.info("📦 candidates=%d", len(relevant_chunks))
+            logger.info("🔍 rag_engine: relevant_chunks[0] type=%s", type(relevant_chunks[0]) if relevant_chunks else "None")
+
+            if not relevant_chunks:
+                # честный низкий релеванс
+                return LOW_REL_JSON.copy(), rag_meta
+
+            # ==== GUARD С ENV ПОРОГАМИ ====
+            if os.getenv('GUARD_ENABLE', 'true').lower() == 'true':
+                # Находим лучший и второй score
+                scores = []
+                for chunk in relevant_chunks:
+                    # В зависимости от режима используем разные score
+                    rag_mode = os.getenv('RAG_MODE', 'PRECISE_SIMPLE')
+                    sc = chunk_scores.of(chunk)
+                    if rag_mode == 'HYBRID_TIGHT':
+                        score = sc.get('total_rrf') or sc.get('hybrid') or sc.get('score', 0.0)
+                    else:
+                        score = sc.get('score', 0.0)
+                    scores.append(score)
+
+                scores.sort(reverse=True)
+                best = scores[0] if scores else 0.0
+                second = scores[1] if len(scores) > 1 else 0.0
+
+                # Пороги из ENV
+                hard_min = float(os.getenv('GUARD_THRESHOLD','0.60'))
+                dyn = os.getenv('GUARD_DYNAMIC','false').lower() == 'true'
+                soft_min = float(os.getenv('GUARD_SOFT_MIN','0.56'))
+                margin = float(os.getenv('GUARD_MARGIN','0.07'))
+
+                def passes_guard(b, s):
+                    if not dyn:
+                        return b >= hard_min
+                    if b >= hard_min:
+                        return True
+                    if b >= soft_min and (b - (s or 0.0)) >= margin:
+                        return True
+                    return False
+
+                # Логируем guard
+                try:
+                    structured_log["guard"] = {
+                        "best": float(best),
+                        "second": float(second),
+                        "margin": float(best - second),
+                        "passed": passes_guard(best, second)
+                    }
+                except Exception:
+                    pass
+
+                if not passes_guard(best, second):
+                    # вторая попытка: узкий conditional MQ, если ещё не включали
+                    mq_enable   = self.mq_enabled()
+                    mq_maxvars  = int(os.getenv('MQ_MAX_VARIANTS','2'))
+                    mq_budget   = int(os.getenv('MQ_MAX_CANDIDATES','4'))
+
+                    if mq_enable and not use_mq:
+                        qv = generate_query_variants(user_message)[:mq_maxvars]
+                        print(f"🔁 Low score (best={best:.3f}, second={second:.3f}) → дополнительный MQ={len(qv)}")
+                        extra = []
+                        for e2, b2 in zip(self.embed_search_many(qv, top=3), self.bm25_search_many(qv, top=3)):
+                            extra.extend(chunk_scores.add(hybrid_merge(e2, b2, 3, 0.60, 0.40)))
+                        # объединяем с бюджетом
+                        pool = (relevant_chunks + extra)[:max(6, mq_budget)]
+                        # повторим дедуп + когерентность
+                        uniq2 = {}
+                        for ch in pool:
+                            key = (ch.file_name, getattr(ch.metadata, "h2_id",""))
+                            if key not in uniq2: uniq2[key] = ch
+                        pool = list(uniq2.values())
+                        if pool:
+                            anchor = pool[0]
+                            atopic = (getattr(anchor, "metadata", None) or {}).topic or ""
+                            afile  = getattr(anchor, "file_name", "")
+                            coh = []
+                            seen = set()
+                            for ch in pool:
+                                if ch.file_name == afile or getattr(getattr(ch,"metadata",None),"topic","") == atopic:
+                                    k = (ch.file_name, getattr(ch.metadata,"h2_id",""))
+                                    if k not in seen:
+                                        coh.append(ch); seen.add(k)
+                            relevant_chunks = coh[:3] if coh else pool[:3]
+                            best  = chunk_scores.of(relevant_chunks[0]).get('hybrid', 0.0) if relevant_chunks else 0.0
+                            second= chunk_scores.of(relevant_chunks[1]).get('hybrid', 0.0) if len(relevant_chunks)>1 else 0.0
+
+                    if not passes_guard(best, second):
+                        # Возвращаем fallback без вызова LLM
+                        from core.logger import log_m
+                        log_m.info({
+                            "ev": "low_rel",
+                            "best": float(best),
+                            "second": float(second),
+                            "hard_min": float(hard_min),
+                            "soft_min": float(soft_min),
+                            "margin": float(margin),
+                            "passed": False
+                        })
+
+                        out = {
+                            "answer": "Хочу ответить точно. Подскажите, вас интересует адрес клиники, цены, врачи или противопоказания?",
+                            "empathy": "",
+                            "cta": {"show": False, "variant": "consult"},
+                            "followups": [
+                                {"label": "Адрес и контакты", "query": "адрес"},
+                                {"label": "Цены на имплантацию", "query": "цены"},
+                                {"label": "Противопоказания", "query": "противопоказания"}
+                            ]
+                        }
+                        return out, rag_meta
+                    else:
+                        # Логируем успешное прохождение guard
+                        from core.logger import log_m
+                        log_m.info({
+                            "ev": "guard_passed",
+                            "best": float(best),
+                            "second": float(second),
+                            "hard_min": float(hard_min),
+                            "soft_min": float(soft_min),
+                            "margin": float(margin),
+                            "passed": True,
+                            "reason": "hard" if best >= hard_min else "soft+margin"
+                        })
+
+            # --- 4) Синтез ответа из нескольких чанков (окна одной секции — одним фрагментом)
+            synth = synthesize_answer(self.expand_windows(relevant_chunks), user_message)
+            answer_text = synth.get("text", "")
+
+            # --- 4.5) Guard-fallback для «боль/страх»
+            cand_cnt = len(relevant_chunks)
+            if cand_cnt == 0:
+                return LOW_REL_JSON.copy(), {"meta": {"relevance_score": 0.0, "cand_cnt": 0}}
+
+            best = relevant_chunks[0]
+            best_score = chunk_scores.of(best).get("score", 0.0)
+
+            # Если после фильтра/переранжировки лучший скор слабый — отдай готовый «эмпатичный» ответ
+            if theme_hint in ("safety", "pain", "fear_pain") and best_score < 0.42:
+                payload = {
+                    "response": {"text": "Понимаю, что страшит именно боль. Процедура делается под местной анестезией – во время операции вы ничего не почувствуете.\n\nПосле – обычно как после удаления зуба: даём обезболивающее и сопровождаем.\n\nЕсли хотите, врач коротко расскажет, как всё проходит именно в вашем случае."},
+                    "cta": {"label": "Записаться на консультацию", "target": "whatsapp"},
+                    "followups": ["Сколько длится приём?", "Какая анестезия используется?"]
+                }
+                return payload, {**rag_meta, "guard_used": True, "relevance_score": best_score}
+
+            score = None
+
+            # Пытаемся извлечь score чанка (оценки этого запроса)
+            for key in ["score", "rank_score", "bm25_score", "similarity"]:
+                if isinstance(best, dict) and key in best:
+                    score = best[key]
+                    break
+                elif key in chunk_scores.of(best):
+                    score = chunk_scores.of(best)[key]
+                    break
+
+            # Если score нет - ставим разумный дефолт
+            if score is None:
+                score = 0.7  # если нет score - даем безопасный дефолт
+
+            # Если это форс-совпадение по алиасу - повышаем score
+            if isinstance(best, dict) and (best.get("forced_by_alias") or best.get("h2_alias_hit")):
+                score = max(score, 0.9)  # если это был форс-алиас (если у вас есть такой флаг)
+
+            # --- 5) Постпроцесс: эмпатия/бридж + CTA
+            best_chunk = relevant_chunks[0] if relevant_chunks else None
+            topic_meta = best_chunk.metadata.to_dict() if best_chunk else {}
+            intent = theme_hint  # или твой интент-детектор
+            payload = postprocess(
+                answer_text=answer_text,
+                user_text=user_message,
+                intent=intent,
+                topic_meta=topic_meta,
+                session={},  # session пока пустой
+                cta_cfg=self.cta_config,
+            )
+
+            # Подстраховка для payload
+            if not isinstance(payload, dict):
+                payload = {"text": str(payload) if payload is not None else best_text}
+            elif not payload.get("text"):
+                payload["text"] = best_text
+
+            # Обновляем метаданные с relevance_score
+            def _mget(meta, key, default=None):
+                """Безопасный доступ к метаданным: dict/obj"""
+                if meta is None:
+                    return default
+                if isinstance(meta, dict):
+                    return meta.get(key, default)
+                return getattr(meta, key, default)
+
+            def _score_of(c):
+                """Пытаемся получить скор из разных полей; если нет - None"""
+                for k in ("score", "rank_score", "bm25_score", "similarity"):
+                    v = c[k] if isinstance(c, dict) and k in c else chunk_scores.of(c).get(k)
+                    if v is not None:
+                        return v
+                return None
+
+            cand_cnt = len(relevant_chunks)
+            best = relevant_chunks[0]
+            meta = getattr(best, "metadata", None) or getattr(best, "meta", {}) or {}
+            # текст для показа (без комментариев и решёток) посчитан при индексации
+            fields = getattr(best, "fields", None)
+            best_text = fields.display if fields is not None else display_text(getattr(best, "text", "") or "")
+            rag_meta["best_text"] = best_text
+            score = _score_of(best)
+            if score is None:
+                score = 0.7  # дефолт, чтобы guard не резал нормальный ответ
+            best_chunk_id = f"{_mget(meta, 'file_basename','')}" + (f"#{_mget(meta, 'h2_id','')}" if _mget(meta, 'h2_id') else "")
+
+            # ВАЖНО: список словарей {"chunk": ..., "score": ... } – именно так ждёт адаптер/арр.ру
+            candidates_with_scores = [
+                {"chunk": c, "score": _score_of(c)}
+                for c in relevant_chunks[:5]
+            ]
+
+            # rag_meta плоские поля (+ вложенный meta для guard - на всякий случай)
+            rag_meta = {
+                "relevance_score": float(score),
+                "cand_cnt": cand_cnt,
+                "theme_hint": theme_hint,
+                "detected_topics": detected_topics,
+                "best_chunk_id": best_chunk_id,
+                "candidates_with_scores": candidates_with_scores,
+                "best_text": best_text,  # пригодится адаптеру как fallback
+                "meta": {
+                    "relevance_score": float(score),
+                    "cand_cnt": cand_cnt,
+                    "doc_type": _mget(meta, "doc_type"),
+                    "topic": _mget(meta, "topic"),
+                    "best_chunk_id": best_chunk_id,
+                }
+            }
+
+            # Логируем ответ в RAG
+            from core.logger import format_candidates_for_log
+            from logging import getLogger
+            log_m = getLogger("cesi.minimal_logs")
+            try:
+                log_m.info({
+                    "ev":"search_candidates",
+                    "count": len(relevant_chunks),
+                    "cands": format_candidates_for_log(candidates_with_scores, top=3)
+                })
+            except Exception as e:
+                logging.getLogger("cesi").warning(f"log_format_error: {e}")
+
+            # Сохраняем структурированный лог
+            log_level = os.getenv('LOG_LEVEL', 'INFO')
+            if log_level in ('DEBUG', 'TRACE'):
+                try:
+                    logs_dir = Path("logs")
+                    logs_dir.mkdir(exist_ok=True)
+                    log_file = logs_dir / "rag_trace.jsonl"
+                    with open(log_file, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(structured_log, ensure_ascii=False) + "\n")
+                except Exception as e:
+                    print(f"❌ Ошибка сохранения структурированного лога: {e}")
+
+            return payload, rag_meta
+
+        except Exception:
+            # Никогда не падаем наружу — лог и безопасный ответ
+            logger.exception("💥 get_rag_answer failed")
+            return LOW_REL_JSON.copy(), rag_meta
+
+def _ingest_task(item: Tuple[str, bytes]) -> FileIndex:
+    """Задача пула процессов: разбор одного md-файла"""
+    path, data = item
+    return RagEngine._ingest_file(Path(path), data)
+
+# ==== ДВИЖОК ПО УМОЛЧАНИЮ ====
+_default_engine: Optional[RagEngine] = None
+_default_engine_lock = threading.Lock()
+
+def get_engine() -> RagEngine:
+    """Общий движок процесса: создаётся и загружается при первом обращении"""
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = RagEngine().load()
+    return _default_engine
+
+def set_engine(engine: RagEngine) -> None:
+    """Подменяет движок по умолчанию (фабрика приложения, тесты, бенчмарки)"""
+    global _default_engine
+    with _default_engine_lock:
+        _default_engine = engine
+
+def get_rag_answer(user_message: str, history: List[Dict] = []) -> tuple[str, dict]:
+    """Основная функция для получения ответа и метаданных (движок по умолчанию)"""
+    return get_engine().get_rag_answer(user_message, history)
 
 def log_query_response(user_message: str, response: str, metadata: dict, chunks_used: List[str] = None):
     """Логирует вопрос/ответ в файл для анализа"""
@@ -0,0 +1,35 @@
+# tests/test_fact_store.py
+"""Прямые ответы из хранилища фактов (core/fact_store.py)"""
+
+from core.fact_store import DoctorFact, FactStore, PriceRow
+
+DOCTOR = DoctorFact("Моисеев Кирилл Николаевич", ("моисеев",), "имплантолог", "Стаж 15 лет", chunk=None)
+
+
+def test_price_without_implant_section():
+    # таблица цен без секции про импланты: ответы по строкам всё равно есть, match не падает
+    store = FactStore(doctors=[DOCTOR], prices=[PriceRow("Стоимость КТ", "3 500 ₽", "Диагностика", chunk=None)])
+    answer = store.match("сколько стоит кт")
+    assert answer is not None
+    assert (answer.intent, answer.key) == ("prices", "Стоимость КТ")
+    assert "3 500 ₽" in answer.text
+
+
+def test_implant_prices_group():
+    rows = [PriceRow("Implantium (Корея)", "от 68 000 ₽", "Цены на импланты", chunk=None),
+            PriceRow("Стоимость КТ", "3 500 ₽", "Диагностика", chunk=None)]
+    answer = FactStore(prices=rows).match("сколько стоит имплантация")
+    assert answer.key == "implants"
+    assert "КТ" not in answer.text
+
+
+def test_declined_feminine_surname():
+    # "бояршина" — не начало "бояршину": совпадение по основе фамилии
+    doctor = DoctorFact("Бояршина Алла Викторовна", ("алла бояршина", "бояршина", "бояршина алла"),
+                        "ортопед", "Стаж 10 лет", chunk=None)
+    store = FactStore(doctors=[DOCTOR, doctor])
+    for query in ("расскажите про бояршину", "запись к Алле Бояршиной", "бояршина"):
+        answer = store.match(query)
+        assert answer is not None, query
+        assert (answer.intent, answer.key) == ("doctors", doctor.name)
+    assert store.match("расскажите про моисеева").key == DOCTOR.name
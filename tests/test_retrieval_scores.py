@@ -0,0 +1,30 @@
+# tests/test_retrieval_scores.py
+"""Оценки ретривала живут в ScoreTable запроса, а не на чанках снимка (rag_engine.py)"""
+
+import pytest
+
+from rag_engine import Frontmatter, RetrievedChunk, ScoreTable, hybrid_merge, rrf_fusion
+
+
+def _chunk(cid: str, h2: str) -> RetrievedChunk:
+    return RetrievedChunk(cid, f"текст {cid}", Frontmatter({"h2_id": h2}), "implants.md")
+
+
+def test_fusion_keeps_chunks_unchanged():
+    a, b = _chunk("a", "one"), _chunk("b", "two")
+    entries = rrf_fusion([(a, 0.9), (b, 0.5)], [(b, 7.0)], k=2)
+    assert [e["chunk"] for e in entries] == [b, a]
+    assert entries[0]["total_rrf"] == entries[0]["rrf_emb"] + entries[0]["rrf_bm25"]
+    assert [e["chunk"] for e in hybrid_merge([(a, 0.9)], [(b, 7.0)], 2, 0.6, 0.4)] == [a, b]
+    # у чанка нет слотов под оценки: запись с другого запроса невозможна
+    with pytest.raises(AttributeError):
+        a.score = 1.0
+
+
+def test_requests_do_not_share_scores():
+    a = _chunk("a", "one")
+    first, second = ScoreTable(), ScoreTable()
+    assert first.add(rrf_fusion([(a, 0.9)], [], k=1)) == [a]
+    first.put(a, score=0.8)
+    assert second.of(a) == {}
+    assert first.of(a)["score"] == 0.8 and first.of(a)["total_rrf"] > 0
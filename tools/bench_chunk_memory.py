@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Память на чанк: прежнее представление против компактного (__slots__ + общий фронтматтер файла).
+Использование: python tools/bench_chunk_memory.py [--files 500] [--sections 100]
+
+Синтетический корпус: files файлов по sections секций (по умолчанию 50k чанков).
+Тексты чанков создаются заранее и общие для обоих вариантов — считается только то,
+что добавляет само представление (объекты чанков, метаданные, словари, списки).
+Отдельно — тексты: строка на чанк против арены (core/text_arena.py).
+"""
+
+import io
+import sys
+import argparse
+import contextlib
+import importlib
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+class LegacyFrontmatter:
+    """Прежний Frontmatter: dict + каждое поле атрибутом экземпляра"""
+
+    FIELDS = {
+        'id': '', 'slug': '', 'title': '', 'description': '', 'doc_type': 'info', 'topic': '',
+        'tags': [], 'aliases': [], 'audience': '', 'updated': '', 'locale': 'ru-RU', 'tone': 'friendly',
+        'emotion': '', 'criticality': 'medium', 'verbatim': False, 'policy_ref': [], 'source': [],
+        'preferred_format': ['short', 'bullets', 'cta'], 'canonical_url': '', 'noindex': False,
+        'cta_action': '', 'cta_text': '', 'cta_link': '',
+        'h2_id': '', 'h2_title': '', 'h3_id': '', 'h3_title': '', 'h2_aliases': [],
+    }
+
+    def __init__(self, data: Dict[str, Any]):
+        self._d = dict(data or {})
+        for k, default in self.FIELDS.items():
+            # как в прежнем коде: у каждого экземпляра свои списки по умолчанию
+            setattr(self, k, self._d.get(k, list(default) if isinstance(default, list) else default))
+        for k, v in self._d.items():
+            if not hasattr(self, k):
+                setattr(self, k, v)
+
+
+class LegacyChunk:
+    def __init__(self, id: str, text: str, metadata: LegacyFrontmatter, file_name: str):
+        self.id = id
+        self.text = text
+        self.metadata = metadata
+        self.file_name = file_name
+        self.updated = metadata.updated if metadata else ""
+        self.criticality = metadata.criticality if metadata else "medium"
+        self.doc_type = metadata.doc_type if metadata else "info"
+        self.tags = metadata.tags if metadata else []
+
+
+def synthetic_corpus(files: int, sections: int):
+    """[(file_name, frontmatter, [(chunk_id, text, block_meta)])] — строки создаются заново, как при разборе"""
+    topics = ["implants", "prices", "doctors", "safety", "warranty", "consultation", "contacts", "clinic"]
+    corpus = []
+    for f in range(files):
+        file_name = f"doc-{f:05d}.md"
+        topic = topics[f % len(topics)]
+        fm = {
+            "id": f"doc-{f:05d}", "title": f"Документ {f}", "description": "Описание документа " * 3,
+            "doc_type": "info", "topic": "".join(topic), "tags": [f"тег{f % 7}", f"тег{f % 11}", "имплантация"],
+            "aliases": [f"алиас {f}", f"синоним {f}"], "updated": "2025-01-15", "criticality": "medium",
+            "doc_id": f"doc-{f:05d}", "primary_h2_id": "обзор", "mini_links": [f"doc-{(f + 1) % files:05d}.md"],
+        }
+        blocks = []
+        for s in range(sections):
+            h2_id = "".join(f"раздел-{s // 4}")
+            blocks.append((f"{file_name}#{h2_id}_{s}", f"## Раздел {s // 4}\n### Подраздел {s}\n" + "Текст секции. " * 20, {
+                "h2_id": h2_id, "h2_title": "".join(f"Раздел {s // 4}"), "h3_id": f"подраздел-{s}",
+                "h3_title": f"Подраздел {s}", "aliases": [], "block_id": f"{file_name}#{s // 4:04d}_{s:04d}",
+            }))
+        corpus.append((file_name, fm, blocks))
+    return corpus
+
+
+def build_legacy(corpus) -> List[LegacyChunk]:
+    chunks = []
+    for file_name, fm, blocks in corpus:
+        metadata = LegacyFrontmatter(fm)
+        for chunk_id, text, block in blocks:
+            chunk = LegacyChunk(chunk_id, text, LegacyFrontmatter(block), file_name)
+            # прежнее слияние: {**файл, **чанк} в новый Frontmatter на каждый чанк
+            chunk.metadata = LegacyFrontmatter({**metadata.__dict__, **chunk.metadata.__dict__})
+            chunk.metadata.tags_lower = [str(t).strip().lower() for t in chunk.metadata.tags]
+            chunks.append(chunk)
+    return chunks
+
+
+def build_compact(corpus) -> list:
+    from rag_engine import Frontmatter, RetrievedChunk, _NO_TAGS
+    chunks = []
+    for file_name, fm, blocks in corpus:
+        metadata = Frontmatter(fm)
+        for chunk_id, text, block in blocks:
+            chunk = RetrievedChunk(chunk_id, text, Frontmatter(block, file=metadata), file_name)
+            chunk.metadata.tags_lower = [str(t).strip().lower() for t in chunk.metadata.tags] or _NO_TAGS
+            chunks.append(chunk)
+    return chunks
+
+
+def texts_as_strings(corpus) -> List[str]:
+    return [text.encode("utf-8").decode("utf-8") for _, _, blocks in corpus for _, text, _ in blocks]
+
+
+def texts_as_arena(corpus):
+    from core.text_arena import TextArena
+    return TextArena.from_texts(text for _, _, blocks in corpus for _, text, _ in blocks)
+
+
+def measure(build, corpus) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    chunks = build(corpus)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del chunks
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память на чанк: прежнее и компактное представление")
+    parser.add_argument("--files", type=int, default=500, help="Файлов в синтетическом корпусе")
+    parser.add_argument("--sections", type=int, default=100, help="Секций (чанков) в файле")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # импорт rag_engine печатает отладку и не должен попасть в замер памяти — заранее и без вывода
+        importlib.import_module("rag_engine")
+
+    n = args.files * args.sections
+    print(f"🧪 Синтетический корпус: {args.files} файлов × {args.sections} секций = {n} чанков")
+    results = {}
+    for name, build in (("прежнее", build_legacy), ("компактное", build_compact)):
+        corpus = synthetic_corpus(args.files, args.sections)
+        results[name] = measure(build, corpus)
+        print(f"  {name:12s} {results[name] / n:8.0f} байт/чанк   {results[name] / 2**20:8.1f} МБ")
+    print(f"📉 Экономия: {1 - results['компактное'] / results['прежнее']:.0%}")
+
+    print("\n📚 Тексты чанков:")
+    texts = {}
+    for name, build in (("строки", texts_as_strings), ("арена", texts_as_arena)):
+        corpus = synthetic_corpus(args.files, args.sections)
+        texts[name] = measure(build, corpus)
+        print(f"  {name:12s} {texts[name] / n:8.0f} байт/чанк   {texts[name] / 2**20:8.1f} МБ")
+    print(f"📉 Экономия: {1 - texts['арена'] / texts['строки']:.0%} (из бандла арена ещё и memory-mapped)")
+
+
+if __name__ == "__main__":
+    main()
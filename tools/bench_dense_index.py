@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Точный векторный поиск без FAISS (core/faiss_compat.NumpyIndexFlatIP) против faiss.IndexFlatIP
+и прежнего варианта с полной сортировкой сходств (np.argsort по всем векторам на каждый запрос).
+Использование: python tools/bench_dense_index.py [--sizes 1000,10000,100000] [--dim 1536] [--k 24]
+
+Векторы и запросы — случайные нормированные; проверяется и совпадение выдачи с FAISS.
+"""
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def argsort_search(x: np.ndarray, q: np.ndarray, k: int):
+    """Прежний поиск: нормировка запроса и полная сортировка всех сходств"""
+    q = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-10)
+    sims = q @ x.T
+    idx = np.argsort(-sims, axis=1)[:, :k]
+    return np.take_along_axis(sims, idx, axis=1), idx
+
+
+def timed(fn, queries, batch: int) -> float:
+    """Среднее время одного вызова search, мс"""
+    t0 = time.perf_counter()
+    calls = 0
+    for b in range(0, len(queries), batch):
+        fn(queries[b:b + batch])
+        calls += 1
+    return (time.perf_counter() - t0) / calls * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumpyIndexFlatIP против faiss.IndexFlatIP")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Размеры корпуса через запятую")
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность векторов")
+    parser.add_argument("--k", type=int, default=24, help="Соседей на запрос (dense_search берёт top × (1 + вопросов))")
+    parser.add_argument("--queries", type=int, default=64, help="Запросов на замер")
+    parser.add_argument("--batch", type=int, default=3, help="Запросов в одном search (варианты multi-query)")
+    args = parser.parse_args()
+
+    from core.faiss_compat import HAS_FAISS, NumpyIndexFlatIP, _faiss, normalize_L2_inplace
+    if not HAS_FAISS:
+        print("⚠️ faiss не установлен — сравнение только с полной сортировкой")
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.queries, args.dim), dtype="float32")
+    normalize_L2_inplace(queries)
+    print(f"🧪 d={args.dim}, k={args.k}, запросов {args.queries}, по 1 и по {args.batch} в search")
+    for n in (int(s) for s in args.sizes.split(",")):
+        xb = rng.standard_normal((n, args.dim), dtype="float32")
+        normalize_L2_inplace(xb)
+
+        t0 = time.perf_counter()
+        index = NumpyIndexFlatIP(args.dim)
+        for part in np.array_split(xb, 10):
+            index.add(part)
+        add_ms = (time.perf_counter() - t0) * 1000
+        backends = [("argsort", lambda q: argsort_search(xb, q, args.k)),
+                    ("numpy", lambda q: index.search(q, args.k))]
+        if HAS_FAISS:
+            flat = _faiss.IndexFlatIP(args.dim)
+            flat.add(xb)
+            backends.append(("faiss", lambda q: flat.search(q, args.k)))
+            same = np.mean(index.search(queries, args.k)[1] == flat.search(queries, args.k)[1])
+            print(f"📦 n={n}: add по частям {add_ms:.1f}ms, совпадение выдачи с FAISS {same:.1%}")
+        else:
+            print(f"📦 n={n}: add по частям {add_ms:.1f}ms")
+
+        for name, fn in backends:
+            single = timed(fn, queries, 1)
+            batched = timed(fn, queries, args.batch)
+            print(f"  {name:8s} 1 запрос {single:8.3f}ms   пакет ×{args.batch} {batched:8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Склейка эмбеддингов запросов (core/embed_coalescer.py) под одновременной нагрузкой:
+каждый запрос отдельным вызовом API против пакетов из одновременных запросов.
+Использование: python tools/bench_embed_coalescer.py [--users 32] [--requests 400] [--rtt-ms 120]
+
+API моделируется клиентом с задержкой rtt + per-text и лимитом одновременных соединений
+(как пул HTTP-клиента), поэтому сравниваются число вызовов и хвост латентности, а не сеть.
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+class SimulatedEmbeddings:
+    """embeddings.create с задержкой сети и ограниченным числом соединений"""
+
+    def __init__(self, rtt_ms: float, per_text_ms: float, connections: int, dim: int = 8):
+        self.rtt = rtt_ms / 1000.0
+        self.per_text = per_text_ms / 1000.0
+        self.dim = dim
+        self.calls = 0
+        self._slots = threading.Semaphore(connections)
+        self._lock = threading.Lock()
+
+    def create(self, model, input, encoding_format=None):
+        texts = [input] if isinstance(input, str) else list(input)
+        with self._slots:
+            with self._lock:
+                self.calls += 1
+            time.sleep(self.rtt + self.per_text * len(texts))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(t))] * self.dim)
+                                     for i, t in enumerate(texts)])
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+
+def run(name, embed, args):
+    queries = [f"вопрос {random.randint(0, 10_000)}" for _ in range(args.requests)]
+    latencies = []
+
+    def user(q):
+        time.sleep(random.random() * args.think_ms / 1000.0)
+        t0 = time.perf_counter()
+        embed(q)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(user, queries))
+    wall = time.perf_counter() - t0
+    print(f"  {name:12s} p50 {percentile(latencies, 50):7.1f}ms  p95 {percentile(latencies, 95):7.1f}ms  "
+          f"p99 {percentile(latencies, 99):7.1f}ms  {args.requests / wall:6.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Склейка эмбеддингов запросов под нагрузкой")
+    parser.add_argument("--users", type=int, default=32, help="Одновременных пользователей")
+    parser.add_argument("--requests", type=int, default=400, help="Всего запросов")
+    parser.add_argument("--rtt-ms", type=float, default=120, help="Задержка одного вызова API")
+    parser.add_argument("--per-text-ms", type=float, default=0.5, help="Добавка за каждый текст в пакете")
+    parser.add_argument("--connections", type=int, default=8, help="Одновременных соединений с API")
+    parser.add_argument("--think-ms", type=float, default=20, help="Разброс прихода запросов")
+    parser.add_argument("--wait-ms", type=float, default=None, help="Окно склейки (по умолчанию EMBED_COALESCE_WAIT_MS)")
+    args = parser.parse_args()
+
+    from core.embed_coalescer import EmbedCoalescer, EMBED_COALESCE_WAIT_MS
+    wait_ms = EMBED_COALESCE_WAIT_MS if args.wait_ms is None else args.wait_ms
+    print(f"🧪 {args.users} пользователей, {args.requests} запросов, API {args.rtt_ms:.0f}ms, "
+          f"соединений {args.connections}, окно {wait_ms:.0f}ms")
+
+    direct = SimulatedEmbeddings(args.rtt_ms, args.per_text_ms, args.connections)
+    run("по одному", lambda q: direct.create(model="m", input=q).data[0].embedding, args)
+    print(f"    вызовов API: {direct.calls}")
+
+    batched = SimulatedEmbeddings(args.rtt_ms, args.per_text_ms, args.connections)
+    coalescer = EmbedCoalescer(SimpleNamespace(embeddings=batched), "m", max_wait_ms=wait_ms,
+                               max_parallel=args.connections)
+    run("склейка", coalescer.embed, args)
+    stats = coalescer.stats()
+    print(f"    вызовов API: {batched.calls}, средний пакет {stats['avg_batch']}")
+    print(f"    размеры пакетов: {' '.join(f'{k}:{v}' for k, v in stats['batch_sizes'].items() if v)}")
+
+
+if __name__ == "__main__":
+    main()
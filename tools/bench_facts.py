@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Прямые ответы из хранилища фактов (core/fact_store.py): какая доля частых вопросов отвечается
+без ретривала и сколько стоит анализ запроса против одного только BM25-поиска.
+Использование: python tools/bench_facts.py [--rounds 500]
+
+Эмбеддинги и LLM не вызываются: для вопросов мимо хранилища обычный путь ещё добавил бы
+эмбеддинг запроса, векторный поиск и синтез ответа.
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import contextlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+QUERIES = ["адрес клиники", "где вы находитесь", "какой у вас телефон", "график работы", "есть парковка",
+           "расскажите про моисеева", "кто такой хан", "сколько стоит имплантация", "цена nobel",
+           "какие виды имплантации", "больно ли ставить имплант", "гарантия на импланты",
+           "противопоказания к имплантации", "рассрочка на импланты", "сколько длится процедура имплантации"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прямые ответы из фактов против ретривала")
+    parser.add_argument("--rounds", type=int, default=500, help="Проходов по набору запросов")
+    args = parser.parse_args()
+
+    os.environ.setdefault("EMBED_CACHE_ENABLE", "false")
+    with contextlib.redirect_stdout(io.StringIO()):
+        from rag_engine import RagEngine
+        engine = RagEngine(use_bundle=False, dense_async=True).load()
+    snap = engine.snapshot
+    if snap.facts is None:
+        print("⚠️ Хранилище фактов выключено (FACTS_ENABLE=false)")
+        return
+    facts = snap.facts
+
+    print(f"🧪 Фактов: врачей {len(facts.doctors)}, полей контактов {len(facts.contacts)}, "
+          f"цен {len(facts.prices)}, видов имплантации {len(facts.implant_kinds)}; готовых ответов {len(facts)}")
+    hits = 0
+    for q in QUERIES:
+        answer = facts.match(q)
+        hits += answer is not None
+        print(f"  {'✅' if answer else '  '} {q:40s} → {f'{answer.intent}/{answer.key}' if answer else 'ретривал'}")
+    print(f"📊 Из хранилища: {hits}/{len(QUERIES)} ({hits / len(QUERIES):.0%})")
+
+    timings = {}
+    for name, fn in (("facts.match", facts.match), ("bm25_search", lambda q: snap.bm25_search(q, top=8))):
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(args.rounds):
+                for q in QUERIES:
+                    fn(q)
+        timings[name] = (time.perf_counter() - t0) / (args.rounds * len(QUERIES)) * 1e6
+        print(f"  {name:12s} {timings[name]:8.1f} мкс/запрос")
+    print(f"📉 Анализ запроса дешевле BM25 в ×{timings['bm25_search'] / timings['facts.match']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Пакетный поиск по вариантам multi-query (embed_search_many / bm25_search_many) против цикла
+embed_search + bm25_search на каждый вариант.
+Использование: python tools/bench_multi_query.py [--variants 3] [--rounds 30] [--rtt-ms 120]
+
+Embeddings API моделируется клиентом с задержкой rtt + per-text (векторы — псевдослучайные от текста),
+кэш запросов и склейщик выключены: сравнивается только число вызовов и поисков на один запрос.
+"""
+
+import io
+import os
+import sys
+import time
+import zlib
+import argparse
+import contextlib
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+QUERIES = ["сколько длится приживление импланта", "можно ли поставить имплант при диабете",
+           "чем отличается nobel от implantium", "что делать после удаления зуба",
+           "как проходит консультация перед имплантацией"]
+SUFFIXES = ["", " стоматология", " в клинике", " подробно", " отзывы пациентов"]
+
+
+class SimulatedEmbeddings:
+    """embeddings.create с задержкой сети; вектор детерминирован текстом"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.rtt = 0.0
+        self.per_text = 0.0
+        self.calls = 0
+
+    def create(self, model, input, encoding_format=None):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.calls += 1
+        time.sleep(self.rtt + self.per_text * len(texts))
+        return SimpleNamespace(data=[
+            SimpleNamespace(index=i, embedding=np.random.default_rng(zlib.crc32(t.encode())).standard_normal(self.dim)
+                            .astype("float32").tolist())
+            for i, t in enumerate(texts)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетный поиск по вариантам multi-query")
+    parser.add_argument("--variants", type=int, default=3, help="Вариантов на запрос")
+    parser.add_argument("--rounds", type=int, default=30, help="Проходов по набору запросов")
+    parser.add_argument("--rtt-ms", type=float, default=120, help="Задержка одного вызова API")
+    parser.add_argument("--per-text-ms", type=float, default=0.5, help="Добавка за каждый текст в пакете")
+    parser.add_argument("--dim", type=int, default=1536, help="Размерность эмбеддингов")
+    args = parser.parse_args()
+
+    os.environ.setdefault("EMBED_CACHE_ENABLE", "false")
+    os.environ["QUERY_CACHE_ENABLE"] = "false"
+    os.environ["EMBED_COALESCE_ENABLE"] = "false"
+    api = SimulatedEmbeddings(args.dim)
+    with contextlib.redirect_stdout(io.StringIO()):
+        from rag_engine import RagEngine
+        engine = RagEngine(use_bundle=False, dense_async=False,
+                           client=SimpleNamespace(embeddings=api)).load()
+    snap = engine.snapshot
+    api.rtt, api.per_text = args.rtt_ms / 1000.0, args.per_text_ms / 1000.0
+    batches = [[q + s for s in SUFFIXES[:args.variants]] for q in QUERIES]
+    print(f"🧪 Чанков {len(snap.all_chunks)}, строк индекса {snap.index.ntotal}, вариантов {args.variants}, "
+          f"API {args.rtt_ms:.0f}ms")
+
+    def loop(variants):
+        return [(snap.embed_search(v, top=6), snap.bm25_search(v, top=6)) for v in variants]
+
+    def batched(variants):
+        return list(zip(snap.embed_search_many(variants, top=6), snap.bm25_search_many(variants, top=6)))
+
+    for variants in batches:
+        a, b = loop(variants), batched(variants)
+        assert [[c.id for c, _ in e] + [c.id for c, _ in m] for e, m in a] == \
+               [[c.id for c, _ in e] + [c.id for c, _ in m] for e, m in b], "выдача разошлась"
+
+    timings = {}
+    for name, fn in (("по варианту", loop), ("пакетом", batched)):
+        api.calls = 0
+        t0 = time.perf_counter()
+        for _ in range(args.rounds):
+            for variants in batches:
+                fn(variants)
+        n = args.rounds * len(batches)
+        timings[name] = (time.perf_counter() - t0) / n * 1000
+        print(f"  {name:12s} {timings[name]:8.1f} мс/запрос, вызовов API на запрос {api.calls / n:.1f}")
+
+    api.rtt = api.per_text = 0.0
+    for name, fn in (("по варианту", loop), ("пакетом", batched)):
+        t0 = time.perf_counter()
+        for _ in range(args.rounds):
+            for variants in batches:
+                fn(variants)
+        print(f"  {name:12s} {(time.perf_counter() - t0) / (args.rounds * len(batches)) * 1000:8.2f} мс/запрос "
+              f"без сети (поиск + BM25)")
+    print(f"📉 Быстрее в ×{timings['по варианту'] / timings['пакетом']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
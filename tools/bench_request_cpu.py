@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+CPU на запрос для текстовой обработки чанков: прежний путь (lower/регэкспы на каждом запросе)
+против производных полей, посчитанных при индексации (core/chunk_fields.py).
+Использование: python tools/bench_request_cpu.py [--rounds 200] [--top 8]
+
+Кандидаты запроса — top BM25 по реальному корпусу md/. На каждый запрос повторяются шаги
+get_rag_answer, которые читают тексты чанков: fallback по теме (проход по всем чанкам),
+бонусы/фильтры по подстрокам, подготовка 3 чанков для ответа, best_text и очистка
+финального текста в app.py. Сетевые вызовы (эмбеддинги, LLM) не участвуют.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import argparse
+import contextlib
+import importlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+QUERIES = ["сколько стоит имплантация", "адрес клиники", "больно ли ставить имплант", "какие врачи работают",
+           "гарантия на импланты", "приживаемость имплантов", "консультация бесплатная",
+           "противопоказания к имплантации", "как добраться до клиники", "сколько длится процедура имплантации"]
+
+BONUS_NEEDLES = (["прижив", "оссеоинтегр"], ["без боли", "анестез", "обезбол"],
+                 ["адрес", "телефон", "график", "как добраться"], ["гаранти"],
+                 ["цена", "стоимость", "сколько стоит", "рассрочка"])
+
+
+def legacy_clean_text(s: str) -> str:
+    """Прежний _clean_text из app.py (регэкспы строками на каждом вызове)"""
+    s = re.sub(r'<!--.*?-->', '', s, flags=re.DOTALL)
+    s = re.sub(r'(?im)^\s*aliases\s*:\s*\[.*?\]\s*$', '', s)
+    s = re.sub(r'(?m)^\s*#{2,3}\s*', '', s)
+    s = re.sub(r'(\*\*|_)(.*?)\1', r'\2', s)
+    s = re.sub(r'(?<!\w)_(.*?)_(?!\w)', r'\1', s)
+    s = re.sub(r'(?m)^\s*[•*]\s+', '- ', s)
+    s = re.sub(r'\n{3,}', '\n\n', s)
+    lines = [ln.strip() for ln in s.splitlines()]
+    if len(lines) >= 2 and lines[0] and lines[0] == lines[1]:
+        lines.pop(1)
+    return "\n".join(lines).strip()
+
+
+def legacy_request(all_chunks, cands, aliases) -> str:
+    from core.text_clean import clean_section_for_prompt
+    from core.answer_shaping import slice_for_prompt
+    # fallback по теме: lower всех текстов
+    hits = [ch for ch in all_chunks if any(a in ch.text.lower() for a in aliases)][:3]
+    # _bonus_for_query, filter_candidates, bonus_for_query: lower каждого кандидата трижды
+    score = 0
+    for _ in range(3):
+        for ch in cands:
+            t = (getattr(ch, "text", "") or "").lower()
+            score += sum(any(x in t for x in needles) for needles in BONUS_NEEDLES)
+    # synthesize_answer: очистка и срез 3 чанков
+    prepared = [slice_for_prompt(clean_section_for_prompt(ch.text), limit_chars=900) for ch in cands[:3]]
+    # best_text
+    best_text = cands[0].text if cands else ""
+    best_text = re.sub(r'<!--.*?>', '', best_text, flags=re.DOTALL)
+    best_text = re.sub(r'^\s*#{1,6}\s*', '', best_text, flags=re.MULTILINE).strip()
+    return legacy_clean_text("\n\n".join(prepared) or best_text) + str(len(hits) + score)
+
+
+def fields_request(all_chunks, cands, aliases) -> str:
+    from app import _clean_text
+    hits = [ch for ch in all_chunks if ch.fields.contains_any(aliases)][:3]
+    score = 0
+    for _ in range(3):
+        for ch in cands:
+            t = ch.fields.lower
+            score += sum(any(x in t for x in needles) for needles in BONUS_NEEDLES)
+    prepared = [ch.fields.prompt_slice(limit_chars=900) for ch in cands[:3]]
+    best_text = cands[0].fields.display if cands else ""
+    return _clean_text("\n\n".join(prepared) or best_text) + str(len(hits) + score)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU на запрос: пересчёт текстов против полей индексации")
+    parser.add_argument("--rounds", type=int, default=200, help="Проходов по набору запросов")
+    parser.add_argument("--top", type=int, default=8, help="Кандидатов BM25 на запрос")
+    args = parser.parse_args()
+
+    os.environ.setdefault("EMBED_CACHE_ENABLE", "false")
+    with contextlib.redirect_stdout(io.StringIO()):
+        # _clean_text берётся из app; импорт печатает отладку и не должен попасть в замер — заранее и без вывода
+        importlib.import_module("app")
+        from rag_engine import RagEngine, route_topics
+        engine = RagEngine(use_bundle=False, dense_async=True).load()
+    snap = engine.snapshot
+    all_chunks = snap.all_chunks
+
+    requests = []
+    for q in QUERIES:
+        cands = [ch for ch, _ in snap.bm25_search(q, top=args.top)]
+        themes = [t for t in route_topics(q, snap.theme_map) if t in snap.theme_map]
+        aliases = snap.theme_map[themes[0]]["tag_aliases"] if themes else []
+        requests.append((cands, aliases))
+
+    print(f"🧪 {len(all_chunks)} чанков, {len(QUERIES)} запросов × {args.rounds} проходов, top={args.top}")
+    results = {}
+    for name, fn in (("пересчёт", legacy_request), ("поля", fields_request)):
+        t0 = time.process_time()
+        for _ in range(args.rounds):
+            for cands, aliases in requests:
+                fn(all_chunks, cands, aliases)
+        results[name] = (time.process_time() - t0) / (args.rounds * len(requests)) * 1e6
+        print(f"  {name:10s} {results[name]:8.1f} мкс CPU/запрос")
+    print(f"📉 Ускорение: ×{results['пересчёт'] / results['поля']:.1f}")
+
+    mem = snap.memory_bytes()
+    print(f"💾 Производные поля: {mem['fields'] / 1024:.1f} КБ ({mem['fields'] / max(1, len(all_chunks)):.0f} байт/чанк)")
+
+
+if __name__ == "__main__":
+    main()
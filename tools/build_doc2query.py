@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Офлайн-генерация вопросов doc2query к чанкам корпуса (см. core/doc2query.py).
+Использование: python tools/build_doc2query.py [--generator template|openai|модуль:фабрика] [--force] [--prune]
+
+Вопросы пишутся в DOC2QUERY_PATH по sha256 текста чанка: неизменённые чанки пропускаются,
+так что повторный запуск после правки md/ генерирует только новые/изменённые секции.
+Индекс подхватывает вопросы при DOC2QUERY_ENABLE=true (и в бандл — через tools/build_index.py).
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import contextlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def main():
+    from core.doc2query import DOC2QUERY_GENERATOR, DOC2QUERY_MODEL, DOC2QUERY_PATH
+
+    parser = argparse.ArgumentParser(description="Офлайн-генерация вопросов doc2query")
+    parser.add_argument("--generator", default=DOC2QUERY_GENERATOR, help="template, openai или модуль:фабрика")
+    parser.add_argument("--model", default=DOC2QUERY_MODEL, help="Модель для генераторов на LLM")
+    parser.add_argument("--out", default=str(DOC2QUERY_PATH), help="JSON с вопросами (по умолчанию DOC2QUERY_PATH)")
+    parser.add_argument("--force", action="store_true", help="Сгенерировать заново и для уже известных чанков")
+    parser.add_argument("--prune", action="store_true", help="Удалить вопросы чанков, которых больше нет в корпусе")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    from rag_engine import RagEngine
+    from core.doc2query import QuestionStore, make_generator, text_digest
+
+    # вопросы генерируются по чанкам корпуса как есть — без векторов (и вызовов embeddings API) и без прошлых вопросов
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = RagEngine(use_bundle=False, dense_async=False, dense=False, doc2query=False).load()
+    chunks = engine.snapshot.all_chunks
+    generate = make_generator(args.generator, client=engine.client, model=args.model)
+
+    store = QuestionStore(args.out)
+    t0 = time.perf_counter()
+    generated = skipped = total = 0
+    for ch in chunks:
+        if not args.force and store.get(ch) is not None:
+            skipped += 1
+            continue
+        questions = generate(ch)
+        store.put(ch, questions)
+        generated += 1
+        total += len(questions)
+        print(f"  ❓ {ch.id}: {' | '.join(questions)}")
+
+    pruned = 0
+    if args.prune:
+        live = {text_digest(ch.text) for ch in chunks}
+        for key in [k for k in store.questions if k not in live]:
+            del store.questions[key]
+            pruned += 1
+
+    store.save(args.generator)
+    print(f"\n📝 Вопросы записаны: {store.path}")
+    print(f"   Чанков: {len(chunks)}, сгенерировано: {generated} ({total} вопросов), пропущено: {skipped}, удалено: {pruned}")
+    print(f"   Генератор: {args.generator}, время: {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Офлайн-сборка бандла индексов из md/.
+Использование: python tools/build_index.py [--tenant NAME] [--md DIR] [--themes FILE] [--out index_bundle] [--check]
+
+--tenant берёт md/, темы, CTA и папку бандла тенанта из TENANTS_CONFIG (см. core/tenants.py);
+--md/--themes/--out переопределяют отдельные пути.
+
+Пишет версионированную сборку (эмбеддинги .npy, тексты, метаданные, BM25,
+карты алиасов и манифест с хэшами) и переключает на неё index_bundle/CURRENT.
+Эмбеддинги берутся из кэша (cache/embeddings.sqlite), в API уходят только промахи —
+при прогретом кэше сборка не ходит в сеть.
+"""
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка бандла индексов RAG")
+    parser.add_argument("--tenant", default=None, help="Тенант из TENANTS_CONFIG (по умолчанию — общий корпус)")
+    parser.add_argument("--md", default=None, help="Папка md-корпуса")
+    parser.add_argument("--themes", default=None, help="Файл тем (themes.json)")
+    parser.add_argument("--out", default=None, help="Корневая папка бандлов (по умолчанию INDEX_BUNDLE_DIR или папка тенанта)")
+    parser.add_argument("--check", action="store_true", help="Прочитать собранный бандл и сверить с индексами")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    from rag_engine import RagEngine
+
+    paths = {}
+    if args.tenant:
+        from core.tenants import TenantRegistry
+        registry = TenantRegistry.from_config()
+        tenant = registry.tenants.get(args.tenant)
+        if tenant is None:
+            print(f"❌ Неизвестный тенант: {args.tenant} (есть: {', '.join(sorted(registry.tenants))})")
+            sys.exit(1)
+        if not tenant.pinned:
+            # тенант по умолчанию собирается как общий корпус; алиасы тенанта не попадают в общую карту
+            paths = dict(md_dir=tenant.md_dir, themes_path=tenant.themes_path, cta_path=tenant.cta_path,
+                         bundle_dir=tenant.bundle_dir, global_aliases=False)
+    if args.md:
+        paths["md_dir"] = Path(args.md)
+    if args.themes:
+        paths["themes_path"] = Path(args.themes)
+
+    t0 = time.perf_counter()
+    # сборка всегда идёт от исходников, а не от прошлого бандла
+    engine = RagEngine(use_bundle=False, dense_async=False, **paths).load()
+    t_build = time.perf_counter() - t0
+    snap = engine.snapshot
+
+    if not snap.all_chunks:
+        print("❌ Нет чанков — бандл не собран")
+        sys.exit(1)
+    if snap.index is None:
+        print("⚠️ Эмбеддинги недоступны — бандл будет только с BM25")
+
+    path = engine.export_index_bundle(Path(args.out) if args.out else None)
+    print(f"\n📦 Бандл записан: {path}")
+    print(f"   Корпус: {engine.md_dir}")
+    print(f"   Чанков: {len(snap.all_chunks)}")
+    print(f"   Сборка индексов: {t_build:.2f}s")
+
+    if args.check:
+        from core.index_bundle import IndexBundle
+        t0 = time.perf_counter()
+        bundle = IndexBundle(path)
+        t_load = (time.perf_counter() - t0) * 1000
+        ok = bundle.texts == [ch.text for ch in snap.all_chunks]
+        ok = ok and [r["id"] for r in bundle.records] == [ch.id for ch in snap.all_chunks]
+        ok = ok and all(isinstance(bundle.maps.get(name), dict) for name in ("h2_index", "file_meta", "entity_index"))
+        corrupted = bundle.verify()
+        print(f"   Загрузка бандла: {t_load:.1f}ms, совпадение: {'да' if ok else 'НЕТ'}, "
+              f"sha256 файлов: {'да' if not corrupted else 'НЕТ ' + ', '.join(corrupted)}")
+        ok = ok and not corrupted
+        if not ok:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 """
 CLI инструмент для тестирования RAG-пайплайна
-Использование: python tools/eval.py [--trace] [--mode PRECISE_SIMPLE|HYBRID_TIGHT]
+Использование: python tools/eval.py [--trace] [--mode PRECISE_SIMPLE|HYBRID_TIGHT] [--doc2query]
+
+--doc2query: сравнение ретривала без вопросов doc2query (с условным multi-query) и с ними
+(multi-query выключен) — recall@k по ожидаемому файлу и задержка на запрос.
 """
 
+import io
 import os
 import sys
 import json
+import time
 import argparse
+import contextlib
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Any
@@ -70,18 +76,15 @@ def load_test_queries() -> List[Dict[str, Any]]:
         }
     ]
 
-def run_single_test(query_data: Dict[str, Any], trace: bool = False) -> Dict[str, Any]:
-    """Запускает один тест"""
+def run_single_test(engine, query_data: Dict[str, Any], trace: bool = False) -> Dict[str, Any]:
+    """Запускает один тест на переданном движке"""
     try:
-        # Импортируем RAG engine
-        from rag_engine import get_rag_answer
-        
         query = query_data["query"]
         print(f"🔍 Тестируем: '{query}'")
         
         # Вызываем RAG
         start_time = datetime.now()
-        response, metadata = get_rag_answer(query)
+        response, metadata = engine.get_rag_answer(query)
         end_time = datetime.now()
         
         # Анализируем результат
@@ -142,6 +145,10 @@ def run_dryrun(mode: str = None, trace: bool = False) -> Dict[str, Any]:
         print(f"📋 Режим: {mode}")
         os.environ["RAG_MODE"] = mode
     
+    # Поднимаем движок один раз на весь прогон (векторный индекс — сразу, чтобы все запросы шли одинаково)
+    from rag_engine import RagEngine
+    engine = RagEngine(dense_async=False).load()
+    
     # Загружаем тестовые запросы
     test_queries = load_test_queries()
     print(f"📝 Загружено {len(test_queries)} тестовых запросов")
@@ -154,7 +161,7 @@ def run_dryrun(mode: str = None, trace: bool = False) -> Dict[str, Any]:
     
     for i, query_data in enumerate(test_queries, 1):
         print(f"\n--- Тест {i}/{len(test_queries)} ---")
-        result = run_single_test(query_data, trace)
+        result = run_single_test(engine, query_data, trace)
         results.append(result)
         
         total_time += result["execution_time_ms"]
@@ -214,14 +221,89 @@ def run_dryrun(mode: str = None, trace: bool = False) -> Dict[str, Any]:
     
     return summary
 
+def measure_retrieval(engine, test_queries: List[Dict[str, Any]], top_k: int) -> Dict[str, Any]:
+    """Recall@k (ожидаемый файл среди найденных) и задержка ретривала на одном движке"""
+    snap = engine.snapshot
+    rows = []
+    for query_data in test_queries:
+        query, expected = query_data["query"], query_data["expected_file"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            chunks = snap.retrieve_relevant_chunks(query, top_k=top_k)
+            ms = (time.perf_counter() - t0) * 1000
+            bm25 = [ch for ch, _ in snap.bm25_search(query, top=top_k)]
+        rows.append({
+            "query": query,
+            "hit": any(ch.file_name == expected for ch in chunks),
+            "bm25_hit": any(ch.file_name == expected for ch in bm25),
+            "ms": ms,
+        })
+    n = len(rows) or 1
+    return {
+        "recall": sum(r["hit"] for r in rows) / n,
+        "bm25_recall": sum(r["bm25_hit"] for r in rows) / n,
+        "avg_ms": sum(r["ms"] for r in rows) / n,
+        "p_max_ms": max((r["ms"] for r in rows), default=0.0),
+        "mq": snap.mq_enabled(),
+        "questions": len(snap.doc2query),
+        "rows": rows,
+    }
+
+def run_doc2query_compare(mode: str = None, top_k: int = 5) -> Dict[str, Any]:
+    """Ретривал без doc2query (с multi-query) против doc2query (multi-query выключен)"""
+    print(f"🧪 Сравнение doc2query: recall@{top_k} и задержка ретривала")
+    if mode:
+        os.environ["RAG_MODE"] = mode
+    from rag_engine import RagEngine
+
+    test_queries = load_test_queries()
+    results = {}
+    for name, doc2query in (("baseline", False), ("doc2query", True)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine = RagEngine(dense_async=False, use_bundle=False, doc2query=doc2query).load()
+        results[name] = measure_retrieval(engine, test_queries, top_k)
+        r = results[name]
+        print(f"   {name:10s} recall@{top_k}={r['recall']:.1%}  bm25 recall@{top_k}={r['bm25_recall']:.1%}  "
+              f"avg={r['avg_ms']:.1f}ms  max={r['p_max_ms']:.1f}ms  (MQ: {'да' if r['mq'] else 'нет'}, вопросов: {r['questions']})")
+
+    base, d2q = results["baseline"], results["doc2query"]
+    delta = {
+        "recall": d2q["recall"] - base["recall"],
+        "bm25_recall": d2q["bm25_recall"] - base["bm25_recall"],
+        "avg_ms": d2q["avg_ms"] - base["avg_ms"],
+    }
+    print(f"\n📊 Δ recall@{top_k}: {delta['recall']:+.1%}, Δ bm25 recall@{top_k}: {delta['bm25_recall']:+.1%}, "
+          f"Δ задержка: {delta['avg_ms']:+.1f}ms/запрос")
+    for b, d in zip(base["rows"], d2q["rows"]):
+        if b["hit"] != d["hit"] or b["bm25_hit"] != d["bm25_hit"]:
+            print(f"   • '{b['query']}': {'✅' if b['hit'] else '❌'}→{'✅' if d['hit'] else '❌'} "
+                  f"(bm25 {'✅' if b['bm25_hit'] else '❌'}→{'✅' if d['bm25_hit'] else '❌'})")
+
+    summary = {"timestamp": datetime.now().isoformat(), "mode": os.getenv("RAG_MODE", "PRECISE_SIMPLE"),
+               "top_k": top_k, "delta": delta, **results}
+    logs_dir = Path("logs/eval")
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    result_file = logs_dir / f"doc2query_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены: {result_file}")
+    return summary
+
 def main():
     parser = argparse.ArgumentParser(description="CLI для тестирования RAG-пайплайна")
     parser.add_argument("--trace", action="store_true", help="Включить детальное логирование")
     parser.add_argument("--mode", choices=["PRECISE_SIMPLE", "HYBRID_TIGHT"], 
                        help="Режим RAG для тестирования")
+    parser.add_argument("--doc2query", action="store_true",
+                        help="Сравнить ретривал без doc2query (с multi-query) и с doc2query (без multi-query)")
+    parser.add_argument("--top-k", type=int, default=5, help="k для recall@k в режиме --doc2query")
     
     args = parser.parse_args()
     
+    if args.doc2query:
+        run_doc2query_compare(args.mode, args.top_k)
+        return
+    
     try:
         summary = run_dryrun(args.mode, args.trace)
         
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Отчёт о времени импорта приложения.
+Использование: python tools/startup_report.py [--runs 5] [--top 15] [--module app]
+
+Запускает `python -X importtime -c "import <module>"` несколько раз в чистых процессах,
+печатает медиану общего времени импорта, самые тяжёлые модули верхнего уровня
+и проверяет, что модули из LAZY_MODULES не грузятся при старте.
+"""
+
+import os
+import re
+import sys
+import argparse
+import subprocess
+import statistics
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# нужны только в редких ветках (заявка на email, опечатки в фамилиях, эмпатия/CTA в ответе)
+LAZY_MODULES = ["smtplib", "email.mime.text", "email.mime.multipart", "difflib",
+                "core.empathy", "core.cta", "core.followup_recommender"]
+
+RX_LINE = re.compile(r"^import time:\s+(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)")
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Кумулятивное время импорта (мкс) каждого модуля за один запуск"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        raise SystemExit(f"❌ import {module} завершился с кодом {proc.returncode}")
+    out = {}
+    for line in proc.stderr.splitlines():
+        m = RX_LINE.match(line)
+        if m:
+            out[m.group(4)] = int(m.group(2))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта приложения по модулям")
+    parser.add_argument("--runs", type=int, default=5, help="Сколько запусков (берётся медиана)")
+    parser.add_argument("--top", type=int, default=15, help="Сколько тяжёлых модулей показать")
+    parser.add_argument("--module", default="app", help="Что импортировать")
+    args = parser.parse_args()
+
+    runs: List[Dict[str, int]] = [import_times(args.module) for _ in range(args.runs)]
+    names = set().union(*runs)
+    median = {n: statistics.median([r.get(n, 0) for r in runs]) for n in names}
+
+    total = median.get(args.module, 0)
+    print(f"\n⏱️ import {args.module}: {total / 1000:.1f}ms (медиана из {args.runs})")
+
+    # только пакеты верхнего уровня — иначе вложенные модули дублируют родителя
+    top = sorted(((n, us) for n, us in median.items() if "." not in n and n != args.module),
+                 key=lambda x: -x[1])[:args.top]
+    print("\n📊 Тяжёлые модули:")
+    for name, us in top:
+        print(f"  {name:30s} {us / 1000:8.1f}ms  {us / total * 100 if total else 0:5.1f}%")
+
+    print("\n💤 Ленивые импорты:")
+    loaded = [n for n in LAZY_MODULES if n in names]
+    for name in LAZY_MODULES:
+        state = f"загружен ({median[name] / 1000:.1f}ms)" if name in names else "не загружен"
+        print(f"  {name:30s} {state}")
+    if loaded:
+        print(f"⚠️ При старте грузятся: {', '.join(loaded)} (могут тянуться сторонними пакетами)")
+
+
+if __name__ == "__main__":
+    main()